@@ -1,27 +1,39 @@
 from __future__ import print_function
 
 """
-To use this, get a trace file such as this one:
+Benchmark allmydata.util.spans.
+
+With no arguments, this times the operations which the immutable downloader
+does on every block request (Spans.add/remove/&/-, DataSpans.add/get/pop)
+against Spans and DataSpans which already hold N separate spans. The time
+per operation should stay about the same as N grows: it used to grow in
+proportion to N, which made downloads of large files with many outstanding
+requests quadratic.
+
+    python bench_spans.py
+
+It can also replay a trace of the DataSpans operations of a real download,
+such as this one:
 
 wget http://tahoe-lafs.org/trac/tahoe-lafs/raw-attachment/ticket/1170/run-112-above28-flog-dump-sh8-on-nsziz.txt
 
-And run this command passing that trace file's name:
+by passing that trace file's name:
 
 python bench_spans.py run-112-above28-flog-dump-sh8-on-nsziz.txt
 """
 
 from pyutil import benchutil
 
-from allmydata.util.spans import DataSpans
+from allmydata.util.spans import Spans, DataSpans
 
-import re, sys
+import random, re, sys
 
 DUMP_S='_received spans trace .dump()'
-GET_R=re.compile('_received spans trace .get\(([0-9]*), ([0-9]*)\)')
-POP_R=re.compile('_received spans trace .pop\(([0-9]*), ([0-9]*)\)')
-REMOVE_R=re.compile('_received spans trace .remove\(([0-9]*), ([0-9]*)\)')
+GET_R=re.compile(r'_received spans trace .get\(([0-9]*), ([0-9]*)\)')
+POP_R=re.compile(r'_received spans trace .pop\(([0-9]*), ([0-9]*)\)')
+REMOVE_R=re.compile(r'_received spans trace .remove\(([0-9]*), ([0-9]*)\)')
 GET_SPANS_S='_received spans trace .get_spans()'
-ADD_R=re.compile('_received spans trace .add\(([0-9]*), len=([0-9]*)\)')
+ADD_R=re.compile(r'_received spans trace .add\(([0-9]*), len=([0-9]*)\)')
 INIT_S='_received spans trace = DataSpans'
 
 class B(object):
@@ -47,7 +59,7 @@ class B(object):
                 mo = ADD_R.search(inline)
                 start = int(mo.group(1))
                 length = int(mo.group(2))
-                self.s.add(start, 'x'*length)
+                self.s.add(start, b'x'*length)
                 # self.stats['add'] = self.stats.get('add', 0) + 1
             elif GET_R.search(inline):
                 mo = GET_R.search(inline)
@@ -76,11 +88,73 @@ class B(object):
 
         # print(self.stats)
 
+BLOCK = 4096
+OPS = 1000
+
+class Synthetic(object):
+    """
+    I start with SIZE spans of BLOCK bytes, with a gap after each, and then
+    time OPS operations at random places among them.
+    """
+    def __init__(self, size):
+        self.size = size
+
+    def init(self, N):
+        rand = random.Random(self.size)
+        self.spans = Spans()
+        self.dataspans = DataSpans()
+        block = b"x" * BLOCK
+        for i in range(self.size):
+            self.spans.add(i * 2 * BLOCK, BLOCK)
+            self.dataspans.add(i * 2 * BLOCK, block)
+        self.offsets = [rand.randrange(self.size * 2 * BLOCK)
+                        for i in range(N)]
+
+    def spans_add_remove(self, N):
+        for offset in self.offsets[:N]:
+            self.spans.add(offset, BLOCK)
+            self.spans.remove(offset, BLOCK)
+
+    def spans_contains(self, N):
+        for offset in self.offsets[:N]:
+            (offset, BLOCK) in self.spans
+
+    def spans_desire(self, N):
+        # what Share._send_requests does: desired - pending - received
+        for offset in self.offsets[:N]:
+            Spans(offset, 3 * BLOCK) - self.spans
+
+    def dataspans_add_pop(self, N):
+        block = b"y" * BLOCK
+        for offset in self.offsets[:N]:
+            self.dataspans.add(offset, block)
+            self.dataspans.pop(offset, BLOCK)
+
+    def dataspans_get(self, N):
+        for offset in self.offsets[:N]:
+            self.dataspans.get(offset, BLOCK // 2)
+
+def synthetic():
+    for name in ["spans_add_remove", "spans_contains", "spans_desire",
+                 "dataspans_add_pop", "dataspans_get"]:
+        print(name)
+        for size in [1000, 10000, 100000]:
+            b = Synthetic(size)
+            print("%7d spans:" % size, end=' ')
+            benchutil.rep_bench(getattr(b, name), OPS, initfunc=b.init, runreps=5,
+                                UNITS_PER_SECOND=1000000)
+
+def trace(fname):
+    for N in [600, 6000, 60000]:
+        b = B(open(fname, 'r'))
+        print("%7d" % N, end=' ')
+        benchutil.rep_bench(b.run, N, initfunc=b.init, runreps=5,
+                            UNITS_PER_SECOND=1000000)
+
 benchutil.print_bench_footer(UNITS_PER_SECOND=1000000)
 print("(microseconds)")
 
-for N in [600, 6000, 60000]:
-    b = B(open(sys.argv[1], 'rU'))
-    print("%7d" % N, end=' ')
-    benchutil.rep_bench(b.run, N, b.init, UNITS_PER_SECOND=1000000)
-
+if len(sys.argv) > 1:
+    trace(sys.argv[1])
+else:
+    synthetic()
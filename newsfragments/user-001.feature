@@ -0,0 +1 @@
+Storage servers can keep an index of the shares they hold (``[storage]share_catalog``), so that share lookups do not list directories on every request.
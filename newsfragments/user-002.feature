@@ -0,0 +1 @@
+Storage servers can answer queries for storage indexes they do not hold from an in-memory Bloom filter (``[storage]bloom_filter.enabled``), without touching the disk.
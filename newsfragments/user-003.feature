@@ -0,0 +1 @@
+Storage servers can keep leases in an indexed database (``[storage]lease_db``), so that the lease expirer no longer opens every share file.
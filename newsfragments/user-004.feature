@@ -0,0 +1 @@
+With the lease database enabled, leases are expired as they lapse instead of by a crawler visiting every share.
@@ -0,0 +1 @@
+Share crawlers can be limited to an I/O budget (``[storage]crawler.max_iops`` and ``crawler.max_bytes_per_second``) and list prefix directories ahead of time (``[storage]crawler.prefetch``).
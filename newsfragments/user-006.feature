@@ -0,0 +1 @@
+Share crawlers now save their state as JSON instead of a pickle, and record their progress after each bucket, so that a restarted server resumes where it stopped.
@@ -0,0 +1 @@
+Storage servers support a ``get_buckets_many`` call, which clients use to ask about several storage indexes in one round trip.
@@ -0,0 +1 @@
+Storage servers support a ``slot_readv_many`` call, which clients use to read several mutable slots in one round trip.
@@ -0,0 +1 @@
+Storage servers can keep recently used share files open (``[storage]fd_cache_size``) and read them without seeking.
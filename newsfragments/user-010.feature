@@ -0,0 +1 @@
+Storage servers can do their disk I/O in a pool of threads (``[storage]io_threads``), so that slow disks no longer stall the reactor.
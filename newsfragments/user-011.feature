@@ -0,0 +1 @@
+Storage servers can make share writes durable before acknowledging them (``[storage]durable_writes``), committing several writes together.
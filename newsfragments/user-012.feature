@@ -0,0 +1 @@
+Storage server latency statistics are now kept in fixed-size histograms, which use constant memory and include every operation.
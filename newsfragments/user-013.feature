@@ -0,0 +1 @@
+Storage servers keep track of space allocated to uploads incrementally and can cache disk statistics (``[storage]disk_stats_ttl``), which makes allocating space cheaper. They can also reserve the space of new shares up front (``[storage]preallocate``).
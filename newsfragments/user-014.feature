@@ -0,0 +1 @@
+Storage servers can pack small immutable shares into shared segment files (``[storage]pack_small_shares``).
@@ -0,0 +1 @@
+Storage servers can spread shares over several directories or disks (``[storage]share_dirs``), placing new shares where there is the most room.
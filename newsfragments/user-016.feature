@@ -0,0 +1 @@
+Storage servers can move frequently read shares to a faster directory (``[storage]hot_dir``) and move them back when they cool down.
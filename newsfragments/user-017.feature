@@ -0,0 +1 @@
+Storage servers can cache reads of popular immutable shares in memory (``[storage]block_cache_size``).
@@ -0,0 +1 @@
+Storage servers can cache the beginning of mutable shares in memory (``[storage]mutable_header_cache_size``), which speeds up servermap queries.
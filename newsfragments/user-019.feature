@@ -0,0 +1 @@
+Storage servers can read ahead of clients which read an immutable share from start to end (``[storage]read_ahead_blocks``).
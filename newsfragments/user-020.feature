@@ -0,0 +1 @@
+Storage servers can share their disk fairly between clients, giving reads priority over writes and lease renewals (``[storage]fair_queuing``).
@@ -0,0 +1 @@
+Clients can cache downloaded immutable segments in memory (``[client]download.segment_cache_size``), so that repeated or overlapping reads are not fetched again.
@@ -0,0 +1 @@
+Immutable downloads can fetch segments ahead of a slow consumer (``[client]download.read_ahead_segments``).
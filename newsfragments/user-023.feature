@@ -0,0 +1 @@
+Immutable downloads can fetch several segments at once (``[client]download.concurrent_segments`` and ``download.max_requests_per_server``).
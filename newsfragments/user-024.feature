@@ -0,0 +1 @@
+Downloads of large files spend much less CPU time keeping track of the parts of shares they have asked for and received.
@@ -0,0 +1 @@
+Immutable downloads now prefer the storage servers which have been answering fastest, and the download status page shows which shares were chosen.
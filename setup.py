@@ -117,8 +117,8 @@ install_requires = [
     "pyrsistent < 0.17.0 ; python_version < '3.0'",
     "pyrsistent ; python_version > '3.0'",
 
-    # A great way to define types of values.
-    "attrs >= 18.2.0",
+    # A great way to define types of values.  19.2.0 added attr.ib(eq=...).
+    "attrs >= 19.2.0",
 
     # WebSocket library for twisted and asyncio
     "autobahn >= 19.5.2",
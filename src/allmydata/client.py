@@ -36,10 +36,18 @@ from twisted.python.filepath import FilePath
 import allmydata
 from allmydata.crypto import rsa, ed25519
 from allmydata.crypto.util import remove_prefix
-from allmydata.storage.server import StorageServer
+from allmydata.storage.server import (
+    StorageServer, DEFAULT_COMMIT_INTERVAL,
+    DEFAULT_PACK_MAX_SHARE_SIZE,
+)
+from allmydata.storage.tiering import DEFAULT_PROMOTE_AFTER
+from allmydata.storage.scheduler import ClientBroker
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
 from allmydata.immutable.offloaded import Helper
+from allmydata.immutable.downloader.cache import SegmentCache
+from allmydata.immutable.downloader.fetcher import \
+     DEFAULT_MAX_REQUESTS_PER_SERVER
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import (
@@ -88,6 +96,10 @@ def _is_valid_section(section_name):
 _client_config = configutil.ValidConfiguration(
     static_valid_sections={
         "client": (
+            "download.concurrent_segments",
+            "download.max_requests_per_server",
+            "download.read_ahead_segments",
+            "download.segment_cache_size",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
@@ -99,7 +111,16 @@ _client_config = configutil.ValidConfiguration(
             "storage.plugins",
         ),
         "storage": (
+            "block_cache_size",
+            "bloom_filter.capacity",
+            "bloom_filter.enabled",
+            "crawler.max_bytes_per_second",
+            "crawler.max_iops",
+            "crawler.prefetch",
             "debug_discard",
+            "disk_stats_ttl",
+            "durable_writes",
+            "durable_writes.commit_interval",
             "enabled",
             "anonymous",
             "expire.cutoff_date",
@@ -109,8 +130,23 @@ _client_config = configutil.ValidConfiguration(
             "expire.mode",
             "expire.mutable",
             "expire.override_lease_duration",
+            "fair_queuing",
+            "fd_cache_size",
+            "hot_dir",
+            "hot_dir.max_bytes_per_second",
+            "hot_dir.max_size",
+            "hot_dir.promote_after",
+            "io_threads",
+            "lease_db",
+            "mutable_header_cache_size",
+            "pack_small_shares",
+            "pack_small_shares.max_share_size",
+            "preallocate",
+            "read_ahead_blocks",
             "readonly",
             "reserved_space",
+            "share_catalog",
+            "share_dirs",
             "storage_dir",
             "plugins",
         ),
@@ -810,6 +846,87 @@ class _Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        share_catalog = self.config.get_config("storage", "share_catalog",
+                                               False, boolean=True)
+
+        lease_db = self.config.get_config("storage", "lease_db", False,
+                                          boolean=True)
+
+        crawler_max_iops = self.config.get_config("storage",
+                                                  "crawler.max_iops", None)
+        if crawler_max_iops is not None:
+            crawler_max_iops = int(crawler_max_iops)
+        crawler_max_bytes_per_second = self.config.get_config(
+            "storage", "crawler.max_bytes_per_second", None)
+        if crawler_max_bytes_per_second is not None:
+            crawler_max_bytes_per_second = parse_abbreviated_size(
+                crawler_max_bytes_per_second)
+        crawler_prefetch = int(self.config.get_config("storage",
+                                                      "crawler.prefetch", 0))
+
+        fd_cache_size = int(self.config.get_config(
+            "storage", "fd_cache_size", 0))
+
+        block_cache_size = parse_abbreviated_size(self.config.get_config(
+            "storage", "block_cache_size", "0"))
+        mutable_header_cache_size = parse_abbreviated_size(
+            self.config.get_config("storage", "mutable_header_cache_size",
+                                   "0"))
+
+        read_ahead_blocks = int(self.config.get_config(
+            "storage", "read_ahead_blocks", 0))
+
+        io_threads = int(self.config.get_config("storage", "io_threads", 0))
+        fair_queuing = self.config.get_config("storage", "fair_queuing",
+                                              False, boolean=True)
+
+        commit_interval = None
+        if self.config.get_config("storage", "durable_writes", False,
+                                  boolean=True):
+            commit_interval = float(self.config.get_config(
+                "storage", "durable_writes.commit_interval",
+                DEFAULT_COMMIT_INTERVAL))
+
+        disk_stats_ttl = float(self.config.get_config(
+            "storage", "disk_stats_ttl", 0))
+        preallocate = self.config.get_config("storage", "preallocate", False,
+                                             boolean=True)
+
+        pack_max_share_size = None
+        if self.config.get_config("storage", "pack_small_shares", False,
+                                  boolean=True):
+            pack_max_share_size = parse_abbreviated_size(
+                self.config.get_config("storage",
+                                       "pack_small_shares.max_share_size",
+                                       "%d" % (DEFAULT_PACK_MAX_SHARE_SIZE,)))
+
+        share_dirs = [
+            self.config.get_config_path(d.strip())
+            for d in self.config.get_config("storage", "share_dirs",
+                                            "").split(",")
+            if d.strip()]
+
+        hot_dir = self.config.get_config("storage", "hot_dir", None)
+        if hot_dir is not None:
+            hot_dir = self.config.get_config_path(hot_dir)
+        hot_dir_max_size = self.config.get_config("storage",
+                                                  "hot_dir.max_size", None)
+        if hot_dir_max_size is not None:
+            hot_dir_max_size = parse_abbreviated_size(hot_dir_max_size)
+        hot_dir_promote_after = int(self.config.get_config(
+            "storage", "hot_dir.promote_after", DEFAULT_PROMOTE_AFTER))
+        hot_dir_max_bytes_per_second = self.config.get_config(
+            "storage", "hot_dir.max_bytes_per_second", None)
+        if hot_dir_max_bytes_per_second is not None:
+            hot_dir_max_bytes_per_second = parse_abbreviated_size(
+                hot_dir_max_bytes_per_second)
+
+        bloom_filter_capacity = None
+        if self.config.get_config("storage", "bloom_filter.enabled", False,
+                                  boolean=True):
+            bloom_filter_capacity = int(self.config.get_config(
+                "storage", "bloom_filter.capacity", 1000000))
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -819,7 +936,28 @@ class _Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           share_catalog=share_catalog,
+                           bloom_filter_capacity=bloom_filter_capacity,
+                           lease_db=lease_db,
+                           crawler_max_iops=crawler_max_iops,
+                           crawler_max_bytes_per_second=crawler_max_bytes_per_second,
+                           crawler_prefetch=crawler_prefetch,
+                           fd_cache_size=fd_cache_size,
+                           block_cache_size=block_cache_size,
+                           mutable_header_cache_size=mutable_header_cache_size,
+                           read_ahead_blocks=read_ahead_blocks,
+                           io_threads=io_threads,
+                           fair_queuing=fair_queuing,
+                           commit_interval=commit_interval,
+                           disk_stats_ttl=disk_stats_ttl,
+                           preallocate=preallocate,
+                           pack_max_share_size=pack_max_share_size,
+                           share_dirs=share_dirs,
+                           hot_dir=hot_dir,
+                           hot_dir_max_size=hot_dir_max_size,
+                           hot_dir_promote_after=hot_dir_promote_after,
+                           hot_dir_max_bytes_per_second=hot_dir_max_bytes_per_second)
         ss.setServiceParent(self)
         return ss
 
@@ -836,6 +974,10 @@ class _Client(node.Node, pollmixin.PollMixin):
             "permutation-seed-base32": self._init_permutation_seed(ss),
         }
 
+        if ss.scheduler is not None:
+            # the scheduler queues each client's operations separately
+            self.tub.brokerClass = ClientBroker
+
         if anonymous_storage_enabled(self.config):
             furl_file = self.config.get_private_path("storage.furl").encode(get_filesystem_encoding())
             furl = self.tub.registerReference(ss, furlFile=furl_file)
@@ -972,6 +1114,19 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        segment_cache = None
+        segment_cache_size = parse_abbreviated_size(self.config.get_config(
+            "client", "download.segment_cache_size", "0"))
+        if segment_cache_size:
+            segment_cache = SegmentCache(segment_cache_size)
+            self.stats_provider.register_producer(segment_cache)
+        read_ahead = int(self.config.get_config(
+            "client", "download.read_ahead_segments", "0"))
+        concurrent_segments = int(self.config.get_config(
+            "client", "download.concurrent_segments", "1"))
+        max_requests_per_server = int(self.config.get_config(
+            "client", "download.max_requests_per_server",
+            DEFAULT_MAX_REQUESTS_PER_SERVER))
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -980,7 +1135,11 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   segment_cache=segment_cache,
+                                   read_ahead=read_ahead,
+                                   concurrent_segments=concurrent_segments,
+                                   max_requests_per_server=max_requests_per_server)
 
     def get_history(self):
         return self.history
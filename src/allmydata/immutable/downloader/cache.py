@@ -0,0 +1,95 @@
+"""
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict
+
+from zope.interface import implementer
+from allmydata.interfaces import IStatsProducer
+
+
+@implementer(IStatsProducer)
+class SegmentCache(object):
+    """I hold validated ciphertext segments of immutable files, for all the
+    DownloadNodes of a client, so that reads which overlap earlier ones
+    (HTTP Range requests, SFTP random access, several people streaming the
+    same file) do not fetch and decode the same segments again.
+
+    Segments are keyed by (storage index, UEB hash, segnum): the UEB hash
+    (from the verifycap) tells apart different encodings of the same
+    ciphertext, whose segments are numbered differently. I also keep each
+    file's UEB, so that a new DownloadNode for the file knows its segment
+    size without asking a server for it.
+
+    I drop the least recently used entries to hold no more than
+    ``max_bytes`` of data.
+    """
+
+    def __init__(self, max_bytes):
+        assert max_bytes > 0, max_bytes
+        self.max_bytes = max_bytes
+        # (storage_index, ueb_hash, segnum or None for the UEB) -> bytes,
+        # least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key):
+        data = self._entries.pop(key, None)
+        if data is not None:
+            self._entries[key] = data
+        return data
+
+    def _put(self, key, data):
+        if len(data) > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = data
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            (old_key, old_data) = self._entries.popitem(last=False)
+            self.bytes -= len(old_data)
+            self.evictions += 1
+
+    def get_segment(self, storage_index, ueb_hash, segnum):
+        """Return the segment, or None if I do not have it."""
+        segment = self._get((storage_index, ueb_hash, segnum))
+        if segment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return segment
+
+    def put_segment(self, storage_index, ueb_hash, segnum, segment):
+        """Remember a segment which has been checked against the ciphertext
+        hash tree."""
+        assert segnum is not None
+        self._put((storage_index, ueb_hash, segnum), segment)
+
+    def get_ueb(self, storage_index, ueb_hash):
+        return self._get((storage_index, ueb_hash, None))
+
+    def put_ueb(self, storage_index, ueb_hash, UEB_s):
+        """Remember a UEB which has been checked against its hash."""
+        self._put((storage_index, ueb_hash, None), UEB_s)
+
+    def get_stats(self):
+        stats = {"downloader.segment_cache.entries": len(self._entries),
+                 "downloader.segment_cache.bytes": self.bytes,
+                 "downloader.segment_cache.hits": self.hits,
+                 "downloader.segment_cache.misses": self.misses,
+                 "downloader.segment_cache.evictions": self.evictions,
+                 }
+        if self.hits + self.misses:
+            stats["downloader.segment_cache.hit_ratio"] = (
+                self.hits / (self.hits + self.misses))
+        return stats
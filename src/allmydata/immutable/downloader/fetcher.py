@@ -11,6 +11,8 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
+import time
+now = time.time
 from twisted.python.failure import Failure
 from foolscap.api import eventually
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
@@ -19,6 +21,42 @@ from allmydata.util.dictutil import DictOfSets
 from .common import OVERDUE, COMPLETE, CORRUPT, DEAD, BADSEGNUM, \
      BadSegmentNumberError
 
+# how many block requests the SegmentFetchers of one download may have
+# outstanding on a server, once more than one of them is running
+DEFAULT_MAX_REQUESTS_PER_SERVER = 2
+
+class ServerRequestLimiter(object):
+    """I count the block requests which the SegmentFetchers of a
+    DownloadNode have outstanding on each server, so that fetching several
+    segments at once spreads the requests over the servers instead of
+    queueing them all up on the fastest ones. A fetcher which finds a
+    server full calls wait(), and I restart its loop when a request
+    finishes."""
+
+    def __init__(self, max_per_server):
+        assert max_per_server > 0, max_per_server
+        self.max_per_server = max_per_server
+        self._outstanding = {} # maps server to number of requests
+        self._waiting = set() # SegmentFetchers held back
+
+    def has_room(self, server):
+        return self._outstanding.get(server, 0) < self.max_per_server
+
+    def started(self, server):
+        self._outstanding[server] = self._outstanding.get(server, 0) + 1
+
+    def finished(self, server):
+        self._outstanding[server] -= 1
+        if not self._outstanding[server]:
+            del self._outstanding[server]
+        waiting, self._waiting = self._waiting, set()
+        for fetcher in waiting:
+            eventually(fetcher.loop)
+
+    def wait(self, fetcher):
+        self._waiting.add(fetcher)
+
+
 class SegmentFetcher(object):
     """I am responsible for acquiring blocks for a single segment. I will use
     the Share instances passed to my add_shares() method to locate, retrieve,
@@ -32,17 +70,30 @@ class SegmentFetcher(object):
     If I am unable to provide enough blocks, I will call my parent's
     fetch_failed() method with (self, f). After either of these events, I
     will shut down and do no further work. My parent can also call my stop()
-    method to have me shut down early."""
+    method to have me shut down early.
+
+    If I am given a ServerRequestLimiter, I tell it about all my block
+    requests until they finish or become OVERDUE, and if 'limited' is True I
+    only send them to servers which it says have room for more. My parent
+    calls my unlimit() method when I become the fetcher for the oldest
+    segment it has yet to deliver.
 
-    def __init__(self, node, segnum, k, logparent):
+    I ask the shares on the servers expected to answer soonest first,
+    going by the speeds the StorageFarmBroker has measured (or the DYHB
+    round trip, before it has any). The speeds change as blocks arrive, so
+    I rank the shares again each time I pick one. If I am given a
+    DownloadStatus, I record each pick in it."""
+
+    def __init__(self, node, segnum, k, logparent, limiter=None,
+                 limited=False, download_status=None):
         self._node = node # _Node
         self.segnum = segnum
         self._k = k
         self._shares = [] # unused Share instances, sorted by "goodness"
-                          # (RTT), then shnum. This is populated when DYHB
-                          # responses arrive, or (for later segments) at
-                          # startup. We remove shares from it when we call
-                          # sh.get_block() on them.
+                          # (expected block time), then shnum. This is
+                          # populated when DYHB responses arrive, or (for
+                          # later segments) at startup. We remove shares
+                          # from it when we call sh.get_block() on them.
         self._shares_from_server = DictOfSets() # maps server to set of
                                                 # Shares on that server for
                                                 # which we have outstanding
@@ -61,6 +112,11 @@ class SegmentFetcher(object):
         self._no_more_shares = False
         self._last_failure = None
         self._running = True
+        self._limiter = limiter
+        self._limited = limited
+        self._limited_shares = set() # Shares whose requests our limiter
+                                     # is counting
+        self._download_status = download_status
 
     def stop(self):
         log.msg("SegmentFetcher(%r).stop" % self._node._si_prefix,
@@ -79,7 +135,7 @@ class SegmentFetcher(object):
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        self._sort_shares()
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -87,6 +143,13 @@ class SegmentFetcher(object):
         self._no_more_shares = True
         eventually(self.loop)
 
+    def unlimit(self):
+        # the segments before ours have been delivered, so nothing else
+        # waits for us to make progress: we may use any server
+        if self._limited:
+            self._limited = False
+            eventually(self.loop)
+
     # internal methods
 
     def loop(self):
@@ -119,10 +182,16 @@ class SegmentFetcher(object):
                   ) < k:
             # we don't have data or active requests for enough shares. Are
             # there any unused shares we can start using?
-            (sent_something, want_more_diversity) = self._find_and_use_share()
+            (sent_something, want_more_diversity,
+             held_back) = self._find_and_use_share()
             if sent_something:
                 # great. loop back around in case we need to send more.
                 continue
+            if held_back:
+                # the servers we could use are busy with other segments.
+                # Wait until one of them has room.
+                self._limiter.wait(self)
+                return
             if want_more_diversity:
                 # we could have sent something if we'd been allowed to pull
                 # more shares per server. Increase the limit and try again.
@@ -197,10 +266,19 @@ class SegmentFetcher(object):
         self.stop()
         self._node.fetch_failed(self, f)
 
+    def _sort_shares(self):
+        expected = dict([(sh, sh.expected_block_time())
+                         for sh in self._shares])
+        self._shares.sort(key=lambda sh: (expected[sh], sh._shnum))
+        return expected
+
     def _find_and_use_share(self):
         sent_something = False
         want_more_diversity = False
-        for sh in self._shares: # find one good share to fetch
+        held_back = False
+        passed_over = 0 # faster shares we could have used, but didn't
+        expected = self._sort_shares()
+        for sh in self._shares: # find one good share
             shnum = sh._shnum ; server = sh._server # XXX
             if shnum in self._blocks:
                 continue # don't request data we already have
@@ -212,15 +290,27 @@ class SegmentFetcher(object):
             if len(sfs.get(server,set())) >= self._max_shares_per_server:
                 # don't pull too much from a single server
                 want_more_diversity = True
+                passed_over += 1
+                continue
+            if self._limited and not self._limiter.has_room(server):
+                held_back = True
+                passed_over += 1
                 continue
             # ok, we can use this share
             self._shares.remove(sh)
             self._active_share_map[shnum] = sh
             self._shares_from_server.add(server, sh)
+            if self._limiter is not None:
+                self._limiter.started(server)
+                self._limited_shares.add(sh)
+            if self._download_status is not None:
+                self._download_status.add_share_selection(
+                    self.segnum, server, shnum, expected[sh], passed_over,
+                    now())
             self._start_share(sh, shnum)
             sent_something = True
             break
-        return (sent_something, want_more_diversity)
+        return (sent_something, want_more_diversity, held_back)
 
     def _start_share(self, share, shnum):
         self._share_observers[share] = o = share.get_block(self.segnum)
@@ -236,6 +326,13 @@ class SegmentFetcher(object):
         for o in list(self._share_observers.values()):
             o.cancel()
         self._share_observers = {}
+        for share in list(self._limited_shares):
+            self._release_limiter(share)
+
+    def _release_limiter(self, share):
+        if share in self._limited_shares:
+            self._limited_shares.discard(share)
+            self._limiter.finished(share._server) # XXX
 
     def _block_request_activity(self, share, shnum, state, block=None, f=None):
         # called by Shares, in response to our s.send_request() calls.
@@ -249,6 +346,7 @@ class SegmentFetcher(object):
         if state in (COMPLETE, CORRUPT, DEAD, BADSEGNUM):
             self._share_observers.pop(share, None)
             server = share._server # XXX
+            self._release_limiter(share)
             self._shares_from_server.discard(server, share)
             if self._active_share_map.get(shnum) is share:
                 del self._active_share_map[shnum]
@@ -262,6 +360,8 @@ class SegmentFetcher(object):
             # no longer active, but still might complete
             del self._active_share_map[shnum]
             self._overdue_share_map.add(shnum, share)
+            # a slow server should not hold back the other segments
+            self._release_limiter(share)
             # OVERDUE is not terminal: it will eventually transition to
             # COMPLETE, CORRUPT, or DEAD.
 
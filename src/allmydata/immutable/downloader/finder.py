@@ -178,6 +178,8 @@ class ShareFinder(object):
         time_received = now()
         d_ev.finished(shnums, time_received)
         dyhb_rtt = time_received - time_sent
+        server_speed = self._storage_broker.get_server_speed(server)
+        server_speed.add_round_trip(dyhb_rtt, time_received)
         if not buckets:
             self.log(format="no shares from [%(name)s]", name=server.get_name(),
                      level=log.NOISY, parent=lp, umid="U7d4JA")
@@ -188,11 +190,12 @@ class ShareFinder(object):
                  level=log.NOISY, parent=lp, umid="0fcEZw")
         shares = []
         for shnum, bucket in buckets.items():
-            s = self._create_share(shnum, bucket, server, dyhb_rtt)
+            s = self._create_share(shnum, bucket, server, dyhb_rtt,
+                                   server_speed)
             shares.append(s)
         self._deliver_shares(shares)
 
-    def _create_share(self, shnum, bucket, server, dyhb_rtt):
+    def _create_share(self, shnum, bucket, server, dyhb_rtt, server_speed):
         if shnum in self._commonshares:
             cs = self._commonshares[shnum]
         else:
@@ -217,7 +220,7 @@ class ShareFinder(object):
             self._commonshares[shnum] = cs
         s = Share(bucket, server, self.verifycap, cs, self.node,
                   self._download_status, shnum, dyhb_rtt,
-                  self._node_logparent)
+                  self._node_logparent, server_speed)
         return s
 
     def _deliver_shares(self, shares):
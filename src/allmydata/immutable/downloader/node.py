@@ -25,7 +25,8 @@ from allmydata.hashtree import IncompleteHashTree, BadHashError, \
 
 # local imports
 from .finder import ShareFinder
-from .fetcher import SegmentFetcher
+from .fetcher import SegmentFetcher, ServerRequestLimiter, \
+     DEFAULT_MAX_REQUESTS_PER_SERVER
 from .segmentation import Segmentation
 from .common import BadCiphertextHashError
 
@@ -51,7 +52,9 @@ class DownloadNode(object):
 
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status, segment_cache=None,
+                 read_ahead=0, concurrent_segments=1,
+                 max_requests_per_server=DEFAULT_MAX_REQUESTS_PER_SERVER):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
@@ -68,6 +71,13 @@ class DownloadNode(object):
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        # a SegmentCache shared with the client's other DownloadNodes, or None
+        self._segment_cache = segment_cache
+        # the most segments each read() fetches ahead of its consumer
+        self._read_ahead = read_ahead
+        # the most segments we fetch at once
+        self._concurrent_segments = concurrent_segments
+        self._limiter = ServerRequestLimiter(max_requests_per_server)
 
         self.share_hash_tree = IncompleteHashTree(self._verifycap.total_shares)
 
@@ -91,7 +101,15 @@ class DownloadNode(object):
 
         # _segment_requests can have duplicates
         self._segment_requests = [] # (segnum, d, cancel_handle, seg_ev, lp)
-        self._active_segment = None # a SegmentFetcher, with .segnum
+        # maps segnum to (SegmentFetcher, start time). There is only one
+        # until we know the real segment size.
+        self._active_segments = {}
+        # maps segnum to the result for segments which arrived before those
+        # requested ahead of them, and wait for them to be delivered first
+        self._finished_segments = {}
+        # a moving average of how long it takes to fetch and validate a
+        # segment, once we start on it, or None until we have done one
+        self.segment_fetch_time = None
 
         self._segsize_observers = observer.OneShotObserverList()
 
@@ -113,6 +131,14 @@ class DownloadNode(object):
                                         self._download_status, lp)
         self._shares = set()
 
+        if segment_cache is not None:
+            # another node may have read the UEB already: then we know the
+            # real segment size from the start
+            UEB_s = segment_cache.get_ueb(self._verifycap.storage_index,
+                                          self._verifycap.uri_extension_hash)
+            if UEB_s is not None:
+                self.validate_and_store_UEB(UEB_s)
+
     def _build_guessed_tables(self, max_segment_size):
         size = min(self._verifycap.size, max_segment_size)
         s = mathutil.next_multiple(size, self._verifycap.needed_shares)
@@ -129,9 +155,9 @@ class DownloadNode(object):
 
     def stop(self):
         # called by the Terminator at shutdown, mostly for tests
-        if self._active_segment:
-            self._active_segment.stop()
-            self._active_segment = None
+        for (fetcher, started) in self._active_segments.values():
+            fetcher.stop()
+        self._active_segments = {}
         self._sharefinder.stop()
 
     # things called by outside callers, via CiphertextFileNode. get_segment()
@@ -173,7 +199,8 @@ class DownloadNode(object):
 
         # for concurrent operations, each read() gets its own Segmentation
         # manager
-        s = Segmentation(self, offset, size, consumer, read_ev, lp)
+        s = Segmentation(self, offset, size, consumer, read_ev, lp,
+                         read_ahead=self._read_ahead)
 
         # this raises an interesting question: what segments to fetch? if
         # offset=0, always fetch the first segment, and then allow
@@ -215,10 +242,35 @@ class DownloadNode(object):
         seg_ev = self._download_status.add_segment_request(segnum, now())
         d = defer.Deferred()
         c = Cancel(self._cancel_request)
+        cached = self._get_cached_segment(segnum)
+        if cached is not None:
+            (offset, segment) = cached
+            when = now()
+            seg_ev.activate(when)
+            seg_ev.deliver(when, offset, len(segment), 0)
+            eventually(self._deliver, d, c, (offset, segment, 0))
+            return (d, c)
         self._segment_requests.append( (segnum, d, c, seg_ev, lp) )
         self._start_new_segment()
         return (d, c)
 
+    def _get_cached_segment(self, segnum):
+        # returns (offset, segment), or None if the segment must be fetched
+        cache = self._segment_cache
+        if cache is None:
+            return None
+        if not self.have_UEB:
+            # without the UEB we cannot tell where the segment starts
+            self._download_status.add_segment_cache_lookup(False)
+            return None
+        segment = cache.get_segment(self._verifycap.storage_index,
+                                    self._verifycap.uri_extension_hash,
+                                    segnum)
+        self._download_status.add_segment_cache_lookup(segment is not None)
+        if segment is None:
+            return None
+        return (segnum * self.segment_size, segment)
+
     def get_segsize(self):
         """Return a Deferred that fires when we know the real segment size."""
         if self.segment_size:
@@ -238,27 +290,82 @@ class DownloadNode(object):
     # arbitrary-sized read() calls into quantized segment fetches
 
     def _start_new_segment(self):
-        if self._active_segment is None and self._segment_requests:
-            (segnum, d, c, seg_ev, lp) = self._segment_requests[0]
+        # until we know the segment size, we might be asking for the wrong
+        # segments, so only fetch one at a time
+        concurrent = self._concurrent_segments if self.have_UEB else 1
+        for (segnum, d, c, seg_ev, lp) in self._segment_requests:
+            if len(self._active_segments) >= concurrent:
+                break
+            if (segnum in self._active_segments
+                or segnum in self._finished_segments):
+                continue
             k = self._verifycap.needed_shares
             log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
                     node=repr(self), segnum=segnum,
                     level=log.NOISY, parent=lp, umid="wAlnHQ")
-            self._active_segment = fetcher = SegmentFetcher(self, segnum, k, lp)
-            seg_ev.activate(now())
+            # the fetcher for the oldest undelivered segment may use any
+            # server, so that the download can always make progress
+            fetcher = SegmentFetcher(self, segnum, k, lp,
+                                     limiter=self._limiter,
+                                     limited=bool(self._active_segments),
+                                     download_status=self._download_status)
+            started = now()
+            self._active_segments[segnum] = (fetcher, started)
+            seg_ev.activate(started)
             active_shares = [s for s in self._shares if s.is_alive()]
             fetcher.add_shares(active_shares) # this triggers the loop
+        # when that segment is delivered, the next one takes its place
+        for (segnum, d, c, seg_ev, lp) in self._segment_requests:
+            if segnum in self._active_segments:
+                (fetcher, started) = self._active_segments[segnum]
+                fetcher.unlimit()
+                break
+
+    def _segment_finished(self, segnum, result):
+        # 'result' is (offset, segment, decodetime) or a Failure. Requests
+        # are answered in the order they were made: a segment which arrives
+        # early waits for the ones requested before it.
+        del self._active_segments[segnum]
+        self._finished_segments[segnum] = result
+        self._deliver_finished_segments()
+        self._start_new_segment()
+
+    def _deliver_finished_segments(self):
+        while (self._segment_requests
+               and self._segment_requests[0][0] in self._finished_segments):
+            segnum = self._segment_requests[0][0]
+            self._deliver_segment(segnum,
+                                  self._finished_segments.pop(segnum))
+
+    def _deliver_segment(self, segnum, result):
+        when = now()
+        if isinstance(result, Failure):
+            for (d,c,seg_ev) in self._extract_requests(segnum):
+                seg_ev.error(when)
+                eventually(self._deliver, d, c, result)
+            return
+        (offset, segment, decodetime) = result
+        for (d,c,seg_ev) in self._extract_requests(segnum):
+            # when we have two requests for the same segment, the second one
+            # will not be "activated" before the data is delivered, so to
+            # allow the status-reporting code to see consistent behavior, we
+            # activate them all now. The SegmentEvent will ignore duplicate
+            # activate() calls. Note that this will result in an inaccurate
+            # "receive speed" for the second request.
+            seg_ev.activate(when)
+            seg_ev.deliver(when, offset, len(segment), decodetime)
+            eventually(self._deliver, d, c, result)
 
 
     # called by our child ShareFinder
     def got_shares(self, shares):
         self._shares.update(shares)
-        if self._active_segment:
-            self._active_segment.add_shares(shares)
+        for (fetcher, started) in list(self._active_segments.values()):
+            fetcher.add_shares(shares)
     def no_more_shares(self):
         self._no_more_shares = True
-        if self._active_segment:
-            self._active_segment.no_more_shares()
+        for (fetcher, started) in list(self._active_segments.values()):
+            fetcher.no_more_shares()
 
     # things called by our Share instances
 
@@ -272,6 +379,10 @@ class DownloadNode(object):
         # TODO: a malformed (but authentic) UEB could throw an assertion in
         # _parse_and_store_UEB, and we should abandon the download.
         self.have_UEB = True
+        if self._segment_cache is not None:
+            self._segment_cache.put_ueb(self._verifycap.storage_index,
+                                        self._verifycap.uri_extension_hash,
+                                        UEB_s)
 
         # inform the ShareFinder about our correct number of segments. This
         # will update the block-hash-trees in all existing CommonShare
@@ -407,13 +518,9 @@ class DownloadNode(object):
         self._sharefinder.hungry()
 
     def fetch_failed(self, sf, f):
-        assert sf is self._active_segment
+        assert self._active_segments[sf.segnum][0] is sf
         # deliver error upwards
-        for (d,c,seg_ev) in self._extract_requests(sf.segnum):
-            seg_ev.error(now())
-            eventually(self._deliver, d, c, f)
-        self._active_segment = None
-        self._start_new_segment()
+        self._segment_finished(sf.segnum, f)
 
     def process_blocks(self, segnum, blocks):
         start = now()
@@ -424,32 +531,30 @@ class DownloadNode(object):
                     segnum=segnum,
                     level=log.OPERATIONAL, parent=self._lp,
                     umid="j60Ojg")
-            when = now()
-            if isinstance(result, Failure):
-                # this catches failures in decode or ciphertext hash
-                for (d,c,seg_ev) in self._extract_requests(segnum):
-                    seg_ev.error(when)
-                    eventually(self._deliver, d, c, result)
-            else:
+            if segnum not in self._active_segments:
+                # the segment was cancelled while being decoded
+                return
+            # a Failure here comes from decode or the ciphertext hash
+            if not isinstance(result, Failure):
                 (offset, segment, decodetime) = result
-                for (d,c,seg_ev) in self._extract_requests(segnum):
-                    # when we have two requests for the same segment, the
-                    # second one will not be "activated" before the data is
-                    # delivered, so to allow the status-reporting code to see
-                    # consistent behavior, we activate them all now. The
-                    # SegmentEvent will ignore duplicate activate() calls.
-                    # Note that this will result in an inaccurate "receive
-                    # speed" for the second request.
-                    seg_ev.activate(when)
-                    seg_ev.deliver(when, offset, len(segment), decodetime)
-                    eventually(self._deliver, d, c, result)
+                (fetcher, started) = self._active_segments[segnum]
+                self._update_segment_fetch_time(now() - started)
+                if self._segment_cache is not None:
+                    self._segment_cache.put_segment(
+                        self._verifycap.storage_index,
+                        self._verifycap.uri_extension_hash, segnum, segment)
             self._download_status.add_misc_event("process_block", start, now())
-            self._active_segment = None
-            self._start_new_segment()
+            self._segment_finished(segnum, result)
         d.addBoth(_deliver)
         d.addErrback(log.err, "unhandled error during process_blocks",
                      level=log.WEIRD, parent=self._lp, umid="MkEsCg")
 
+    def _update_segment_fetch_time(self, elapsed):
+        if self.segment_fetch_time is None:
+            self.segment_fetch_time = elapsed
+        else:
+            self.segment_fetch_time += (elapsed - self.segment_fetch_time) / 4
+
     def _decode_blocks(self, segnum, blocks):
         start = now()
         tail = (segnum == self.num_segments-1)
@@ -489,7 +594,7 @@ class DownloadNode(object):
     def _check_ciphertext_hash(self, segment_and_decodetime, segnum):
         (segment, decodetime) = segment_and_decodetime
         start = now()
-        assert self._active_segment.segnum == segnum
+        assert segnum in self._active_segments
         assert self.segment_size is not None
         offset = segnum * self.segment_size
 
@@ -531,12 +636,16 @@ class DownloadNode(object):
         self._segment_requests = [t for t in self._segment_requests
                                   if t[2] != cancel]
         segnums = [segnum for (segnum,d,c,seg_ev,lp) in self._segment_requests]
-        # self._active_segment might be None in rare circumstances, so make
-        # sure we tolerate it
-        if self._active_segment and self._active_segment.segnum not in segnums:
-            self._active_segment.stop()
-            self._active_segment = None
-            self._start_new_segment()
+        for segnum in list(self._active_segments):
+            if segnum not in segnums:
+                (fetcher, started) = self._active_segments.pop(segnum)
+                fetcher.stop()
+        for segnum in list(self._finished_segments):
+            if segnum not in segnums:
+                del self._finished_segments[segnum]
+        # the cancelled request may have been holding back others
+        self._deliver_finished_segments()
+        self._start_new_segment()
 
     # called by ShareFinder to choose hashtree sizes in CommonShares, and by
     # SegmentFetcher to tell if it is still fetching a valid segnum.
@@ -10,7 +10,7 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import time
+import math, time
 now = time.time
 from zope.interface import implementer
 from twisted.internet import defer
@@ -29,8 +29,16 @@ class Segmentation(object):
     (from my CiphertextDownloader) in order, and trim the segments down to
     match the offset+size span. I use the Producer/Consumer interface to only
     request one segment at a time.
+
+    With read_ahead>0, I also ask for up to that many of the segments after
+    the one I am waiting for, so that they are fetched while the consumer is
+    busy with the earlier ones. How many depends on how many segments the
+    consumer gets through in the time it takes to fetch one (the
+    bandwidth-delay product, in segments). While the consumer is paused I
+    do not ask for any more.
     """
-    def __init__(self, node, offset, size, consumer, read_ev, logparent=None):
+    def __init__(self, node, offset, size, consumer, read_ev, logparent=None,
+                 read_ahead=0):
         self._node = node
         self._hungry = True
         self._active_segnum = None
@@ -44,6 +52,13 @@ class Segmentation(object):
         self._read_ev = read_ev
         self._start_pause = None
         self._lp = logparent
+        self._max_read_ahead = read_ahead
+        # segnum -> (Deferred, cancel) for the segments asked for ahead
+        self._prefetched = {}
+        # a moving average of how long the consumer takes over a segment,
+        # from when we write it to when it is hungry for the next one
+        self._consume_time = None
+        self._last_write = None
 
     def start(self):
         self._alive = True
@@ -71,6 +86,9 @@ class Segmentation(object):
             self._hungry = False
             self._deferred.callback(self._consumer)
             return
+        if self._last_write is not None:
+            self._update_consume_time(now() - self._last_write)
+            self._last_write = None
         n = self._node
         have_actual_segment_size = n.segment_size is not None
         guess_s = ""
@@ -87,7 +105,14 @@ class Segmentation(object):
                 offset=self._offset, guess=guess_s, segnum=wanted_segnum,
                 level=log.NOISY, parent=self._lp, umid="5WfN0w")
         self._active_segnum = wanted_segnum
-        d,c = n.get_segment(wanted_segnum, self._lp)
+        prefetched = self._prefetched.pop(wanted_segnum, None)
+        if prefetched is None:
+            d,c = n.get_segment(wanted_segnum, self._lp)
+        else:
+            d,c = prefetched
+        if have_actual_segment_size:
+            # before 'd' gets callbacks, which may run right away
+            self._read_ahead(wanted_segnum)
         self._cancel_segment_request = c
         d.addBoth(self._request_retired)
         d.addCallback(self._got_segment, wanted_segnum)
@@ -96,6 +121,43 @@ class Segmentation(object):
             d.addErrback(self._retry_bad_segment)
         d.addErrback(self._error)
 
+    def _read_ahead(self, segnum):
+        if not self._max_read_ahead:
+            return
+        n = self._node
+        last_segnum = min((self._offset + self._size - 1) // n.segment_size,
+                          n.num_segments - 1)
+        for ahead in range(segnum + 1,
+                           min(segnum + self._read_ahead_depth(),
+                               last_segnum) + 1):
+            if ahead not in self._prefetched:
+                log.msg(format="reading ahead segnum=%(segnum)d",
+                        segnum=ahead,
+                        level=log.NOISY, parent=self._lp, umid="Pq1rJw")
+                self._prefetched[ahead] = n.get_segment(ahead, self._lp)
+
+    def _read_ahead_depth(self):
+        fetch_time = self._node.segment_fetch_time
+        if fetch_time is None or self._consume_time is None:
+            return 1
+        if self._consume_time <= 0:
+            return self._max_read_ahead
+        depth = int(math.ceil(fetch_time / self._consume_time))
+        return max(1, min(depth, self._max_read_ahead))
+
+    def _update_consume_time(self, elapsed):
+        if self._consume_time is None:
+            self._consume_time = elapsed
+        else:
+            self._consume_time += (elapsed - self._consume_time) / 4
+
+    def _cancel_read_ahead(self):
+        for (d,c) in self._prefetched.values():
+            c.cancel()
+            # nobody will want to hear that it failed, either
+            d.addErrback(lambda f: None)
+        self._prefetched.clear()
+
     def _request_retired(self, res):
         self._active_segnum = None
         self._cancel_segment_request = None
@@ -133,6 +195,7 @@ class Segmentation(object):
         self._offset += len(desired_data)
         self._size -= len(desired_data)
         self._consumer.write(desired_data)
+        self._last_write = now()
         # the consumer might call our .pauseProducing() inside that write()
         # call, setting self._hungry=False
         self._read_ev.update(len(desired_data), 0, 0)
@@ -154,6 +217,7 @@ class Segmentation(object):
                 level=log.WEIRD, parent=self._lp, umid="EYlXBg")
         self._alive = False
         self._hungry = False
+        self._cancel_read_ahead()
         self._deferred.errback(f)
 
     def stopProducing(self):
@@ -165,6 +229,7 @@ class Segmentation(object):
         if self._cancel_segment_request:
             self._cancel_segment_request.cancel()
             self._cancel_segment_request = None
+        self._cancel_read_ahead()
         e = DownloadStopped("our Consumer called stopProducing()")
         self._deferred.errback(e)
 
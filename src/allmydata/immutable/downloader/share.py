@@ -47,7 +47,8 @@ class Share(object):
     # servers. A different backend would use a different class.
 
     def __init__(self, rref, server, verifycap, commonshare, node,
-                 download_status, shnum, dyhb_rtt, logparent):
+                 download_status, shnum, dyhb_rtt, logparent,
+                 server_speed=None):
         self._rref = rref
         self._server = server
         self._node = node # holds share_hash_tree and UEB
@@ -64,6 +65,9 @@ class Share(object):
         self._si_prefix = base32.b2a(verifycap.storage_index)[:8]
         self._shnum = shnum
         self._dyhb_rtt = dyhb_rtt
+        # the StorageFarmBroker's ServerSpeed for our server, which we update
+        # with the time each of our reads takes
+        self._server_speed = server_speed
         # self._alive becomes False upon fatal corruption or server error
         self._alive = True
         self._loop_scheduled = False
@@ -142,8 +146,20 @@ class Share(object):
         self._fieldsize = wbp.fieldsize
         self._fieldstruct = wbp.fieldstruct
         self.guessed_offsets = wbp._offsets
+        self._guessed_block_size = r["block_size"]
 
     # called by our client, the SegmentFetcher
+    def expected_block_time(self):
+        """How long I expect my server to take to send me a block: going by
+        what our downloads have seen of it lately, or else by how quickly it
+        answered the DYHB query."""
+        if self._server_speed is not None:
+            block_size = self._node.block_size or self._guessed_block_size
+            expected = self._server_speed.expected_time(block_size, now())
+            if expected is not None:
+                return expected
+        return self._dyhb_rtt
+
     def get_block(self, segnum):
         """Add a block number to the list of requests. This will eventually
         result in a fetch of the data necessary to validate the block, then
@@ -755,10 +771,11 @@ class Share(object):
                          share=repr(self),
                          start=start, length=length,
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
+            sent = now()
             block_ev = ds.add_block_request(self._server, self._shnum,
-                                            start, length, now())
+                                            start, length, sent)
             d = self._send_request(start, length)
-            d.addCallback(self._got_data, start, length, block_ev, lp)
+            d.addCallback(self._got_data, start, length, block_ev, sent, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
             d.addCallback(self._trigger_loop)
             d.addErrback(lambda f:
@@ -769,8 +786,12 @@ class Share(object):
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
-    def _got_data(self, data, start, length, block_ev, lp):
-        block_ev.finished(len(data), now())
+    def _got_data(self, data, start, length, block_ev, sent, lp):
+        received = now()
+        block_ev.finished(len(data), received)
+        if self._server_speed is not None:
+            self._server_speed.add_response(len(data), received - sent,
+                                            received)
         if not self._alive:
             return
         log.msg(format="%(share)s._got_data [%(start)d:+%(length)d] -> %(datalen)d",
@@ -152,11 +152,26 @@ class DownloadStatus(object):
         #  response_length (None until success)
         self.block_requests = []
 
+        # self.share_selections records the share each SegmentFetcher chose
+        # to ask for a block, and why. It is a list of dicts:
+        #  segment_number
+        #  server (instance of IServer)
+        #  shnum
+        #  expected_time (how long the server was expected to take)
+        #  rank (how many usable shares that were expected to be as fast
+        #        were passed over, to spread the load across servers)
+        #  time
+        self.share_selections = []
+
         self.known_shares = [] # (server, shnum)
         self.problems = []
 
         self.misc_events = []
 
+        # lookups in the client's segment cache, if it has one
+        self.segment_cache_hits = 0
+        self.segment_cache_misses = 0
+
     def add_misc_event(self, what, start, finish=None):
         self.misc_events.append( {"what": what,
                                   "start_time": start,
@@ -215,6 +230,29 @@ class DownloadStatus(object):
         self.block_requests.append(r)
         return BlockRequestEvent(r, self)
 
+    def add_share_selection(self, segnum, server, shnum, expected_time, rank,
+                            when):
+        self.share_selections.append( {"segment_number": segnum,
+                                       "server": server,
+                                       "shnum": shnum,
+                                       "expected_time": expected_time,
+                                       "rank": rank,
+                                       "time": when,
+                                       } )
+
+    def add_segment_cache_lookup(self, hit):
+        if hit:
+            self.segment_cache_hits += 1
+        else:
+            self.segment_cache_misses += 1
+
+    def get_segment_cache_hit_rate(self):
+        # returns None if the cache was never asked
+        lookups = self.segment_cache_hits + self.segment_cache_misses
+        if not lookups:
+            return None
+        return self.segment_cache_hits / lookups
+
     def update_last_timestamp(self, when):
         if self.last_timestamp is None or when > self.last_timestamp:
             self.last_timestamp = when
@@ -33,16 +33,24 @@ from allmydata.immutable.repairer import Repairer
 from allmydata.immutable.downloader.node import DownloadNode, \
      IDownloadStatusHandlingConsumer
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.immutable.downloader.fetcher import \
+     DEFAULT_MAX_REQUESTS_PER_SERVER
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, segment_cache=None, read_ahead=0,
+                 concurrent_segments=1,
+                 max_requests_per_server=DEFAULT_MAX_REQUESTS_PER_SERVER):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._segment_cache = segment_cache
+        self._read_ahead = read_ahead
+        self._concurrent_segments = concurrent_segments
+        self._max_requests_per_server = max_requests_per_server
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -57,7 +65,11 @@ class CiphertextFileNode(object):
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      segment_cache=self._segment_cache,
+                                      read_ahead=self._read_ahead,
+                                      concurrent_segments=self._concurrent_segments,
+                                      max_requests_per_server=self._max_requests_per_server)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -245,11 +257,17 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, segment_cache=None, read_ahead=0,
+                 concurrent_segments=1,
+                 max_requests_per_server=DEFAULT_MAX_REQUESTS_PER_SERVER):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         segment_cache=segment_cache,
+                                         read_ahead=read_ahead,
+                                         concurrent_segments=concurrent_segments,
+                                         max_requests_per_server=max_requests_per_server)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
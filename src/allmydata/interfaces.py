@@ -40,6 +40,8 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_STORAGE_INDEXES_PER_QUERY = 1000 # for get_buckets_many
+MAX_SLOT_READS_PER_QUERY = 100 # for slot_readv_many
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -165,6 +167,24 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_many(storage_indexes=ListOf(
+            StorageIndex, maxLength=MAX_STORAGE_INDEXES_PER_QUERY)):
+        """
+        Do get_buckets() for several storage indexes in one round trip.
+        Servers which implement this advertise a true value for the
+        'get-buckets-many' key (under
+        'http://allmydata.org/tahoe/protocols/storage/v1') in their version
+        information.
+
+        @return: a dictionary mapping each storage index for which I hold
+                 shares to a dictionary of {sharenum: bucket reader}, as
+                 get_buckets() would return. Storage indexes for which I hold
+                 no shares are left out.
+        """
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_STORAGE_INDEXES_PER_QUERY)
+
     def slot_readv(storage_index=StorageIndex,
                    shares=ListOf(int), readv=ReadVector):
         """Read a vector from the numbered shares associated with the given
@@ -172,6 +192,23 @@ class RIStorageServer(RemoteInterface):
         known shares. Returns a dictionary with one key per share."""
         return DictOf(int, ReadData) # shnum -> results
 
+    def slot_readv_many(reads=ListOf(
+            TupleOf(StorageIndex, ListOf(int), ReadVector),
+            maxLength=MAX_SLOT_READS_PER_QUERY)):
+        """
+        Do slot_readv() for several slots in one round trip. Each element of
+        'reads' is a (storage_index, shares, readv) tuple, as the arguments
+        of slot_readv(). Servers which implement this advertise a true value
+        for the 'slot-readv-many' key (under
+        'http://allmydata.org/tahoe/protocols/storage/v1') in their version
+        information.
+
+        @return: a list with one element per read, in the same order, each
+                 being the dictionary that slot_readv() would return.
+        """
+        return ListOf(DictOf(int, ReadData),
+                      maxLength=MAX_SLOT_READS_PER_QUERY)
+
     def slot_testv_and_readv_and_writev(storage_index=StorageIndex,
                                         secrets=TupleOf(WriteEnablerSecret,
                                                         LeaseRenewSecret,
@@ -342,6 +379,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.get_buckets``
         """
 
+    def get_buckets_many(
+            storage_indexes,
+    ):
+        """
+        :see: ``RIStorageServer.get_buckets_many``
+        """
+
     def slot_readv(
             storage_index,
             shares,
@@ -351,6 +395,13 @@ class IStorageServer(Interface):
         :see: ``RIStorageServer.slot_readv``
         """
 
+    def slot_readv_many(
+            reads,
+    ):
+        """
+        :see: ``RIStorageServer.slot_readv_many``
+        """
+
     def slot_testv_and_readv_and_writev(
             storage_index,
             secrets,
@@ -489,6 +540,11 @@ class IStorageBroker(Interface):
         """
         @return: unicode nickname, or None
         """
+    def get_server_speed(server):
+        """
+        @return: the ServerSpeed which measures how quickly the given
+                 IServer answers our requests
+        """
 
     # methods moved from IntroducerClient, need review
     def get_all_connections():
@@ -2877,6 +2933,14 @@ class IStatsProducer(Interface):
         to be monitored, and numeric values.
         """
 
+class IHistogramProducer(Interface):
+    def get_histograms():
+        """
+        Return a dictionary mapping the names of measurements (like stats
+        names) to ``allmydata.util.histogram.Histogram`` instances holding
+        every value measured since startup.
+        """
+
 class FileTooLargeError(Exception):
     pass
 
@@ -16,6 +16,8 @@ from allmydata.util.assertutil import precondition
 from allmydata.interfaces import INodeMaker
 from allmydata.immutable.literal import LiteralFileNode
 from allmydata.immutable.filenode import ImmutableFileNode, CiphertextFileNode
+from allmydata.immutable.downloader.fetcher import \
+     DEFAULT_MAX_REQUESTS_PER_SERVER
 from allmydata.immutable.upload import Data
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.publish import MutableData
@@ -31,7 +33,9 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None, segment_cache=None,
+                 read_ahead=0, concurrent_segments=1,
+                 max_requests_per_server=DEFAULT_MAX_REQUESTS_PER_SERVER):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -41,6 +45,10 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.segment_cache = segment_cache
+        self.read_ahead = read_ahead
+        self.concurrent_segments = concurrent_segments
+        self.max_requests_per_server = max_requests_per_server
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
 
@@ -48,10 +56,18 @@ class NodeMaker(object):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 segment_cache=self.segment_cache,
+                                 read_ahead=self.read_ahead,
+                                 concurrent_segments=self.concurrent_segments,
+                                 max_requests_per_server=self.max_requests_per_server)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  segment_cache=self.segment_cache,
+                                  read_ahead=self.read_ahead,
+                                  concurrent_segments=self.concurrent_segments,
+                                  max_requests_per_server=self.max_requests_per_server)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
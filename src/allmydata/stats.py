@@ -20,7 +20,7 @@ from zope.interface import implementer
 from foolscap.api import eventually
 
 from allmydata.util import log, dictutil
-from allmydata.interfaces import IStatsProducer
+from allmydata.interfaces import IStatsProducer, IHistogramProducer
 
 @implementer(IStatsProducer)
 class CPUUsageMonitor(service.MultiService):
@@ -101,3 +101,10 @@ class StatsProvider(service.MultiService):
         ret = { 'counters': self.counters, 'stats': stats }
         log.msg(format='get_stats() -> %(stats)s', stats=ret, level=log.NOISY)
         return ret
+
+    def get_histograms(self):
+        histograms = {}
+        for sp in self.stats_producers:
+            if IHistogramProducer.providedBy(sp):
+                histograms.update(sp.get_histograms())
+        return histograms
@@ -0,0 +1,108 @@
+"""
+A byte-bounded cache of data read from immutable shares.
+
+When many clients download the same file, every one of them reads the same
+blocks of the same shares through ``BucketReader.remote_read``. With this
+cache only the first of those reads goes to the disk (or to an I/O thread).
+
+Immutable share data never changes, so a cached read stays good until the
+share is deleted, which is what ``invalidate`` is for.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import threading
+from collections import OrderedDict
+
+
+class BlockCache(object):
+    """
+    I remember the results of share reads, keyed by ``(storage index,
+    shnum, offset, length)``, evicting the least recently used ones to keep
+    the data I hold under ``max_bytes``.
+
+    A read of more than ``max_bytes / 16`` bytes is not cached, so that one
+    large read cannot push out everything else.
+
+    I may be used from several threads at once.
+    """
+
+    def __init__(self, max_bytes):
+        assert max_bytes > 0, max_bytes
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_bytes // 16
+        self._lock = threading.Lock()
+        # (storage_index, shnum, offset, length) -> data, least recently
+        # used first
+        self._entries = OrderedDict()
+        # (storage_index, shnum) -> set of keys in _entries
+        self._shares = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, storage_index, shnum, offset, length):
+        """
+        :return: The data read earlier, or None.
+        """
+        key = (storage_index, shnum, offset, length)
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[key] = data
+            return data
+
+    def put(self, storage_index, shnum, offset, length, data):
+        """
+        Remember that reading ``length`` bytes at ``offset`` gave ``data``.
+        """
+        if len(data) > self.max_entry_size:
+            return
+        key = (storage_index, shnum, offset, length)
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._shares.setdefault(key[:2], set()).add(key)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                (old, old_data) = self._entries.popitem(last=False)
+                self._forget(old, old_data)
+                self.evictions += 1
+
+    def _forget(self, key, data):
+        self.bytes -= len(data)
+        keys = self._shares[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._shares[key[:2]]
+
+    def invalidate(self, storage_index, shnum):
+        """
+        Forget everything read from a share, which has been deleted.
+        """
+        with self._lock:
+            for key in self._shares.pop((storage_index, shnum), ()):
+                self.bytes -= len(self._entries.pop(key))
+
+    def get_stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    }
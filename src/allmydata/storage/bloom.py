@@ -0,0 +1,293 @@
+"""
+An in-memory filter of the storage indexes held by a storage server.
+
+Most ``get_buckets`` and ``slot_readv`` queries are for storage indexes the
+server has never held. A counting Bloom filter of the buckets which are
+present lets the server answer those from memory instead of probing the
+share directory.
+
+The filter never produces false negatives as long as every bucket which
+becomes non-empty is added and only buckets which have become empty are
+removed. It can produce false positives (which just cost the usual disk
+probe), and these accumulate as counters saturate or removals are skipped,
+so it can be rebuilt from a fresh scan of the share directory at any time.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, math, struct, hashlib
+
+from twisted.application import service
+from twisted.internet import defer, threads
+
+from allmydata.util import log
+from allmydata.util.observer import OneShotObserverList
+
+
+class CountingBloomFilter(object):
+    """
+    A Bloom filter with one-byte saturating counters, so that items can be
+    removed as well as added.
+
+    A counter which reaches 255 sticks there: it is never decremented again,
+    since it is no longer known how many items it counts.
+    """
+    MAX_COUNT = 255
+
+    def __init__(self, capacity, false_positive_rate=0.01):
+        """
+        :param int capacity: The number of items the filter is sized for.
+        :param float false_positive_rate: The false positive rate expected
+            when ``capacity`` items have been added.
+        """
+        capacity = max(1, capacity)
+        self.num_counters = int(math.ceil(
+            -capacity * math.log(false_positive_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_counters / capacity * math.log(2))))
+        self.counters = bytearray(self.num_counters)
+
+    def _positions(self, key):
+        (h1, h2) = struct.unpack(">QQ", hashlib.sha256(key).digest()[:16])
+        h2 |= 1
+        m = self.num_counters
+        return [(h1 + i * h2) % m for i in range(self.num_hashes)]
+
+    def add(self, key):
+        counters = self.counters
+        for pos in self._positions(key):
+            if counters[pos] < self.MAX_COUNT:
+                counters[pos] += 1
+
+    def remove(self, key):
+        """
+        Remove a key which was previously added. Removing a key which was not
+        added can cause false negatives for other keys.
+        """
+        counters = self.counters
+        for pos in self._positions(key):
+            if 0 < counters[pos] < self.MAX_COUNT:
+                counters[pos] -= 1
+
+    def __contains__(self, key):
+        counters = self.counters
+        for pos in self._positions(key):
+            if not counters[pos]:
+                return False
+        return True
+
+
+def scan_buckets(sharedir, stopped=None):
+    """
+    List the bucket directories below ``sharedir``. This only lists the
+    prefix directories, it does not look inside the buckets, so empty buckets
+    are included.
+
+    :param stopped: If not None, a callable checked before each prefix
+        directory is listed: once it returns True the scan ends early.
+
+    :return list[bytes]: The base32 storage index of each bucket.
+    """
+    buckets = []
+    try:
+        prefixes = os.listdir(sharedir)
+    except EnvironmentError:
+        return buckets
+    for prefix in prefixes:
+        if prefix == "incoming":
+            continue
+        if stopped is not None and stopped():
+            break
+        try:
+            names = os.listdir(os.path.join(sharedir, prefix))
+        except EnvironmentError:
+            continue # not a directory
+        for name in names:
+            buckets.append(name.encode("ascii"))
+    return buckets
+
+
+class StorageIndexFilter(service.Service):
+    """
+    I answer "might this server hold shares for this storage index?" from
+    memory, and keep statistics about how useful my answers are.
+
+    Keys are base32-encoded storage indexes (bytes), which is the form the
+    bucket directories are named in.
+
+    Until I have been seeded with a scan of the share directory (and of
+    ``extra_sharedirs``, the server's other share directories, and of
+    ``pack``, the ``PackStore`` holding packed shares, if there is one) I
+    answer every query with ``True``.
+
+    I build the first filter when I am started. Stopping me abandons a
+    rebuild which is still scanning, and waits for its thread to finish.
+    """
+
+    def __init__(self, sharedir, capacity, false_positive_rate=0.01,
+                 pack=None, extra_sharedirs=()):
+        self.sharedir = sharedir
+        self.extra_sharedirs = list(extra_sharedirs)
+        self.pack = pack
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self._filter = None
+        # while a rebuild is running: the buckets added since it started, to
+        # be applied to the new filter before it replaces the old one
+        self._pending = None
+        self._rebuilding = None
+        self._building = None # the Deferred for the scan's thread
+        self._stopped = False
+        self._ready = OneShotObserverList()
+        self.lookups = 0
+        self.negatives = 0
+        self.false_positives = 0
+        self.rebuilds = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._stopped = False
+        self.rebuild()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        # read by the scan's thread, which gives up when it sees this
+        self._stopped = True
+        if self._building is None:
+            return None
+        d = defer.Deferred()
+        self._building.addBoth(lambda ign: d.callback(None))
+        return d
+
+    def is_ready(self):
+        return self._filter is not None
+
+    def when_ready(self):
+        """
+        :return Deferred: Fires once the first filter has been built.
+        """
+        return self._ready.when_fired()
+
+    def rebuild(self):
+        """
+        Build a new filter from a scan of the share directory, in a thread.
+        The current filter (if any) stays in use until the new one is ready.
+
+        :return Deferred: Fires when the new filter is in use.
+        """
+        if self._rebuilding is not None:
+            return self._rebuilding.when_fired()
+        self._rebuilding = OneShotObserverList()
+        self._pending = []
+        d = self._building = threads.deferToThread(self._build)
+        d.addCallbacks(self._install, self._failed)
+        def _done(ignored):
+            self._building = None
+            rebuilding, self._rebuilding = self._rebuilding, None
+            rebuilding.fire(None)
+        d.addCallback(_done)
+        return self._rebuilding.when_fired()
+
+    def _failed(self, f):
+        self._pending = None
+        if self._stopped:
+            return
+        log.err(f, "unable to build storage index filter",
+                facility="tahoe.storage", level=log.UNUSUAL)
+
+    def _build(self):
+        # this runs in a thread, so it must not touch anything but the new
+        # filter
+        stopped = lambda: self._stopped
+        buckets = scan_buckets(self.sharedir, stopped)
+        for sharedir in self.extra_sharedirs:
+            buckets.extend(scan_buckets(sharedir, stopped))
+        if stopped():
+            return None
+        if self.pack is not None:
+            buckets.extend(si.encode("ascii")
+                           for si in self.pack.list_buckets())
+        if self.extra_sharedirs or self.pack is not None:
+            # a bucket may have shares both packed and in its directory,
+            # or in more than one share directory
+            buckets = sorted(set(buckets))
+        f = CountingBloomFilter(self.capacity, self.false_positive_rate)
+        for key in buckets:
+            f.add(key)
+        return (f, len(buckets))
+
+    def _install(self, result):
+        if result is None or self._stopped:
+            # abandoned: the scan may have missed buckets
+            self._pending = None
+            return
+        (f, num_buckets) = result
+        if num_buckets > self.capacity:
+            log.msg(format="storage index filter has capacity %(capacity)d"
+                    " but there are %(buckets)d buckets: expect more false"
+                    " positives", capacity=self.capacity,
+                    buckets=num_buckets, facility="tahoe.storage",
+                    level=log.UNUSUAL)
+        for key in self._pending:
+            f.add(key)
+        self._pending = None
+        self._filter = f
+        self.rebuilds += 1
+        self._ready.fire_if_not_fired(None)
+
+    def bucket_added(self, key):
+        """
+        A bucket which was empty (or absent) now holds a share.
+        """
+        if self._filter is not None:
+            self._filter.add(key)
+        if self._pending is not None:
+            self._pending.append(key)
+
+    def bucket_removed(self, key):
+        """
+        A bucket no longer holds any shares.
+        """
+        if self._pending is not None:
+            # The scan may not have seen this bucket yet, so the new filter
+            # might not contain it. Leave it in both filters: that is only a
+            # false positive, which the next rebuild will clean up.
+            return
+        if self._filter is not None:
+            self._filter.remove(key)
+
+    def might_contain(self, key):
+        """
+        :return bool: ``False`` if the bucket is definitely not present.
+        """
+        self.lookups += 1
+        if self._filter is None or key in self._filter:
+            return True
+        self.negatives += 1
+        return False
+
+    def record_false_positive(self):
+        self.false_positives += 1
+
+    def get_stats(self):
+        stats = {"ready": int(self.is_ready()),
+                 "lookups": self.lookups,
+                 "negatives": self.negatives,
+                 "false_positives": self.false_positives,
+                 "rebuilds": self.rebuilds,
+                 }
+        if self.lookups:
+            stats["hit_rate"] = self.negatives / self.lookups
+        positives = self.lookups - self.negatives
+        if positives:
+            stats["false_positive_rate"] = self.false_positives / positives
+        return stats
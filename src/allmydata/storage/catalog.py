@@ -0,0 +1,320 @@
+"""
+An index of the shares held by a storage server.
+
+The share catalog is an SQLite database which maps each storage index to the
+share numbers, sizes and share types held for it. When it is enabled the
+storage server updates it as shares are created and deleted, and consults it
+instead of listing the bucket directory on every lookup. Most queries a
+storage server sees are for storage indexes it does not hold, and answering
+those from an indexed table avoids touching the (often uncached) share
+directories at all.
+
+The share files themselves remain the authoritative record. The catalog is
+only trusted once a ``ShareCatalogCrawler`` has completed a full pass over
+the share directories while the catalog was being maintained. If the node
+stops without closing the catalog cleanly, the catalog is marked incomplete
+and the next crawler pass rebuilds it.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2, PY3
+if PY2:
+    # We omit anything that might end up in pickle, just in case.
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
+
+import os, struct, threading
+from functools import wraps
+
+from allmydata.util import fileutil, log
+from allmydata.util.dbutil import get_db, DBError
+from allmydata.storage.common import si_b2a
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.mutable import MutableShareFile
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32, as used for bucket directories
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(16) NOT NULL,      -- "immutable" or "mutable"
+ size INTEGER NOT NULL,               -- size of the share file in bytes
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE catalog_state
+(
+ complete INTEGER NOT NULL,  -- 1 once a full crawl has populated the catalog
+ clean INTEGER NOT NULL      -- 1 if the catalog was closed cleanly
+);
+
+INSERT INTO catalog_state (complete, clean) VALUES (0, 1);
+"""
+
+
+def storage_index_to_b32(storage_index):
+    """
+    Convert a binary storage index into the base32 form used as a key in the
+    catalog (and as the name of the bucket directory).
+    """
+    sia = si_b2a(storage_index)
+    if PY3:
+        sia = sia.decode("ascii")
+    return sia
+
+
+def get_share_catalog(dbfile):
+    """
+    Open or create the share catalog stored in ``dbfile``.
+
+    A catalog which cannot be opened is discarded and a new, empty (and so
+    incomplete) one is created in its place: the catalog can always be
+    rebuilt from the share files.
+
+    :return ShareCatalog: The opened catalog.
+    """
+    try:
+        (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                               dbname="share catalog",
+                               check_same_thread=False)
+    except DBError as e:
+        log.msg("discarding unusable share catalog: %s" % (e,),
+                facility="tahoe.storage", level=log.UNUSUAL)
+        fileutil.remove_if_possible(dbfile)
+        (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                               dbname="share catalog",
+                               check_same_thread=False)
+    return ShareCatalog(sqlite3, db)
+
+
+def _synchronized(method):
+    """
+    Make a ``ShareCatalog`` method hold the catalog's lock, since lookups
+    may come from the storage server's I/O threads.
+    """
+    @wraps(method)
+    def _locked(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return _locked
+
+
+class ShareCatalog(object):
+    """
+    I keep track of which shares a storage server holds.
+
+    Storage indexes are given to me in their base32 form (a native string),
+    the same form used for the bucket directory names.
+    """
+
+    def __init__(self, sqlite_module, connection):
+        self._lock = threading.RLock()
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.cursor.execute("SELECT complete, clean FROM catalog_state")
+        (complete, clean) = self.cursor.fetchone()
+        if not clean:
+            # We were not shut down cleanly, so some updates may have been
+            # lost: don't trust the catalog until it has been rebuilt.
+            log.msg("share catalog was not closed cleanly, will rebuild",
+                    facility="tahoe.storage", level=log.UNUSUAL)
+            complete = 0
+        self._complete = bool(complete)
+        self.mark_in_use()
+
+    @_synchronized
+    def _set_state(self, complete, clean):
+        # These are the only writes which need to survive a crash, so make
+        # them synchronous. Everything else can be rebuilt by a crawl, so the
+        # remaining writes are allowed to skip the fsync.
+        self.cursor.execute("PRAGMA synchronous = FULL")
+        self.cursor.execute("UPDATE catalog_state SET complete=?, clean=?",
+                            (int(complete), int(clean)))
+        self.connection.commit()
+        self.cursor.execute("PRAGMA synchronous = OFF")
+
+    def mark_in_use(self):
+        """
+        Record that the catalog is open and being updated. If we crash
+        before ``mark_clean`` is called, the catalog will not be trusted the
+        next time it is opened.
+        """
+        self._set_state(self._complete, False)
+
+    def mark_clean(self):
+        """
+        Record that every share change has been written to the catalog.
+        """
+        self._set_state(self._complete, True)
+
+    def mark_complete(self):
+        """
+        Record that a full crawl has brought the catalog up to date, so it
+        can be trusted to answer lookups.
+        """
+        self._complete = True
+        self._set_state(True, False)
+
+    def is_complete(self):
+        """
+        :return bool: ``True`` if lookups can be answered from the catalog
+            alone.
+        """
+        return self._complete
+
+    @_synchronized
+    def get_shares(self, storage_index_b32):
+        """
+        :return list[(int, unicode, int)]: A (shnum, sharetype, size) tuple
+            for each share held for the given storage index, ordered by share
+            number.
+        """
+        self.cursor.execute("SELECT shnum, sharetype, size FROM shares"
+                            " WHERE storage_index=? ORDER BY shnum",
+                            (storage_index_b32,))
+        return self.cursor.fetchall()
+
+    @_synchronized
+    def add_share(self, storage_index_b32, shnum, sharetype, size):
+        """
+        Record that a share exists, or update its size.
+        """
+        self.cursor.execute("INSERT OR REPLACE INTO shares"
+                            " (storage_index, shnum, sharetype, size)"
+                            " VALUES (?,?,?,?)",
+                            (storage_index_b32, shnum, sharetype, size))
+        self.connection.commit()
+
+    @_synchronized
+    def remove_share(self, storage_index_b32, shnum):
+        """
+        Record that a share no longer exists.
+        """
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (storage_index_b32, shnum))
+        self.connection.commit()
+
+    @_synchronized
+    def set_bucket(self, storage_index_b32, shares):
+        """
+        Replace everything known about a storage index.
+
+        :param list[(int, unicode, int)] shares: A (shnum, sharetype, size)
+            tuple for each share actually present in the bucket.
+        """
+        self.cursor.execute("DELETE FROM shares WHERE storage_index=?",
+                            (storage_index_b32,))
+        self.cursor.executemany("INSERT INTO shares"
+                                " (storage_index, shnum, sharetype, size)"
+                                " VALUES (?,?,?,?)",
+                                [(storage_index_b32, shnum, sharetype, size)
+                                 for (shnum, sharetype, size) in shares])
+        self.connection.commit()
+
+    @_synchronized
+    def prune_prefix(self, prefix, storage_indexes_b32):
+        """
+        Forget about any storage index which starts with ``prefix`` but is
+        not in ``storage_indexes_b32``.
+
+        :param prefix: The two-character prefix directory name.
+        :param storage_indexes_b32: The buckets present in that prefix
+            directory.
+        """
+        present = set(storage_indexes_b32)
+        self.cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, prefix + "\x7f"))
+        missing = [(si,) for (si,) in self.cursor.fetchall()
+                   if si not in present]
+        if missing:
+            self.cursor.executemany("DELETE FROM shares WHERE storage_index=?",
+                                    missing)
+            self.connection.commit()
+        return len(missing)
+
+    @_synchronized
+    def count_shares(self):
+        """
+        :return int: The number of shares in the catalog.
+        """
+        self.cursor.execute("SELECT COUNT(*) FROM shares")
+        return self.cursor.fetchone()[0]
+
+
+class ShareCatalogCrawler(ShareCrawler):
+    """I bring a ShareCatalog up to date with the share files on disk.
+
+    Each cycle I replace the catalog entries of every bucket I visit with
+    what is actually present in the bucket directory, and forget about
+    buckets which no longer exist. Once I have completed a cycle which was
+    started while the catalog was being maintained by this process, the
+    catalog is marked complete and the storage server starts answering
+    lookups from it. Later cycles repair any drift, such as shares which
+    were copied into or deleted from the share directory by hand.
+    """
+
+    minimum_cycle_time = 24*60*60 # once a day is plenty for reconciliation
+
+    def __init__(self, server, statefile, catalog):
+        self.catalog = catalog
+        self._cycle_started_here = False
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        # ["catalog-shares"]: the number of shares in the catalog at the end
+        #                     of the last complete cycle
+        self.state.setdefault("catalog-shares", None)
+
+    def started_cycle(self, cycle):
+        self._cycle_started_here = True
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        # buckets uploaded since ``buckets`` was listed are already in the
+        # catalog, and must stay there
+        self.charge_io(len(self.sharedirs))
+        self.catalog.prune_prefix(prefix, self.list_prefix_buckets(prefixdir))
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        shares = []
+        bucket_shares = self.list_bucket_shares(prefixdir, storage_index_b32)
+        self.charge_io(1)
+        for (shnum, filename) in bucket_shares:
+            self.charge_io(2, 32) # the header read and the stat
+            try:
+                if self.pack is not None and self.pack.has_share(filename):
+                    header = self.pack.read(filename, 0, 32)
+                    size = self.pack.get_size(filename)
+                else:
+                    with open(filename, "rb") as sf:
+                        header = sf.read(32)
+                    size = os.stat(filename).st_size
+            except EnvironmentError:
+                continue
+            if header[:32] == MutableShareFile.MAGIC:
+                sharetype = "mutable"
+            elif header[:4] == struct.pack(">L", 1):
+                sharetype = "immutable"
+            else:
+                continue # non-sharefile
+            shares.append((shnum, sharetype, size))
+        self.catalog.set_bucket(storage_index_b32, shares)
+
+    def finished_cycle(self, cycle):
+        if self._cycle_started_here and not self.catalog.is_complete():
+            self.catalog.mark_complete()
+        self.state["catalog-shares"] = self.catalog.count_shares()
@@ -0,0 +1,141 @@
+"""
+Make share writes durable with periodic group commits.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, sys, time, errno
+
+from twisted.application import service
+from twisted.internet import defer
+
+
+def fsync_path(path):
+    """
+    Flush ``path``, a file or a directory, to stable storage. Paths which no
+    longer exist are ignored: whatever removed them will make its own
+    commit. Directories are not synced on Windows, which cannot open them.
+    """
+    is_dir = os.path.isdir(path)
+    if is_dir and sys.platform == "win32":
+        return
+    if is_dir or sys.platform != "win32":
+        flags = os.O_RDONLY
+    else:
+        # Windows refuses to flush a read-only descriptor
+        flags = os.O_RDWR | getattr(os, "O_BINARY", 0)
+    try:
+        fd = os.open(path, flags)
+    except EnvironmentError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class GroupCommitter(service.Service):
+    """
+    I sync files and directories to disk on behalf of many writers at once.
+
+    A writer hands me the paths it changed and gets a Deferred which fires
+    once they are all on stable storage. Instead of syncing right away I
+    collect paths for ``interval`` seconds and then sync the whole batch,
+    each path once no matter how many writers asked for it. Writers are
+    acknowledged together when their batch has been committed, or all get
+    the failure if it could not be.
+
+    :ivar record_commit: If not None, called with the number of paths and
+        the number of seconds it took each time a batch is committed.
+    """
+
+    def __init__(self, interval, executor=None, clock=None,
+                 record_commit=None):
+        assert interval >= 0, interval
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.interval = interval
+        self._executor = executor
+        self._clock = clock
+        self.record_commit = record_commit
+        self._paths = set()
+        self._waiting = []
+        self._timer = None
+        self.commits = 0
+        self.synced = 0 # paths, summed over all commits
+        self.max_batch_size = 0
+
+    def sync(self, paths):
+        """
+        :param paths: The files and directories which must be synced.
+
+        :return Deferred: Fires with None once they have been.
+        """
+        d = defer.Deferred()
+        self._paths.update(paths)
+        self._waiting.append(d)
+        if self._timer is None:
+            self._timer = self._clock.callLater(self.interval, self.commit)
+        return d
+
+    def commit(self):
+        """
+        Sync everything collected so far, now.
+
+        :return Deferred: Fires when the batch has been committed.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        paths, self._paths = sorted(self._paths), set()
+        waiting, self._waiting = self._waiting, []
+        start = time.time()
+        if self._executor is None or not self._executor.running:
+            d = defer.maybeDeferred(self._sync_all, paths)
+        else:
+            d = self._executor.run(self._sync_all, paths)
+        def _committed(res):
+            self.commits += 1
+            self.synced += len(paths)
+            self.max_batch_size = max(self.max_batch_size, len(paths))
+            if self.record_commit is not None:
+                self.record_commit(len(paths), time.time() - start)
+            for w in waiting:
+                w.callback(None)
+        def _failed(f):
+            for w in waiting:
+                w.errback(f)
+        d.addCallbacks(_committed, _failed)
+        return d
+
+    def _sync_all(self, paths):
+        for path in paths:
+            fsync_path(path)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._waiting:
+            # don't leave anyone hanging
+            return self.commit()
+
+    def get_stats(self):
+        stats = {"commits": self.commits,
+                 "synced": self.synced,
+                 "max_batch_size": self.max_batch_size,
+                 "waiting": len(self._waiting),
+                 }
+        if self.commits:
+            stats["mean_batch_size"] = self.synced / self.commits
+        return stats
@@ -38,3 +38,16 @@ def storage_index_to_dir(storageindex):
         # On Python 3 we expect paths to be unicode.
         sia = sia.decode("ascii")
     return os.path.join(sia[:2], sia)
+
+def get_share_space(filename):
+    """
+    :return (int, int): The size of a share file and the disk space it uses.
+        Where the platform cannot tell us the disk usage, the size is used
+        instead.
+    """
+    s = os.stat(filename)
+    try:
+        used_space = s.st_blocks * 512
+    except AttributeError:
+        used_space = s.st_size # no stat().st_blocks on windows
+    return (s.st_size, used_space)
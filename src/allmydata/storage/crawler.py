@@ -15,19 +15,45 @@ if PY2:
     # so as not to create brittle pickles with random magic objects.
     from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
 
-import os, time, struct
+import os, re, time, struct, json
 try:
     import cPickle as pickle
 except ImportError:
     import pickle  # type: ignore
-from twisted.internet import reactor
+from twisted.internet import defer, reactor, threads
 from twisted.application import service
 from allmydata.storage.common import si_b2a
+from allmydata.storage.commit import fsync_path
 from allmydata.util import fileutil
 
+# $SHARENUM matches this regex:
+NUM_RE=re.compile("^[0-9]+$")
+
 class TimeSliceExceeded(Exception):
     pass
 
+
+def list_buckets(prefixdir):
+    """Return the sorted names of the bucket directories in a prefixdir.
+
+    Where os.scandir() is available the directory entry types are used to
+    skip anything which is not a directory, which on most filesystems does
+    not need a stat() per entry. Otherwise every entry is returned.
+    """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        buckets = os.listdir(prefixdir)
+    else:
+        it = scandir(prefixdir)
+        try:
+            buckets = [entry.name for entry in it if entry.is_dir()]
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+    buckets.sort()
+    return buckets
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -44,6 +70,20 @@ class ShareCrawler(service.MultiService):
     long enough to ensure that 'minimum_cycle_time' elapses between the start
     of two consecutive cycles.
 
+    CPU time is a poor measure of the load a crawler puts on the disks, so it
+    can also be given an I/O budget: 'max_iops' (filesystem operations per
+    second) and 'max_bytes_per_second'. Directory listings are counted by the
+    crawler itself; subclasses report the work done by process_bucket() with
+    charge_io(). A slice ends early once it has used up its share of the
+    budget, and the crawler sleeps long enough afterwards to keep the average
+    within it.
+
+    If 'prefetch_prefixes' is non-zero, that many of the upcoming prefixdirs
+    are listed ahead of time in the reactor's thread pool, so that the
+    listing I/O (which can take hundreds of milliseconds for an uncached
+    prefixdir) overlaps with the crawler's sleeps instead of stalling the
+    reactor.
+
     We assume that the normal upload/download/get_buckets traffic of a tahoe
     grid will cause the prefixdir contents to be mostly cached in the kernel,
     or that the number of buckets in each prefixdir will be small enough to
@@ -69,10 +109,20 @@ class ShareCrawler(service.MultiService):
     as timing history to allow the pace to be predicted and controlled. The
     statefile will be updated and written to disk after each time slice (just
     before the crawler yields to the reactor), and also after each cycle is
-    finished, and also when stopService() is called. Note that this means
-    that a crawler which is interrupted with SIGKILL while it is in the
-    middle of a time slice will lose progress: the next time the node is
-    started, the crawler will repeat some unknown amount of work.
+    finished, and also when stopService() is called.
+
+    Within a time slice, a snapshot of the state is appended to a journal
+    file (the statefile name plus ".journal") after a bucket or prefixdir
+    has been processed, at most once every 'checkpoint_interval' seconds.
+    The journal is discarded whenever the statefile is written. A crawler
+    which is interrupted with SIGKILL in the middle of a time slice resumes
+    from the last journal entry, so it repeats at most 'checkpoint_interval'
+    seconds of work (none at all if checkpoint_interval is 0). Checkpoints
+    and the statefile are synced to disk, so the same holds after a crash
+    or power failure, at the cost of an fsync per checkpoint. The state and
+    the journal are stored as JSON, so anything a subclass keeps in
+    self.state must be JSON-serializable, or be converted by an override of
+    serialize_state() and converted back in add_initial_state().
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
@@ -83,6 +133,12 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    max_iops = None # filesystem operations per second, None for no limit
+    max_bytes_per_second = None # bytes read per second, None for no limit
+    prefetch_prefixes = 0 # list this many prefixdirs ahead, in threads
+    # prefetched listings older than this are not trusted
+    prefetch_max_age = 60
+    checkpoint_interval = 0.1 # seconds between journal checkpoints
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -90,7 +146,16 @@ class ShareCrawler(service.MultiService):
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        # every directory the server keeps shares in, self.sharedir first
+        self.sharedirs = server.sharedirs
+        # the PackStore holding the server's packed shares, if any
+        self.pack = server.pack
+        # the server's FairScheduler, if any: clients' requests come first
+        self.scheduler = server.scheduler
         self.statefile = statefile
+        self.journalfile = statefile + ".journal"
+        self.journal = None # open for appending once we write a checkpoint
+        self.last_checkpoint_time = None
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         if PY3:
@@ -99,6 +164,10 @@ class ShareCrawler(service.MultiService):
         self.prefixes.sort()
         self.timer = None
         self.bucket_cache = (None, [])
+        self.prefetched = {} # prefix index -> (time listed, buckets)
+        self.prefetching = set() # prefix indexes being listed
+        self.slice_io_ops = 0
+        self.slice_io_bytes = 0
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
@@ -212,10 +281,10 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
-        try:
-            with open(self.statefile, "rb") as f:
-                state = pickle.load(f)
-        except Exception:
+        state = self.read_journal()
+        if state is None:
+            state = self.read_statefile()
+        if state is None:
             state = {"version": 1,
                      "last-cycle-finished": None,
                      "current-cycle": None,
@@ -231,6 +300,78 @@ class ShareCrawler(service.MultiService):
             self.last_complete_prefix_index = self.prefixes.index(lcp)
         self.add_initial_state()
 
+    def read_statefile(self):
+        try:
+            with open(self.statefile, "rb") as f:
+                data = f.read()
+        except EnvironmentError:
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            pass
+        # written by an older version, which used pickle. The next
+        # save_state() replaces it with JSON.
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def read_journal(self):
+        """Return the newest complete checkpoint in the journal, or None."""
+        try:
+            with open(self.journalfile, "rb") as f:
+                lines = f.read().split(b"\n")
+        except EnvironmentError:
+            return None
+        # the last element is an incomplete line (or empty): a checkpoint
+        # only counts once its newline has been written
+        for line in reversed(lines[:-1]):
+            try:
+                return json.loads(line.decode("utf-8"))
+            except ValueError:
+                continue
+        return None
+
+    def serialize_state(self, state):
+        """Return a JSON-serializable equivalent of 'state'.
+
+        Subclasses which keep values like tuple-keyed dictionaries in
+        self.state can override this to convert them (without modifying
+        'state'), and convert them back in add_initial_state().
+        """
+        return state
+
+    def _encode_state(self):
+        lcpi = self.last_complete_prefix_index
+        if lcpi == -1:
+            last_complete_prefix = None
+        else:
+            last_complete_prefix = self.prefixes[lcpi]
+        self.state["last-complete-prefix"] = last_complete_prefix
+        return json.dumps(self.serialize_state(self.state)).encode("utf-8")
+
+    def checkpoint(self):
+        """Append the current state to the journal, unless we did so less
+        than checkpoint_interval seconds ago."""
+        now = time.time()
+        if (self.last_checkpoint_time is not None and
+            now < self.last_checkpoint_time + self.checkpoint_interval):
+            return
+        self.last_checkpoint_time = now
+        data = self._encode_state()
+        created = False
+        if self.journal is None:
+            created = not os.path.exists(self.journalfile)
+            self.journal = open(self.journalfile, "ab")
+        # a single write of a complete line, so that a process killed during
+        # the write leaves at most a partial line behind
+        self.journal.write(data + b"\n")
+        self.journal.flush()
+        fsync_path(self.journalfile)
+        if created:
+            fsync_path(os.path.dirname(os.path.abspath(self.journalfile)))
+
     def add_initial_state(self):
         """Hook method to add extra keys to self.state when first loaded.
 
@@ -244,18 +385,21 @@ class ShareCrawler(service.MultiService):
         pass
 
     def save_state(self):
-        lcpi = self.last_complete_prefix_index
-        if lcpi == -1:
-            last_complete_prefix = None
-        else:
-            last_complete_prefix = self.prefixes[lcpi]
-        self.state["last-complete-prefix"] = last_complete_prefix
+        data = self._encode_state()
         tmpfile = self.statefile + ".tmp"
         with open(tmpfile, "wb") as f:
-            # Newer protocols won't work in Python 2; when it is dropped,
-            # protocol v4 can be used (added in Python 3.4).
-            pickle.dump(self.state, f, protocol=2)
+            f.write(data)
+        # the new statefile must be on disk before it replaces the old one,
+        # and the rename before the journal is removed
+        fsync_path(tmpfile)
         fileutil.move_into_place(tmpfile, self.statefile)
+        fsync_path(os.path.dirname(os.path.abspath(self.statefile)))
+        # everything in the journal is now older than the statefile
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        fileutil.remove_if_possible(self.journalfile)
+        self.last_checkpoint_time = time.time()
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -270,15 +414,56 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        self.prefetched.clear()
         self.save_state()
         return service.MultiService.stopService(self)
 
+    def charge_io(self, ops=1, nbytes=0):
+        """Count filesystem work against the I/O budget of this time slice.
+
+        :param int ops: The number of filesystem operations (opens, stats,
+            directory listings, reads) performed.
+        :param int nbytes: The number of bytes read.
+        """
+        self.slice_io_ops += ops
+        self.slice_io_bytes += nbytes
+
+    def should_yield(self, start_slice):
+        """Has the current time slice used up its CPU time or I/O budget, or
+        are clients waiting for the server?"""
+        if time.time() >= start_slice + self.cpu_slice:
+            return True
+        if self.scheduler is not None and self.scheduler.waiting():
+            return True
+        if (self.max_iops is not None and
+            self.slice_io_ops >= self.max_iops * self.cpu_slice):
+            return True
+        if (self.max_bytes_per_second is not None and
+            self.slice_io_bytes >= self.max_bytes_per_second * self.cpu_slice):
+            return True
+        return False
+
+    def io_sleep_time(self, this_slice):
+        """How long must we sleep after a slice which took 'this_slice'
+        seconds to stay within the I/O budget?"""
+        sleep_time = 0.0
+        if self.max_iops:
+            sleep_time = max(sleep_time,
+                             self.slice_io_ops / self.max_iops - this_slice)
+        if self.max_bytes_per_second:
+            sleep_time = max(sleep_time,
+                             self.slice_io_bytes / self.max_bytes_per_second
+                             - this_slice)
+        return sleep_time
+
     def start_slice(self):
         start_slice = time.time()
         self.timer = None
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        self.slice_io_ops = 0
+        self.slice_io_bytes = 0
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
@@ -295,6 +480,7 @@ class ShareCrawler(service.MultiService):
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
         sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        sleep_time = max(sleep_time, self.io_sleep_time(this_slice))
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -332,12 +518,9 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
+                buckets = self.get_prefix_buckets(i, prefixdir)
                 self.bucket_cache = (i, buckets)
+            self.prefetch(i+1)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
             self.last_complete_prefix_index = i
@@ -349,7 +532,8 @@ class ShareCrawler(service.MultiService):
             self.last_prefix_finished_time = now
 
             self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
+            self.checkpoint()
+            if self.should_yield(start_slice):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
@@ -361,6 +545,7 @@ class ShareCrawler(service.MultiService):
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
+        self.prefetched.clear()
         self.finished_cycle(cycle)
         self.save_state()
 
@@ -382,9 +567,119 @@ class ShareCrawler(service.MultiService):
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
             self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
+            self.checkpoint()
+            if self.should_yield(start_slice):
                 raise TimeSliceExceeded()
 
+    def get_prefix_buckets(self, i, prefixdir):
+        """Return the sorted bucket names in the i'th prefixdir, using a
+        listing prefetched by a worker thread if a recent one is available."""
+        self.charge_io(len(self.sharedirs))
+        listed = self.prefetched.pop(i, None)
+        if listed is not None:
+            (when, buckets) = listed
+            if time.time() - when < self.prefetch_max_age:
+                return buckets
+        return self.list_prefix_buckets(prefixdir)
+
+    def list_prefix_buckets(self, prefixdir):
+        """Return the sorted bucket names in a prefixdir, listed now.
+
+        The list passed to ``process_prefixdir`` may have been made by a
+        worker thread a while ago, or in an earlier time slice, so it can
+        miss buckets created since. Use this instead before concluding that
+        a bucket is gone."""
+        prefix = os.path.basename(prefixdir)
+        return self._merge_listings(
+            [self._list_prefixdir(os.path.join(sharedir, prefix))
+             for sharedir in self.sharedirs], prefix)
+
+    def _list_prefixdir(self, prefixdir):
+        # this may be run in a thread
+        try:
+            return list_buckets(prefixdir)
+        except EnvironmentError:
+            return []
+
+    def _merge_listings(self, listings, prefix):
+        # this may be run in a thread
+        if self.pack is not None:
+            # a bucket whose shares are all packed has no directory
+            listings.append(self.pack.list_buckets(prefix))
+        listings = [l for l in listings if l]
+        if len(listings) == 1:
+            return listings[0]
+        buckets = set()
+        for l in listings:
+            buckets.update(l)
+        return sorted(buckets)
+
+    def find_bucketdir(self, prefixdir, storage_index_b32):
+        """Return the directory holding a bucket's share files: the one in
+        whichever share directory has it, or the one under ``prefixdir`` if
+        none does."""
+        prefix = os.path.basename(prefixdir)
+        if len(self.sharedirs) > 1:
+            for sharedir in self.sharedirs:
+                bucketdir = os.path.join(sharedir, prefix, storage_index_b32)
+                if os.path.isdir(bucketdir):
+                    return bucketdir
+        return os.path.join(prefixdir, storage_index_b32)
+
+    def list_bucket_shares(self, prefixdir, storage_index_b32):
+        """Return a sorted list of (shnum, filename) tuples for the shares
+        in a bucket, in any share directory, including the packed ones.
+        Packed shares have the filename their share file would have had."""
+        prefix = os.path.basename(prefixdir)
+        shares = {}
+        if self.pack is not None:
+            bucketdir = os.path.join(prefixdir, storage_index_b32)
+            for shnum in self.pack.list_shares(storage_index_b32):
+                shares[shnum] = os.path.join(bucketdir, "%d" % shnum)
+        for sharedir in self.sharedirs:
+            bucketdir = os.path.join(sharedir, prefix, storage_index_b32)
+            try:
+                filenames = os.listdir(bucketdir)
+            except EnvironmentError:
+                continue
+            for f in filenames:
+                if NUM_RE.match(f):
+                    shares[int(f)] = os.path.join(bucketdir, f)
+        return sorted(shares.items())
+
+    def share_exists(self, filename):
+        """Is there a share (in a file of its own, or packed) called
+        ``filename``?"""
+        if self.pack is not None and self.pack.has_share(filename):
+            return True
+        return os.path.exists(filename)
+
+    def prefetch(self, first):
+        """Start listing the prefixdirs after 'first' in worker threads."""
+        if not self.prefetch_prefixes or not self.running:
+            return
+        last = min(first + self.prefetch_prefixes, len(self.prefixes))
+        for i in range(first, last):
+            if i in self.prefetched or i in self.prefetching:
+                continue
+            self.prefetching.add(i)
+            prefix = self.prefixes[i]
+            # each share directory is listed in a thread of its own, so
+            # several disks are read at once
+            d = defer.gatherResults([
+                threads.deferToThread(self._list_prefixdir,
+                                      os.path.join(sharedir, prefix))
+                for sharedir in self.sharedirs])
+            d.addCallback(self._merge_listings, prefix)
+            d.addCallback(self._prefetched, i)
+            # the reactor thread will list it again when it gets there
+            d.addErrback(lambda f, i=i: self.prefetching.discard(i))
+
+    def _prefetched(self, buckets, i):
+        self.prefetching.discard(i)
+        if self.running:
+            self.prefetched[i] = (time.time(), buckets)
+
     # the remaining methods are explictly for subclasses to implement.
 
     def started_cycle(self, cycle):
@@ -481,6 +776,10 @@ class BucketCountingCrawler(ShareCrawler):
         self.state.setdefault("bucket-counts", {})
         self.state.setdefault("last-complete-bucket-count", None)
         self.state.setdefault("storage-index-samples", {})
+        # JSON turned the cycle numbers into strings
+        self.state["bucket-counts"] = dict(
+            (int(cycle), counts) for (cycle, counts)
+            in self.state["bucket-counts"].items())
 
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         # we override process_prefixdir() because we don't want to look at
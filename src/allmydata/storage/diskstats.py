@@ -0,0 +1,124 @@
+"""
+Remember disk statistics for a while instead of asking the OS every time.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from twisted.application import service
+from twisted.internet import task
+
+from allmydata.util import fileutil, log
+
+
+class DiskStatsCache(service.Service):
+    """
+    I remember what ``fileutil.get_disk_stats`` said about the disk holding
+    ``whichdir`` for up to ``ttl`` seconds.
+
+    While I am running I refresh the statistics in the background (in a
+    thread, if I have an ``IOExecutor``), so that asking for them costs
+    nothing. If they are ever older than ``ttl`` anyway, ``get`` refreshes
+    them itself.
+
+    Space known to have been used since the last refresh can be subtracted
+    with ``consume``, so that a burst of uploads cannot overcommit the disk
+    before the next refresh notices.
+    """
+
+    def __init__(self, whichdir, reserved_space, ttl, executor=None,
+                 clock=None):
+        assert ttl > 0, ttl
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._whichdir = whichdir
+        self._reserved_space = reserved_space
+        self.ttl = ttl
+        self._executor = executor
+        self._clock = clock
+        self._fetched = None # when the stats were fetched
+        self._stats = None
+        self._error = None # what get_disk_stats raised instead
+        self._loop = None
+        self._refreshing = False
+        self.refreshes = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop = task.LoopingCall(self.refresh)
+        self._loop.clock = self._clock
+        # often enough that get() never finds them out of date
+        self._loop.start(self.ttl / 2, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def _fetch(self):
+        try:
+            return (fileutil.get_disk_stats(self._whichdir,
+                                            self._reserved_space), None)
+        except (AttributeError, EnvironmentError) as e:
+            return (None, e)
+
+    def _store(self, fetched, result):
+        self._fetched = fetched
+        (self._stats, self._error) = result
+        self.refreshes += 1
+
+    def refresh(self):
+        """
+        Fetch the statistics again, in a thread if I have an executor.
+        """
+        if self._refreshing:
+            return
+        fetched = self._clock.seconds()
+        if self._executor is None or not self._executor.running:
+            self._store(fetched, self._fetch())
+            return
+        self._refreshing = True
+        d = self._executor.run(self._fetch)
+        def _done(result):
+            self._refreshing = False
+            # a synchronous refresh may have overtaken this one
+            if self._fetched is None or fetched >= self._fetched:
+                self._store(fetched, result)
+        d.addCallback(_done)
+        d.addErrback(log.err, "refreshing disk statistics")
+
+    def get(self):
+        """
+        :return: The dict ``fileutil.get_disk_stats`` returned, at most
+            ``ttl`` seconds ago.
+
+        :raise: Whatever ``fileutil.get_disk_stats`` raised instead.
+        """
+        if (self._fetched is None or
+            self._clock.seconds() - self._fetched >= self.ttl):
+            self._store(self._clock.seconds(), self._fetch())
+        if self._error is not None:
+            raise self._error
+        return dict(self._stats)
+
+    def consume(self, nbytes):
+        """
+        Account for ``nbytes`` having been written to the disk since the
+        statistics were fetched.
+        """
+        if self._stats is None:
+            return
+        for key in ('free_for_root', 'free_for_nonroot', 'avail'):
+            if key in self._stats:
+                self._stats[key] = max(self._stats[key] - nbytes, 0)
+        if 'used' in self._stats:
+            self._stats['used'] += nbytes
@@ -0,0 +1,193 @@
+"""
+Run storage server disk I/O in a thread pool, off the reactor thread.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import time
+
+from twisted.application import service
+from twisted.internet import defer, threads
+from twisted.python.threadpool import ThreadPool
+
+from allmydata.storage.scheduler import PRIORITY_READ
+
+
+class IOExecutor(service.Service):
+    """
+    I run blocking disk operations in a bounded pool of threads.
+
+    Operations given the same key run one after another, in the order they
+    were submitted, so that (for example) a mutable slot's test-and-set is
+    never interleaved with another write or read of the same slot.
+    Operations with different keys, or with no key, run concurrently.
+
+    Everything except the operation itself (including the callbacks on the
+    Deferreds I return) happens on the reactor thread. Nothing runs until I
+    have been started.
+
+    :ivar record_wait: If not None, called on the reactor thread with the
+        number of seconds each operation waited before a thread started it.
+
+    :ivar scheduler: If not None, a ``FairScheduler`` which decides when the
+        operations submitted with ``run_for`` (as ``call_io`` does) start.
+    """
+
+    def __init__(self, name, num_threads, reactor=None, record_wait=None):
+        assert num_threads > 0, num_threads
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._name = name
+        self._pool = ThreadPool(minthreads=0, maxthreads=num_threads,
+                                name=name)
+        self.num_threads = num_threads
+        self.record_wait = record_wait
+        self.scheduler = None
+        self._locks = {} # key -> DeferredLock
+        self.queued = 0 # submitted but not yet started by a thread
+        self.in_progress = 0 # (not .running, which Service uses)
+
+    def startService(self):
+        service.Service.startService(self)
+        if self._pool.joined:
+            # a stopped pool cannot be started again
+            self._pool = ThreadPool(minthreads=0, maxthreads=self.num_threads,
+                                    name=self._name)
+        self._pool.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if not self._pool.joined:
+            # this waits for the operations already running
+            self._pool.stop()
+
+    def run(self, f, *args, **kwargs):
+        """
+        Call ``f(*args, **kwargs)`` in a thread.
+
+        :return Deferred: Fires with the result, on the reactor thread.
+        """
+        submitted = time.time()
+        self.queued += 1
+        def _in_thread():
+            started = time.time()
+            self._reactor.callFromThread(self._started, started - submitted)
+            return f(*args, **kwargs)
+        d = threads.deferToThreadPool(self._reactor, self._pool, _in_thread)
+        def _finished(res):
+            self.in_progress -= 1
+            return res
+        d.addBoth(_finished)
+        return d
+
+    def request_for(self, client, priority):
+        """
+        :param client: The tubid of the client the operation is for, or None
+            if it is not known.
+
+        :return: What ``run_for`` needs to queue an operation of
+            ``priority`` for ``client``, or None if I have no scheduler.
+        """
+        if self.scheduler is None:
+            return None
+        return (client, priority)
+
+    def run_for(self, request, f, *args, **kwargs):
+        """
+        Like ``run``, but wait for my scheduler to start the operation, on
+        behalf of ``request`` (from ``request_for``). If ``request`` is None
+        the operation starts right away.
+        """
+        if self.scheduler is None or request is None:
+            return self.run(f, *args, **kwargs)
+        (client, priority) = request
+        return self.scheduler.submit(client, priority, self.run, f,
+                                     *args, **kwargs)
+
+    def _started(self, waited):
+        self.queued -= 1
+        self.in_progress += 1
+        if self.record_wait is not None:
+            self.record_wait(waited)
+
+    def serialize(self, key, f, *args, **kwargs):
+        """
+        Call ``f(*args, **kwargs)`` once every operation submitted earlier
+        with the same key has finished, and hold later ones back until the
+        Deferred it returns has fired. ``f`` runs on the reactor thread and
+        uses ``run`` for its blocking parts.
+        """
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = defer.DeferredLock()
+        d = lock.run(f, *args, **kwargs)
+        def _forget(res):
+            if (self._locks.get(key) is lock and
+                not lock.locked and not lock.waiting):
+                del self._locks[key]
+            return res
+        d.addBoth(_forget)
+        return d
+
+    def is_busy(self, key):
+        """
+        :return bool: Whether an operation submitted with ``serialize`` for
+            ``key`` has yet to finish.
+        """
+        return key in self._locks
+
+    def run_serially(self, key, f, *args, **kwargs):
+        """
+        Like ``run``, but ordered with the other operations for ``key``.
+        """
+        return self.serialize(key, self.run, f, *args, **kwargs)
+
+    def get_stats(self):
+        return {"threads": self.num_threads,
+                "queued": self.queued,
+                "running": self.in_progress,
+                "serialized_keys": len(self._locks),
+                }
+
+
+def call_io(executor, key, io, then=None, priority=PRIORITY_READ,
+            client=None):
+    """
+    Run ``io``, a callable doing blocking disk I/O, and pass its result to
+    ``then`` (if given) on the reactor thread.
+
+    :param executor: An ``IOExecutor``, or None to do everything
+        synchronously.
+    :param key: Passed to ``IOExecutor.run_serially``, or None to run ``io``
+        without ordering it against anything else.
+    :param priority: What kind of operation this is, for the executor's
+        scheduler.
+    :param client: The tubid of the client the operation is for, for the
+        executor's scheduler, or None if it is not known.
+
+    :return: The result of ``then`` (or of ``io``) if ``executor`` is None,
+        otherwise a Deferred which fires with it.
+    """
+    if executor is None:
+        result = io()
+        if then is not None:
+            result = then(result)
+        return result
+    request = executor.request_for(client, priority)
+    if key is None:
+        d = executor.run_for(request, io)
+    else:
+        d = executor.serialize(key, executor.run_for, request, io)
+    if then is not None:
+        d.addCallback(then)
+    return d
@@ -9,12 +9,20 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
 
 import time, os, pickle, struct
+from twisted.application import service
+from twisted.internet import reactor
 from allmydata.storage.crawler import ShareCrawler
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.pack import PackedShareFile
+from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      UnknownImmutableContainerVersionError
 from twisted.python import log as twlog
 
+# the time between a lease being granted or renewed and its expiration time,
+# see LeaseInfo.get_grant_renew_time_time
+GRANT_TO_EXPIRATION = 31*24*60*60
+
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
     and which have expired. I can remove the expired leases (if so
@@ -53,6 +61,10 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
+    If I am given a LeaseDB which has finished migrating, I read the leases
+    of each prefix from it instead of opening every share file, and only
+    open the shares which have leases to cancel.
+
     """
 
     slow_start = 360 # wait 6 minutes after startup
@@ -62,8 +74,12 @@ class LeaseCheckingCrawler(ShareCrawler):
                  expiration_enabled, mode,
                  override_lease_duration, # used if expiration_mode=="age"
                  cutoff_date, # used if expiration_mode=="cutoff-date"
-                 sharetypes):
+                 sharetypes,
+                 lease_db=None):
         self.historyfile = historyfile
+        self.lease_db = lease_db
+        # the lease database's view of the prefix being processed, if any
+        self._prefix_shares = None
         self.expiration_enabled = expiration_enabled
         self.mode = mode
         self.override_lease_duration = None
@@ -90,6 +106,18 @@ class LeaseCheckingCrawler(ShareCrawler):
         # the keys individually
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
+        # undo serialize_state(): JSON has only string keys and no tuples
+        so_far = self.state["cycle-to-date"]
+        lah = so_far["lease-age-histogram"]
+        if isinstance(lah, list):
+            so_far["lease-age-histogram"] = dict(((minage, maxage), count)
+                                                 for (minage, maxage, count)
+                                                 in lah)
+        so_far["leases-per-share-histogram"] = dict(
+            (int(k), v) for (k, v)
+            in so_far["leases-per-share-histogram"].items())
+        so_far["corrupt-shares"] = [tuple(which)
+                                    for which in so_far["corrupt-shares"]]
 
         # initialize history
         if not os.path.exists(self.historyfile):
@@ -99,6 +127,14 @@ class LeaseCheckingCrawler(ShareCrawler):
                 # protocol v4 can be used (added in Python 3.4).
                 pickle.dump(history, f, protocol=2)
 
+    def serialize_state(self, state):
+        so_far = state["cycle-to-date"].copy()
+        so_far["lease-age-histogram"] = self.convert_lease_age_histogram(
+            so_far["lease-age-histogram"])
+        state = state.copy()
+        state["cycle-to-date"] = so_far
+        return state
+
     def create_empty_cycle_dict(self):
         recovered = self.create_empty_recovered_dict()
         so_far = {"corrupt-shares": [],
@@ -119,72 +155,259 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+        # space recovered by the LeaseExpiryQueue while we were sleeping
+        # between cycles counts towards this one
+        between = self.state.pop("recovered-between-cycles", {})
+        rec = self.state["cycle-to-date"]["space-recovered"]
+        for k in between:
+            self.increment(rec, k, between[k])
 
     def stat(self, fn):
         return os.stat(fn)
 
+    def stat_bucketdir(self, bucketdir):
+        try:
+            return self.stat(bucketdir)
+        except EnvironmentError:
+            # a bucket whose shares are all packed has no directory
+            return None
+
+    def get_share_space(self, sf):
+        """Return the (sharebytes, diskbytes) used by share file ``sf``."""
+        if isinstance(sf, PackedShareFile):
+            return sf.get_space()
+        return self.share_space(self.stat(sf.home))
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        # Once the lease database holds every share, examine this prefix's
+        # leases with a single range query instead of opening every share.
+        if self.lease_db is not None and self.lease_db.is_migrated():
+            self._prefix_shares = self.lease_db.get_prefix_shares(prefix)
+        try:
+            ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                           buckets, start_slice)
+        finally:
+            self._prefix_shares = None
+
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
-        bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
+        bucketdir = self.find_bucketdir(prefixdir, storage_index_b32)
+        if self._prefix_shares is not None:
+            shares = self._prefix_shares.get(storage_index_b32, {})
+            self.process_bucket_from_lease_db(bucketdir, storage_index_b32,
+                                              shares)
+            return
+        s = self.stat_bucketdir(bucketdir)
         would_keep_shares = []
-        wks = None
 
-        for fn in os.listdir(bucketdir):
-            try:
-                shnum = int(fn)
-            except ValueError:
-                continue # non-numeric means not a sharefile
-            sharefile = os.path.join(bucketdir, fn)
-            try:
-                wks = self.process_share(sharefile)
-            except (UnknownMutableContainerVersionError,
-                    UnknownImmutableContainerVersionError,
-                    struct.error):
-                twlog.msg("lease-checker error processing %s" % sharefile)
-                twlog.err()
-                which = (storage_index_b32, shnum)
-                self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+        self.charge_io(2) # the stat and the listing
+        for (shnum, sharefile) in self.list_bucket_shares(prefixdir,
+                                                          storage_index_b32):
+            would_keep_shares.append(
+                self.process_share_file(sharefile, storage_index_b32, shnum))
+
+        self.finished_bucket(would_keep_shares, lambda: s)
+
+    def process_bucket_from_lease_db(self, bucketdir, storage_index_b32,
+                                     shares):
+        """Examine a bucket using the leases recorded in the lease database.
+        Only shares which have a lease to cancel are opened: their leases are
+        re-read from the share file itself before anything is removed."""
+        now = time.time()
+        would_keep_shares = []
+        for shnum in sorted(shares):
+            (sharetype, size, used_space, leases) = shares[shnum]
+            leases = [LeaseInfo(owner_num, None, None, expiration_time)
+                      for (owner_num, expiration_time) in leases]
+            if self.expiration_enabled and [li for li in leases
+                                            if self.is_expired(sharetype,
+                                                               li, now)]:
+                sharefile = os.path.join(bucketdir, "%d" % shnum)
+                if not self.share_exists(sharefile):
+                    # deleted behind our back
+                    self.lease_db.remove_share(storage_index_b32, shnum)
+                    continue
+                wks = self.process_share_file(sharefile, storage_index_b32,
+                                              shnum)
+            else:
+                wks = self.process_leases(sharetype, size, used_space, leases,
+                                          None, now)
             would_keep_shares.append(wks)
 
+        self.finished_bucket(would_keep_shares,
+                             lambda: self.stat_bucketdir(bucketdir))
+
+    def process_share_file(self, sharefile, storage_index_b32, shnum):
+        self.charge_io(1)
+        try:
+            wks = self.process_share(sharefile)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            twlog.msg("lease-checker error processing %s" % sharefile)
+            twlog.err()
+            which = (storage_index_b32, shnum)
+            self.state["cycle-to-date"]["corrupt-shares"].append(which)
+            wks = (1, 1, 1, "unknown")
+        if not wks[2]:
+            # the last lease was cancelled, which deleted the share
+            self.server.share_removed(storage_index_b32, shnum)
+        return wks
+
+    def finished_bucket(self, would_keep_shares, stat_bucketdir):
         sharetype = None
-        if wks:
+        if would_keep_shares:
             # use the last share's sharetype as the buckettype
-            sharetype = wks[3]
+            sharetype = would_keep_shares[-1][3]
         rec = self.state["cycle-to-date"]["space-recovered"]
         self.increment(rec, "examined-buckets", 1)
         if sharetype:
             self.increment(rec, "examined-buckets-"+sharetype, 1)
-        del wks
 
+        kept = [sum([wks[i] for wks in would_keep_shares]) for i in range(3)]
+        if 0 not in kept:
+            return # no space recovered, so don't bother with the stat
+        s = stat_bucketdir()
         try:
-            bucket_diskbytes = s.st_blocks * 512
+            bucket_diskbytes = s.st_blocks * 512 if s is not None else 0
         except AttributeError:
             bucket_diskbytes = 0 # no stat().st_blocks on windows
-        if sum([wks[0] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("original", bucket_diskbytes, sharetype)
-        if sum([wks[1] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
-        if sum([wks[2] for wks in would_keep_shares]) == 0:
-            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
+        for (i, a) in enumerate(("original", "configured", "actual")):
+            if kept[i] == 0:
+                self.increment_bucketspace(a, bucket_diskbytes, sharetype)
+
+    def is_expired(self, sharetype, li, now):
+        """Is this lease expired according to our configuration?"""
+        if sharetype not in self.sharetypes_to_expire:
+            return False
+        if self.mode == "age":
+            age_limit = li.get_expiration_time()
+            if self.override_lease_duration is not None:
+                age_limit = self.override_lease_duration
+            return now - li.get_grant_renew_time_time() > age_limit
+        assert self.mode == "cutoff-date"
+        return li.get_grant_renew_time_time() < self.cutoff_date
+
+    def get_expiration_cutoff(self, now):
+        """
+        :return: A time such that (for the share types we expire) exactly
+            those leases with an expiration time before it are expired
+            according to our configuration at time ``now``.
+        """
+        if self.mode == "age":
+            if self.override_lease_duration is not None:
+                # now - grant_renew_time > override_lease_duration
+                return (now - self.override_lease_duration
+                        + GRANT_TO_EXPIRATION)
+            # now - grant_renew_time > expiration_time
+            return (now + GRANT_TO_EXPIRATION) / 2
+        assert self.mode == "cutoff-date"
+        # grant_renew_time < cutoff_date
+        return self.cutoff_date + GRANT_TO_EXPIRATION
+
+    def get_due_time(self, expiration_time):
+        """
+        :return: The time at which a lease which expires at
+            ``expiration_time`` will be expired according to our
+            configuration, or None if that will never happen.
+        """
+        if self.mode == "age":
+            if self.override_lease_duration is not None:
+                return (expiration_time - GRANT_TO_EXPIRATION
+                        + self.override_lease_duration)
+            return 2 * expiration_time - GRANT_TO_EXPIRATION
+        assert self.mode == "cutoff-date"
+        if expiration_time < self.cutoff_date + GRANT_TO_EXPIRATION:
+            return 0 # already expired
+        return None
+
+    def expire_share(self, sharefile, storage_index_b32, shnum, now):
+        """Cancel the expired leases on a share which the LeaseExpiryQueue
+        found in the lease database, and count the space recovered if that
+        deleted the share."""
+        if self.state["current-cycle"] is None:
+            rec = self.state.setdefault("recovered-between-cycles",
+                                        self.create_empty_recovered_dict())
+        else:
+            rec = self.state["cycle-to-date"]["space-recovered"]
+        bucketdir = os.path.dirname(sharefile)
+        try:
+            sf = get_share_file(sharefile, self.lease_db, self.pack)
+            sharetype = sf.sharetype
+            space = self.get_share_space(sf)
+            bucket_s = self.stat_bucketdir(bucketdir)
+            expired = [li for li in sf.get_leases()
+                       if self.is_expired(sharetype, li, now)]
+            if not expired:
+                # the lease database was out of date
+                self.lease_db.record_share(sf)
+                return
+            for li in expired:
+                sf.cancel_lease(li.cancel_secret)
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            twlog.msg("lease-expirer error processing %s" % sharefile)
+            twlog.err()
+            which = (storage_index_b32, shnum)
+            self.state["cycle-to-date"]["corrupt-shares"].append(which)
+            # don't look at it again
+            self.lease_db.remove_share(storage_index_b32, shnum)
+            return
+        except EnvironmentError:
+            # deleted behind our back
+            self.lease_db.remove_share(storage_index_b32, shnum)
+            return
+        if sf.exists():
+            return # some of its leases are still valid
+        self.server.share_removed(storage_index_b32, shnum)
+        (sharebytes, diskbytes) = space
+        self.increment_space("actual", sharebytes, diskbytes, sharetype, rec)
+        prefixdir = os.path.dirname(bucketdir)
+        if not self.list_bucket_shares(prefixdir, storage_index_b32):
+            try:
+                bucket_diskbytes = (bucket_s.st_blocks * 512
+                                    if bucket_s is not None else 0)
+            except AttributeError:
+                bucket_diskbytes = 0 # no stat().st_blocks on windows
+            self.increment_bucketspace("actual", bucket_diskbytes, sharetype,
+                                       rec)
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        sf = get_share_file(sharefilename, self.lease_db, self.pack)
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
+        (sharebytes, diskbytes) = self.get_share_space(sf)
+        return self.process_leases(sharetype, sharebytes, diskbytes,
+                                   list(sf.get_leases()), sf, now)
 
+    def share_space(self, s):
+        sharebytes = s.st_size
+        try:
+            # note that stat(2) says that st_blocks is 512 bytes, and that
+            # st_blksize is "optimal file sys I/O ops blocksize", which is
+            # independent of the block-size that st_blocks uses.
+            diskbytes = s.st_blocks * 512
+        except AttributeError:
+            # the docs say that st_blocks is only on linux. I also see it on
+            # MacOS. But it isn't available on windows.
+            diskbytes = sharebytes
+        return (sharebytes, diskbytes)
+
+    def process_leases(self, sharetype, sharebytes, diskbytes, leases, sf,
+                       now):
+        """Gather statistics about one share's leases, and cancel the expired
+        ones if expiration is enabled (and ``sf``, the share file, is
+        given)."""
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
-            grant_renew_time = li.get_grant_renew_time_time()
-            age = li.get_age()
+            age = now - li.get_grant_renew_time_time()
             self.add_lease_age_to_histogram(age)
 
             #  expired-or-not according to original expiration time
@@ -192,60 +415,40 @@ class LeaseCheckingCrawler(ShareCrawler):
                 num_valid_leases_original += 1
 
             #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
-
-            if expired:
+            if self.is_expired(sharetype, li, now):
                 expired_leases_configured.append(li)
             else:
                 num_valid_leases_configured += 1
 
         so_far = self.state["cycle-to-date"]
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
-        self.increment_space("examined", s, sharetype)
+        self.increment_space("examined", sharebytes, diskbytes, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
 
-        if self.expiration_enabled:
+        if self.expiration_enabled and sf is not None:
             for li in expired_leases_configured:
                 sf.cancel_lease(li.cancel_secret)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
-            self.increment_space("original", s, sharetype)
+            self.increment_space("original", sharebytes, diskbytes, sharetype)
 
         if num_valid_leases_configured == 0:
             would_keep_share[1] = 0
-            self.increment_space("configured", s, sharetype)
+            self.increment_space("configured", sharebytes, diskbytes,
+                                 sharetype)
             if self.expiration_enabled:
                 would_keep_share[2] = 0
-                self.increment_space("actual", s, sharetype)
+                self.increment_space("actual", sharebytes, diskbytes,
+                                     sharetype)
 
         return would_keep_share
 
-    def increment_space(self, a, s, sharetype):
-        sharebytes = s.st_size
-        try:
-            # note that stat(2) says that st_blocks is 512 bytes, and that
-            # st_blksize is "optimal file sys I/O ops blocksize", which is
-            # independent of the block-size that st_blocks uses.
-            diskbytes = s.st_blocks * 512
-        except AttributeError:
-            # the docs say that st_blocks is only on linux. I also see it on
-            # MacOS. But it isn't available on windows.
-            diskbytes = sharebytes
-        so_far_sr = self.state["cycle-to-date"]["space-recovered"]
+    def increment_space(self, a, sharebytes, diskbytes, sharetype,
+                        so_far_sr=None):
+        if so_far_sr is None:
+            so_far_sr = self.state["cycle-to-date"]["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
         self.increment(so_far_sr, a+"-diskbytes", diskbytes)
@@ -254,8 +457,10 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
             self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
 
-    def increment_bucketspace(self, a, bucket_diskbytes, sharetype):
-        rec = self.state["cycle-to-date"]["space-recovered"]
+    def increment_bucketspace(self, a, bucket_diskbytes, sharetype,
+                              rec=None):
+        if rec is None:
+            rec = self.state["cycle-to-date"]["space-recovered"]
         self.increment(rec, a+"-diskbytes", bucket_diskbytes)
         self.increment(rec, a+"-buckets", 1)
         if sharetype:
@@ -437,3 +642,99 @@ class LeaseCheckingCrawler(ShareCrawler):
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+
+class LeaseExpiryQueue(service.Service):
+    """I cancel leases as soon as they expire, instead of waiting for the
+    LeaseCheckingCrawler to reach them on its way around the share
+    directories. Shares left without leases are deleted.
+
+    The expiration-time index of the LeaseDB is my queue: I sleep until the
+    earliest lease in it is due according to the lease checker's
+    configuration, then cancel the leases which have lapsed. The lease
+    database tells me when leases are added or renewed, so that a new lease
+    which will expire sooner than the one I am waiting for wakes me earlier.
+
+    The lease checker keeps crawling, to gather the statistics shown on the
+    status page; the space I recover is added to its results.
+    """
+
+    slow_start = 60 # wait a minute after startup
+    # cancel the leases on at most this many shares before letting the
+    # reactor run again
+    batch_size = 100
+    # look at the queue at least this often
+    max_sleep = 60*60
+
+    def __init__(self, lease_checker, lease_db):
+        self.lease_checker = lease_checker
+        self.lease_db = lease_db
+        self.timer = None
+        self.next_wake_time = None
+
+    def startService(self):
+        self.lease_db.watch_expirations(self.lease_changed)
+        self.schedule(self.slow_start)
+        service.Service.startService(self)
+
+    def stopService(self):
+        self.lease_db.unwatch_expirations(self.lease_changed)
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.next_wake_time = None
+        return service.Service.stopService(self)
+
+    def schedule(self, delay):
+        if self.timer:
+            self.timer.cancel()
+        self.next_wake_time = time.time() + delay
+        self.timer = reactor.callLater(delay, self.wake)
+
+    def lease_changed(self, expiration_time):
+        """A lease which expires at ``expiration_time`` has been added or
+        renewed."""
+        if self.timer is None:
+            return # we're busy, or stopped
+        due_time = self.lease_checker.get_due_time(expiration_time)
+        if due_time is not None and due_time < self.next_wake_time:
+            self.schedule(max(0, due_time - time.time()))
+
+    def wake(self):
+        self.timer = None
+        self.next_wake_time = None
+        if not self.lease_db.is_migrated():
+            # the database doesn't know about every share yet
+            self.schedule(self.max_sleep)
+            return
+        now = time.time()
+        if self.expire_due_shares(now) == self.batch_size:
+            # there may be more
+            self.schedule(0)
+            return
+        delay = self.max_sleep
+        earliest = self.lease_db.get_earliest_expiration_time(
+            self.lease_checker.sharetypes_to_expire)
+        if earliest is not None:
+            due_time = self.lease_checker.get_due_time(earliest)
+            if due_time is not None:
+                delay = max(0, min(delay, due_time - now))
+        self.schedule(delay)
+
+    def expire_due_shares(self, now):
+        """Cancel the leases which are expired at time ``now``, for up to
+        ``batch_size`` shares.
+
+        :return int: The number of shares examined.
+        """
+        lc = self.lease_checker
+        shares = self.lease_db.get_expiring_shares(
+            lc.get_expiration_cutoff(now), lc.sharetypes_to_expire,
+            self.batch_size)
+        for (storage_index_b32, shnum) in shares:
+            bucketdir = lc.find_bucketdir(
+                os.path.join(lc.sharedir, storage_index_b32[:2]),
+                storage_index_b32)
+            sharefile = os.path.join(bucketdir, "%d" % shnum)
+            lc.expire_share(sharefile, storage_index_b32, shnum, now)
+        return len(shares)
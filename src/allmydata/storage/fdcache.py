@@ -0,0 +1,207 @@
+"""
+A bounded cache of open, read-only share file descriptors.
+
+Without it every ``BucketReader.remote_read`` and ``slot_readv`` opens the
+share file, seeks, reads and closes it again. With it the read path for a
+hot share is a single ``pread``.
+
+A cached descriptor refers to the file's inode, so writes made through other
+descriptors (new leases, mutable share writes) are visible through it. The
+descriptor must be dropped when the file is unlinked or replaced, which is
+what ``invalidate`` is for.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, threading
+from collections import OrderedDict
+
+
+def pread(fd, length, offset):
+    """
+    Read up to ``length`` bytes from ``fd`` starting at ``offset``, without
+    using or moving the descriptor's file position (except on platforms
+    without ``os.pread``). Fewer bytes are returned only at the end of the
+    file.
+    """
+    if not hasattr(os, "pread"):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return _read_fully(lambda n, o: os.read(fd, n), length, offset)
+    return _read_fully(lambda n, o: os.pread(fd, n, o), length, offset)
+
+def _read_fully(read, length, offset):
+    chunks = []
+    while length > 0:
+        data = read(length, offset)
+        if not data:
+            break
+        chunks.append(data)
+        length -= len(data)
+        offset += len(data)
+    return b"".join(chunks)
+
+
+class CachedFile(object):
+    """
+    A read-only file-like view of a share file whose descriptor is held by a
+    ``FileDescriptorCache``. Only the methods the share file classes use are
+    provided. The descriptor stays open while I am open, even if the cache
+    drops it in the meantime; closing me leaves it open in the cache.
+    """
+
+    def __init__(self, cache, entry):
+        self._cache = cache
+        self._entry = entry
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._entry is not None:
+            self._cache._unpin(self._entry)
+            self._entry = None
+
+    def fileno(self):
+        return self._entry.fd
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._entry.fd).st_size
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def read(self, length):
+        data = pread(self._entry.fd, length, self._position)
+        self._position += len(data)
+        return data
+
+
+class _Entry(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.pins = 0 # readers using the descriptor right now
+        self.dropped = False # no longer in the cache: close when unpinned
+
+
+class FileDescriptorCache(object):
+    """
+    I keep up to ``max_size`` share files open for reading, closing the least
+    recently used one to make room for another.
+
+    I may be used from several threads at once. A descriptor which is dropped
+    while another thread is reading from it is only closed once that read
+    has finished, so its number cannot be reused for another file under the
+    reader's feet.
+    """
+
+    def __init__(self, max_size):
+        assert max_size > 0, max_size
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # filename -> _Entry, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __del__(self):
+        try:
+            self.close_all()
+        except Exception:
+            pass # the interpreter is shutting down
+
+    def _pin(self, filename):
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[filename] = entry
+                entry.pins += 1
+                return entry
+        # open the file without holding the lock
+        fd = os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is None:
+                entry = _Entry(fd)
+                while len(self._entries) >= self.max_size:
+                    (_, old) = self._entries.popitem(last=False)
+                    self._drop(old)
+                    self.evictions += 1
+            else:
+                # another thread opened it meanwhile
+                os.close(fd)
+            self._entries[filename] = entry
+            entry.pins += 1
+            return entry
+
+    def _unpin(self, entry):
+        with self._lock:
+            entry.pins -= 1
+            if entry.dropped and not entry.pins:
+                os.close(entry.fd)
+
+    def _drop(self, entry):
+        # the caller holds the lock
+        entry.dropped = True
+        if not entry.pins:
+            os.close(entry.fd)
+
+    def open_file(self, filename):
+        """
+        :return CachedFile: A file-like object for reading ``filename``.
+
+        :raise EnvironmentError: If the file cannot be opened, just like
+            ``open`` would.
+        """
+        return CachedFile(self, self._pin(filename))
+
+    def pread(self, filename, length, offset):
+        entry = self._pin(filename)
+        try:
+            return pread(entry.fd, length, offset)
+        finally:
+            self._unpin(entry)
+
+    def invalidate(self, filename):
+        """
+        Drop the cached descriptor for ``filename``, if there is one. This
+        must be done before the file is unlinked or replaced.
+        """
+        with self._lock:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                self._drop(entry)
+
+    def close_all(self):
+        with self._lock:
+            while self._entries:
+                (_, entry) = self._entries.popitem()
+                self._drop(entry)
+
+    def get_stats(self):
+        with self._lock:
+            return {"open": len(self._entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    }
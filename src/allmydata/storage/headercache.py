@@ -0,0 +1,147 @@
+"""
+A cache of the beginnings of mutable shares.
+
+A servermap update starts by reading the first few kilobytes of every share
+of a mutable file: the header, sequence number, root hash, signature and
+offset table, and usually the share hash chain too. For directories which
+are read often these reads are the most common storage requests of all.
+With this cache they are answered from memory until the share is written
+to again.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import threading
+from collections import OrderedDict
+
+
+class MutableHeaderCache(object):
+    """
+    I remember the first bytes of the data of mutable shares, as returned by
+    the reads starting at offset 0 which clients make, and answer any read
+    vector which falls within them. I hold up to ``max_bytes`` of data,
+    evicting the least recently used shares first, and no more than
+    ``max_bytes / 16`` of any one share.
+
+    The server must call ``invalidate`` once it has written to a share (or
+    deleted it). A read which was already under way then is not cached,
+    since it may have seen the data before the write.
+
+    I may be used from several threads at once.
+    """
+
+    def __init__(self, max_bytes):
+        assert max_bytes > 0, max_bytes
+        self.max_bytes = max_bytes
+        self.max_entry_size = max_bytes // 16
+        self._lock = threading.Lock()
+        # (storage_index, shnum) -> (prefix, complete), least recently used
+        # first. If complete is True, prefix is all of the share's data.
+        self._entries = OrderedDict()
+        # (storage_index, shnum) -> [reads in progress, invalidated since]
+        self._reading = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def readv(self, storage_index, shnum, readv, read):
+        """
+        :param readv: A list of ``(offset, length)`` tuples.
+        :param read: A callable which reads ``readv`` from the share, and
+            returns a list of the data read, if I cannot answer it myself.
+
+        :return: A list of the data read.
+        """
+        key = (storage_index, shnum)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                datav = self._answer(entry, readv)
+                if datav is not None:
+                    self.hits += 1
+                    self._entries[key] = self._entries.pop(key)
+                    return datav
+            self.misses += 1
+            reading = self._reading.setdefault(key, [0, False])
+            reading[0] += 1
+        datav = None
+        try:
+            datav = read()
+            return datav
+        finally:
+            with self._lock:
+                reading[0] -= 1
+                if not reading[0]:
+                    del self._reading[key]
+                if datav is not None and not reading[1]:
+                    self._remember(key, readv, datav)
+
+    def _answer(self, entry, readv):
+        (prefix, complete) = entry
+        datav = []
+        for (offset, length) in readv:
+            if not complete and offset + length > len(prefix):
+                return None
+            datav.append(prefix[offset:offset+length])
+        return datav
+
+    def _remember(self, key, readv, datav):
+        best = None
+        for ((offset, length), data) in zip(readv, datav):
+            if offset == 0 and length > 0:
+                # a short read means the end of the data was reached
+                entry = (data, len(data) < length)
+                if best is None or len(data) > len(best[0]):
+                    best = entry
+        if best is None:
+            return
+        (prefix, complete) = best
+        if len(prefix) > self.max_entry_size:
+            (prefix, complete) = (prefix[:self.max_entry_size], False)
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[0])
+            if len(old[0]) > len(prefix):
+                (prefix, complete) = old
+        self._entries[key] = (prefix, complete)
+        self.bytes += len(prefix)
+        while self.bytes > self.max_bytes:
+            (_, (old_prefix, _)) = self._entries.popitem(last=False)
+            self.bytes -= len(old_prefix)
+            self.evictions += 1
+
+    def invalidate(self, storage_index, shnum):
+        """
+        Forget what I know about a share, which has just been written to or
+        deleted.
+        """
+        key = (storage_index, shnum)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= len(entry[0])
+                self.invalidations += 1
+            reading = self._reading.get(key)
+            if reading is not None:
+                reading[1] = True
+
+    def get_stats(self):
+        with self._lock:
+            return {"entries": len(self._entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    }
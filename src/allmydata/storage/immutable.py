@@ -11,11 +11,12 @@ from future.utils import PY2, bytes_to_native_str
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import os, stat, struct, time
+import os, stat, struct, time, errno
 
 from collections_extended import RangeMap
 
 from foolscap.api import Referenceable
+from twisted.internet import defer
 
 from zope.interface import implementer
 from allmydata.interfaces import (
@@ -26,7 +27,12 @@ from allmydata.util import base32, fileutil, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.common import UnknownImmutableContainerVersionError
+from allmydata.storage.common import (
+    UnknownImmutableContainerVersionError, get_share_space,
+)
+from allmydata.storage.executor import call_io
+from allmydata.storage.scheduler import PRIORITY_WRITE
+from allmydata.storage.readahead import SequentialReadAhead
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -53,15 +59,23 @@ from allmydata.storage.common import UnknownImmutableContainerVersionError
 # then the value stored in this field will be the actual share data length
 # modulo 2**32.
 
+# What preallocating a share file fails with when the disk (or the user's
+# quota) is full.
+NO_SPACE_ERRNOS = tuple(getattr(errno, name) for name in ("ENOSPC", "EDQUOT")
+                        if hasattr(errno, name))
+
 class ShareFile(object):
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, lease_db=None,
+                 fd_cache=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If lease_db is not None then lease changes are written through to that LeaseDB. If fd_cache is not None then reads use the FileDescriptorCache instead of opening the file each time. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._lease_db = lease_db
+        self._fd_cache = fd_cache
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -81,9 +95,8 @@ class ShareFile(object):
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            with open(self.home, 'rb') as f:
-                filesize = os.path.getsize(self.home)
-                (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
+            (filesize, header) = self._read_header()
+            (version, unused, num_leases) = struct.unpack(">LLL", header)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -92,9 +105,54 @@ class ShareFile(object):
             self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
         self._data_offset = 0xc
 
+    def _read_header(self):
+        with self._open_for_read() as f:
+            return (os.fstat(f.fileno()).st_size, f.read(0xc))
+
+    def _open(self, mode):
+        return open(self.home, mode)
+
+    def _open_for_read(self):
+        if self._fd_cache is None:
+            return self._open('rb')
+        return self._fd_cache.open_file(self.home)
+
+    def _invalidate_fd(self):
+        if self._fd_cache is not None:
+            self._fd_cache.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate_fd()
         os.unlink(self.home)
 
+    def exists(self):
+        return os.path.exists(self.home)
+
+    def get_space(self):
+        return get_share_space(self.home)
+
+    def preallocate(self):
+        """
+        Have the filesystem reserve blocks for the whole share data area, so
+        that writing the share data later cannot run out of space. Nothing
+        happens where the platform or filesystem cannot do this.
+
+        :raise EnvironmentError: With an errno in ``NO_SPACE_ERRNOS`` if
+            there is not enough space.
+        """
+        if not hasattr(os, "posix_fallocate"):
+            return
+        fd = os.open(self.home, os.O_RDWR)
+        try:
+            # the leases already sit beyond the data, so this never changes
+            # the size of the file
+            os.posix_fallocate(fd, 0, self._lease_offset)
+        except EnvironmentError as e:
+            if e.errno in NO_SPACE_ERRNOS:
+                raise
+        finally:
+            os.close(fd)
+
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
@@ -103,6 +161,8 @@ class ShareFile(object):
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return b""
+        if self._fd_cache is not None:
+            return self._fd_cache.pread(self.home, actuallength, seekpos)
         with open(self.home, 'rb') as f:
             f.seek(seekpos)
             return f.read(actuallength)
@@ -112,7 +172,7 @@ class ShareFile(object):
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
-        with open(self.home, 'rb+') as f:
+        with self._open('rb+') as f:
             real_offset = self._data_offset+offset
             f.seek(real_offset)
             assert f.tell() == real_offset
@@ -134,11 +194,12 @@ class ShareFile(object):
         f.write(struct.pack(">L", num_leases))
 
     def _truncate_leases(self, f, num_leases):
+        self._invalidate_fd()
         f.truncate(self._lease_offset + num_leases * self.LEASE_SIZE)
 
     def get_leases(self):
         """Yields a LeaseInfo instance for all leases."""
-        with open(self.home, 'rb') as f:
+        with self._open('rb') as f:
             (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
             f.seek(self._lease_offset)
             for i in range(num_leases):
@@ -147,10 +208,11 @@ class ShareFile(object):
                     yield LeaseInfo().from_immutable_data(data)
 
     def add_lease(self, lease_info):
-        with open(self.home, 'rb+') as f:
+        with self._open('rb+') as f:
             num_leases = self._read_num_leases(f)
             self._write_lease_record(f, num_leases, lease_info)
             self._write_num_leases(f, num_leases+1)
+        self._record_leases()
 
     def renew_lease(self, renew_secret, new_expire_time):
         for i,lease in enumerate(self.get_leases()):
@@ -159,8 +221,9 @@ class ShareFile(object):
                 if new_expire_time > lease.expiration_time:
                     # yes
                     lease.expiration_time = new_expire_time
-                    with open(self.home, 'rb+') as f:
+                    with self._open('rb+') as f:
                         self._write_lease_record(f, i, lease)
+                    self._record_leases()
                 return
         raise IndexError("unable to renew non-existent lease")
 
@@ -193,23 +256,43 @@ class ShareFile(object):
             # the same order as they were added, so that if we crash while
             # doing this, we won't lose any non-cancelled leases.
             leases = [l for l in leases if l] # remove the cancelled leases
-            with open(self.home, 'rb+') as f:
+            with self._open('rb+') as f:
                 for i, lease in enumerate(leases):
                     self._write_lease_record(f, i, lease)
                 self._write_num_leases(f, len(leases))
                 self._truncate_leases(f, len(leases))
         space_freed = self.LEASE_SIZE * num_leases_removed
         if not len(leases):
-            space_freed += os.stat(self.home)[stat.ST_SIZE]
+            space_freed += self.get_space()[0]
             self.unlink()
+        self._record_leases()
         return space_freed
 
+    def _record_leases(self):
+        if self._lease_db is not None:
+            self._lease_db.record_share(self)
+
 
 @implementer(RIBucketWriter)
 class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 executor=None, committer=None, preallocate=False, pack=None,
+                 client=None):
         self.ss = ss
+        # writes to this share are ordered by running them on the executor
+        # under the key self.incominghome
+        self._executor = executor
+        # the tubid of the uploader, whose turn the executor's scheduler
+        # waits for
+        self._client = client
+        # if given, a GroupCommitter which must sync the share before we
+        # acknowledge its close
+        self._committer = committer
+        # if given, a PackStore the finished share goes into, instead of
+        # being moved to finalhome
+        self._pack = pack
+        self._packed_into = None # the pack segment file it went into
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
@@ -219,6 +302,12 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        if preallocate:
+            try:
+                self._sharefile.preallocate()
+            except EnvironmentError:
+                self._remove_incoming()
+                raise
         self._already_written = RangeMap()
 
     def allocated_size(self):
@@ -230,26 +319,51 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
         if self.throw_out_all_data:
             return
 
-        # Make sure we're not conflicting with existing data:
-        end = offset + len(data)
-        for (chunk_start, chunk_stop, _) in self._already_written.ranges(offset, end):
-            chunk_len = chunk_stop - chunk_start
-            actual_chunk = self._sharefile.read_share_data(chunk_start, chunk_len)
-            writing_chunk = data[chunk_start - offset:chunk_stop - offset]
-            if actual_chunk != writing_chunk:
-                raise ConflictingWriteError(
-                    "Chunk {}-{} doesn't match already written data.".format(chunk_start, chunk_stop)
-                )
-        self._sharefile.write_share_data(offset, data)
-
-        self._already_written.set(True, offset, end)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        def _write():
+            # Make sure we're not conflicting with existing data:
+            end = offset + len(data)
+            for (chunk_start, chunk_stop, _) in self._already_written.ranges(offset, end):
+                chunk_len = chunk_stop - chunk_start
+                actual_chunk = self._sharefile.read_share_data(chunk_start, chunk_len)
+                writing_chunk = data[chunk_start - offset:chunk_stop - offset]
+                if actual_chunk != writing_chunk:
+                    raise ConflictingWriteError(
+                        "Chunk {}-{} doesn't match already written data.".format(chunk_start, chunk_stop)
+                    )
+            self._sharefile.write_share_data(offset, data)
+
+            self._already_written.set(True, offset, end)
+        def _written(ign):
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        return call_io(self._executor, self.incominghome, _write, _written,
+                       priority=PRIORITY_WRITE, client=self._client)
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
-
+        # no more writes or aborts may be queued behind this
+        self.closed = True
+        try:
+            filelen = call_io(self._executor, self.incominghome, self._close,
+                              priority=PRIORITY_WRITE, client=self._client)
+        except BaseException:
+            self._close_failed()
+            raise
+        if self._executor is None:
+            return self._closed(filelen, start)
+        d = filelen
+        d.addErrback(lambda f: self._close_failed().addCallback(lambda ign: f))
+        d.addCallback(self._closed, start)
+        return d
+
+    def _close(self):
+        if self._pack is not None:
+            with open(self.incominghome, 'rb') as f:
+                data = f.read()
+            self._packed_into = self._pack.put(self.finalhome, data)
+            self._remove_incoming()
+            return len(data)
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
         try:
@@ -276,13 +390,46 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
+        return os.stat(self.finalhome)[stat.ST_SIZE]
+
+    def _close_failed(self):
+        # The share could not be moved into place. Since we are closed,
+        # neither an abort nor a disconnection will clean up after us, so
+        # give back the space we were allocated and throw the upload away.
         self._sharefile = None
-        self.closed = True
+        self.ss.bucket_writer_closed(self, 0)
+        return call_io(self._executor, self.incominghome,
+                       self._discard_incoming, priority=PRIORITY_WRITE,
+                       client=self._client)
 
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
+    def _discard_incoming(self):
+        try:
+            if os.path.exists(self.incominghome):
+                self._remove_incoming()
+        except EnvironmentError:
+            # what went wrong with the close is what the uploader hears about
+            pass
+
+    def _closed(self, filelen, start):
+        self._sharefile = None
         self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
+        d = None
+        if self._committer is not None:
+            # The share's data, and its new name in the bucket directory
+            # (which may itself be new in its prefix directory), must reach
+            # the disk before the uploader is told the share is safe.
+            if self._packed_into is not None:
+                d = self._committer.sync([self._packed_into])
+            else:
+                bucketdir = os.path.dirname(self.finalhome)
+                d = self._committer.sync([self.finalhome, bucketdir,
+                                          os.path.dirname(bucketdir)])
+        def _done(ign=None):
+            self.ss.add_latency("close", time.time() - start)
+            self.ss.count("close")
+        if d is None:
+            return _done()
+        return d.addCallback(_done)
 
     def disconnected(self):
         if not self.closed:
@@ -291,34 +438,54 @@ class BucketWriter(Referenceable):  # type: ignore # warner/foolscap#78
     def remote_abort(self):
         log.msg("storage: aborting sharefile %s" % self.incominghome,
                 facility="tahoe.storage", level=log.UNUSUAL)
-        self._abort()
         self.ss.count("abort")
+        return self._abort()
 
     def _abort(self):
         if self.closed:
             return
 
+        # We are now considered closed for further writing.
+        self.closed = True
+
+        def _removed(ign):
+            self._sharefile = None
+            # We must tell the storage server about this so that it stops
+            # expecting us to use the space it allocated for us earlier.
+            self.ss.bucket_writer_closed(self, 0)
+        return call_io(self._executor, self.incominghome,
+                       self._remove_incoming, _removed,
+                       priority=PRIORITY_WRITE, client=self._client)
+
+    def _remove_incoming(self):
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
-        self._sharefile = None
-
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
-        self.ss.bucket_writer_closed(self, 0)
 
 
 @implementer(RIBucketReader)
 class BucketReader(Referenceable):  # type: ignore # warner/foolscap#78
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 fd_cache=None, executor=None, pack=None, block_cache=None,
+                 read_ahead=0, read_ahead_stats=None, client=None):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        self._fd_cache = fd_cache
+        self._pack = pack
+        self._share_file = self._open(sharefname)
+        self._executor = executor
+        # the tubid of the downloader, whose turn the executor's scheduler
+        # waits for
+        self._client = client
+        self._block_cache = block_cache
+        self._read_ahead = None
+        if read_ahead:
+            self._read_ahead = SequentialReadAhead(self._read, read_ahead,
+                                                   executor, read_ahead_stats,
+                                                   client=client)
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -329,12 +496,55 @@ class BucketReader(Referenceable):  # type: ignore # warner/foolscap#78
                                ),
                                self.shnum)
 
+    def _open(self, sharefname):
+        if self._pack is not None and self._pack.has_share(sharefname):
+            return self._pack.open_share(sharefname)
+        return ShareFile(sharefname, fd_cache=self._fd_cache)
+
+    def _read(self, offset, length):
+        try:
+            return self._share_file.read_share_data(offset, length)
+        except EnvironmentError as e:
+            if e.errno != errno.ENOENT or self.storage_index is None:
+                raise
+            # the share may have been moved to another share directory
+            sharefname = self.ss.find_share(self.storage_index, self.shnum)
+            if sharefname is None:
+                raise
+            self._share_file = self._open(sharefname)
+            return self._share_file.read_share_data(offset, length)
+
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        cache = self._block_cache
+        def _done(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        if cache is not None:
+            data = cache.get(self.storage_index, self.shnum, offset, length)
+            if data is not None:
+                if self._read_ahead is not None:
+                    self._read_ahead.skipped(offset, length)
+                # no need to wait for an I/O thread
+                if self._executor is None:
+                    return _done(data)
+                return defer.succeed(_done(data))
+        if self._read_ahead is not None:
+            def _read_done(data):
+                if cache is not None:
+                    cache.put(self.storage_index, self.shnum, offset, length,
+                              data)
+                return _done(data)
+            return self._read_ahead.read(offset, length, _read_done)
+        def _read():
+            data = self._read(offset, length)
+            if cache is not None:
+                cache.put(self.storage_index, self.shnum, offset, length,
+                          data)
+            return data
+        return call_io(self._executor, None, _read, _done,
+                       client=self._client)
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share(b"immutable",
@@ -0,0 +1,373 @@
+"""
+An indexed record of the leases held on a storage server's shares.
+
+Normally the only record of a lease is in the share file it applies to, so
+the lease checker has to open and parse every share on the server to find
+out which leases have expired. The lease database keeps a copy of each
+share's leases (and its size) in an SQLite table indexed by storage index and
+by expiration time, so that questions like "which shares in this prefix have
+expired leases?" become range queries.
+
+The share files remain the authoritative record. Lease changes made through a
+``ShareFile`` or ``MutableShareFile`` which was given the database are
+written through to it, and a ``LeaseMigrationCrawler`` copies the leases of
+existing shares into it once. Until that has completed the database is not
+used to make expiry decisions, and even afterwards a share is only deleted
+after its leases have been re-read from the share file itself.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    # We omit anything that might end up in pickle, just in case.
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, range, str, max, min  # noqa: F401
+
+import os, struct
+
+from allmydata.util import fileutil, log
+from allmydata.util.dbutil import get_db, DBError
+from allmydata.storage.common import UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.shares import get_share_file
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32, as used for bucket directories
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(16) NOT NULL,      -- "immutable" or "mutable"
+ size INTEGER NOT NULL,               -- size of the share file in bytes
+ used_space INTEGER NOT NULL,         -- disk space used by the share file
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,
+ shnum INTEGER NOT NULL,
+ owner_num INTEGER NOT NULL,
+ expiration_time INTEGER NOT NULL,    -- seconds since epoch
+ FOREIGN KEY (storage_index, shnum) REFERENCES shares (storage_index, shnum)
+   ON DELETE CASCADE
+);
+
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+CREATE INDEX leases_by_expiration_time ON leases (expiration_time);
+
+CREATE TABLE leasedb_state
+(
+ migrated INTEGER NOT NULL  -- 1 once every existing share has been recorded
+);
+
+INSERT INTO leasedb_state (migrated) VALUES (0);
+"""
+
+
+def get_lease_db(dbfile):
+    """
+    Open or create the lease database stored in ``dbfile``.
+
+    A database which cannot be opened is discarded and a new, empty (and so
+    unmigrated) one is created in its place.
+
+    :return LeaseDB: The opened database.
+    """
+    try:
+        (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                               dbname="lease database")
+    except DBError as e:
+        log.msg("discarding unusable lease database: %s" % (e,),
+                facility="tahoe.storage", level=log.UNUSUAL)
+        fileutil.remove_if_possible(dbfile)
+        (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                               dbname="lease database")
+    return LeaseDB(sqlite3, db)
+
+
+class LeaseDB(object):
+    """
+    I keep a copy of the leases on a storage server's shares.
+
+    Storage indexes are given to me in their base32 form (a native string),
+    the same form used for the bucket directory names. Every change is
+    committed before the method which made it returns: a lease renewal which
+    was lost in a crash could otherwise let a share be expired early.
+    """
+
+    def __init__(self, sqlite_module, connection):
+        self.sqlite_module = sqlite_module
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.cursor.execute("SELECT migrated FROM leasedb_state")
+        self._migrated = bool(self.cursor.fetchone()[0])
+        self._expiration_watchers = []
+
+    def watch_expirations(self, callback):
+        """
+        Arrange for ``callback`` to be called with the earliest expiration
+        time of a share's leases whenever they are recorded.
+        """
+        self._expiration_watchers.append(callback)
+
+    def unwatch_expirations(self, callback):
+        self._expiration_watchers.remove(callback)
+
+    def is_migrated(self):
+        """
+        :return bool: ``True`` once every share which existed before the
+            database was created has been recorded in it.
+        """
+        return self._migrated
+
+    def mark_migrated(self):
+        self._migrated = True
+        self.cursor.execute("UPDATE leasedb_state SET migrated=1")
+        self.connection.commit()
+
+    def _add_share(self, storage_index_b32, shnum, sharetype, size,
+                   used_space):
+        # An INSERT OR REPLACE would delete the share's leases along with the
+        # old row.
+        self.cursor.execute("UPDATE shares SET sharetype=?, size=?,"
+                            " used_space=?"
+                            " WHERE storage_index=? AND shnum=?",
+                            (sharetype, size, used_space,
+                             storage_index_b32, shnum))
+        if self.cursor.rowcount == 0:
+            self.cursor.execute("INSERT INTO shares"
+                                " (storage_index, shnum, sharetype, size,"
+                                "  used_space)"
+                                " VALUES (?,?,?,?,?)",
+                                (storage_index_b32, shnum, sharetype, size,
+                                 used_space))
+
+    def add_share(self, storage_index_b32, shnum, sharetype, size, used_space):
+        """
+        Record that a share exists, or update its size. Its leases are left
+        alone.
+        """
+        self._add_share(storage_index_b32, shnum, sharetype, size, used_space)
+        self.connection.commit()
+
+    def set_share(self, storage_index_b32, shnum, sharetype, size, used_space,
+                  leases):
+        """
+        Record a share and replace all of its leases.
+
+        :param list[(int, int)] leases: An (owner_num, expiration_time) tuple
+            for each lease on the share.
+        """
+        self._add_share(storage_index_b32, shnum, sharetype, size, used_space)
+        self.cursor.execute("DELETE FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (storage_index_b32, shnum))
+        self.cursor.executemany("INSERT INTO leases"
+                                " (storage_index, shnum, owner_num,"
+                                "  expiration_time)"
+                                " VALUES (?,?,?,?)",
+                                [(storage_index_b32, shnum, owner_num,
+                                  int(expiration_time))
+                                 for (owner_num, expiration_time) in leases])
+        self.connection.commit()
+        if leases:
+            earliest = min([int(expiration_time)
+                            for (owner_num, expiration_time) in leases])
+            for callback in self._expiration_watchers[:]:
+                callback(earliest)
+
+    def record_share(self, share):
+        """
+        Copy the current leases of a share file into the database, or forget
+        the share if its file has been deleted.
+
+        :param share: A ``ShareFile`` or ``MutableShareFile``.
+        """
+        (bucketdir, shnum) = os.path.split(share.home)
+        storage_index_b32 = os.path.basename(bucketdir)
+        shnum = int(shnum)
+        if not share.exists():
+            self.remove_share(storage_index_b32, shnum)
+            return
+        (size, used_space) = share.get_space()
+        leases = [(lease.owner_num, lease.get_expiration_time())
+                  for lease in share.get_leases()]
+        self.set_share(storage_index_b32, shnum, share.sharetype, size,
+                       used_space, leases)
+
+    def remove_share(self, storage_index_b32, shnum):
+        """
+        Record that a share (and so its leases) no longer exists.
+        """
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (storage_index_b32, shnum))
+        self.connection.commit()
+
+    def prune_prefix(self, prefix, storage_indexes_b32):
+        """
+        Forget about any storage index which starts with ``prefix`` but is
+        not in ``storage_indexes_b32``.
+        """
+        present = set(storage_indexes_b32)
+        self.cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, prefix + "\x7f"))
+        missing = [(si,) for (si,) in self.cursor.fetchall()
+                   if si not in present]
+        if missing:
+            self.cursor.executemany("DELETE FROM shares WHERE storage_index=?",
+                                    missing)
+            self.connection.commit()
+        return len(missing)
+
+    def get_prefix_shares(self, prefix):
+        """
+        Describe every share whose storage index starts with ``prefix``.
+
+        :return dict: Maps each base32 storage index to a dict which maps
+            share numbers to a (sharetype, size, used_space, leases) tuple,
+            where leases is a list of (owner_num, expiration_time) tuples.
+        """
+        buckets = {}
+        self.cursor.execute("SELECT storage_index, shnum, sharetype, size,"
+                            " used_space FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, prefix + "\x7f"))
+        for (si, shnum, sharetype, size, used_space) in self.cursor.fetchall():
+            buckets.setdefault(si, {})[shnum] = (sharetype, size, used_space,
+                                                 [])
+        self.cursor.execute("SELECT storage_index, shnum, owner_num,"
+                            " expiration_time FROM leases"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, prefix + "\x7f"))
+        for (si, shnum, owner_num, expiration_time) in self.cursor.fetchall():
+            buckets[si][shnum][3].append((owner_num, expiration_time))
+        return buckets
+
+    def _sharetype_clause(self, sharetypes):
+        # Most servers expire both kinds of share, and then the shares table
+        # need not be consulted at all.
+        sharetypes = sorted(set(sharetypes))
+        if sharetypes == ["immutable", "mutable"]:
+            return ("", ())
+        return (" AND EXISTS (SELECT 1 FROM shares"
+                "  WHERE shares.storage_index = leases.storage_index"
+                "  AND shares.shnum = leases.shnum"
+                "  AND shares.sharetype IN (%s))"
+                % (",".join("?" * len(sharetypes)),),
+                tuple(sharetypes))
+
+    def get_expiring_shares(self, before, sharetypes, limit):
+        """
+        Find the shares with a lease which expires before ``before``.
+
+        :param sharetypes: Only shares of these types are returned.
+        :param int limit: Return at most this many shares.
+
+        :return list[(unicode, int)]: The base32 storage index and share
+            number of each share, in order of their earliest expiration time.
+        """
+        (clause, args) = self._sharetype_clause(sharetypes)
+        self.cursor.execute("SELECT storage_index, shnum,"
+                            " MIN(expiration_time) AS earliest FROM leases"
+                            " WHERE expiration_time < ?" + clause +
+                            " GROUP BY storage_index, shnum"
+                            " ORDER BY earliest LIMIT ?",
+                            (before,) + args + (limit,))
+        return [(si, shnum) for (si, shnum, earliest)
+                in self.cursor.fetchall()]
+
+    def get_earliest_expiration_time(self, sharetypes):
+        """
+        :return: The earliest expiration time of any lease on a share of one
+            of the given types, or None if there are no such leases.
+        """
+        (clause, args) = self._sharetype_clause(sharetypes)
+        self.cursor.execute("SELECT MIN(expiration_time) FROM leases"
+                            " WHERE 1" + clause, args)
+        return self.cursor.fetchone()[0]
+
+    def count_shares(self):
+        """
+        :return int: The number of shares in the database.
+        """
+        self.cursor.execute("SELECT COUNT(*) FROM shares")
+        return self.cursor.fetchone()[0]
+
+    def count_leases(self):
+        """
+        :return int: The number of leases in the database.
+        """
+        self.cursor.execute("SELECT COUNT(*) FROM leases")
+        return self.cursor.fetchone()[0]
+
+
+class LeaseMigrationCrawler(ShareCrawler):
+    """I copy the leases of every existing share into a LeaseDB, once.
+
+    Shares which are created or have their leases changed while I am running
+    are written through to the database by the storage server. Once I have
+    completed a cycle which was started in this process every share is
+    accounted for: I mark the database migrated and remove myself from the
+    storage server.
+    """
+
+    slow_start = 0
+
+    def __init__(self, server, statefile, lease_db):
+        self.lease_db = lease_db
+        self._cycle_started_here = False
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        # ["migrated-shares"]: the number of shares in the database when the
+        #                      migration finished, or None
+        self.state.setdefault("migrated-shares", None)
+
+    def started_cycle(self, cycle):
+        self._cycle_started_here = True
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        # the server has written through the leases of buckets uploaded
+        # since ``buckets`` was listed, and they must stay
+        self.charge_io(len(self.sharedirs))
+        self.lease_db.prune_prefix(prefix, self.list_prefix_buckets(prefixdir))
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucket_shares = self.list_bucket_shares(prefixdir, storage_index_b32)
+        self.charge_io(1)
+        for (shnum, filename) in bucket_shares:
+            self.charge_io(1)
+            try:
+                sf = get_share_file(filename, pack=self.pack)
+                self.lease_db.record_share(sf)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error, EnvironmentError):
+                # the lease checker will report it as corrupt
+                log.msg(format="lease migration unable to read share"
+                        " %(si)s-%(shnum)d", si=storage_index_b32, shnum=shnum,
+                        facility="tahoe.storage", level=log.UNUSUAL)
+
+    def finished_cycle(self, cycle):
+        if not self._cycle_started_here:
+            # A previous process started this cycle, and may have changed
+            # leases without recording them. Go around again.
+            return
+        self.lease_db.mark_migrated()
+        self.state["migrated-shares"] = self.lease_db.count_shares()
+        self.disownServiceParent()
@@ -19,7 +19,7 @@ from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     DataTooLargeError
+     DataTooLargeError, get_share_space
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 
 
@@ -67,11 +67,12 @@ class MutableShareFile(object):
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, lease_db=None, fd_cache=None):
         self.home = filename
+        self._fd_cache = fd_cache # reads use it if not None
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
-            with open(self.home, 'rb') as f:
+            with self._open_for_read() as f:
                 data = f.read(self.HEADER_SIZE)
             (magic,
              write_enabler_nodeid, write_enabler,
@@ -82,6 +83,7 @@ class MutableShareFile(object):
                       (filename, magic, self.MAGIC)
                 raise UnknownMutableContainerVersionError(msg)
         self.parent = parent # for logging
+        self._lease_db = lease_db # lease changes are written through to it
 
     def log(self, *args, **kwargs):
         return self.parent.log(*args, **kwargs)
@@ -106,9 +108,25 @@ class MutableShareFile(object):
             f.write(struct.pack(">L", num_extra_leases))
             # extra leases go here, none at creation
 
+    def _open_for_read(self):
+        if self._fd_cache is None:
+            return open(self.home, 'rb')
+        return self._fd_cache.open_file(self.home)
+
+    def _invalidate_fd(self):
+        if self._fd_cache is not None:
+            self._fd_cache.invalidate(self.home)
+
     def unlink(self):
+        self._invalidate_fd()
         os.unlink(self.home)
 
+    def exists(self):
+        return os.path.exists(self.home)
+
+    def get_space(self):
+        return get_share_space(self.home)
+
     def _read_data_length(self, f):
         f.seek(self.DATA_LENGTH_OFFSET)
         (data_length,) = struct.unpack(">Q", f.read(8))
@@ -160,6 +178,7 @@ class MutableShareFile(object):
         if new_extra_lease_offset < old_extra_lease_offset:
             # TODO: allow containers to shrink. For now they remain large.
             return
+        self._invalidate_fd()
         num_extra_leases = self._read_num_extra_leases(f)
         f.seek(old_extra_lease_offset)
         leases_size = 4 + num_extra_leases * self.LEASE_SIZE
@@ -297,6 +316,7 @@ class MutableShareFile(object):
                 self._write_lease_record(f, empty_slot, lease_info)
             else:
                 self._write_lease_record(f, num_lease_slots, lease_info)
+        self._record_leases()
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
@@ -308,6 +328,8 @@ class MutableShareFile(object):
                         # yes
                         lease.expiration_time = new_expire_time
                         self._write_lease_record(f, leasenum, lease)
+                        f.close()
+                        self._record_leases()
                     return
                 accepting_nodeids.add(lease.nodeid)
         # Return the accepting_nodeids set, to give the client a chance to
@@ -357,6 +379,7 @@ class MutableShareFile(object):
                 if not remaining:
                     freed_space += os.stat(self.home)[stat.ST_SIZE]
                     self.unlink()
+                self._record_leases()
                 return freed_space
 
         msg = ("Unable to cancel non-existent lease. I have leases "
@@ -366,6 +389,10 @@ class MutableShareFile(object):
         msg += " ."
         raise IndexError(msg)
 
+    def _record_leases(self):
+        if self._lease_db is not None:
+            self._lease_db.record_share(self)
+
     def _pack_leases(self, f):
         # TODO: reclaim space from cancelled leases
         return 0
@@ -382,7 +409,7 @@ class MutableShareFile(object):
 
     def readv(self, readv):
         datav = []
-        with open(self.home, 'rb') as f:
+        with self._open_for_read() as f:
             for (offset, length) in readv:
                 datav.append(self._read_share_data(f, offset, length))
         return datav
@@ -449,9 +476,10 @@ class EmptyShare(object):
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             lease_db=None, fd_cache=None):
     ms = MutableShareFile(filename, parent)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, lease_db, fd_cache)
 
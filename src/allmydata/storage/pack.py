@@ -0,0 +1,473 @@
+"""
+A log-structured store for small immutable shares.
+
+Normally every share is a file of its own, in a directory of its own. A grid
+full of small files uses an inode (and usually a whole disk block) per share
+and makes anything which walks the share directories slow. When a storage
+server packs small shares, each one is instead appended, as the exact bytes
+its share file would have held, to one of a few large segment files, and an
+SQLite index maps (storage index, share number) to the segment, offset and
+length of its record. Larger shares are still stored as plain files.
+
+A packed share keeps the name its share file would have had, which is how
+the rest of the storage server refers to it. ``PackedShareFile`` can be used
+wherever a ``ShareFile`` can.
+
+Records are never changed in size where they lie: a share whose leases grow
+or shrink is appended again and its old record becomes dead space. Deleting
+a share (when its last lease is cancelled or expires) also leaves dead space
+behind. Segments which are mostly dead are compacted in the background by
+copying their live records to the end of the store and removing them.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, errno, threading
+from io import BytesIO
+
+from twisted.application import service
+from twisted.internet import defer, task
+
+from allmydata.util import fileutil, log
+from allmydata.util.dbutil import get_db
+from allmydata.storage.common import UnknownImmutableContainerVersionError
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.immutable import ShareFile
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE segments
+(
+ segment INTEGER PRIMARY KEY,
+ size INTEGER NOT NULL,  -- bytes committed to the segment file
+ dead INTEGER NOT NULL   -- how many of them belong to no share any more
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL,  -- base32, as used for bucket directories
+ shnum INTEGER NOT NULL,
+ segment INTEGER NOT NULL,
+ offset INTEGER NOT NULL,
+ length INTEGER NOT NULL,
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX segment_shares ON shares (segment);
+"""
+
+# A new segment file is started once the current one reaches this size.
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+# Segments with at least this fraction of dead bytes are compacted.
+DEFAULT_COMPACTION_THRESHOLD = 0.5
+
+# How often, in seconds, to look for segments to compact.
+DEFAULT_COMPACTION_INTERVAL = 60 * 60
+
+
+def _no_such_share(filename):
+    return IOError(errno.ENOENT, "no such packed share", filename)
+
+
+class PackStore(service.Service):
+    """
+    I keep small immutable shares in segment files under ``packdir``.
+
+    Shares are named by the path their share file would have under
+    ``sharedir`` (``$SHAREDIR/$START/$STORAGEINDEX/$SHNUM``).
+
+    I may be used from several threads at once. While I am running I
+    compact segments every ``compaction_interval`` seconds, in a thread if I
+    have an ``IOExecutor``.
+    """
+
+    def __init__(self, packdir, sharedir,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 compaction_threshold=DEFAULT_COMPACTION_THRESHOLD,
+                 compaction_interval=DEFAULT_COMPACTION_INTERVAL,
+                 executor=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        fileutil.make_dirs(packdir)
+        self.packdir = packdir
+        self.sharedir = sharedir
+        self.segment_size = segment_size
+        self.compaction_threshold = compaction_threshold
+        self.compaction_interval = compaction_interval
+        self._executor = executor
+        self._clock = clock
+        self._lock = threading.RLock()
+        self._loop = None
+        self._compacting = False
+        # segment files are opened for reading through this
+        self._fds = FileDescriptorCache(16)
+        self.compactions = 0
+        self.reclaimed_bytes = 0
+        (self._sqlite, self._db) = get_db(
+            os.path.join(packdir, "index.sqlite"),
+            create_version=(SCHEMA_v1, 1), dbname="pack index",
+            check_same_thread=False)
+        self._cursor = self._db.cursor()
+        self._recover()
+        self._active = self._last_segment()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.packdir, "segment-%08d" % (segment,))
+
+    def _key(self, filename):
+        (bucketdir, shnum) = os.path.split(filename)
+        return (os.path.basename(bucketdir), int(shnum))
+
+    def _recover(self):
+        # Bytes appended to a segment whose index update never committed
+        # (because we crashed in between) belong to nothing: cut them off.
+        self._cursor.execute("SELECT segment, size FROM segments")
+        for (segment, size) in self._cursor.fetchall():
+            path = self._segment_path(segment)
+            try:
+                actual = os.stat(path).st_size
+            except EnvironmentError:
+                log.msg("pack segment %s is missing" % (path,),
+                        facility="tahoe.storage", level=log.WEIRD)
+                self._cursor.execute("DELETE FROM shares WHERE segment=?",
+                                     (segment,))
+                self._cursor.execute("DELETE FROM segments WHERE segment=?",
+                                     (segment,))
+                continue
+            if actual > size:
+                with open(path, "rb+") as f:
+                    f.truncate(size)
+        self._db.commit()
+
+    def _last_segment(self):
+        self._cursor.execute("SELECT MAX(segment) FROM segments")
+        return self._cursor.fetchone()[0]
+
+    def startService(self):
+        service.Service.startService(self)
+        self._loop = task.LoopingCall(self._start_compaction)
+        self._loop.clock = self._clock
+        self._loop.start(self.compaction_interval, now=False)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self._fds.close_all()
+
+    def _locate(self, filename):
+        # the caller holds the lock
+        (storage_index_b32, shnum) = self._key(filename)
+        self._cursor.execute("SELECT segment, offset, length FROM shares"
+                             " WHERE storage_index=? AND shnum=?",
+                             (storage_index_b32, shnum))
+        return self._cursor.fetchone()
+
+    def has_share(self, filename):
+        with self._lock:
+            return self._locate(filename) is not None
+
+    def get_size(self, filename):
+        """
+        :return int: The size of the share file ``filename`` is packed from.
+
+        :raise EnvironmentError: If there is no such share.
+        """
+        with self._lock:
+            location = self._locate(filename)
+        if location is None:
+            raise _no_such_share(filename)
+        return location[2]
+
+    def read(self, filename, offset, length):
+        """
+        Read part of a packed share, as if from its share file: reads beyond
+        the end of it are truncated.
+
+        :raise EnvironmentError: If there is no such share.
+        """
+        for attempt in (0, 1):
+            with self._lock:
+                location = self._locate(filename)
+            if location is None:
+                raise _no_such_share(filename)
+            (segment, record_offset, record_length) = location
+            length = max(0, min(length, record_length - offset))
+            if length == 0:
+                return b""
+            try:
+                return self._fds.pread(self._segment_path(segment), length,
+                                       record_offset + offset)
+            except EnvironmentError:
+                # compaction moved the share while we were looking
+                if attempt:
+                    raise
+
+    def get(self, filename):
+        """
+        :return bytes: All of a packed share, as its share file would hold.
+        """
+        return self.read(filename, 0, self.get_size(filename))
+
+    def list_shares(self, storage_index_b32):
+        """
+        :return list[int]: The share numbers packed for a storage index.
+        """
+        with self._lock:
+            self._cursor.execute("SELECT shnum FROM shares"
+                                 " WHERE storage_index=? ORDER BY shnum",
+                                 (storage_index_b32,))
+            return [shnum for (shnum,) in self._cursor.fetchall()]
+
+    def list_buckets(self, prefix=""):
+        """
+        :return list[unicode]: The sorted storage indexes (base32), starting
+            with ``prefix``, which have shares packed.
+        """
+        with self._lock:
+            self._cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                                 " WHERE storage_index >= ?"
+                                 " AND storage_index < ?"
+                                 " ORDER BY storage_index",
+                                 (prefix, prefix + "\x7f"))
+            return [si for (si,) in self._cursor.fetchall()]
+
+    def count_shares(self):
+        with self._lock:
+            self._cursor.execute("SELECT COUNT(*) FROM shares")
+            return self._cursor.fetchone()[0]
+
+    def put(self, filename, data):
+        """
+        Store ``data`` as the whole of share ``filename``, replacing any
+        earlier version of it.
+
+        :return unicode: The segment file the share is now in, which must be
+            synced before the share is durable.
+        """
+        with self._lock:
+            location = self._locate(filename)
+            if location is not None and location[2] == len(data):
+                # the same size (a renewed lease): overwrite it where it is
+                (segment, offset, length) = location
+                with open(self._segment_path(segment), "rb+") as f:
+                    f.seek(offset)
+                    f.write(data)
+                return self._segment_path(segment)
+            segment = self._append(filename, data)
+            if location is not None:
+                self._add_dead(location[0], location[2])
+            self._db.commit()
+            return self._segment_path(segment)
+
+    def _append(self, filename, data):
+        # the caller holds the lock, and commits
+        size = None
+        if self._active is not None:
+            self._cursor.execute("SELECT size FROM segments WHERE segment=?",
+                                 (self._active,))
+            row = self._cursor.fetchone()
+            if row is not None:
+                size = row[0]
+        if size is None or size + len(data) > self.segment_size:
+            self._active = (self._last_segment() or 0) + 1
+            size = 0
+            self._cursor.execute("INSERT INTO segments (segment, size, dead)"
+                                 " VALUES (?,0,0)", (self._active,))
+        with open(self._segment_path(self._active), "ab") as f:
+            f.write(data)
+        (storage_index_b32, shnum) = self._key(filename)
+        self._cursor.execute("INSERT OR REPLACE INTO shares"
+                             " (storage_index, shnum, segment, offset, length)"
+                             " VALUES (?,?,?,?,?)",
+                             (storage_index_b32, shnum, self._active, size,
+                              len(data)))
+        self._cursor.execute("UPDATE segments SET size=? WHERE segment=?",
+                             (size + len(data), self._active))
+        return self._active
+
+    def _add_dead(self, segment, nbytes):
+        self._cursor.execute("UPDATE segments SET dead=dead+? WHERE segment=?",
+                             (nbytes, segment))
+
+    def remove(self, filename):
+        """
+        Delete a packed share. Its space is reclaimed by compaction.
+
+        :raise EnvironmentError: If there is no such share.
+        """
+        with self._lock:
+            location = self._locate(filename)
+            if location is None:
+                raise _no_such_share(filename)
+            (storage_index_b32, shnum) = self._key(filename)
+            self._cursor.execute("DELETE FROM shares"
+                                 " WHERE storage_index=? AND shnum=?",
+                                 (storage_index_b32, shnum))
+            self._add_dead(location[0], location[2])
+            self._db.commit()
+
+    def open_share(self, filename, lease_db=None):
+        """
+        :return PackedShareFile: The packed share ``filename``.
+        """
+        return PackedShareFile(filename, self, lease_db=lease_db)
+
+    def _start_compaction(self):
+        if self._compacting:
+            return
+        self._compacting = True
+        if self._executor is None or not self._executor.running:
+            d = defer.maybeDeferred(self.compact)
+        else:
+            d = self._executor.run(self.compact)
+        def _done(res):
+            self._compacting = False
+            return res
+        d.addBoth(_done)
+        d.addErrback(log.err, "compacting pack segments")
+
+    def compact(self):
+        """
+        Copy the live shares out of every segment whose dead fraction is at
+        least ``compaction_threshold``, and remove those segments.
+
+        :return int: The number of bytes of segment file removed.
+        """
+        with self._lock:
+            self._cursor.execute("SELECT segment, size FROM segments"
+                                 " WHERE size > 0 AND dead >= size * ?"
+                                 " ORDER BY segment",
+                                 (self.compaction_threshold,))
+            segments = self._cursor.fetchall()
+        reclaimed = 0
+        for (segment, size) in segments:
+            self._compact_segment(segment)
+            reclaimed += size
+        if segments:
+            self.compactions += 1
+            self.reclaimed_bytes += reclaimed
+            log.msg(format="compacted %(segments)d pack segments",
+                    segments=len(segments), facility="tahoe.storage")
+        return reclaimed
+
+    def _compact_segment(self, segment):
+        path = self._segment_path(segment)
+        with self._lock:
+            if segment == self._active:
+                # don't copy the live shares onto the end of their own segment
+                self._active = None
+            self._cursor.execute("SELECT storage_index, shnum, offset, length"
+                                 " FROM shares WHERE segment=?", (segment,))
+            records = self._cursor.fetchall()
+        for (storage_index_b32, shnum, offset, length) in records:
+            filename = os.path.join(self.sharedir, storage_index_b32[:2],
+                                    storage_index_b32, "%d" % shnum)
+            # move one share at a time, so readers are not held up for long
+            with self._lock:
+                if self._locate(filename) != (segment, offset, length):
+                    continue # changed (or deleted) since we looked
+                data = self._fds.pread(path, length, offset)
+                self._append(filename, data)
+                self._db.commit()
+        with self._lock:
+            self._cursor.execute("SELECT COUNT(*) FROM shares WHERE segment=?",
+                                 (segment,))
+            if self._cursor.fetchone()[0]:
+                return # a share was overwritten in place meanwhile
+            self._cursor.execute("DELETE FROM segments WHERE segment=?",
+                                 (segment,))
+            self._db.commit()
+            self._fds.invalidate(path)
+            fileutil.remove_if_possible(path)
+
+    def get_stats(self):
+        with self._lock:
+            self._cursor.execute("SELECT COUNT(*), SUM(size), SUM(dead)"
+                                 " FROM segments")
+            (segments, size, dead) = self._cursor.fetchone()
+            self._cursor.execute("SELECT COUNT(*) FROM shares")
+            (shares,) = self._cursor.fetchone()
+        return {"segments": segments,
+                "shares": shares,
+                "live_bytes": (size or 0) - (dead or 0),
+                "dead_bytes": dead or 0,
+                "compactions": self.compactions,
+                "reclaimed_bytes": self.reclaimed_bytes,
+                }
+
+
+class _PackedImage(BytesIO):
+    """
+    The whole of a packed share as a file-like object. If it was opened for
+    writing, closing it puts it back.
+    """
+
+    def __init__(self, pack, filename, writable):
+        BytesIO.__init__(self, pack.get(filename))
+        self._pack = pack
+        self._filename = filename
+        self._writable = writable
+
+    def close(self):
+        if self._writable and not self.closed:
+            self._pack.put(self._filename, self.getvalue())
+        BytesIO.close(self)
+
+
+class PackedShareFile(ShareFile):
+    """
+    An immutable share kept in a ``PackStore`` rather than a file of its own.
+    Packed shares are never created or written to through me: a finished
+    share file is packed whole by its ``BucketWriter``.
+    """
+
+    def __init__(self, filename, pack, lease_db=None):
+        self._pack = pack
+        ShareFile.__init__(self, filename, lease_db=lease_db)
+
+    def _read_header(self):
+        header = self._pack.read(self.home, 0, 0xc)
+        if len(header) < 0xc:
+            raise UnknownImmutableContainerVersionError(
+                "packed share %s is truncated" % (self.home,))
+        return (self._pack.get_size(self.home), header)
+
+    def _open(self, mode):
+        return _PackedImage(self._pack, self.home, mode != "rb")
+
+    def read_share_data(self, offset, length):
+        seekpos = self._data_offset + offset
+        length = max(0, min(length, self._lease_offset - seekpos))
+        if length == 0:
+            return b""
+        return self._pack.read(self.home, seekpos, length)
+
+    def preallocate(self):
+        pass
+
+    def unlink(self):
+        self._pack.remove(self.home)
+
+    def exists(self):
+        return self._pack.has_share(self.home)
+
+    def get_space(self):
+        size = self._pack.get_size(self.home)
+        return (size, size)
+
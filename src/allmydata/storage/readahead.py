@@ -0,0 +1,201 @@
+"""
+Read ahead of clients which read an immutable share from start to end.
+
+A streaming download asks for one block of each share after another, at
+increasing offsets. Read one at a time, every block costs a seek. Once a
+``BucketReader`` sees two reads in a row which follow each other, it also
+reads the next few blocks and keeps them in memory until they are asked for.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from functools import partial
+
+from twisted.internet import defer
+
+from allmydata.util.observer import OneShotObserverList
+from allmydata.storage.executor import call_io
+
+# The most that is read ahead of one reader at a time, however big its
+# reads are.
+MAX_READ_AHEAD = 1024*1024
+
+
+class ReadAheadStats(object):
+    """
+    I count what the ``SequentialReadAhead`` of every reader of a server did.
+    """
+
+    def __init__(self):
+        self.prefetches = 0
+        self.prefetched_bytes = 0
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_stats(self):
+        stats = {"prefetches": self.prefetches,
+                 "prefetched_bytes": self.prefetched_bytes,
+                 # including what is still buffered
+                 "wasted_bytes": self.prefetched_bytes - self.used_bytes,
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 }
+        if self.hits + self.misses:
+            stats["hit_ratio"] = self.hits / (self.hits + self.misses)
+        return stats
+
+
+class SequentialReadAhead(object):
+    """
+    I read a share for one reader. When a read starts where the last one
+    ended, I read the ``blocks`` reads of the same size after it too, and
+    answer the next reads from those while they last.
+
+    With an ``IOExecutor`` the blocks ahead are read in a thread while the
+    client works through the ones before them. Without one, nothing can be
+    read in the background, so the blocks ahead are read along with the
+    block asked for, which still saves the seeks between them.
+
+    :param read: A callable taking an offset and a length, which reads the
+        share.
+
+    :param client: The tubid of the client reading, for the executor's
+        scheduler, or None if it is not known.
+    """
+
+    def __init__(self, read, blocks, executor=None, stats=None, client=None):
+        assert blocks > 0, blocks
+        self._read = read
+        self.blocks = blocks
+        self._executor = executor
+        self._client = client
+        if stats is None:
+            stats = ReadAheadStats()
+        self._stats = stats
+        self._next_offset = None
+        # the data read ahead, from _buffer_offset on
+        self._buffer_offset = 0
+        self._buffer = b""
+        # None, or (offset, length, OneShotObserverList) of a read ahead
+        # being done in a thread
+        self._pending = None
+        # changed when the buffer is thrown away, so that reads ahead which
+        # were under way then are too
+        self._generation = 0
+        self._at_end = False
+
+    def read(self, offset, length, then):
+        """
+        Read ``length`` bytes at ``offset``, and pass them to ``then``.
+
+        :return: Like ``call_io``, the result of ``then`` or a Deferred
+            which fires with it.
+        """
+        data = self._take(offset, length)
+        if data is not None:
+            self._stats.hits += 1
+            self._next_offset = offset + length
+            self._read_ahead(length)
+            if self._executor is None:
+                return then(data)
+            return defer.succeed(then(data))
+        if self._pending is not None:
+            (start, size, observers) = self._pending
+            if start <= offset and offset + length <= start + size:
+                d = observers.when_fired()
+                d.addCallback(lambda ign: self.read(offset, length, then))
+                return d
+        self._stats.misses += 1
+        sequential = offset == self._next_offset
+        self.skipped(offset, length)
+        if not sequential:
+            return call_io(self._executor, None,
+                           partial(self._read, offset, length), then,
+                           client=self._client)
+        # whatever is left does not reach as far as this read
+        self._buffer = b""
+        if self._executor is None:
+            size = min(length * self.blocks, MAX_READ_AHEAD)
+            data = self._read(offset, length + size)
+            self._add(offset + length, data[length:], size)
+            return then(data[:length])
+        d = call_io(self._executor, None,
+                    partial(self._read, offset, length), then,
+                    client=self._client)
+        self._read_ahead(length)
+        return d
+
+    def skipped(self, offset, length):
+        """
+        Note that ``length`` bytes at ``offset`` were read without me. Unless
+        they are the next ones, the data read ahead is thrown away.
+        """
+        if offset != self._next_offset:
+            self._buffer = b""
+            self._pending = None
+            self._generation += 1
+            self._at_end = False
+        elif self._buffer:
+            self._take(offset, length)
+        self._next_offset = offset + length
+
+    def _take(self, offset, length):
+        end = self._buffer_offset + len(self._buffer)
+        if not (self._buffer_offset <= offset and offset + length <= end):
+            return None
+        data = self._buffer[offset - self._buffer_offset:
+                            offset - self._buffer_offset + length]
+        self._stats.used_bytes += len(data)
+        # nobody reading sequentially will want what came before
+        self._buffer = self._buffer[offset - self._buffer_offset + length:]
+        self._buffer_offset = offset + length
+        return data
+
+    def _add(self, offset, data, size):
+        if not self._buffer:
+            self._buffer_offset = offset
+        self._buffer += data
+        self._stats.prefetches += 1
+        self._stats.prefetched_bytes += len(data)
+        # a short read found the end of the share
+        self._at_end = len(data) < size
+
+    def _read_ahead(self, length):
+        if self._executor is None or self._pending is not None:
+            return
+        if self._at_end:
+            return
+        size = min(length * self.blocks, MAX_READ_AHEAD)
+        if self._buffer:
+            if len(self._buffer) >= size // 2:
+                return
+            start = self._buffer_offset + len(self._buffer)
+        else:
+            start = self._next_offset
+        observers = OneShotObserverList()
+        self._pending = (start, size, observers)
+        generation = self._generation
+        def _done(data):
+            if generation == self._generation:
+                self._pending = None
+                self._add(start, data, size)
+            else:
+                self._stats.prefetched_bytes += len(data)
+        def _failed(f):
+            if generation == self._generation:
+                self._pending = None
+            # whoever was waiting for the data will read it themselves
+        d = call_io(self._executor, None, partial(self._read, start, size),
+                    client=self._client)
+        d.addCallbacks(_done, _failed)
+        d.addBoth(lambda ign: observers.fire(None))
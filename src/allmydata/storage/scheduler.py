@@ -0,0 +1,200 @@
+"""
+Share the storage server fairly between the clients using it.
+
+Without this the server starts clients' operations in the order they
+arrive, so one client repairing or backing up a lot of files can keep the
+disk busy enough that everyone else's reads wait behind its writes.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import heapq, itertools, time
+from collections import OrderedDict
+from functools import partial
+
+from foolscap.broker import Broker
+from twisted.internet import defer
+
+# The kinds of operation, from the most to the least urgent. Reads are what
+# people wait for; writes are mostly uploads and repairs, which take a while
+# anyway; lease renewals can be done at any time before the leases expire.
+PRIORITY_READ = "read"
+PRIORITY_WRITE = "write"
+PRIORITY_LEASE = "lease"
+
+# How much of its share of the server a client gets for each kind of
+# operation, relative to the others.
+DEFAULT_WEIGHTS = {PRIORITY_READ: 4,
+                   PRIORITY_WRITE: 2,
+                   PRIORITY_LEASE: 1,
+                   }
+
+# The number of clients whose statistics are kept once they have nothing
+# queued or running.
+MAX_IDLE_CLIENTS = 100
+
+
+class ClientBroker(Broker):
+    """
+    A ``Broker`` for a ``Tub`` to use (as its ``brokerClass``) for each of
+    its connections, which tells objects who is calling them.
+
+    Foolscap does not tell a ``Referenceable`` which client called it. So
+    the remote calls to an object with a ``for_client`` method go instead
+    to what that returns for the tubid of the client at the other end of
+    the connection (or for None, if that is not known).
+    """
+
+    def getMyReferenceByCLID(self, clid):
+        obj = Broker.getMyReferenceByCLID(self, clid)
+        for_client = getattr(obj, "for_client", None)
+        if for_client is None:
+            return obj
+        client = None
+        if self.remote_tubref is not None:
+            client = self.remote_tubref.getTubID()
+        return for_client(client)
+
+
+class _ClientStats(object):
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.operations = 0
+        self.service_time = 0.0
+        self.wait_time = 0.0
+
+    def get_stats(self):
+        return {"queued": self.queued,
+                "running": self.running,
+                "operations": self.operations,
+                "service_time": self.service_time,
+                "wait_time": self.wait_time,
+                }
+
+
+class FairScheduler(object):
+    """
+    I run up to ``slots`` operations at once, and decide which of the ones
+    waiting start next, using self-clocked weighted fair queuing: each
+    client's operations of each priority make up a flow, every operation
+    gets a finish tag ``1/weight`` after the previous one of its flow (or
+    after the current virtual time, if later), and the operation with the
+    lowest tag goes first.
+
+    A client with a long queue of operations therefore waits its turn
+    behind a client which has only just asked for something, and reads get
+    through four times as often as lease renewals.
+    """
+
+    def __init__(self, slots, weights=None, get_time=time.time):
+        assert slots > 0, slots
+        self.slots = slots
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self._get_time = get_time
+        self._queue = [] # heap of (tag, seq, client, call, Deferred, time)
+        self._seq = itertools.count()
+        self._finish_tags = {} # (client, priority) -> tag of its last one
+        self._virtual_time = 0.0
+        self._running = 0
+        self._dispatching = False
+        # client -> _ClientStats, least recently active first
+        self._clients = OrderedDict()
+
+    def waiting(self):
+        """
+        :return int: How many operations are waiting for a slot.
+        """
+        return len(self._queue)
+
+    def submit(self, client, priority, f, *args, **kwargs):
+        """
+        Call ``f(*args, **kwargs)`` (on the reactor thread) once it is the
+        turn of ``client``'s operations of ``priority``.
+
+        :return Deferred: Fires with what ``f`` returns (or what the
+            Deferred it returns fires with).
+        """
+        flow = (client, priority)
+        tag = (max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+               + 1.0 / self.weights[priority])
+        self._finish_tags[flow] = tag
+        stats = self._clients.pop(client, None)
+        if stats is None:
+            stats = _ClientStats()
+        self._clients[client] = stats
+        stats.queued += 1
+        d = defer.Deferred()
+        heapq.heappush(self._queue, (tag, next(self._seq), client,
+                                     partial(f, *args, **kwargs), d,
+                                     self._get_time()))
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        if self._dispatching:
+            # an operation finished right away; the loop below carries on
+            return
+        self._dispatching = True
+        try:
+            while self._running < self.slots and self._queue:
+                (tag, seq, client, call, d, submitted) = heapq.heappop(
+                    self._queue)
+                self._virtual_time = tag
+                self._running += 1
+                stats = self._clients[client]
+                stats.queued -= 1
+                stats.running += 1
+                started = self._get_time()
+                stats.wait_time += started - submitted
+                result = defer.maybeDeferred(call)
+                result.addBoth(self._finished, client, started)
+                result.chainDeferred(d)
+        finally:
+            self._dispatching = False
+
+    def _finished(self, res, client, started):
+        self._running -= 1
+        stats = self._clients[client]
+        stats.running -= 1
+        stats.operations += 1
+        stats.service_time += self._get_time() - started
+        if not (stats.queued or stats.running):
+            # every tag of an idle client is in the past
+            for priority in self.weights:
+                self._finish_tags.pop((client, priority), None)
+            self._forget_idle_clients()
+        self._dispatch()
+        return res
+
+    def _forget_idle_clients(self):
+        idle = [client for (client, stats) in self._clients.items()
+                if not (stats.queued or stats.running)]
+        for client in idle[:len(idle) - MAX_IDLE_CLIENTS]:
+            del self._clients[client]
+
+    def get_client_stats(self):
+        """
+        :return: A dict mapping each client (a tubid, or None for calls which
+            did not come from a client) to a dict of its statistics.
+        """
+        return dict((client, stats.get_stats())
+                    for (client, stats) in self._clients.items())
+
+    def get_stats(self):
+        return {"slots": self.slots,
+                "queued": len(self._queue),
+                "running": self._running,
+                "clients": len(self._clients),
+                }
@@ -15,26 +15,55 @@ else:
     from typing import Dict
 
 import os, re, struct, time
+from functools import partial
 import six
 
 from foolscap.api import Referenceable
 from foolscap.ipb import IRemoteReference
 from twisted.application import service
+from twisted.internet import defer
 
 from zope.interface import implementer
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import (
+    RIStorageServer, IStatsProducer, IHistogramProducer,
+)
 from allmydata.util import fileutil, idlib, log, time_format
 import allmydata # for __full_version__
 
-from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
+from allmydata.storage.common import (
+    si_b2a, si_a2b, storage_index_to_dir, get_share_space,
+)
 _pyflakes_hush = [si_b2a, si_a2b, storage_index_to_dir] # re-exported
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
-from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.immutable import (
+    ShareFile, BucketWriter, BucketReader, NO_SPACE_ERRNOS,
+)
+from allmydata.storage.crawler import BucketCountingCrawler, ShareCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, LeaseExpiryQueue
+from allmydata.storage.catalog import (
+    get_share_catalog, ShareCatalogCrawler, storage_index_to_b32,
+)
+from allmydata.storage.bloom import StorageIndexFilter
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.blockcache import BlockCache
+from allmydata.storage.headercache import MutableHeaderCache
+from allmydata.storage.readahead import ReadAheadStats
+from allmydata.storage.scheduler import (
+    FairScheduler, PRIORITY_READ, PRIORITY_WRITE, PRIORITY_LEASE,
+)
+from allmydata.storage.executor import IOExecutor, call_io
+from allmydata.storage.commit import GroupCommitter
+from allmydata.storage.diskstats import DiskStatsCache
+from allmydata.storage.tiering import TierMigrator, DEFAULT_PROMOTE_AFTER
+from allmydata.storage.pack import PackStore
+from allmydata.util.histogram import WindowedHistogram
+from allmydata.storage.leasedb import (
+    get_lease_db, LeaseMigrationCrawler,
+)
+from allmydata.storage.shares import get_share_file
 
 # storage/
 # storage/shares/incoming
@@ -46,6 +75,9 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
+# Any extra share directories ([storage]share_dirs) are laid out the same
+# way, each with its own incoming/. A bucket is kept in only one of them.
+
 # $SHARENUM matches this regex:
 NUM_RE=re.compile("^[0-9]+$")
 
@@ -54,8 +86,16 @@ NUM_RE=re.compile("^[0-9]+$")
 # For now it's not actually configurable, but maybe someday.
 DEFAULT_RENEWAL_TIME = 31 * 24 * 60 * 60
 
+# How long, in seconds, durable writes wait for others to share their group
+# commit with, unless configured otherwise.
+DEFAULT_COMMIT_INTERVAL = 0.01
+
+# Immutable shares up to this size are packed into segment files, if packing
+# is enabled but the size is not configured.
+DEFAULT_PACK_MAX_SHARE_SIZE = 64 * 1024
+
 
-@implementer(RIStorageServer, IStatsProducer)
+@implementer(RIStorageServer, IStatsProducer, IHistogramProducer)
 class StorageServer(service.MultiService, Referenceable):
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
@@ -68,7 +108,28 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
                  expiration_sharetypes=("mutable", "immutable"),
-                 get_current_time=time.time):
+                 get_current_time=time.time,
+                 share_catalog=False,
+                 bloom_filter_capacity=None,
+                 lease_db=False,
+                 crawler_max_iops=None,
+                 crawler_max_bytes_per_second=None,
+                 crawler_prefetch=0,
+                 fd_cache_size=0,
+                 io_threads=0,
+                 commit_interval=None,
+                 disk_stats_ttl=0,
+                 preallocate=False,
+                 pack_max_share_size=None,
+                 share_dirs=(),
+                 hot_dir=None,
+                 hot_dir_max_size=None,
+                 hot_dir_promote_after=DEFAULT_PROMOTE_AFTER,
+                 hot_dir_max_bytes_per_second=None,
+                 block_cache_size=0,
+                 mutable_header_cache_size=0,
+                 read_ahead_blocks=0,
+                 fair_queuing=False):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, bytes)
         assert len(nodeid) == 20
@@ -78,18 +139,48 @@ class StorageServer(service.MultiService, Referenceable):
         sharedir = os.path.join(storedir, "shares")
         fileutil.make_dirs(sharedir)
         self.sharedir = sharedir
+        # Shares may also be kept in other directories, usually on other
+        # disks. Each bucket lives in just one of them, with the same layout
+        # as the main share directory.
+        self.sharedirs = [sharedir]
+        for d in share_dirs:
+            d = os.path.abspath(d)
+            if d not in self.sharedirs:
+                fileutil.make_dirs(d)
+                self.sharedirs.append(d)
+        # New buckets go in these. The hot tier, if there is one, only gets
+        # the buckets the tier migrator moves there.
+        self._placement_sharedirs = list(self.sharedirs)
+        self.hotdir = None
+        if hot_dir is not None:
+            self.hotdir = os.path.abspath(hot_dir)
+            assert self.hotdir not in self.sharedirs, self.hotdir
+            fileutil.make_dirs(self.hotdir)
+            self.sharedirs.append(self.hotdir)
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
         self.reserved_space = int(reserved_space)
+        # sharedir -> DiskStatsCache, set up below once self._io exists
+        self._disk_stats = {}
         self.no_storage = discard_storage
         self.readonly_storage = readonly_storage
         self.stats_provider = stats_provider
         if self.stats_provider:
             self.stats_provider.register_producer(self)
+        # each share directory has its own incoming/, since a finished share
+        # is renamed into place and that only works within a filesystem
         self.incomingdir = os.path.join(sharedir, 'incoming')
+        self.incomingdirs = [os.path.join(d, 'incoming')
+                             for d in self.sharedirs]
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
+        for incomingdir in self.incomingdirs:
+            fileutil.make_dirs(incomingdir)
+        # sharedir -> the first share directory on the same filesystem, and
+        # those of them new buckets can go in, whose space adds up
+        self._disk_of = self._group_by_disk(self.sharedirs)
+        self._disk_sharedirs = [d for d in self._placement_sharedirs
+                                if self._disk_of[d] == d]
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -97,18 +188,79 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        # category -> WindowedHistogram
+        self.latencies = {}
+        for category in ["allocate", # immutable
+                         "write",
+                         "close",
+                         "read",
+                         "get",
+                         "get-many",
+                         "writev", # mutable
+                         "readv",
+                         "readv-many",
+                         "io-wait", # time spent waiting for a thread
+                         "commit", # time taken by each group commit
+                         "add-lease", # both
+                         "renew",
+                         "cancel",
+                         ]:
+            self.latencies[category] = WindowedHistogram(
+                clock=get_current_time)
+        self._fd_cache = None
+        if fd_cache_size:
+            self._fd_cache = FileDescriptorCache(fd_cache_size)
+        self._block_cache = None
+        if block_cache_size:
+            self._block_cache = BlockCache(block_cache_size)
+        self._header_cache = None
+        if mutable_header_cache_size:
+            self._header_cache = MutableHeaderCache(mutable_header_cache_size)
+        self._read_ahead_blocks = read_ahead_blocks
+        self._read_ahead_stats = None
+        if read_ahead_blocks:
+            self._read_ahead_stats = ReadAheadStats()
+        self._io = None
+        if io_threads:
+            self._io = IOExecutor(
+                "storage-io-%s" % (idlib.shortnodeid_b2a(nodeid),),
+                io_threads,
+                record_wait=lambda waited: self.add_latency("io-wait", waited),
+            )
+            self._io.setServiceParent(self)
+        # the crawlers look at this, to make way for clients
+        self.scheduler = None
+        if fair_queuing and self._io is not None:
+            self.scheduler = FairScheduler(io_threads)
+            self._io.scheduler = self.scheduler
+        self.add_pack_store(pack_max_share_size)
         self.add_bucket_counter()
+        self.add_share_catalog(share_catalog)
+        self._si_filter = None
+        if bloom_filter_capacity is not None:
+            self._si_filter = StorageIndexFilter(
+                self.sharedir, bloom_filter_capacity, pack=self.pack,
+                extra_sharedirs=self.sharedirs[1:])
+            self._si_filter.setServiceParent(self)
+
+        self.add_lease_db(lease_db)
+        # With durable writes, writes are only acknowledged once a group
+        # commit has synced them to disk.
+        self._committer = None
+        if commit_interval is not None:
+            self._committer = GroupCommitter(
+                commit_interval,
+                executor=self._io,
+                record_commit=self._record_commit,
+            )
+            self._committer.setServiceParent(self)
+        if disk_stats_ttl:
+            for d in set(self._disk_of.values()):
+                self._disk_stats[d] = DiskStatsCache(d, self.reserved_space,
+                                                     disk_stats_ttl,
+                                                     executor=self._io)
+                self._disk_stats[d].setServiceParent(self)
+        self._preallocate = preallocate
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
@@ -117,8 +269,24 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
-                                   expiration_sharetypes)
+                                   expiration_sharetypes,
+                                   lease_db=self._lease_db)
         self.lease_checker.setServiceParent(self)
+        self.add_tier_migrator(hot_dir_max_size, hot_dir_promote_after)
+        self.lease_expiry_queue = None
+        if expiration_enabled and self._lease_db is not None:
+            # expire leases as soon as they lapse, rather than when the lease
+            # checker gets around to them
+            self.lease_expiry_queue = LeaseExpiryQueue(self.lease_checker,
+                                                       self._lease_db)
+            self.lease_expiry_queue.setServiceParent(self)
+        self.limit_crawlers(crawler_max_iops, crawler_max_bytes_per_second,
+                            crawler_prefetch)
+        if (self.tier_migrator is not None and
+            hot_dir_max_bytes_per_second is not None):
+            # moving buckets between disks takes more I/O than crawling
+            self.tier_migrator.max_bytes_per_second = \
+                hot_dir_max_bytes_per_second
         self._get_current_time = get_current_time
 
         # Currently being-written Bucketwriters. For Foolscap, lifetime is tied
@@ -129,6 +297,11 @@ class StorageServer(service.MultiService, Referenceable):
 
         # Map in-progress filesystem path -> BucketWriter:
         self._bucket_writers = {}  # type: Dict[str,BucketWriter]
+        # The sum of their allocated sizes:
+        self._allocated = 0
+        # ... and for those writing to each share directory:
+        self._allocated_in = dict((d, 0) for d in self.sharedirs)
+        self._writers_in = dict((d, 0) for d in self.sharedirs)
         # Canaries and disconnect markers for BucketWriters created via Foolscap:
         self._bucket_writer_disconnect_markers = {}  # type: Dict[BucketWriter,(IRemoteReference, object)]
 
@@ -138,46 +311,335 @@ class StorageServer(service.MultiService, Referenceable):
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        if self.pack is not None and self.pack.count_shares():
+            return True
+        for sharedir in self.sharedirs:
+            if set(os.listdir(sharedir)) - set(["incoming"]):
+                return True
+        return False
+
+    @staticmethod
+    def _group_by_disk(sharedirs):
+        """Map each of ``sharedirs`` to the first of them on the same
+        filesystem."""
+        first_on = {} # st_dev -> sharedir
+        result = {}
+        for d in sharedirs:
+            dev = os.stat(d).st_dev
+            result[d] = first_on.setdefault(dev, d)
+        return result
+
+    def _sharedir_of(self, incominghome):
+        """Return the share directory an incoming share is being written
+        to."""
+        # $SHAREDIR/incoming/$START/$STORAGEINDEX/$SHARENUM
+        d = incominghome
+        for i in range(4):
+            d = os.path.dirname(d)
+        return d
+
+    def _existing_bucketdir(self, si_dir):
+        """Return the bucket directory for ``si_dir`` in whichever share
+        directory has one, or None."""
+        for sharedir in self.sharedirs:
+            bucketdir = os.path.join(sharedir, si_dir)
+            if os.path.isdir(bucketdir):
+                return bucketdir
+        return None
+
+    def _bucketdir(self, si_dir):
+        """Return the directory which holds, or would hold, the bucket
+        ``si_dir``."""
+        if len(self.sharedirs) > 1:
+            bucketdir = self._existing_bucketdir(si_dir)
+            if bucketdir is not None:
+                return bucketdir
+        return os.path.join(self.sharedir, si_dir)
+
+    def _choose_sharedir(self, size):
+        """Pick the share directory a new bucket of shares of ``size`` bytes
+        goes in: the one with the most unallocated space per bucket being
+        written to it, so that both space and write load are spread over the
+        disks.
+
+        :return: The share directory, or None if none has room.
+        """
+        best = None
+        best_score = None
+        for sharedir in self._placement_sharedirs:
+            space = self._available_space_in(sharedir)
+            if space is None:
+                space = 2**64
+            space -= self._allocated_in[sharedir]
+            if space < size:
+                continue
+            score = space / (1 + self._writers_in[sharedir])
+            if best is None or score > best_score:
+                (best, best_score) = (sharedir, score)
+        return best
+
+    def add_pack_store(self, max_share_size):
+        """Pack immutable shares of up to ``max_share_size`` bytes into
+        segment files, or none if it is None. Shares packed by an earlier run
+        stay readable either way."""
+        self._pack_max_share_size = max_share_size
+        packdir = os.path.join(self.storedir, "packs")
+        if max_share_size is None and not os.path.exists(packdir):
+            self.pack = None
+            return
+        self.pack = PackStore(packdir, self.sharedir, executor=self._io)
+        self.pack.setServiceParent(self)
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_tier_migrator(self, max_size, promote_after):
+        """Move frequently read buckets into the hot share directory, and
+        back out once they are no longer read, if there is one."""
+        self.tier_migrator = None
+        if self.hotdir is None:
+            return
+        statefile = os.path.join(self.storedir, "tier_migrator.state")
+        self.tier_migrator = TierMigrator(self, statefile, self.hotdir,
+                                          max_size=max_size,
+                                          promote_after=promote_after)
+        self.tier_migrator.setServiceParent(self)
+
+    def add_share_catalog(self, enabled):
+        catalogfile = os.path.join(self.storedir, "share_catalog.sqlite")
+        if not enabled:
+            # A catalog left over from an earlier run would not have seen any
+            # of the changes made since, so get rid of it.
+            fileutil.remove_if_possible(catalogfile)
+            self._share_catalog = None
+            return
+        self._share_catalog = get_share_catalog(catalogfile)
+        statefile = os.path.join(self.storedir, "share_catalog.state")
+        self.catalog_crawler = ShareCatalogCrawler(self, statefile,
+                                                   self._share_catalog)
+        self.catalog_crawler.setServiceParent(self)
+
+    def add_lease_db(self, enabled):
+        dbfile = os.path.join(self.storedir, "leasedb.sqlite")
+        statefile = os.path.join(self.storedir, "lease_migration.state")
+        if not enabled:
+            # A database left over from an earlier run would not have seen
+            # any of the lease changes made since, so get rid of it.
+            fileutil.remove_if_possible(dbfile)
+            fileutil.remove_if_possible(statefile)
+            self._lease_db = None
+            return
+        self._lease_db = get_lease_db(dbfile)
+        if not self._lease_db.is_migrated():
+            self.lease_migrator = LeaseMigrationCrawler(self, statefile,
+                                                        self._lease_db)
+            self.lease_migrator.setServiceParent(self)
+
+    def limit_crawlers(self, max_iops, max_bytes_per_second, prefetch):
+        """Give every share crawler the same I/O budget, since they all
+        compete for the same disk."""
+        for s in self:
+            if isinstance(s, ShareCrawler):
+                s.max_iops = max_iops
+                s.max_bytes_per_second = max_bytes_per_second
+                s.prefetch_prefixes = prefetch
+
+    def startService(self):
+        if self._share_catalog is not None:
+            self._share_catalog.mark_in_use()
+        service.MultiService.startService(self)
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        if self._share_catalog is not None:
+            d.addCallback(lambda ign: self._share_catalog.mark_clean())
+        if self._fd_cache is not None:
+            self._fd_cache.close_all()
+        return d
+
+    def _count_bucket_shares(self, storage_index_b32):
+        count = 0
+        if self.pack is not None:
+            count += len(self.pack.list_shares(storage_index_b32))
+        for sharedir in self.sharedirs:
+            bucketdir = os.path.join(sharedir, storage_index_b32[:2],
+                                     storage_index_b32)
+            try:
+                count += len([f for f in os.listdir(bucketdir)
+                              if NUM_RE.match(f)])
+            except OSError:
+                pass
+        return count
+
+    def _open_share_file(self, filename):
+        """
+        :return ShareFile: The immutable share ``filename``, whether it has a
+            file of its own or is packed.
+        """
+        if self.pack is not None and self.pack.has_share(filename):
+            return self.pack.open_share(filename, lease_db=self._lease_db)
+        return ShareFile(filename, lease_db=self._lease_db,
+                         fd_cache=self._fd_cache)
+
+    def share_added(self, storage_index_b32, shnum, sharetype, filename,
+                    first_in_bucket=None):
+        """Note that a share has been created. ``first_in_bucket`` says
+        whether the bucket was empty before; if it is None the share
+        directory is checked.
+
+        This method is not for client use.
+        """
+        if self._share_catalog is not None or self._lease_db is not None:
+            sf = get_share_file(filename, pack=self.pack)
+        if self._share_catalog is not None:
+            (size, _) = sf.get_space()
+            self._share_catalog.add_share(storage_index_b32, shnum,
+                                          sharetype, size)
+        if self._lease_db is not None:
+            self._lease_db.record_share(sf)
+        if self._si_filter is not None:
+            # the filter counts buckets, not shares
+            if first_in_bucket is None:
+                first_in_bucket = self._count_bucket_shares(
+                    storage_index_b32) == 1
+            if first_in_bucket:
+                self._si_filter.bucket_added(storage_index_b32.encode("ascii"))
+
+    def share_modified(self, storage_index_b32, shnum, sharetype, filename):
+        """Note that an existing share has been written to.
+
+        This method is not for client use.
+        """
+        if self._share_catalog is not None:
+            size = os.stat(filename).st_size
+            self._share_catalog.add_share(storage_index_b32, shnum,
+                                          sharetype, size)
+        if self._lease_db is not None:
+            (size, used_space) = get_share_space(filename)
+            self._lease_db.add_share(storage_index_b32, shnum, sharetype,
+                                     size, used_space)
+
+    def share_removed(self, storage_index_b32, shnum, last_in_bucket=None):
+        """Note that a share has been deleted. ``last_in_bucket`` says whether
+        the bucket is now empty; if it is None the share directory is
+        checked.
+
+        This method is not for client use.
+        """
+        if self._fd_cache is not None:
+            # the share may have been deleted through a share file object
+            # that did not know about the cache
+            for sharedir in self.sharedirs:
+                self._fd_cache.invalidate(os.path.join(
+                    sharedir, storage_index_b32[:2], storage_index_b32,
+                    "%d" % shnum))
+        if self._block_cache is not None:
+            self._block_cache.invalidate(
+                si_a2b(storage_index_b32.encode("ascii")), shnum)
+        if self._header_cache is not None:
+            self._header_cache.invalidate(
+                si_a2b(storage_index_b32.encode("ascii")), shnum)
+        if self._share_catalog is not None:
+            self._share_catalog.remove_share(storage_index_b32, shnum)
+        if self._lease_db is not None:
+            self._lease_db.remove_share(storage_index_b32, shnum)
+        if self._si_filter is not None:
+            if last_in_bucket is None:
+                last_in_bucket = not self._count_bucket_shares(
+                    storage_index_b32)
+            if last_in_bucket:
+                self._si_filter.bucket_removed(storage_index_b32.encode("ascii"))
+
+    def _record_read(self, storage_index, filenames):
+        """Tell the tier migrator that the shares ``filenames`` of
+        ``storage_index`` were read. This may be called from an I/O
+        thread."""
+        if self.tier_migrator is None or not filenames:
+            return
+        hot = [f for f in filenames
+               if f.startswith(self.hotdir + os.sep)]
+        self.tier_migrator.tracker.record_read(
+            storage_index_to_b32(storage_index), bool(hot))
+
+    def bucket_uploading(self, storage_index_b32):
+        """Is a bucket being uploaded to?
+
+        This method is not for client use.
+        """
+        si_dir = os.path.join(storage_index_b32[:2], storage_index_b32)
+        for incomingdir in self.incomingdirs:
+            if os.path.exists(os.path.join(incomingdir, si_dir)):
+                return True
+        return False
+
+    def bucket_busy(self, storage_index_b32):
+        """Is a bucket being uploaded to or written to?
+
+        This method is not for client use.
+        """
+        if self.bucket_uploading(storage_index_b32):
+            return True
+        return (self._io is not None and
+                self._io.is_busy(si_a2b(storage_index_b32.encode("ascii"))))
+
+    def bucket_moved(self, storage_index_b32, bucketdir, newbucketdir):
+        """Note that the share files of a bucket have been moved from
+        ``bucketdir`` to ``newbucketdir``.
+
+        This method is not for client use.
+        """
+        if self._fd_cache is not None:
+            for f in os.listdir(newbucketdir):
+                self._fd_cache.invalidate(os.path.join(bucketdir, f))
+
+    def find_share(self, storage_index, shnum):
+        """Return the filename of a share, wherever it is now, or None.
+
+        This method is not for client use.
+        """
+        for (n, filename) in self._find_bucket_shares(storage_index):
+            if n == shnum:
+                return filename
+        return None
+
+    def _record_commit(self, batch_size, latency):
+        self.add_latency("commit", latency)
+        self.count("commit")
+        self.count("commit-paths", batch_size)
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
     def get_latencies(self):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
-        following keys: mean, 01_0_percentile, 10_0_percentile,
-        50_0_percentile (median), 90_0_percentile, 95_0_percentile,
-        99_0_percentile, 99_9_percentile.  If there are insufficient
-        samples for a given percentile to be interpreted unambiguously
-        that percentile will be reported as None. If no samples have been
-        collected for the given category, then that category name will
-        not be present in the return value. """
+        latency numbers for each category, taken over the last few minutes.
+        If there are sufficient samples for unambiguous interpretation, each
+        dict will contain the following keys: mean, 01_0_percentile,
+        10_0_percentile, 50_0_percentile (median), 90_0_percentile,
+        95_0_percentile, 99_0_percentile, 99_9_percentile.  If there are
+        insufficient samples for a given percentile to be interpreted
+        unambiguously that percentile will be reported as None. If no
+        samples have been collected for the given category, then that
+        category name will not be present in the return value. The
+        percentiles come from histograms, so are approximate to within a
+        few percent. """
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
         for category in self.latencies:
-            if not self.latencies[category]:
+            samples = self.latencies[category].recent()
+            if not samples.count:
                 continue
             stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
+            count = samples.count
             stats["samplesize"] = count
-            samples.sort()
             if count > 1:
-                stats["mean"] = sum(samples) / count
+                stats["mean"] = samples.sum / count
             else:
                 stats["mean"] = None
 
@@ -188,20 +650,30 @@ class StorageServer(service.MultiService, Referenceable):
 
             for percentile, percentilestring, minnumtoobserve in orderstatlist:
                 if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
+                    stats[percentilestring] = samples.percentile(percentile)
                 else:
                     stats[percentilestring] = None
 
             output[category] = stats
         return output
 
+    def get_histograms(self):
+        """
+        :return: A dict mapping ``storage_server.latencies.<category>`` to a
+            ``Histogram`` of every latency recorded for that category.
+        """
+        return {"storage_server.latencies.%s" % (category,): h.total
+                for (category, h) in self.latencies.items()
+                if h.total.count}
+
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for incomingdir in self.incomingdirs:
+            fileutil.rm_dir(incomingdir)
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
@@ -213,7 +685,7 @@ class StorageServer(service.MultiService, Referenceable):
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            disk = self.get_disk_stats()
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -237,6 +709,54 @@ class StorageServer(service.MultiService, Referenceable):
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
             stats['storage_server.total_bucket_count'] = bucket_count
+        if self._share_catalog is not None:
+            stats['storage_server.share_catalog.complete'] = \
+                int(self._share_catalog.is_complete())
+        if self._si_filter is not None:
+            for name, v in self._si_filter.get_stats().items():
+                stats['storage_server.bloom_filter.%s' % (name,)] = v
+        if self._fd_cache is not None:
+            for name, v in self._fd_cache.get_stats().items():
+                stats['storage_server.fd_cache.%s' % (name,)] = v
+        if self._block_cache is not None:
+            for name, v in self._block_cache.get_stats().items():
+                stats['storage_server.block_cache.%s' % (name,)] = v
+        if self._header_cache is not None:
+            for name, v in self._header_cache.get_stats().items():
+                stats['storage_server.mutable_header_cache.%s' % (name,)] = v
+        if self._read_ahead_stats is not None:
+            for name, v in self._read_ahead_stats.get_stats().items():
+                stats['storage_server.read_ahead.%s' % (name,)] = v
+        if self.scheduler is not None:
+            for name, v in self.scheduler.get_stats().items():
+                stats['storage_server.scheduler.%s' % (name,)] = v
+            for (client, client_stats) in self.scheduler.get_client_stats().items():
+                for name, v in client_stats.items():
+                    stats['storage_server.scheduler.client.%s.%s'
+                          % (client or "unknown", name)] = v
+        if self._io is not None:
+            for name, v in self._io.get_stats().items():
+                stats['storage_server.io.%s' % (name,)] = v
+        if self._committer is not None:
+            for name, v in self._committer.get_stats().items():
+                stats['storage_server.group_commit.%s' % (name,)] = v
+        if self.pack is not None:
+            for name, v in self.pack.get_stats().items():
+                stats['storage_server.pack.%s' % (name,)] = v
+        if self.tier_migrator is not None:
+            for name, v in self.tier_migrator.get_stats().items():
+                stats['storage_server.tiering.%s' % (name,)] = v
+        if len(self.sharedirs) > 1:
+            for (i, sharedir) in enumerate(self.sharedirs):
+                prefix = 'storage_server.share_dirs.%d.' % (i,)
+                avail = self._available_space_in(sharedir)
+                if avail is not None:
+                    stats[prefix + 'disk_avail'] = avail
+                stats[prefix + 'allocated'] = self._allocated_in[sharedir]
+                stats[prefix + 'writers'] = self._writers_in[sharedir]
+        if self._lease_db is not None:
+            stats['storage_server.lease_db.migrated'] = \
+                int(self._lease_db.is_migrated())
         return stats
 
     def get_available_space(self):
@@ -245,30 +765,73 @@ class StorageServer(service.MultiService, Referenceable):
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        try:
+            return self.get_disk_stats()['avail']
+        except AttributeError:
+            return None
+        except EnvironmentError:
+            log.msg("OS call to get disk statistics failed")
+            return 0
+
+    def _available_space_in(self, sharedir):
+        """Like ``get_available_space``, for the disk holding one share
+        directory."""
+        if self.readonly_storage:
+            return 0
+        try:
+            return self.get_disk_stats(sharedir)['avail']
+        except AttributeError:
+            return None
+        except EnvironmentError:
+            log.msg("OS call to get disk statistics failed")
+            return 0
+
+    def get_disk_stats(self, sharedir=None):
+        """
+        :return: ``fileutil.get_disk_stats`` for the disk holding
+            ``sharedir``, or a recent enough answer from it if disk
+            statistics are cached. If ``sharedir`` is None, the sums over
+            the disks holding all the share directories.
+        """
+        if sharedir is None:
+            if len(self._disk_sharedirs) == 1:
+                return self.get_disk_stats(self._disk_sharedirs[0])
+            total = {}
+            for d in self._disk_sharedirs:
+                for key, value in self.get_disk_stats(d).items():
+                    total[key] = total.get(key, 0) + value
+            return total
+        disk_stats = self._disk_stats.get(self._disk_of.get(sharedir, sharedir))
+        if disk_stats is None:
+            return fileutil.get_disk_stats(sharedir, self.reserved_space)
+        return disk_stats.get()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._bucket_writers.values():
-            space += bw.allocated_size()
-        return space
+        return self._allocated
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
         if remaining_space is None:
             # We're on a platform that has no API to get disk stats.
             remaining_space = 2**64
+        max_share_size = remaining_space
+        if len(self._disk_sharedirs) > 1:
+            # a share has to fit on one disk
+            max_share_size = max(
+                self._available_space_in(d) for d in self._disk_sharedirs)
 
         # Unicode strings might be nicer, but for now sticking to bytes since
         # this is what the wire protocol has always been.
         version = { b"http://allmydata.org/tahoe/protocols/storage/v1" :
-                    { b"maximum-immutable-share-size": remaining_space,
+                    { b"maximum-immutable-share-size": max_share_size,
                       b"maximum-mutable-share-size": MAX_MUTABLE_SHARE_SIZE,
                       b"available-space": remaining_space,
                       b"tolerates-immutable-read-overrun": True,
                       b"delete-mutable-shares-with-zero-length-writev": True,
                       b"fills-holes-with-zero-bytes": True,
                       b"prevents-read-past-end-of-share-data": True,
+                      b"get-buckets-many": True,
+                      b"slot-readv-many": True,
                       },
                     b"application-version": allmydata.__full_version__.encode("utf-8"),
                     }
@@ -277,7 +840,7 @@ class StorageServer(service.MultiService, Referenceable):
     def _allocate_buckets(self, storage_index,
                           renew_secret, cancel_secret,
                           sharenums, allocated_size,
-                          owner_num=0):
+                          owner_num=0, client=None):
         """
         Generic bucket allocation API.
         """
@@ -304,13 +867,30 @@ class StorageServer(service.MultiService, Referenceable):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
+        # small shares are packed rather than moved into a bucket directory
+        pack = None
+        if (self._pack_max_share_size is not None and
+            max_space_per_bucket <= self._pack_max_share_size):
+            pack = self.pack
+
+        # All of a bucket's shares go in the same share directory: the one
+        # it is already in, if any.
+        sharedir = self.sharedir
+        if len(self.sharedirs) > 1 and pack is None:
+            bucketdir = self._existing_bucketdir(si_dir)
+            if bucketdir is not None:
+                sharedir = os.path.dirname(os.path.dirname(bucketdir))
+            else:
+                sharedir = (self._choose_sharedir(max_space_per_bucket)
+                            or self.sharedir)
+
+        remaining_space = self._available_space_in(sharedir)
         limited = remaining_space is not None
         if limited:
             # this is a bit conservative, since some of this allocated_size()
             # has already been written to disk, where it will show up in
             # get_available_space.
-            remaining_space -= self.allocated_size()
+            remaining_space -= self._allocated_in[sharedir]
         # self.readonly_storage causes remaining_space <= 0
 
         # fill alreadygot with all shares that we have, not just the ones
@@ -319,16 +899,18 @@ class StorageServer(service.MultiService, Referenceable):
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
+            sf = self._open_share_file(fn)
             sf.add_or_renew_lease(lease_info)
 
+        incomingdir = os.path.join(sharedir, 'incoming')
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            incominghome = os.path.join(incomingdir, si_dir, "%d" % shnum)
+            finalhome = os.path.join(sharedir, si_dir, "%d" % shnum)
+            if shnum in alreadygot or os.path.exists(finalhome):
                 # great! we already have it. easy.
                 pass
-            elif os.path.exists(incominghome):
+            elif [d for d in self.incomingdirs
+                  if os.path.exists(os.path.join(d, si_dir, "%d" % shnum))]:
                 # For Foolscap we don't create BucketWriters for shnums that
                 # have a partial share (in incoming/), so if a second upload
                 # occurs while the first is still in progress, the second
@@ -336,20 +918,35 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
-                bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info)
+                try:
+                    bw = BucketWriter(self, incominghome, finalhome,
+                                      max_space_per_bucket, lease_info,
+                                      executor=self._io,
+                                      committer=self._committer,
+                                      preallocate=self._preallocate,
+                                      pack=pack, client=client)
+                except EnvironmentError as e:
+                    if e.errno not in NO_SPACE_ERRNOS:
+                        raise
+                    # the disk is fuller than the statistics said
+                    log.msg("no space to preallocate %s" % (incominghome,),
+                            level=log.UNUSUAL)
+                    continue
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
                 self._bucket_writers[incominghome] = bw
+                self._allocated += max_space_per_bucket
+                self._allocated_in[sharedir] += max_space_per_bucket
+                self._writers_in[sharedir] += 1
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
+        if bucketwriters and pack is None:
+            fileutil.make_dirs(os.path.join(sharedir, si_dir))
 
         self.add_latency("allocate", self._get_current_time() - start)
         return alreadygot, bucketwriters
@@ -357,11 +954,11 @@ class StorageServer(service.MultiService, Referenceable):
     def remote_allocate_buckets(self, storage_index,
                                 renew_secret, cancel_secret,
                                 sharenums, allocated_size,
-                                canary, owner_num=0):
+                                canary, owner_num=0, client=None):
         """Foolscap-specific ``allocate_buckets()`` API."""
         alreadygot, bucketwriters = self._allocate_buckets(
             storage_index, renew_secret, cancel_secret, sharenums, allocated_size,
-            owner_num=owner_num,
+            owner_num=owner_num, client=client,
         )
         # Abort BucketWriters if disconnection happens.
         for bw in bucketwriters.values():
@@ -371,21 +968,52 @@ class StorageServer(service.MultiService, Referenceable):
 
     def _iter_share_files(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
+            if self.pack is not None and self.pack.has_share(filename):
+                yield self.pack.open_share(filename, lease_db=self._lease_db)
+                continue
             with open(filename, 'rb') as f:
                 header = f.read(32)
             if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+                sf = MutableShareFile(filename, self, self._lease_db,
+                                      self._fd_cache)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
             elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+                sf = ShareFile(filename, lease_db=self._lease_db,
+                               fd_cache=self._fd_cache)
             else:
                 continue # non-sharefile
             yield sf
 
+    def for_client(self, client):
+        """
+        :param client: The tubid of a client, or None if it is not known.
+
+        :return: What the remote calls which ``client`` makes to me over
+            its connection (through a ``ClientBroker``) should go to.
+        """
+        if self.scheduler is None:
+            return self
+        return _ClientStorageServer(self, client)
+
+    def _schedule(self, client, priority, f, *args):
+        """
+        Call ``f(*args)`` on the reactor thread when the scheduler (if any)
+        starts it, for ``client``.
+        """
+        if self.scheduler is None:
+            return f(*args)
+        return self.scheduler.submit(client, priority, f, *args)
+
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
-                         owner_num=1):
+                         owner_num=1, client=None):
+        return self._schedule(client, PRIORITY_LEASE, self._add_lease,
+                              storage_index, renew_secret, cancel_secret,
+                              owner_num)
+
+    def _add_lease(self, storage_index, renew_secret, cancel_secret,
+                   owner_num):
         start = self._get_current_time()
         self.count("add-lease")
         new_expire_time = self._get_current_time() + DEFAULT_RENEWAL_TIME
@@ -397,7 +1025,11 @@ class StorageServer(service.MultiService, Referenceable):
         self.add_latency("add-lease", self._get_current_time() - start)
         return None
 
-    def remote_renew_lease(self, storage_index, renew_secret):
+    def remote_renew_lease(self, storage_index, renew_secret, client=None):
+        return self._schedule(client, PRIORITY_LEASE, self._renew_lease,
+                              storage_index, renew_secret)
+
+    def _renew_lease(self, storage_index, renew_secret):
         start = self._get_current_time()
         self.count("renew")
         new_expire_time = self._get_current_time() + DEFAULT_RENEWAL_TIME
@@ -413,34 +1045,114 @@ class StorageServer(service.MultiService, Referenceable):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
         del self._bucket_writers[bw.incominghome]
+        self._allocated -= bw.allocated_size()
+        sharedir = self._sharedir_of(bw.incominghome)
+        self._allocated_in[sharedir] -= bw.allocated_size()
+        self._writers_in[sharedir] -= 1
+        disk_stats = self._disk_stats.get(self._disk_of.get(sharedir, sharedir))
+        if disk_stats is not None:
+            disk_stats.consume(consumed_size)
         if bw in self._bucket_writer_disconnect_markers:
             canary, disconnect_marker = self._bucket_writer_disconnect_markers.pop(bw)
             canary.dontNotifyOnDisconnect(disconnect_marker)
+        if consumed_size:
+            # the share was moved into place (an aborted upload consumes
+            # nothing)
+            (bucketdir, shnum) = os.path.split(bw.finalhome)
+            self.share_added(os.path.basename(bucketdir), int(shnum),
+                             "immutable", bw.finalhome)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        si_filter = self._si_filter
+        if si_filter is None or not si_filter.is_ready():
+            for share in self._find_bucket_shares(storage_index):
+                yield share
+            return
+        if not si_filter.might_contain(si_b2a(storage_index)):
+            return
+        found = False
+        for share in self._find_bucket_shares(storage_index):
+            found = True
+            yield share
+        if not found:
+            si_filter.record_false_positive()
+
+    def _find_bucket_shares(self, storage_index):
+        si_dir = storage_index_to_dir(storage_index)
+        storagedir = os.path.join(self.sharedir, si_dir)
+        catalog = self._share_catalog
+        if catalog is not None and catalog.is_complete():
+            si_b32 = storage_index_to_b32(storage_index)
+            shares = catalog.get_shares(si_b32)
+            if shares:
+                storagedir = self._bucketdir(si_dir)
+            for (shnum, sharetype, size) in shares:
+                yield (shnum, os.path.join(storagedir, "%d" % shnum))
+            return
+        if self.pack is not None:
+            si_b32 = storage_index_to_b32(storage_index)
+            for shnum in self.pack.list_shares(si_b32):
+                yield (shnum, os.path.join(storagedir, "%d" % shnum))
+        for sharedir in self.sharedirs:
+            storagedir = os.path.join(sharedir, si_dir)
+            try:
+                for f in os.listdir(storagedir):
+                    if NUM_RE.match(f):
+                        filename = os.path.join(storagedir, f)
+                        yield (int(f), filename)
+            except OSError:
+                # Commonly caused by there being no buckets at all.
+                pass
 
-    def remote_get_buckets(self, storage_index):
+    def remote_get_buckets(self, storage_index, client=None):
         start = self._get_current_time()
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %r" % si_s)
+        def _done(bucketreaders):
+            self.add_latency("get", self._get_current_time() - start)
+            return bucketreaders
+        return call_io(self._io, None,
+                       lambda: self._get_bucket_readers(storage_index, client),
+                       _done, client=client)
+
+    def remote_get_buckets_many(self, storage_indexes, client=None):
+        start = self._get_current_time()
+        self.count("get-many")
+        log.msg("storage: get_buckets_many for %d storage indexes"
+                % len(storage_indexes))
+        self.count("get", len(storage_indexes))
+        def _get():
+            results = {}
+            for storage_index in storage_indexes:
+                bucketreaders = self._get_bucket_readers(storage_index,
+                                                         client)
+                if bucketreaders:
+                    results[storage_index] = bucketreaders
+            return results
+        def _done(results):
+            self.add_latency("get-many", self._get_current_time() - start)
+            return results
+        return call_io(self._io, None, _get, _done, client=client)
+
+    def _get_bucket_readers(self, storage_index, client=None):
         bucketreaders = {} # k: sharenum, v: BucketReader
+        filenames = []
         for shnum, filename in self._get_bucket_shares(storage_index):
             bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", self._get_current_time() - start)
+                                                storage_index, shnum,
+                                                fd_cache=self._fd_cache,
+                                                executor=self._io,
+                                                pack=self.pack,
+                                                block_cache=self._block_cache,
+                                                read_ahead=self._read_ahead_blocks,
+                                                read_ahead_stats=self._read_ahead_stats,
+                                                client=client)
+            filenames.append(filename)
+        self._record_read(storage_index, filenames)
         return bucketreaders
 
     def get_leases(self, storage_index):
@@ -455,7 +1167,7 @@ class StorageServer(service.MultiService, Referenceable):
         # from the first share
         try:
             shnum, filename = next(self._get_bucket_shares(storage_index))
-            sf = ShareFile(filename)
+            sf = self._open_share_file(filename)
             return sf.get_leases()
         except StopIteration:
             return iter([])
@@ -473,12 +1185,12 @@ class StorageServer(service.MultiService, Referenceable):
             return share.get_leases()
         return []
 
-    def _collect_mutable_shares_for_storage_index(self, bucketdir, write_enabler, si_s):
+    def _collect_mutable_shares_for_storage_index(self, storage_index, write_enabler, si_s):
         """
         Gather up existing mutable shares for the given storage index.
 
-        :param bytes bucketdir: The filesystem path containing shares for the
-            given storage index.
+        :param bytes storage_index: The storage index for which to collect
+            shares.
 
         :param bytes write_enabler: The write enabler secret for the shares.
 
@@ -491,17 +1203,12 @@ class StorageServer(service.MultiService, Referenceable):
             from integer share numbers to ``MutableShareFile`` instances.
         """
         shares = {}
-        if os.path.isdir(bucketdir):
-            # shares exist if there is a file for them
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        # shares exist if there is a file for them
+        for sharenum, filename in self._get_bucket_shares(storage_index):
+            msf = MutableShareFile(filename, self, self._lease_db,
+                                   self._fd_cache)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         return shares
 
     def _evaluate_test_vectors(self, test_and_write_vectors, shares):
@@ -548,10 +1255,12 @@ class StorageServer(service.MultiService, Referenceable):
             read_data[sharenum] = share.readv(read_vector)
         return read_data
 
-    def _evaluate_write_vectors(self, bucketdir, secrets, test_and_write_vectors, shares):
+    def _evaluate_write_vectors(self, storage_index, bucketdir, secrets, test_and_write_vectors, shares):
         """
         Execute write vectors against share data.
 
+        :param bytes storage_index: The storage index the shares belong to.
+
         :param bytes bucketdir: The parent directory holding the shares.  This
             is removed if the last share is removed from it.  If shares are
             created, they are created in it.
@@ -569,15 +1278,38 @@ class StorageServer(service.MultiService, Referenceable):
         :return dict[int, MutableShareFile]: The shares which still exist
             after applying the vectors.
         """
+        (remaining_shares, changes) = self._apply_write_vectors(
+            storage_index, bucketdir, secrets, test_and_write_vectors, shares)
+        self._report_share_changes(changes)
+        return remaining_shares
+
+    def _apply_write_vectors(self, storage_index, bucketdir, secrets, test_and_write_vectors, shares):
+        """
+        Do the disk I/O part of ``_evaluate_write_vectors``, without telling
+        anything about the shares which were created, modified or removed.
+        This may be called from an ``IOExecutor`` thread.
+
+        :return: A 2-tuple of the shares which still exist after applying the
+            vectors, and a list of changes for ``_report_share_changes``.
+        """
         remaining_shares = {}
+        changes = []
+        si_b32 = storage_index_to_b32(storage_index)
+        # the number of shares in the bucket, as the changes are reported
+        num_shares = len(shares)
 
         for sharenum in test_and_write_vectors:
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
             if new_length == 0:
                 if sharenum in shares:
                     shares[sharenum].unlink()
+                    self._invalidate_header(storage_index, sharenum)
+                    num_shares -= 1
+                    changes.append(("removed", si_b32, sharenum, None,
+                                    num_shares == 0))
             else:
-                if sharenum not in shares:
+                created = sharenum not in shares
+                if created:
                     # allocate a new share
                     allocated_size = 2000 # arbitrary, really
                     share = self._allocate_slot_share(bucketdir, secrets,
@@ -586,6 +1318,12 @@ class StorageServer(service.MultiService, Referenceable):
                                                       owner_num=0)
                     shares[sharenum] = share
                 shares[sharenum].writev(datav, new_length)
+                self._invalidate_header(storage_index, sharenum)
+                if created:
+                    num_shares += 1
+                changes.append(("added" if created else "modified",
+                                si_b32, sharenum, shares[sharenum].home,
+                                num_shares == 1))
                 remaining_shares[sharenum] = shares[sharenum]
 
             if new_length == 0:
@@ -594,7 +1332,40 @@ class StorageServer(service.MultiService, Referenceable):
                 # truncate a share we weren't even holding.
                 if os.path.exists(bucketdir) and [] == os.listdir(bucketdir):
                     os.rmdir(bucketdir)
-        return remaining_shares
+        return (remaining_shares, changes)
+
+    def _invalidate_header(self, storage_index, sharenum):
+        # while the slot is still locked, so that no read of the old data
+        # can be answered from the cache once the write has been answered
+        if self._header_cache is not None:
+            self._header_cache.invalidate(storage_index, sharenum)
+
+    def _report_share_changes(self, changes):
+        for (change, si_b32, sharenum, filename, bucket_changed) in changes:
+            if change == "removed":
+                self.share_removed(si_b32, sharenum, bucket_changed)
+            elif change == "added":
+                self.share_added(si_b32, sharenum, "mutable", filename,
+                                 bucket_changed)
+            else:
+                self.share_modified(si_b32, sharenum, "mutable", filename)
+
+    def _changed_paths(self, bucketdir, changes):
+        """
+        :return: The files and directories which must be synced to make the
+            changes returned by ``_apply_write_vectors`` durable.
+        """
+        paths = set()
+        for (change, si_b32, sharenum, filename, bucket_changed) in changes:
+            if filename is not None:
+                paths.add(filename)
+            if change != "modified":
+                # the bucket directory gained or lost an entry, and so did
+                # its parent if the bucket directory itself came or went
+                paths.add(bucketdir)
+                if bucket_changed:
+                    paths.add(os.path.dirname(bucketdir))
+        return paths
 
     def _make_lease_info(self, renew_secret, cancel_secret):
         """
@@ -626,6 +1397,7 @@ class StorageServer(service.MultiService, Referenceable):
             test_and_write_vectors,
             read_vector,
             renew_leases,
+            client=None,
     ):
         """
         Read data from shares and conditionally write some data to them.
@@ -634,6 +1406,9 @@ class StorageServer(service.MultiService, Referenceable):
             vectors pass then shares in this slot will also have an updated
             lease applied to them.
 
+        :param client: The tubid of the client writing, for the scheduler, or
+            None if it is not known.
+
         See ``allmydata.interfaces.RIStorageServer`` for details about other
         parameters and return value.
         """
@@ -644,53 +1419,112 @@ class StorageServer(service.MultiService, Referenceable):
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         bucketdir = os.path.join(self.sharedir, si_dir)
+        if len(self.sharedirs) > 1:
+            bucketdir = self._existing_bucketdir(si_dir)
+            if bucketdir is None:
+                sharedir = self._choose_sharedir(0) or self.sharedir
+                bucketdir = os.path.join(sharedir, si_dir)
+
+        def _read():
+            # If collection succeeds we know the write_enabler is good for
+            # all existing shares.
+            shares = self._collect_mutable_shares_for_storage_index(
+                storage_index,
+                write_enabler,
+                si_s,
+            )
 
-        # If collection succeeds we know the write_enabler is good for all
-        # existing shares.
-        shares = self._collect_mutable_shares_for_storage_index(
-            bucketdir,
-            write_enabler,
-            si_s,
-        )
-
-        # Now evaluate test vectors.
-        testv_is_good = self._evaluate_test_vectors(
-            test_and_write_vectors,
-            shares,
-        )
+            # Now evaluate test vectors.
+            testv_is_good = self._evaluate_test_vectors(
+                test_and_write_vectors,
+                shares,
+            )
 
-        # now gather the read vectors, before we do any writes
-        read_data = self._evaluate_read_vectors(
-            read_vector,
-            shares,
-        )
+            # now gather the read vectors, before we do any writes
+            read_data = self._evaluate_read_vectors(
+                read_vector,
+                shares,
+            )
+            return (shares, testv_is_good, read_data)
 
-        if testv_is_good:
+        def _write(shares):
             # now apply the write vectors
-            remaining_shares = self._evaluate_write_vectors(
+            return self._apply_write_vectors(
+                storage_index,
                 bucketdir,
                 secrets,
                 test_and_write_vectors,
                 shares,
             )
+
+        def _written(result):
+            (remaining_shares, changes) = result
+            self._report_share_changes(changes)
             if renew_leases:
                 lease_info = self._make_lease_info(renew_secret, cancel_secret)
                 self._add_or_renew_leases(remaining_shares, lease_info)
-
-        # all done
-        self.add_latency("writev", self._get_current_time() - start)
-        return (testv_is_good, read_data)
+            return changes
+
+        def _commit(changes):
+            # with durable writes, the answer waits for a group commit
+            if self._committer is None:
+                return None
+            return self._committer.sync(self._changed_paths(bucketdir, changes))
+
+        def _done(testv_is_good, read_data):
+            # all done
+            self.add_latency("writev", self._get_current_time() - start)
+            return (testv_is_good, read_data)
+
+        if self._io is None:
+            (shares, testv_is_good, read_data) = _read()
+            if testv_is_good:
+                d = _commit(_written(_write(shares)))
+                if d is not None:
+                    d.addCallback(lambda ign: _done(testv_is_good, read_data))
+                    return d
+            return _done(testv_is_good, read_data)
+
+        # The reads and writes happen in I/O threads, but the slot stays
+        # locked until the leases (which live in the lease database) have
+        # been added, so no other operation sees it half-way through. It is
+        # unlocked before the commit, so the next write to the slot can join
+        # the same batch.
+        commits = []
+        request = self._io.request_for(client, PRIORITY_WRITE)
+        def _locked():
+            d = self._io.run_for(request, _read)
+            def _maybe_write(res):
+                (shares, testv_is_good, read_data) = res
+                if not testv_is_good:
+                    return (testv_is_good, read_data)
+                d2 = self._io.run(_write, shares)
+                d2.addCallback(_written)
+                d2.addCallback(lambda changes: commits.append(_commit(changes)))
+                d2.addCallback(lambda ign: (testv_is_good, read_data))
+                return d2
+            d.addCallback(_maybe_write)
+            return d
+        d = self._io.serialize(storage_index, _locked)
+        def _committed(res):
+            if not commits or commits[0] is None:
+                return _done(*res)
+            commits[0].addCallback(lambda ign: _done(*res))
+            return commits[0]
+        d.addCallback(_committed)
+        return d
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
                                                secrets,
                                                test_and_write_vectors,
-                                               read_vector):
+                                               read_vector, client=None):
         return self.slot_testv_and_readv_and_writev(
             storage_index,
             secrets,
             test_and_write_vectors,
             read_vector,
             renew_leases=True,
+            client=client,
         )
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
@@ -700,34 +1534,65 @@ class StorageServer(service.MultiService, Referenceable):
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, self._lease_db, self._fd_cache)
         return share
 
-    def remote_slot_readv(self, storage_index, shares, readv):
+    def remote_slot_readv(self, storage_index, shares, readv, client=None):
         start = self._get_current_time()
         self.count("readv")
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %r %r" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _done(datavs):
+            log.msg("returning shares %s" % (list(datavs.keys()),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", self._get_current_time() - start)
-            return {}
+            return datavs
+        return call_io(self._io, storage_index,
+                       lambda: self._slot_readv(storage_index, shares, readv),
+                       _done, client=client)
+
+    def remote_slot_readv_many(self, reads, client=None):
+        start = self._get_current_time()
+        self.count("readv-many")
+        log.msg("storage: slot_readv_many for %d slots" % len(reads),
+                facility="tahoe.storage", level=log.OPERATIONAL)
+        self.count("readv", len(reads))
+        def _done(results):
+            self.add_latency("readv-many", self._get_current_time() - start)
+            return results
+        if self._io is None:
+            return _done([self._slot_readv(storage_index, shares, readv)
+                          for (storage_index, shares, readv) in reads])
+        # each read is ordered with the writes to its own slot
+        request = self._io.request_for(client, PRIORITY_READ)
+        d = defer.gatherResults([
+            self._io.serialize(storage_index, self._io.run_for, request,
+                               self._slot_readv, storage_index, shares, readv)
+            for (storage_index, shares, readv) in reads
+        ], consumeErrors=True)
+        def _first_error(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addCallbacks(_done, _first_error)
+        return d
+
+    def _slot_readv(self, storage_index, shares, readv):
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        filenames = []
+        # shares exist if there is a file for them
+        for sharenum, filename in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (list(datavs.keys()),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", self._get_current_time() - start)
+                msf = MutableShareFile(filename, self,
+                                       fd_cache=self._fd_cache)
+                if self._header_cache is None:
+                    datavs[sharenum] = msf.readv(readv)
+                else:
+                    datavs[sharenum] = self._header_cache.readv(
+                        storage_index, sharenum, readv,
+                        partial(msf.readv, readv))
+                filenames.append(filename)
+        self._record_read(storage_index, filenames)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
@@ -757,3 +1622,61 @@ class StorageServer(service.MultiService, Referenceable):
                 share_type=share_type, si=si_s, shnum=shnum, reason=reason,
                 level=log.SCARY, umid="SGx2fA")
         return None
+
+
+@implementer(RIStorageServer)
+class _ClientStorageServer(Referenceable):  # type: ignore # warner/foolscap#78
+    """
+    I am a ``StorageServer`` as one client's connection sees it: the
+    operations of the remote calls I receive are queued for that client.
+    """
+
+    def __init__(self, server, client):
+        self._server = server
+        self._client = client
+
+    def remote_get_version(self):
+        return self._server.remote_get_version()
+
+    def remote_allocate_buckets(self, storage_index,
+                                renew_secret, cancel_secret,
+                                sharenums, allocated_size,
+                                canary, owner_num=0):
+        return self._server.remote_allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums,
+            allocated_size, canary, owner_num, client=self._client)
+
+    def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
+                         owner_num=1):
+        return self._server.remote_add_lease(
+            storage_index, renew_secret, cancel_secret, owner_num,
+            client=self._client)
+
+    def remote_get_buckets(self, storage_index):
+        return self._server.remote_get_buckets(storage_index,
+                                               client=self._client)
+
+    def remote_get_buckets_many(self, storage_indexes):
+        return self._server.remote_get_buckets_many(storage_indexes,
+                                                    client=self._client)
+
+    def remote_slot_testv_and_readv_and_writev(self, storage_index,
+                                               secrets,
+                                               test_and_write_vectors,
+                                               read_vector):
+        return self._server.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, read_vector,
+            client=self._client)
+
+    def remote_slot_readv(self, storage_index, shares, readv):
+        return self._server.remote_slot_readv(storage_index, shares, readv,
+                                              client=self._client)
+
+    def remote_slot_readv_many(self, reads):
+        return self._server.remote_slot_readv_many(reads,
+                                                   client=self._client)
+
+    def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
+                                    reason):
+        return self._server.remote_advise_corrupt_share(
+            share_type, storage_index, shnum, reason)
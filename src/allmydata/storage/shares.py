@@ -14,11 +14,13 @@ if PY2:
 from allmydata.storage.mutable import MutableShareFile
 from allmydata.storage.immutable import ShareFile
 
-def get_share_file(filename):
+def get_share_file(filename, lease_db=None, pack=None):
+    if pack is not None and pack.has_share(filename):
+        return pack.open_share(filename, lease_db=lease_db)
     with open(filename, "rb") as f:
         prefix = f.read(32)
     if prefix == MutableShareFile.MAGIC:
-        return MutableShareFile(filename)
+        return MutableShareFile(filename, lease_db=lease_db)
     # otherwise assume it's immutable
-    return ShareFile(filename)
+    return ShareFile(filename, lease_db=lease_db)
 
@@ -0,0 +1,356 @@
+"""
+Keep frequently read buckets in a fast "hot" share directory.
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, shutil, threading
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from allmydata.util import fileutil, log
+from allmydata.storage.common import si_a2b
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.commit import fsync_path
+
+# Default number of reads (roughly, within a cycle of the migrator) which
+# make a bucket hot.
+DEFAULT_PROMOTE_AFTER = 3
+
+# Default number of storage indexes whose reads are counted.
+DEFAULT_TRACKED = 100000
+
+
+class ReadTracker(object):
+    """
+    I count the reads of the ``capacity`` most recently read storage
+    indexes, forgetting the least recently read ones first, and count how
+    many reads were served from each tier.
+
+    I may be used from I/O threads.
+    """
+
+    def __init__(self, capacity=DEFAULT_TRACKED):
+        self.capacity = capacity
+        self._reads = OrderedDict() # storage_index_b32 -> reads, LRU first
+        self._lock = threading.Lock()
+        self.hot_reads = 0
+        self.cold_reads = 0
+
+    def __len__(self):
+        return len(self._reads)
+
+    def record_read(self, storage_index_b32, hot):
+        """
+        Note that the bucket ``storage_index_b32`` was read, from the hot
+        tier if ``hot``.
+        """
+        with self._lock:
+            reads = self._reads.pop(storage_index_b32, 0)
+            self._reads[storage_index_b32] = reads + 1
+            if len(self._reads) > self.capacity:
+                self._reads.popitem(last=False)
+            if hot:
+                self.hot_reads += 1
+            else:
+                self.cold_reads += 1
+
+    def get_reads(self, storage_index_b32):
+        with self._lock:
+            return self._reads.get(storage_index_b32, 0)
+
+    def decay(self):
+        """
+        Halve every count, forgetting the storage indexes whose count
+        reaches zero, so that old reads matter less than recent ones.
+        """
+        with self._lock:
+            for storage_index_b32, reads in list(self._reads.items()):
+                if reads // 2:
+                    self._reads[storage_index_b32] = reads // 2
+                else:
+                    del self._reads[storage_index_b32]
+
+    def get_stats(self):
+        with self._lock:
+            stats = {"hot_reads": self.hot_reads,
+                     "cold_reads": self.cold_reads,
+                     "tracked": len(self._reads),
+                     }
+            reads = self.hot_reads + self.cold_reads
+            if reads:
+                stats["hit_ratio"] = self.hot_reads / reads
+            return stats
+
+
+def get_dir_size(dirname):
+    """Return the total size of the files below ``dirname``, leaving out
+    its ``incoming/``."""
+    total = 0
+    for (root, dirs, files) in os.walk(dirname):
+        if root == dirname and "incoming" in dirs:
+            dirs.remove("incoming")
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except EnvironmentError:
+                pass # removed behind our back
+    return total
+
+
+class TierMigrator(ShareCrawler):
+    """
+    I move buckets between the hot share directory (``hotdir``, usually on
+    an SSD) and the server's other share directories, which make up the
+    capacity tier.
+
+    The server tells my ``tracker`` about every read. A bucket read at least
+    ``promote_after`` times is moved into the hot tier when I come across
+    it, if that leaves no more than ``max_size`` bytes there (and the disk
+    has room). The counts are halved after every cycle, so a hot bucket
+    which is no longer read is moved back out a few cycles later, or as soon
+    as the hot tier is over ``max_size`` and the bucket is not hot enough to
+    have been promoted.
+
+    Buckets which are being uploaded or written to are left alone until the
+    next cycle. A bucket is moved between filesystems by copying it into the
+    destination's ``incoming/`` and syncing it, renaming it into place and
+    only then deleting the original, so it can be read from one directory
+    or the other all the time. If the node is killed between the last two
+    steps there are two copies: the one in the hot tier is deleted when I
+    find them.
+
+    If the server has I/O threads, the copying and syncing is done in them,
+    one bucket at a time, while the writes to that bucket wait; a bucket
+    which changed while it was being copied stays where it was.
+
+    The bytes copied count against my ``max_bytes_per_second``.
+    """
+
+    slow_start = 60
+    minimum_cycle_time = 10*60
+
+    def __init__(self, server, statefile, hotdir, max_size=None,
+                 promote_after=DEFAULT_PROMOTE_AFTER, tracker=None):
+        ShareCrawler.__init__(self, server, statefile)
+        self.hotdir = hotdir
+        self.max_size = max_size
+        self.promote_after = promote_after
+        if tracker is None:
+            tracker = ReadTracker()
+        self.tracker = tracker
+        self.hot_bytes = None
+        # cycles finished since the tracker started counting: until then,
+        # a bucket might be hot but not have been read yet
+        self._cycles_tracked = 0
+        # storage_index_b32 -> Deferred, for the moves done in I/O threads
+        # which have yet to finish
+        self._moving = {}
+        self._move_lock = defer.DeferredLock()
+
+    def stopService(self):
+        # let a copy which has started finish, so that it is not left behind
+        # in incoming/: the moves still waiting give up when they see we
+        # have stopped
+        moves = list(self._moving.values())
+        d = defer.maybeDeferred(ShareCrawler.stopService, self)
+        d.addCallback(lambda ign: defer.DeferredList(moves))
+        return d
+
+    def add_initial_state(self):
+        self.state.setdefault("promoted-buckets", 0)
+        self.state.setdefault("demoted-buckets", 0)
+        self.state.setdefault("migrated-bytes", 0)
+
+    def started_cycle(self, cycle):
+        # shares may have been deleted from the hot tier, or added to it
+        self.hot_bytes = get_dir_size(self.hotdir)
+
+    def finished_cycle(self, cycle):
+        self.tracker.decay()
+        self._cycles_tracked += 1
+
+    def get_hot_bytes(self):
+        if self.hot_bytes is None:
+            self.hot_bytes = get_dir_size(self.hotdir)
+        return self.hot_bytes
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        if storage_index_b32 in self._moving:
+            return
+        hot_bucketdir = os.path.join(self.hotdir, prefix, storage_index_b32)
+        cold_bucketdirs = [os.path.join(d, prefix, storage_index_b32)
+                           for d in self.sharedirs if d != self.hotdir]
+        cold_bucketdirs = [d for d in cold_bucketdirs if os.path.isdir(d)]
+        is_hot = os.path.isdir(hot_bucketdir)
+        self.charge_io(len(self.sharedirs))
+        if is_hot and cold_bucketdirs:
+            # an interrupted move: both copies are complete
+            self.hot_bytes = self.get_hot_bytes() - self._size(hot_bucketdir)
+            fileutil.rm_dir(hot_bucketdir)
+            self.server.bucket_moved(storage_index_b32, hot_bucketdir,
+                                     cold_bucketdirs[0])
+            return
+        if not (is_hot or cold_bucketdirs):
+            return # all its shares are packed
+        if self.server.bucket_busy(storage_index_b32):
+            return
+        reads = self.tracker.get_reads(storage_index_b32)
+        if is_hot:
+            over = (self.max_size is not None and
+                    self.get_hot_bytes() > self.max_size)
+            if ((reads == 0 and self._cycles_tracked) or
+                (over and reads < self.promote_after)):
+                self._demote(storage_index_b32, prefix, hot_bucketdir)
+        elif reads >= self.promote_after:
+            self._promote(storage_index_b32, prefix, cold_bucketdirs[0])
+
+    def _size(self, bucketdir):
+        filenames = os.listdir(bucketdir)
+        self.charge_io(1 + len(filenames))
+        return sum(os.path.getsize(os.path.join(bucketdir, f))
+                   for f in filenames)
+
+    def _promote(self, storage_index_b32, prefix, bucketdir):
+        size = self._size(bucketdir)
+        if (self.max_size is not None and
+            self.get_hot_bytes() + size > self.max_size):
+            return
+        avail = self.server._available_space_in(self.hotdir)
+        if avail is not None and avail < size:
+            return
+        self._move(storage_index_b32, bucketdir,
+                   os.path.join(self.hotdir, prefix, storage_index_b32), size,
+                   "promoted-buckets")
+        self.hot_bytes = self.get_hot_bytes() + size
+
+    def _demote(self, storage_index_b32, prefix, bucketdir):
+        size = self._size(bucketdir)
+        sharedir = self.server._choose_sharedir(size)
+        if sharedir is None:
+            return # nowhere has room
+        self._move(storage_index_b32, bucketdir,
+                   os.path.join(sharedir, prefix, storage_index_b32), size,
+                   "demoted-buckets")
+        self.hot_bytes = max(0, self.get_hot_bytes() - size)
+
+    def _same_filesystem(self, a, b):
+        return os.stat(a).st_dev == os.stat(b).st_dev
+
+    def _move(self, storage_index_b32, bucketdir, newbucketdir, size, counter):
+        # The hot tier's size is updated by our caller straight away, so that
+        # it does not promote too much while the copies are made, and worked
+        # out again at the start of the next cycle. ``counter`` is only
+        # counted once the bucket is in its new place.
+        parent = os.path.dirname(newbucketdir)
+        fileutil.make_dirs(parent)
+        if self._same_filesystem(bucketdir, parent):
+            os.rename(bucketdir, newbucketdir)
+            self.charge_io(1)
+            self._moved(storage_index_b32, bucketdir, newbucketdir, counter)
+            return
+        sharedir = os.path.dirname(parent)
+        tmpdir = os.path.join(sharedir, "incoming", "migrating",
+                              storage_index_b32)
+        self.charge_io(3 * len(os.listdir(bucketdir)) + 3, size)
+        executor = self.server._io
+        if executor is None or not executor.running:
+            (files, nbytes) = self._copy_bucket(bucketdir, tmpdir)
+            os.rename(tmpdir, newbucketdir)
+            fsync_path(parent)
+            fileutil.rm_dir(bucketdir)
+            self.state["migrated-bytes"] += nbytes
+            self._moved(storage_index_b32, bucketdir, newbucketdir, counter)
+            return
+        d = self._move_lock.run(
+            executor.serialize, si_a2b(storage_index_b32.encode("ascii")),
+            self._copy_and_move, executor, storage_index_b32, bucketdir,
+            tmpdir, newbucketdir, counter)
+        self._moving[storage_index_b32] = d
+        def _done(res):
+            del self._moving[storage_index_b32]
+            return res
+        d.addBoth(_done)
+        d.addErrback(log.err, "moving bucket %s" % (storage_index_b32,))
+
+    def _list_bucket(self, bucketdir):
+        """Return what ``_copy_bucket`` needs to tell whether a bucket
+        changed while it was being copied."""
+        files = {}
+        for f in os.listdir(bucketdir):
+            st = os.stat(os.path.join(bucketdir, f))
+            files[f] = (st.st_size, st.st_mtime)
+        return files
+
+    def _copy_bucket(self, bucketdir, tmpdir):
+        """Copy the files of ``bucketdir`` into ``tmpdir`` and sync them.
+
+        :return: a tuple of ``_list_bucket(bucketdir)`` from before the copy
+            and the number of bytes copied.
+        """
+        fileutil.rm_dir(tmpdir)
+        fileutil.make_dirs(tmpdir)
+        files = self._list_bucket(bucketdir)
+        nbytes = 0
+        for f in files:
+            tmpfile = os.path.join(tmpdir, f)
+            shutil.copy2(os.path.join(bucketdir, f), tmpfile)
+            fsync_path(tmpfile)
+            nbytes += os.path.getsize(tmpfile)
+        return (files, nbytes)
+
+    @defer.inlineCallbacks
+    def _copy_and_move(self, executor, storage_index_b32, bucketdir, tmpdir,
+                       newbucketdir, counter):
+        # This runs on the reactor thread, with the writes to the bucket
+        # waiting for it, and does the slow parts in the I/O threads. Only
+        # uploads and lease renewals can get at the bucket in the meantime.
+        def _unchanged(files):
+            return (os.path.isdir(bucketdir) and
+                    not self.server.bucket_uploading(storage_index_b32) and
+                    self._list_bucket(bucketdir) == files)
+        if not (self.running and executor.running and
+                os.path.isdir(bucketdir)):
+            return
+        (files, nbytes) = yield executor.run(self._copy_bucket, bucketdir,
+                                             tmpdir)
+        if not (self.running and executor.running and _unchanged(files)):
+            fileutil.rm_dir(tmpdir)
+            return
+        os.rename(tmpdir, newbucketdir)
+        if executor.running:
+            yield executor.run(fsync_path, os.path.dirname(newbucketdir))
+        else:
+            fsync_path(os.path.dirname(newbucketdir))
+        if not _unchanged(files):
+            # use the original, which has had a lease added to it
+            fileutil.rm_dir(newbucketdir)
+            return
+        fileutil.rm_dir(bucketdir)
+        self.state["migrated-bytes"] += nbytes
+        self._moved(storage_index_b32, bucketdir, newbucketdir, counter)
+
+    def _moved(self, storage_index_b32, bucketdir, newbucketdir, counter):
+        self.state[counter] += 1
+        self.server.bucket_moved(storage_index_b32, bucketdir, newbucketdir)
+        log.msg(format="moved bucket %(si)s to %(dir)s", si=storage_index_b32,
+                dir=newbucketdir, facility="tahoe.storage")
+
+    def get_stats(self):
+        stats = self.tracker.get_stats()
+        stats["promoted"] = self.state["promoted-buckets"]
+        stats["demoted"] = self.state["demoted-buckets"]
+        stats["migrated_bytes"] = self.state["migrated-bytes"]
+        if self.hot_bytes is not None:
+            stats["hot_bytes"] = self.hot_bytes
+        return stats
@@ -50,7 +50,7 @@ from zope.interface import (
     Interface,
     implementer,
 )
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.application import service
 from twisted.plugin import (
     getPlugins,
@@ -68,6 +68,8 @@ from allmydata.interfaces import (
     IServer,
     IStorageServer,
     IFoolscapStoragePlugin,
+    MAX_STORAGE_INDEXES_PER_QUERY,
+    MAX_SLOT_READS_PER_QUERY,
 )
 from allmydata.util import log, base32, connection_status
 from allmydata.util.assertutil import precondition
@@ -146,6 +148,67 @@ class StorageClientConfig(object):
         )
 
 
+class ServerSpeed(object):
+    """
+    I keep moving averages of how fast a storage server has been for us:
+    the round-trip time of requests which return little data, and the
+    throughput of those which return whole blocks. Downloads use me to ask
+    the servers which should answer soonest.
+    """
+
+    # how much each new measurement counts, against all the earlier ones
+    WEIGHT = 0.25
+
+    # responses smaller than this measure the round trip, not throughput
+    SMALL_RESPONSE = 4096
+
+    # estimates older than this are not trusted, so that a server which was
+    # slow once, and so stopped being used, gets another chance
+    MAX_AGE = 60.0
+
+    def __init__(self):
+        self.round_trip_time = None
+        self.throughput = None # bytes per second
+        self.last_update = None
+
+    def _average(self, old, new):
+        if old is None:
+            return new
+        return old + self.WEIGHT * (new - old)
+
+    def add_round_trip(self, seconds, when):
+        self.round_trip_time = self._average(self.round_trip_time, seconds)
+        self.last_update = when
+
+    def add_response(self, size, seconds, when):
+        """
+        Note that a read returned ``size`` bytes ``seconds`` after it was
+        sent.
+        """
+        if size < self.SMALL_RESPONSE or seconds <= 0:
+            self.add_round_trip(seconds, when)
+            return
+        self.throughput = self._average(self.throughput, size / seconds)
+        self.last_update = when
+
+    def expected_time(self, size, when):
+        """
+        :return: How many seconds I expect a read of ``size`` bytes to take,
+            or None if I do not know (or have not heard for too long).
+        """
+        if self.last_update is None or when - self.last_update > self.MAX_AGE:
+            return None
+        if size >= self.SMALL_RESPONSE and self.throughput is not None:
+            return size / self.throughput
+        return self.round_trip_time
+
+    def get_stats(self):
+        return {"round_trip_time": self.round_trip_time,
+                "throughput": self.throughput,
+                "last_update": self.last_update,
+                }
+
+
 @implementer(IStorageBroker)
 class StorageFarmBroker(service.MultiService):
     """I live on the client, and know about storage servers. For each server
@@ -192,6 +255,8 @@ class StorageFarmBroker(service.MultiService):
         self.introducer_client = None
         self._threshold_listeners = [] # tuples of (threshold, Deferred)
         self._connected_high_water_mark = 0
+        # serverid -> ServerSpeed, for every server a download has used
+        self._server_speeds = BytesKeyDict()
 
     @log_call(action_type=u"storage-client:broker:set-static-servers")
     def set_static_servers(self, servers):
@@ -431,6 +496,16 @@ class StorageFarmBroker(service.MultiService):
                     permute_server_hash(peer_selection_index, seed))
         return sorted(connected_servers, key=_permuted)
 
+    def get_server_speed(self, server):
+        """
+        :return ServerSpeed: What all our downloads have seen of how fast
+            ``server`` is. Whoever measures it updates it.
+        """
+        serverid = server.get_serverid()
+        if serverid not in self._server_speeds:
+            self._server_speeds[serverid] = ServerSpeed()
+        return self._server_speeds[serverid]
+
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
 
@@ -921,13 +996,51 @@ class _StorageServer(object):
     """
     ``_StorageServer`` is a direct pass-through to an ``RIStorageServer`` via
     a ``RemoteReference``.
+
+    The exceptions are ``get_buckets`` and ``slot_readv``: if the server
+    supports ``get_buckets_many`` (or ``slot_readv_many``), at most
+    ``MAX_LOOKUPS_IN_FLIGHT`` bucket lookups (or slot reads) are sent to it
+    at a time, and the ones requested while those are outstanding (for
+    example by the checkers of a deep-check, by the share finders of several
+    downloads, or by the servermap updates of sibling directories) are then
+    sent together as a single batched message. An idle server sees no extra
+    latency. If a batch fails, its lookups (or reads) are retried one at a
+    time, and a batch which has not been answered after ``BATCH_TIMEOUT``
+    seconds no longer holds back the ones after it.
     """
+    MAX_LOOKUPS_IN_FLIGHT = 2
+    BATCH_TIMEOUT = 60
+
     _get_rref = attr.ib()
+    _clock = attr.ib(default=reactor, repr=False, eq=False)
+    # storage index -> Deferreds waiting for its buckets
+    _pending_lookups = attr.ib(default=attr.Factory(dict), init=False,
+                               repr=False, eq=False)
+    _lookups_in_flight = attr.ib(default=0, init=False, repr=False, eq=False)
+    # (storage_index, shares, readv, Deferred) for each slot read waiting to
+    # be sent
+    _pending_reads = attr.ib(default=attr.Factory(list), init=False,
+                             repr=False, eq=False)
+    _reads_in_flight = attr.ib(default=0, init=False, repr=False, eq=False)
 
     @property
     def _rref(self):
         return self._get_rref()
 
+    def _supports(self, feature):
+        version = getattr(self._rref, "version", None)
+        if not version:
+            return False
+        v1 = version.get(b"http://allmydata.org/tahoe/protocols/storage/v1",
+                         {})
+        return bool(v1.get(feature, False))
+
+    def _supports_get_buckets_many(self):
+        return self._supports(b"get-buckets-many")
+
+    def _supports_slot_readv_many(self):
+        return self._supports(b"slot-readv-many")
+
     def get_version(self):
         return self._rref.callRemote(
             "get_version",
@@ -969,10 +1082,121 @@ class _StorageServer(object):
             self,
             storage_index,
     ):
-        return self._rref.callRemote(
-            "get_buckets",
-            storage_index,
-        )
+        if not self._supports_get_buckets_many():
+            return self._rref.callRemote(
+                "get_buckets",
+                storage_index,
+            )
+        d = defer.Deferred()
+        self._pending_lookups.setdefault(storage_index, []).append(d)
+        self._send_pending_lookups()
+        return d
+
+    def _send_pending_lookups(self):
+        if (not self._pending_lookups or
+            self._lookups_in_flight >= self.MAX_LOOKUPS_IN_FLIGHT):
+            return
+        storage_indexes = sorted(self._pending_lookups)
+        batch = storage_indexes[:MAX_STORAGE_INDEXES_PER_QUERY]
+        waiting = dict((storage_index, self._pending_lookups.pop(storage_index))
+                       for storage_index in batch)
+        self._lookups_in_flight += 1
+        if len(batch) == 1:
+            [storage_index] = batch
+            d = self._rref.callRemote("get_buckets", storage_index)
+            d.addCallback(lambda buckets: {storage_index: buckets})
+        else:
+            d = self._rref.callRemote("get_buckets_many", batch)
+        self._when_batch_done(d, self._lookups_done)
+        d.addCallbacks(self._got_many_buckets, self._get_many_failed,
+                       callbackArgs=(waiting,), errbackArgs=(waiting,))
+
+    def _when_batch_done(self, d, done):
+        """
+        Call ``done`` when the batch ``d`` fires, or after ``BATCH_TIMEOUT``
+        seconds if it has not fired by then: a server which never answers
+        one batch must not hold up all the later ones.
+        """
+        timer = self._clock.callLater(self.BATCH_TIMEOUT, done)
+        def _fired(res):
+            if timer.active():
+                timer.cancel()
+                done()
+            return res
+        d.addBoth(_fired)
+
+    def _lookups_done(self):
+        self._lookups_in_flight -= 1
+        self._send_pending_lookups()
+
+    def _got_many_buckets(self, results, waiting):
+        for (storage_index, ds) in waiting.items():
+            buckets = results.get(storage_index, {})
+            for d in ds:
+                # each caller gets a dictionary it may modify
+                d.callback(dict(buckets))
+
+    def _get_many_failed(self, f, waiting):
+        if len(waiting) > 1:
+            # don't fail every lookup in the batch because of one storage
+            # index the server could not handle: ask for each on its own
+            for (storage_index, ds) in waiting.items():
+                d = self._rref.callRemote("get_buckets", storage_index)
+                d.addCallback(lambda buckets, storage_index=storage_index:
+                              {storage_index: buckets})
+                one = {storage_index: ds}
+                d.addCallbacks(self._got_many_buckets, self._get_many_failed,
+                               callbackArgs=(one,), errbackArgs=(one,))
+            return
+        for ds in waiting.values():
+            for d in ds:
+                d.errback(f)
+
+    def get_buckets_many(
+            self,
+            storage_indexes,
+    ):
+        """
+        Look up the buckets for several storage indexes, in as few messages
+        as the server allows.
+
+        :return Deferred[dict]: Fires with a dictionary mapping each storage
+            index for which the server holds shares to a dictionary of
+            {sharenum: bucket reader}.
+        """
+        storage_indexes = list(storage_indexes)
+        if self._supports_get_buckets_many():
+            queries = [
+                self._rref.callRemote(
+                    "get_buckets_many",
+                    storage_indexes[i:i+MAX_STORAGE_INDEXES_PER_QUERY],
+                )
+                for i in range(0, len(storage_indexes),
+                               MAX_STORAGE_INDEXES_PER_QUERY)
+            ]
+        else:
+            def _one(buckets, storage_index):
+                if buckets:
+                    return {storage_index: buckets}
+                return {}
+            queries = [
+                self._rref.callRemote(
+                    "get_buckets",
+                    storage_index,
+                ).addCallback(_one, storage_index)
+                for storage_index in storage_indexes
+            ]
+        d = defer.gatherResults(queries, consumeErrors=True)
+        def _merge(batches):
+            results = {}
+            for batch in batches:
+                results.update(batch)
+            return results
+        def _first_error(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addCallbacks(_merge, _first_error)
+        return d
 
     def slot_readv(
             self,
@@ -980,12 +1204,104 @@ class _StorageServer(object):
             shares,
             readv,
     ):
-        return self._rref.callRemote(
-            "slot_readv",
-            storage_index,
-            shares,
-            readv,
-        )
+        if not self._supports_slot_readv_many():
+            return self._rref.callRemote(
+                "slot_readv",
+                storage_index,
+                shares,
+                readv,
+            )
+        d = defer.Deferred()
+        self._pending_reads.append((storage_index, shares, readv, d))
+        self._send_pending_reads()
+        return d
+
+    def _send_pending_reads(self):
+        if (not self._pending_reads or
+            self._reads_in_flight >= self.MAX_LOOKUPS_IN_FLIGHT):
+            return
+        batch = self._pending_reads[:MAX_SLOT_READS_PER_QUERY]
+        del self._pending_reads[:MAX_SLOT_READS_PER_QUERY]
+        self._reads_in_flight += 1
+        if len(batch) == 1:
+            [(storage_index, shares, readv, _)] = batch
+            d = self._rref.callRemote("slot_readv",
+                                      storage_index, shares, readv)
+            d.addCallback(lambda datavs: [datavs])
+        else:
+            reads = [(storage_index, shares, readv)
+                     for (storage_index, shares, readv, _) in batch]
+            d = self._rref.callRemote("slot_readv_many", reads)
+        self._when_batch_done(d, self._reads_done)
+        d.addCallbacks(self._got_many_reads, self._read_many_failed,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+
+    def _reads_done(self):
+        self._reads_in_flight -= 1
+        self._send_pending_reads()
+
+    def _got_many_reads(self, results, batch):
+        for ((storage_index, shares, readv, d), datavs) in zip(batch, results):
+            d.callback(datavs)
+
+    def _read_many_failed(self, f, batch):
+        if len(batch) > 1:
+            # don't fail every read in the batch because of one the server
+            # could not handle: send each on its own
+            for read in batch:
+                (storage_index, shares, readv, _) = read
+                d = self._rref.callRemote("slot_readv",
+                                          storage_index, shares, readv)
+                d.addCallback(lambda datavs: [datavs])
+                d.addCallbacks(self._got_many_reads, self._read_many_failed,
+                               callbackArgs=([read],), errbackArgs=([read],))
+            return
+        for (storage_index, shares, readv, d) in batch:
+            d.errback(f)
+
+    def slot_readv_many(
+            self,
+            reads,
+    ):
+        """
+        Do several slot reads in as few messages as the server allows.
+
+        :param reads: An iterable of ``(storage_index, shares, readv)``
+            tuples.
+
+        :return Deferred[list]: Fires with one ``slot_readv`` result per
+            read, in the same order.
+        """
+        reads = list(reads)
+        if self._supports_slot_readv_many():
+            queries = [
+                self._rref.callRemote(
+                    "slot_readv_many",
+                    reads[i:i+MAX_SLOT_READS_PER_QUERY],
+                )
+                for i in range(0, len(reads), MAX_SLOT_READS_PER_QUERY)
+            ]
+        else:
+            queries = [
+                self._rref.callRemote(
+                    "slot_readv",
+                    storage_index,
+                    shares,
+                    readv,
+                ).addCallback(lambda datavs: [datavs])
+                for (storage_index, shares, readv) in reads
+            ]
+        d = defer.gatherResults(queries, consumeErrors=True)
+        def _concatenate(batches):
+            results = []
+            for batch in batches:
+                results.extend(batch)
+            return results
+        def _first_error(f):
+            f.trap(defer.FirstError)
+            return f.value.subFailure
+        d.addCallbacks(_concatenate, _first_error)
+        return d
 
     def slot_testv_and_readv_and_writev(
             self,
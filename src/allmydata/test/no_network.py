@@ -34,6 +34,7 @@ from functools import (
 from zope.interface import implementer
 from twisted.application import service
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 from twisted.web.error import Error
 from foolscap.api import Referenceable, fireEventually, RemoteException
@@ -52,6 +53,7 @@ from allmydata.util.hashutil import permute_server_hash
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.interfaces import IStorageBroker, IServer
 from allmydata.storage_client import (
+    ServerSpeed,
     _StorageServer,
 )
 from .common import (
@@ -150,6 +152,10 @@ class LocalWrapper(object):
             if methname == "get_buckets":
                 for shnum in res:
                     res[shnum] = self._wrap(res[shnum])
+            if methname == "get_buckets_many":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = self._wrap(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
         if self.post_call_notifier:
@@ -181,6 +187,11 @@ class NoNetworkServer(object):
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        # like NativeStorageServer, hand out the same IStorageServer each
+        # time, so concurrent get_buckets calls can be batched. Its batch
+        # timeouts never fire, so that hung servers leave no timers behind.
+        self._storage_server = _StorageServer(lambda: self.rref,
+                                              clock=Clock())
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     # Special method used by copy.copy() and copy.deepcopy(). When those are
@@ -211,7 +222,7 @@ class NoNetworkServer(object):
     def get_storage_server(self):
         if self.rref is None:
             return None
-        return _StorageServer(lambda: self.rref)
+        return self._storage_server
     def get_version(self):
         return self.rref.version
     def start_connecting(self, trigger_cb):
@@ -220,6 +231,8 @@ class NoNetworkServer(object):
 
 @implementer(IStorageBroker)
 class NoNetworkStorageBroker(object):  # type: ignore # missing many methods
+    def __init__(self):
+        self._server_speeds = {}
     def get_servers_for_psi(self, peer_selection_index):
         def _permuted(server):
             seed = server.get_permutation_seed()
@@ -229,6 +242,9 @@ class NoNetworkStorageBroker(object):  # type: ignore # missing many methods
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
         return None
+    def get_server_speed(self, server):
+        return self._server_speeds.setdefault(server.get_serverid(),
+                                              ServerSpeed())
     def when_connected_enough(self, threshold):
         return defer.Deferred()
     def get_all_serverids(self):
@@ -16,7 +16,7 @@ if PY2:
     # anyway, and tests pass just fine on Python 3.
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, dict, list, object, range, str, max, min  # noqa: F401
 
-import time
+import time, json, pickle
 import os.path
 from twisted.trial import unittest
 from twisted.application import service
@@ -25,6 +25,7 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
+from allmydata.storage import crawler
 from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
 
 from allmydata.test.common_util import StallMixin, FakeCanary
@@ -71,6 +72,23 @@ class PacedCrawler(ShareCrawler):
     def finished_cycle(self, cycle):
         eventually(self.finished_d.callback, None)
 
+class Killed(Exception):
+    pass
+
+class KilledCrawler(BucketEnumeratingCrawler):
+    checkpoint_interval = 0 # checkpoint after every bucket
+    def __init__(self, *args, **kwargs):
+        BucketEnumeratingCrawler.__init__(self, *args, **kwargs)
+        self.countdown = None
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        if self.countdown == 0:
+            # like SIGKILL: nothing gets a chance to save the state
+            raise Killed()
+        BucketEnumeratingCrawler.process_bucket(self, cycle, prefix,
+                                                prefixdir, storage_index_b32)
+        if self.countdown is not None:
+            self.countdown -= 1
+
 class ConsumingCrawler(ShareCrawler):
     cpu_slice = 0.5
     allowed_cpu_percentage = 0.5
@@ -106,6 +124,16 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class PrefetchCountingCrawler(BucketEnumeratingCrawler):
+    def __init__(self, *args, **kwargs):
+        BucketEnumeratingCrawler.__init__(self, *args, **kwargs)
+        self.prefetch_hits = 0
+
+    def get_prefix_buckets(self, i, prefixdir):
+        if i in self.prefetched:
+            self.prefetch_hits += 1
+        return BucketEnumeratingCrawler.get_prefix_buckets(self, i, prefixdir)
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -403,6 +431,167 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_done)
         return d
 
+    def test_io_budget(self):
+        self.basedir = "crawler/Basic/io_budget"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = BucketEnumeratingCrawler(ss, statefile)
+        # each prefixdir listing costs one operation, so a 500s slice at
+        # 0.01 operations per second can list five prefixdirs
+        c.max_iops = 0.01
+        c.load_state()
+        self.failUnlessRaises(TimeSliceExceeded,
+                              c.start_current_prefix, time.time())
+        self.failUnlessEqual(c.last_complete_prefix_index, 4)
+        self.failUnlessEqual(c.slice_io_ops, 5)
+        # and the crawler must rest long enough to average 0.01 ops/s
+        self.failUnlessEqual(c.io_sleep_time(0), 500)
+        self.failUnlessEqual(c.io_sleep_time(100), 400)
+
+        c.max_iops = None
+        c.max_bytes_per_second = 10
+        c.charge_io(0, 10000)
+        self.failUnlessEqual(c.io_sleep_time(0), 1000)
+
+        # without a budget the cycle finishes in one slice
+        c.max_bytes_per_second = None
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+
+    def test_prefetch(self):
+        self.basedir = "crawler/Basic/prefetch"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = PrefetchCountingCrawler(ss, statefile)
+        c.prefetch_prefixes = 4
+        c.slow_start = 300 # keep it from crawling by itself
+        c.setServiceParent(self.s)
+        c.prefetch(0)
+        self.failUnlessEqual(c.prefetching, set([0, 1, 2, 3]))
+
+        d = self.poll(lambda: len(c.prefetched) == 4)
+        def _prefetched(ignored):
+            self.failIf(c.prefetching)
+            c.prefetch_prefixes = 0
+            c.start_current_prefix(time.time())
+            self.failUnlessEqual(c.prefetch_hits, 4)
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            self.failIf(c.prefetched)
+        d.addCallback(_prefetched)
+        return d
+
+    def test_checkpoint(self):
+        self.basedir = "crawler/Basic/checkpoint"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = KilledCrawler(ss, statefile)
+        c.countdown = 6
+        self.failUnlessRaises(Killed, c.start_current_prefix, time.time())
+        self.failUnlessEqual(len(c.all_buckets), 6)
+        self.failUnless(os.path.exists(c.journalfile))
+        # the statefile was never written
+        self.failIf(os.path.exists(statefile))
+
+        # a new process picks up right after the last processed bucket
+        c2 = KilledCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state["current-cycle"], 0)
+        self.failUnlessEqual(c2.state["last-complete-bucket"],
+                             sorted(c.all_buckets)[-1].decode("ascii"))
+        c2.start_current_prefix(time.time())
+        self.failUnlessEqual(len(c2.all_buckets), 4)
+        self.failUnlessEqual(sorted(sis), sorted(c.all_buckets+c2.all_buckets))
+        # finishing the cycle wrote the statefile, which retires the journal
+        self.failIf(os.path.exists(c2.journalfile))
+        with open(statefile, "rb") as f:
+            state = json.loads(f.read().decode("utf-8"))
+        self.failUnlessEqual(state["last-cycle-finished"], 0)
+
+    def test_checkpoint_torn_write(self):
+        self.basedir = "crawler/Basic/checkpoint_torn_write"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        for i in range(10):
+            self.write(i, ss, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+
+        c = KilledCrawler(ss, statefile)
+        c.countdown = 3
+        self.failUnlessRaises(Killed, c.start_current_prefix, time.time())
+        # a checkpoint which was only partly written is ignored
+        with open(c.journalfile, "ab") as f:
+            f.write(b'{"version": 1, "current-cy')
+        c2 = KilledCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state["last-complete-bucket"],
+                             sorted(c.all_buckets)[-1].decode("ascii"))
+
+    def test_checkpoint_synced(self):
+        self.basedir = "crawler/Basic/checkpoint_synced"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        for i in range(10):
+            self.write(i, ss, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        synced = []
+        self.patch(crawler, "fsync_path", synced.append)
+        basedir = os.path.abspath(self.basedir)
+
+        c = KilledCrawler(ss, statefile)
+        c.countdown = 3
+        self.failUnlessRaises(Killed, c.start_current_prefix, time.time())
+        # every checkpoint is synced, and the journal's directory entry once
+        self.failUnlessEqual(synced[:2], [c.journalfile, basedir])
+        self.failUnlessEqual(synced[2:], [c.journalfile] * (len(synced) - 2))
+        self.failUnless(len(synced) > 2)
+
+        del synced[:]
+        c.save_state()
+        self.failUnlessEqual(synced, [statefile + ".tmp", basedir])
+
+    def test_pickled_state(self):
+        self.basedir = "crawler/Basic/pickled_state"
+        fileutil.make_dirs(self.basedir)
+        serverid = b"\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        # state written by an older version
+        with open(statefile, "wb") as f:
+            pickle.dump({"version": 1,
+                         "last-cycle-finished": 3,
+                         "current-cycle": None,
+                         "last-complete-prefix": None,
+                         "last-complete-bucket": None,
+                         }, f, protocol=2)
+        c = BucketEnumeratingCrawler(ss, statefile)
+        self.failUnlessEqual(c.state["last-cycle-finished"], 3)
+        c.save_state()
+        with open(statefile, "rb") as f:
+            state = json.loads(f.read().decode("utf-8"))
+        self.failUnlessEqual(state["last-cycle-finished"], 3)
+
     def test_empty_subclass(self):
         self.basedir = "crawler/Basic/empty_subclass"
         fileutil.make_dirs(self.basedir)
@@ -28,9 +28,11 @@ from allmydata.test.common import ShouldFailMixin
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
      DownloadStopped
 from allmydata.immutable.downloader.common import BadSegmentNumberError, \
-     BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
+     BadCiphertextHashError, COMPLETE, OVERDUE, DEAD, CORRUPT
 from allmydata.immutable.downloader.status import DownloadStatus
-from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.cache import SegmentCache
+from allmydata.immutable.downloader.fetcher import SegmentFetcher, \
+     ServerRequestLimiter
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -911,6 +913,31 @@ class PausingConsumer(MemoryConsumer):
     def _unpause(self):
         self.producer.resumeProducing()
 
+class SlowConsumer(MemoryConsumer):
+    """I pause for 'delay' seconds after every write."""
+    def __init__(self, delay):
+        MemoryConsumer.__init__(self)
+        self.delay = delay
+        self.writes = 0
+        self.paused = False
+        self._unpause_timer = None
+    def write(self, data):
+        self.writes += 1
+        if self.delay:
+            self.paused = True
+            self.producer.pauseProducing()
+            self._unpause_timer = reactor.callLater(self.delay, self._unpause)
+        return MemoryConsumer.write(self, data)
+    def _unpause(self):
+        self._unpause_timer = None
+        self.paused = False
+        self.producer.resumeProducing()
+    def unregisterProducer(self):
+        if self._unpause_timer:
+            self._unpause_timer.cancel()
+            self._unpause_timer = None
+        MemoryConsumer.unregisterProducer(self)
+
 class PausingAndStoppingConsumer(PausingConsumer):
     debug_stopped = False
     def write(self, data):
@@ -942,6 +969,146 @@ class StallingConsumer(MemoryConsumer):
             self.halfway_cb()
         return MemoryConsumer.write(self, data)
 
+class ReadAhead(_Base, unittest.TestCase):
+    def _upload(self, read_ahead):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.nodemaker.read_ahead = read_ahead
+        self.data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(self.data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            n._cnode._maybe_create_download_node()
+            node = n._cnode._node
+            # (segnum, writes the consumer had seen) for each request
+            self.requests = []
+            get_segment = node.get_segment
+            def _get_segment(segnum, logparent=None):
+                self.failIf(self.consumer.paused)
+                self.requests.append((segnum, self.consumer.writes))
+                return get_segment(segnum, logparent)
+            node.get_segment = _get_segment
+            return n
+        d.addCallback(_uploaded)
+        return d
+
+    def test_read_ahead(self):
+        d = self._upload(3)
+        def _read(n):
+            self.consumer = SlowConsumer(0)
+            return n.read(self.consumer)
+        d.addCallback(_read)
+        def _check(c):
+            self.failUnlessEqual(b"".join(c.chunks), self.data)
+            # the segment size is only known once segment 0 arrives. The
+            # consumer takes no time at all, so we then ask for as many
+            # segments as we may.
+            self.failUnlessEqual(self.requests,
+                                 [(0, 0), (1, 1), (2, 1), (3, 1), (4, 1)])
+        d.addCallback(_check)
+        return d
+
+    def test_slow_consumer(self):
+        d = self._upload(3)
+        def _read(n):
+            self.consumer = SlowConsumer(0.1)
+            return n.read(self.consumer)
+        d.addCallback(_read)
+        def _check(c):
+            self.failUnlessEqual(b"".join(c.chunks), self.data)
+            # the consumer takes longer over each segment than it takes to
+            # fetch one, so one segment ahead is enough, and nothing is asked
+            # for while it is paused
+            self.failUnlessEqual(self.requests,
+                                 [(0, 0), (1, 1), (2, 1), (3, 2), (4, 3)])
+        d.addCallback(_check)
+        return d
+
+class ConcurrentSegments(_Base, unittest.TestCase):
+    def test_reorder(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.nodemaker.read_ahead = 4
+        self.c0.nodemaker.concurrent_segments = 3
+        data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        processed = []
+        delivered = []
+        most_active = []
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            n._cnode._maybe_create_download_node()
+            node = n._cnode._node
+            # hold segment 1 back until another one has been fetched
+            held = []
+            process_blocks = node.process_blocks
+            def _process_blocks(segnum, blocks):
+                most_active.append(len(node._active_segments))
+                if segnum == 1:
+                    held.append(blocks)
+                    return
+                processed.append(segnum)
+                process_blocks(segnum, blocks)
+                if held:
+                    processed.append(1)
+                    process_blocks(1, held.pop())
+            node.process_blocks = _process_blocks
+            deliver_segment = node._deliver_segment
+            def _deliver_segment(segnum, result):
+                delivered.append(segnum)
+                return deliver_segment(segnum, result)
+            node._deliver_segment = _deliver_segment
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _check(res):
+            self.failUnlessEqual(res, data)
+            self.failUnlessEqual(max(most_active), 3)
+            self.failIfEqual(processed, [0, 1, 2, 3, 4])
+            self.failUnlessEqual(delivered, [0, 1, 2, 3, 4])
+        d.addCallback(_check)
+        return d
+
+    def test_oldest_segment_unlimited(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.nodemaker.read_ahead = 4
+        self.c0.nodemaker.concurrent_segments = 3
+        data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        fetchers = []
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            n._cnode._maybe_create_download_node()
+            node = n._cnode._node
+            start_new_segment = node._start_new_segment
+            def _start_new_segment():
+                start_new_segment()
+                active = sorted(node._active_segments.items())
+                fetchers.append(([segnum for (segnum, ign) in active],
+                                 [segnum for (segnum, (fetcher, started))
+                                  in active if not fetcher._limited]))
+            node._start_new_segment = _start_new_segment
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _check(res):
+            self.failUnlessEqual(res, data)
+            self.failUnlessIn(([1, 2, 3], [1]), fetchers)
+            # each segment in turn was fetched without limits, once the
+            # ones before it had been delivered
+            for (active, unlimited) in fetchers:
+                self.failUnlessEqual(unlimited, active[:1])
+        d.addCallback(_check)
+        return d
+
 class Corruption(_Base, unittest.TestCase):
 
     def _corrupt_flip(self, ign, imm_uri, which):
@@ -1231,6 +1398,104 @@ class DownloadV2(_Base, unittest.TestCase):
         d.addCallback(_uploaded)
         return d
 
+class SegmentCaching(_Base, unittest.TestCase):
+    def test_cache(self):
+        c = SegmentCache(100)
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb", 0), None)
+        c.put_segment(b"si", b"ueb", 0, b"a"*40)
+        c.put_segment(b"si", b"ueb", 1, b"b"*40)
+        c.put_ueb(b"si", b"ueb", b"c"*10)
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb", 0), b"a"*40)
+        # a different encoding of the same file
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb2", 0), None)
+        # segment 1 is now the least recently used
+        c.put_segment(b"si", b"ueb", 2, b"d"*40)
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb", 1), None)
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb", 2), b"d"*40)
+        self.failUnlessEqual(c.get_ueb(b"si", b"ueb"), b"c"*10)
+        # too big to keep at all
+        c.put_segment(b"si", b"ueb", 3, b"e"*101)
+        self.failUnlessEqual(c.get_segment(b"si", b"ueb", 3), None)
+        stats = c.get_stats()
+        self.failUnlessEqual(stats["downloader.segment_cache.entries"], 3)
+        self.failUnlessEqual(stats["downloader.segment_cache.bytes"], 90)
+        self.failUnlessEqual(stats["downloader.segment_cache.hits"], 2)
+        self.failUnlessEqual(stats["downloader.segment_cache.misses"], 4)
+        self.failUnlessEqual(stats["downloader.segment_cache.evictions"], 1)
+        self.failUnlessEqual(stats["downloader.segment_cache.hit_ratio"],
+                             2 / 6)
+
+    def test_download(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.nodemaker.segment_cache = SegmentCache(100000)
+        data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            self.cap = uri.from_string(ur.get_uri())
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            d = download_to_data(n)
+            def _read1(res):
+                self.failUnlessEqual(res, data)
+                ds = n._cnode._download_status
+                self.failUnlessEqual(ds.segment_cache_hits, 0)
+                self.failUnless(ds.block_requests)
+            d.addCallback(_read1)
+            return d
+        d.addCallback(_uploaded)
+        def _read_again(ign):
+            # a new node gets the UEB and every segment from the cache,
+            # without asking any server
+            n = self.c0.nodemaker._create_immutable(self.cap)
+            d = n.read(MemoryConsumer(), 7000, 12000)
+            def _read2(con):
+                self.failUnlessEqual(b"".join(con.chunks), data[7000:19000])
+                ds = n._cnode._download_status
+                self.failUnlessEqual(ds.segment_cache_hits, 3)
+                self.failUnlessEqual(ds.segment_cache_misses, 0)
+                self.failUnlessEqual(ds.get_segment_cache_hit_rate(), 1.0)
+                self.failUnlessEqual(ds.dyhb_requests, [])
+                self.failUnlessEqual(ds.block_requests, [])
+            d.addCallback(_read2)
+            return d
+        d.addCallback(_read_again)
+        return d
+
+class ShareSelection(_Base, unittest.TestCase):
+    def test_download(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        data = (plaintext*100)[:30000] # multiple of k
+        u = upload.Data(data, None)
+        u.max_segment_size = 6000 # 5 segs
+        d = self.c0.upload(u)
+        def _uploaded(ur):
+            n = self.c0.create_node_from_uri(ur.get_uri())
+            d = download_to_data(n)
+            def _downloaded(res):
+                self.failUnlessEqual(res, data)
+                ds = n._cnode._download_status
+                # k shares for each segment
+                selections = ds.share_selections
+                self.failUnlessEqual(
+                    sorted(set([sel["segment_number"] for sel in selections])),
+                    list(range(5)))
+                self.failUnless(len(selections) >= 5*3, selections)
+                # and the broker knows how fast each server used was
+                broker = self.c0.get_storage_broker()
+                for sel in selections:
+                    speed = broker.get_server_speed(sel["server"])
+                    self.failIfEqual(speed.round_trip_time, None)
+                    self.failIfEqual(speed.last_update, None)
+            d.addCallback(_downloaded)
+            return d
+        d.addCallback(_uploaded)
+        return d
+
 class Status(unittest.TestCase):
     def test_status(self):
         now = 12345.1
@@ -1288,6 +1553,15 @@ class Status(unittest.TestCase):
         e2.finished(now+3)
         self.failUnlessEqual(ds.get_active(), False)
 
+    def test_segment_cache_hit_rate(self):
+        ds = DownloadStatus("si-1", 123)
+        self.failUnlessEqual(ds.get_segment_cache_hit_rate(), None)
+        ds.add_segment_cache_lookup(True)
+        ds.add_segment_cache_lookup(False)
+        ds.add_segment_cache_lookup(True)
+        ds.add_segment_cache_lookup(True)
+        self.failUnlessEqual(ds.get_segment_cache_hit_rate(), 0.75)
+
 def make_server(clientid):
     tubid = hashutil.tagged_hash(b"clientid", clientid)[:20]
     return NoNetworkServer(tubid, None)
@@ -1302,6 +1576,10 @@ class MyShare(object):
         self._shnum = shnum
         self._server = server
         self._dyhb_rtt = rtt
+        self.expected = rtt
+
+    def expected_block_time(self):
+        return self.expected
 
     def __repr__(self):
         return "sh%d-on-%s" % (self._shnum, str(self._server.get_name(), "ascii"))
@@ -1539,6 +1817,100 @@ class Selection(unittest.TestCase):
         d.addCallback(_check2)
         return d
 
+    def test_server_request_limit(self):
+        node = FakeNode()
+        limiter = ServerRequestLimiter(1)
+        servers = make_servers([b"peer-A", b"peer-B", b"peer-C"])
+        shares = [MyShare(0, servers[b"peer-A"], 0.0),
+                  MyShare(1, servers[b"peer-B"], 1.0),
+                  MyShare(2, servers[b"peer-C"], 2.0),
+                  ]
+        # another segment is being fetched from peer-A
+        limiter.started(servers[b"peer-A"])
+        sf = MySegmentFetcher(node, 0, 2, None, limiter=limiter, limited=True)
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[2]])
+            self.failIf(limiter.has_room(servers[b"peer-B"]))
+            sf._block_request_activity(shares[1], 1, COMPLETE, "block-1")
+            sf._block_request_activity(shares[2], 2, CORRUPT)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            # peer-A is still busy, so we wait for it
+            self.failUnlessEqual(node.processed, None)
+            self.failUnlessEqual(node.failed, None)
+            self.failUnless(limiter.has_room(servers[b"peer-B"]))
+            limiter.finished(servers[b"peer-A"])
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[2], shares[0]])
+            sf._block_request_activity(shares[0], 0, COMPLETE, "block-0")
+            return flushEventualQueue()
+        d.addCallback(_check3)
+        def _check4(ign):
+            self.failUnlessEqual(node.processed, (0, {0: "block-0",
+                                                      1: "block-1"}))
+            self.failUnless(limiter.has_room(servers[b"peer-A"]))
+        d.addCallback(_check4)
+        return d
+
+    def test_server_request_limit_overdue(self):
+        node = FakeNode()
+        limiter = ServerRequestLimiter(1)
+        server = make_server(b"peer-A")
+        share = MyShare(0, server, 0.0)
+        # two fetchers for the same segment, as FakeNode has only one
+        sf0 = MySegmentFetcher(node, 0, 1, None, limiter=limiter)
+        sf0.add_shares([share])
+        sf1 = MySegmentFetcher(node, 0, 1, None, limiter=limiter,
+                               limited=True)
+        sf1.add_shares([MyShare(0, server, 0.0)])
+        d = flushEventualQueue()
+        def _check1(ign):
+            # peer-A is busy with segment 0
+            self.failUnlessEqual(sf1._test_start_shares, [])
+            sf0._block_request_activity(share, 0, OVERDUE)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            # the overdue request no longer counts against peer-A
+            self.failUnlessEqual(len(sf1._test_start_shares), 1)
+            self.failIf(limiter.has_room(server))
+            sf0._block_request_activity(share, 0, COMPLETE, "block-0")
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            # and is not released twice when it finally completes
+            self.failUnlessEqual(node.processed, (0, {0: "block-0"}))
+            self.failIf(limiter.has_room(server))
+        d.addCallback(_check3)
+        return d
+
+    def test_unlimit(self):
+        node = FakeNode()
+        limiter = ServerRequestLimiter(1)
+        server = make_server(b"peer-A")
+        limiter.started(server)
+        sf = MySegmentFetcher(node, 0, 1, None, limiter=limiter, limited=True)
+        share = MyShare(0, server, 0.0)
+        sf.add_shares([share])
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares, [])
+            # the segment before ours has been delivered
+            sf.unlimit()
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares, [share])
+        d.addCallback(_check2)
+        return d
+
     def test_overdue(self):
         node = FakeNode()
         sf = MySegmentFetcher(node, 0, 3, None)
@@ -1654,3 +2026,59 @@ class Selection(unittest.TestCase):
                                                       2: "block-2"}) )
         d.addCallback(_check4)
         return d
+
+    def test_prefer_fast_servers(self):
+        node = FakeNode()
+        ds = DownloadStatus(b"si", 100)
+        sf = MySegmentFetcher(node, 0, 2, None, download_status=ds)
+        servers = make_servers([b"peer-A", b"peer-B", b"peer-C"])
+        shares = [MyShare(0, servers[b"peer-A"], 0.0),
+                  MyShare(1, servers[b"peer-B"], 0.1),
+                  MyShare(2, servers[b"peer-B"], 0.2),
+                  MyShare(3, servers[b"peer-C"], 0.3)]
+        # peer-A answered the DYHB first, but has been slow since
+        shares[0].expected = 5.0
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            # sh2 was faster than sh3, but its server is already in use
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[3]])
+            self.failUnlessEqual([(sel["shnum"], sel["expected_time"],
+                                   sel["rank"])
+                                  for sel in ds.share_selections],
+                                 [(1, 0.1, 0), (3, 0.3, 1)])
+            # peer-A has sped up again by the time peer-C fails
+            shares[0].expected = 1.0
+            sf.add_shares([MyShare(4, make_server(b"peer-D"), 2.0)])
+            sf._block_request_activity(shares[3], 3, DEAD)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[1], shares[3], shares[0]])
+            self.failUnlessEqual(ds.share_selections[-1]["shnum"], 0)
+            self.failUnlessEqual(ds.share_selections[-1]["rank"], 1)
+        d.addCallback(_check2)
+        return d
+
+    def test_rank_counts_usable_shares(self):
+        node = FakeNode()
+        ds = DownloadStatus(b"si", 100)
+        sf = MySegmentFetcher(node, 0, 2, None, download_status=ds)
+        servers = make_servers([b"peer-A", b"peer-B", b"peer-C"])
+        # sh0-on-peer-B is faster than sh1, but sh0 is already being
+        # fetched from peer-A, so nothing useful was passed over
+        shares = [MyShare(0, servers[b"peer-A"], 0.0),
+                  MyShare(0, servers[b"peer-B"], 0.1),
+                  MyShare(1, servers[b"peer-C"], 0.2)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check(ign):
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[2]])
+            self.failUnlessEqual([(sel["shnum"], sel["rank"])
+                                  for sel in ds.share_selections],
+                                 [(0, 0), (1, 0)])
+        d.addCallback(_check)
+        return d
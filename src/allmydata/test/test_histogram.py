@@ -0,0 +1,114 @@
+"""
+Tests for allmydata.util.histogram.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+
+from allmydata.util.histogram import Histogram, WindowedHistogram
+
+
+class HistogramTests(unittest.TestCase):
+
+    def test_empty(self):
+        h = Histogram()
+        self.assertEqual(h.count, 0)
+        self.assertIs(h.percentile(0.5), None)
+        self.assertEqual(h.cumulative_counts()[-1], (float("inf"), 0))
+
+    def test_bucket_bounds(self):
+        """
+        A value on a bucket boundary is counted in the bucket below it.
+        """
+        for index in range(-1, Histogram.OCTAVES * Histogram.SUBBUCKETS):
+            bound = Histogram.upper_bound(index)
+            self.assertEqual(Histogram.bucket_for(bound), index)
+            self.assertEqual(Histogram.bucket_for(bound * 1.0000001), index + 1)
+        self.assertEqual(Histogram.bucket_for(0), -1)
+        self.assertEqual(Histogram.bucket_for(1e9),
+                         Histogram.OCTAVES * Histogram.SUBBUCKETS)
+
+    def test_percentiles(self):
+        """
+        Percentiles are within a bucket's width of the exact ones, and never
+        outside the range of the values.
+        """
+        h = Histogram()
+        values = [0.001 * i for i in range(1, 10001)]
+        for v in values:
+            h.add(v)
+        for fraction in (0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            exact = values[int(fraction * len(values))]
+            self.assertTrue(abs(h.percentile(fraction) - exact) <= 0.025 * exact,
+                            (fraction, h.percentile(fraction), exact))
+        self.assertEqual(h.percentile(0), 0.001)
+        self.assertEqual(h.percentile(1), 10.0)
+        self.assertEqual(h.min, 0.001)
+        self.assertEqual(h.max, 10.0)
+        self.assertAlmostEqual(h.sum, sum(values))
+
+    def test_huge_values(self):
+        h = Histogram()
+        h.add(1e7)
+        h.add(2e7)
+        self.assertEqual(h.percentile(0.5), 2e7)
+        self.assertEqual(h.cumulative_counts()[-2:],
+                         [(Histogram.upper_bound(Histogram.OCTAVES * Histogram.SUBBUCKETS - 1), 0),
+                          (float("inf"), 2)])
+
+    def test_cumulative_counts(self):
+        h = Histogram()
+        for v in [0, 0.5, 1, 1.5, 3]:
+            h.add(v)
+        counts = dict(h.cumulative_counts())
+        self.assertEqual(len(counts), Histogram.OCTAVES + 2)
+        self.assertEqual(counts[Histogram.MIN_VALUE], 1)
+        self.assertEqual(counts[0.5], 2)
+        self.assertEqual(counts[1.0], 3)
+        self.assertEqual(counts[2.0], 4)
+        self.assertEqual(counts[4.0], 5)
+        self.assertEqual(counts[float("inf")], 5)
+
+    def test_merge(self):
+        a = Histogram()
+        a.add(1)
+        b = Histogram()
+        b.add(3)
+        b.add(5)
+        a.merge(b)
+        self.assertEqual((a.count, a.sum, a.min, a.max), (3, 9, 1, 5))
+        c = Histogram()
+        for v in [1, 3, 5]:
+            c.add(v)
+        self.assertEqual(a.cumulative_counts(), c.cumulative_counts())
+
+
+class WindowedHistogramTests(unittest.TestCase):
+
+    def test_window(self):
+        clock = Clock()
+        h = WindowedHistogram(window=60, slices=6, clock=clock.seconds)
+        h.add(1)
+        clock.advance(30)
+        h.add(2)
+        self.assertEqual(h.recent().count, 2)
+        clock.advance(30)
+        # the first value's slice has left the window
+        h.add(3)
+        recent = h.recent()
+        self.assertEqual((recent.count, recent.min, recent.max), (2, 2, 3))
+        clock.advance(60)
+        self.assertEqual(h.recent().count, 0)
+        self.assertEqual(h.total.count, 3)
+        # old slices are not kept around
+        self.assertEqual(len(h._slices), 0)
@@ -339,6 +339,62 @@ class IStorageServerImmutableAPIsTestsMixin(object):
         buckets = yield self.storage_server.get_buckets(storage_index)
         self.assertEqual(set(buckets.keys()), {1})
 
+    @inlineCallbacks
+    def _write_share(self, storage_index, sharenum, data):
+        (_, allocated) = yield self.storage_server.allocate_buckets(
+            storage_index,
+            renew_secret=new_secret(),
+            cancel_secret=new_secret(),
+            sharenums={sharenum},
+            allocated_size=len(data),
+            canary=Referenceable(),
+        )
+        yield allocated[sharenum].callRemote("write", 0, data)
+        yield allocated[sharenum].callRemote("close")
+
+    @inlineCallbacks
+    def test_get_buckets_many(self):
+        """
+        ``IStorageServer.get_buckets_many()`` returns the buckets of every
+        given storage index which has shares, and leaves out the others.
+        """
+        si_1, si_2, si_empty = (new_storage_index() for i in range(3))
+        yield self._write_share(si_1, 0, b"1" * 10)
+        yield self._write_share(si_1, 3, b"2" * 10)
+        yield self._write_share(si_2, 1, b"3" * 10)
+
+        results = yield self.storage_server.get_buckets_many(
+            [si_1, si_2, si_empty])
+        self.assertEqual(set(results.keys()), {si_1, si_2})
+        self.assertEqual(set(results[si_1].keys()), {0, 3})
+        self.assertEqual(set(results[si_2].keys()), {1})
+        self.assertEqual(
+            (yield results[si_2][1].callRemote("read", 0, 10)), b"3" * 10
+        )
+
+    @inlineCallbacks
+    def test_concurrent_get_buckets(self):
+        """
+        Concurrent ``IStorageServer.get_buckets()`` calls each get the
+        buckets of their own storage index.
+        """
+        si_1, si_2 = new_storage_index(), new_storage_index()
+        yield self._write_share(si_1, 0, b"1" * 10)
+        yield self._write_share(si_2, 2, b"2" * 10)
+
+        d_1 = self.storage_server.get_buckets(si_1)
+        d_2 = self.storage_server.get_buckets(si_2)
+        d_1_again = self.storage_server.get_buckets(si_1)
+        buckets_1 = yield d_1
+        buckets_2 = yield d_2
+        buckets_1_again = yield d_1_again
+        self.assertEqual(set(buckets_1.keys()), {0})
+        self.assertEqual(set(buckets_2.keys()), {2})
+        self.assertEqual(set(buckets_1_again.keys()), {0})
+        self.assertEqual(
+            (yield buckets_2[2].callRemote("read", 0, 10)), b"2" * 10
+        )
+
     @inlineCallbacks
     def test_read_bucket_at_offset(self):
         """
@@ -754,6 +810,40 @@ class IStorageServerMutableAPIsTestsMixin(object):
             {0: [b"abcdefg"], 1: [b"0123456"], 2: [b"9876543"]},
         )
 
+    @inlineCallbacks
+    def test_slot_readv_many(self):
+        """
+        ``IStorageServer.slot_readv_many()`` returns one ``slot_readv()``
+        result per read, in the order the reads were given, and concurrent
+        ``slot_readv()`` calls each get the result of their own read.
+        """
+        si_1, si_2, si_empty = (new_storage_index() for i in range(3))
+        for (storage_index, data) in [(si_1, b"abcdefg"), (si_2, b"0123456")]:
+            (written, _) = yield self.staraw(
+                storage_index,
+                self.new_secrets(),
+                tw_vectors={0: ([], [(0, data)], 7), 1: ([], [(0, data)], 7)},
+                r_vector=[],
+            )
+            self.assertEqual(written, True)
+
+        reads = yield self.storage_server.slot_readv_many([
+            (si_2, [1], [(0, 3)]),
+            (si_empty, [], [(0, 7)]),
+            (si_1, [], [(2, 3), (6, 8)]),
+        ])
+        self.assertEqual(
+            reads,
+            [{1: [b"012"]}, {}, {0: [b"cde", b"g"], 1: [b"cde", b"g"]}],
+        )
+
+        d_1 = self.storage_server.slot_readv(si_1, [0], [(0, 7)])
+        d_2 = self.storage_server.slot_readv(si_2, [1], [(0, 7)])
+        d_1_again = self.storage_server.slot_readv(si_1, [1], [(1, 1)])
+        self.assertEqual((yield d_1), {0: [b"abcdefg"]})
+        self.assertEqual((yield d_2), {1: [b"0123456"]})
+        self.assertEqual((yield d_1_again), {1: [b"b"]})
+
 
 class _FoolscapMixin(SystemTestMixin):
     """Run tests on Foolscap version of ``IStorageServer."""
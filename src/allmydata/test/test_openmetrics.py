@@ -34,6 +34,7 @@ from testtools.matchers import (
 )
 from testtools.content import text_content
 
+from allmydata.util.histogram import Histogram
 from allmydata.web.status import Statistics
 from allmydata.test.common import SyncTestCase
 
@@ -105,6 +106,7 @@ class FakeStatsProvider(object):
                 "storage_server.latencies.get.90_0_percentile": 0.0002999305725097656,
                 "storage_server.latencies.get.01_0_percentile": 0.0001239776611328125,
                 "cpu_monitor.total": 641.4941180000001,
+                "storage_server.latencies.add-lease.mean": 0.00012302398681640625,
                 "storage_server.latencies.write.samplesize": 1000,
                 "storage_server.latencies.write.95_0_percentile": 9.489059448242188e-05,
                 "storage_server.latencies.read.50_0_percentile": 6.890296936035156e-05,
@@ -139,6 +141,17 @@ class FakeStatsProvider(object):
         }
         return stats
 
+    def get_histograms(self):
+        read = Histogram()
+        for latency in [2.8848648071289062e-05, 6.890296936035156e-05, 0.5]:
+            read.add(latency)
+        add_lease = Histogram()
+        add_lease.add(0.00012302398681640625)
+        return {
+            "storage_server.latencies.read": read,
+            "storage_server.latencies.add-lease": add_lease,
+        }
+
 
 class HackItResource(Resource, object):
     """
@@ -170,6 +183,47 @@ class OpenMetrics(SyncTestCase):
         d = rta.request(b"GET", b"http://localhost/?t=openmetrics")
         self.assertThat(d, succeeded(matches_stats(self)))
 
+    def test_histograms(self):
+        """
+        Histograms are rendered as OpenMetrics histograms, with cumulative
+        buckets.
+        """
+        root = HackItResource()
+        root.putChild(b"", Statistics(FakeStatsProvider()))
+        rta = RequestTraversalAgent(root)
+        d = rta.request(b"GET", b"http://localhost/?t=openmetrics")
+        d.addCallback(readBodyText)
+        d.addCallback(lambda body: {
+            family.name: family
+            for family in parser.text_string_to_metric_families(body)
+        })
+        self.assertThat(d, succeeded(AfterPreprocessing(
+            lambda families: families["tahoe_histograms_storage_server_latencies_read"],
+            MatchesStructure(
+                type=Equals("histogram"),
+                samples=AfterPreprocessing(
+                    lambda samples: [
+                        (s.name, s.labels.get("le"), s.value)
+                        for s in samples
+                        if s.labels.get("le") in (None, "6.103515625e-05",
+                                                  "0.0001220703125", "+Inf")
+                    ],
+                    Equals([
+                        ("tahoe_histograms_storage_server_latencies_read_bucket",
+                         "6.103515625e-05", 1),
+                        ("tahoe_histograms_storage_server_latencies_read_bucket",
+                         "0.0001220703125", 2),
+                        ("tahoe_histograms_storage_server_latencies_read_bucket",
+                         "+Inf", 3),
+                        ("tahoe_histograms_storage_server_latencies_read_count",
+                         None, 3),
+                        ("tahoe_histograms_storage_server_latencies_read_sum",
+                         None, 0.5000977516174316),
+                    ]),
+                ),
+            ),
+        )))
+
 
 def matches_stats(testcase):
     """
@@ -289,6 +289,7 @@ class ByteSpans(unittest.TestCase):
                 #print("%s &= %s" % (s2.dump(), ns2.dump()))
                 s1 = s1 & ns1; s2 = s2 & ns2
             #print("s2 now %s" % s2.dump())
+            s2._check()
             self.failUnlessEqual(list(s1.each()), list(s2.each()))
             self.failUnlessEqual(s1.len(), s2.len())
             self.failUnlessEqual(bool(s1), bool(s2))
@@ -607,6 +608,7 @@ class StringSpans(unittest.TestCase):
                 self.failUnlessEqual(d1, d2)
             #print("s1 now %s" % list(s1._dump()))
             #print("s2 now %s" % list(s2._dump()))
+            s2.assert_invariants()
             self.failUnlessEqual(s1.len(), s2.len())
             self.failUnlessEqual(list(s1._dump()), list(s2._dump()))
             for j in range(100):
@@ -615,3 +617,28 @@ class StringSpans(unittest.TestCase):
                 length = max(1, int(what[5:6], 16))
                 d1 = s1.get(start, length); d2 = s2.get(start, length)
                 self.failUnlessEqual(d1, d2, "%d+%d" % (start, length))
+
+    def test_touching_chunks(self):
+        # chunks which touch are kept apart, without copying their data,
+        # but look like one
+        ds = DataSpans()
+        ds.add(0, b"abc")
+        ds.add(3, b"def")
+        ds.add(6, b"gh")
+        ds.add(10, b"xy")
+        self.failUnlessEqual(ds.len(), 10)
+        self.failUnlessEqual(ds.get(1, 6), b"bcdefg")
+        self.failUnlessEqual(ds.get(1, 8), None)
+        self.failUnlessEqual(ds.get_chunks(), [(0, b"abcdefgh"), (10, b"xy")])
+        self.failUnlessEqual(ds.dump(), "len=10: [0-7],[10-11]")
+        self.failUnlessEqual(list(ds.get_spans()), [(0, 8), (10, 2)])
+        self.failUnlessEqual(ds.pop(2, 3), b"cde")
+        self.failUnlessEqual(ds.get_chunks(),
+                             [(0, b"ab"), (5, b"fgh"), (10, b"xy")])
+
+    def test_mutable_data(self):
+        data = bytearray(b"abcd")
+        ds = DataSpans()
+        ds.add(0, data)
+        data[0:1] = b"z"
+        self.failUnlessEqual(ds.get(0, 4), b"abcd")
@@ -15,22 +15,27 @@ from six import ensure_str
 
 import time
 import os.path
+import errno
 import platform
 import stat
 import struct
 import shutil
+import threading
 from uuid import uuid4
 
 from twisted.trial import unittest
 
-from twisted.internet import defer
+from twisted.internet import defer, reactor, threads
 from twisted.internet.task import Clock
 
+from foolscap.api import Referenceable, Tub
+
 from hypothesis import given, strategies
 
 import itertools
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32
+from allmydata.util.iputil import listenOnUnused
 from allmydata.storage.server import StorageServer, DEFAULT_RENEWAL_TIME
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.mutable import MutableShareFile
@@ -39,6 +44,22 @@ from allmydata.storage.common import storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
      si_b2a, si_a2b
 from allmydata.storage.lease import LeaseInfo
+from allmydata.storage import bloom
+from allmydata.storage.bloom import CountingBloomFilter
+from allmydata.storage.fdcache import FileDescriptorCache
+from allmydata.storage.blockcache import BlockCache
+from allmydata.storage.headercache import MutableHeaderCache
+from allmydata.storage.readahead import SequentialReadAhead, ReadAheadStats
+from allmydata.storage.scheduler import (
+    FairScheduler, PRIORITY_READ, PRIORITY_WRITE, PRIORITY_LEASE,
+    ClientBroker,
+)
+from allmydata.storage.executor import IOExecutor
+from allmydata.storage import commit
+from allmydata.storage.commit import GroupCommitter, fsync_path
+from allmydata.storage.diskstats import DiskStatsCache
+from allmydata.storage.pack import PackStore, PackedShareFile
+from allmydata.storage.tiering import ReadTracker
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -438,11 +459,12 @@ class Server(unittest.TestCase):
         basedir = os.path.join("storage", "Server", name)
         return basedir
 
-    def create(self, name, reserved_space=0, klass=StorageServer, get_current_time=time.time):
+    def create(self, name, reserved_space=0, klass=StorageServer, get_current_time=time.time,
+               **kwargs):
         workdir = self.workdir(name)
         ss = klass(workdir, b"\x00" * 20, reserved_space=reserved_space,
                    stats_provider=FakeStatsProvider(),
-                   get_current_time=get_current_time)
+                   get_current_time=get_current_time, **kwargs)
         ss.setServiceParent(self.sparent)
         return ss
 
@@ -468,6 +490,23 @@ class Server(unittest.TestCase):
         sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
         self.failUnlessIn(b'available-space', sv1)
 
+    def test_get_buckets_many(self):
+        ss = self.create("test_get_buckets_many")
+        ver = ss.remote_get_version()
+        sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get(b'get-buckets-many'), sv1)
+
+        for (si, sharenums) in [(b"si1", [0, 1]), (b"si2", [4])]:
+            already, writers = self.allocate(ss, si, sharenums, 10)
+            for wb in writers.values():
+                wb.remote_write(0, b"a" * 10)
+                wb.remote_close()
+        results = ss.remote_get_buckets_many([b"si1", b"si2", b"si3"])
+        self.failUnlessEqual(set(results.keys()), set([b"si1", b"si2"]))
+        self.failUnlessEqual(set(results[b"si1"].keys()), set([0, 1]))
+        self.failUnlessEqual(results[b"si2"][4].remote_read(0, 10), b"a" * 10)
+        self.failUnlessEqual(ss.remote_get_buckets_many([]), {})
+
     def allocate(self, ss, storage_index, sharenums, size, canary=None):
         renew_secret = hashutil.my_renewal_secret_hash(b"%d" % next(self._lease_secret))
         cancel_secret = hashutil.my_cancel_secret_hash(b"%d" % next(self._lease_secret))
@@ -554,6 +593,22 @@ class Server(unittest.TestCase):
             writer.remote_abort()
         self.failUnlessEqual(ss.allocated_size(), 0)
 
+    def test_close_fails(self):
+        """
+        A share which cannot be moved into place gives back its space, and
+        what was uploaded is thrown away.
+        """
+        ss = self.create("test_close_fails")
+        already, writers = self.allocate(ss, b"allocate", [0], 150)
+        writers[0].remote_write(0, b"a" * 150)
+        def _fail(src, dst):
+            raise OSError(errno.EIO, "disk on fire")
+        self.patch(fileutil, "rename", _fail)
+        self.failUnlessRaises(OSError, writers[0].remote_close)
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        self.failUnlessEqual(ss._bucket_writers, {})
+        self.failIf(os.path.exists(writers[0].incominghome))
+
 
     def test_allocate(self):
         ss = self.create("test_allocate")
@@ -706,6 +761,64 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    def test_reserved_space_cached(self):
+        """
+        With cached disk statistics, allocations do not ask the OS for them
+        each time, and space used by closed shares is accounted for before
+        the statistics are refreshed.
+        """
+        calls = []
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            calls.append(whichdir)
+            return {'total': 20000, 'free_for_root': 15000,
+                    'free_for_nonroot': 15000, 'used': 5000,
+                    'avail': 15000 - reserved_space}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+
+        ss = self.create("test_reserved_space_cached", reserved_space=10000,
+                         disk_stats_ttl=3600)
+        del calls[:]
+        already, writers = self.allocate(ss, b"vid1", [0, 1, 2], 1000)
+        self.failUnlessEqual(len(writers), 3)
+        self.failUnlessEqual(ss.allocated_size(), 3000)
+        for bw in writers.values():
+            bw.remote_write(0, b"a" * 1000)
+            bw.remote_close()
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        # the three shares took 3000 bytes and their overhead out of the
+        # 5000 available, so another 1000-byte share no longer fits
+        already, writers = self.allocate(ss, b"vid2", [0, 1], 1000)
+        self.failUnlessEqual(len(writers), 1)
+        self.failUnless(len(calls) <= 1, calls)
+        self.failUnless(ss.get_stats()['storage_server.disk_avail'] < 2000)
+
+    def test_preallocate(self):
+        ss = self.create("test_preallocate", preallocate=True)
+        already, writers = self.allocate(ss, b"vid", [0], 1000)
+        bw = writers[0]
+        # the file is no bigger than it would have been anyway
+        self.failUnlessEqual(os.stat(bw.incominghome).st_size,
+                             0x0c + 1000 + ShareFile.LEASE_SIZE)
+        bw.remote_write(0, b"a" * 1000)
+        bw.remote_close()
+        self.failUnlessEqual(os.stat(bw.finalhome).st_size,
+                             0x0c + 1000 + ShareFile.LEASE_SIZE)
+
+    def test_preallocate_no_space(self):
+        """
+        Shares which cannot be preallocated are not accepted, and leave
+        nothing behind.
+        """
+        def posix_fallocate(fd, offset, length):
+            raise OSError(errno.ENOSPC, "No space left on device")
+        self.patch(os, "posix_fallocate", posix_fallocate)
+        ss = self.create("test_preallocate_no_space", preallocate=True)
+        already, writers = self.allocate(ss, b"vid", [0, 1], 1000)
+        self.failUnlessEqual(writers, {})
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        self.failUnlessEqual(
+            [files for (_, _, files) in os.walk(ss.incomingdir) if files], [])
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -1000,6 +1113,31 @@ class MutableServer(unittest.TestCase):
         self.failUnlessIn(" had magic ", str(e))
         self.failUnlessIn(" but we wanted ", str(e))
 
+    def test_slot_readv_many(self):
+        ss = self.create("test_slot_readv_many")
+        ver = ss.remote_get_version()
+        sv1 = ver[b'http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get(b'slot-readv-many'), sv1)
+
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        for (si, data) in [(b"si1", b"1" * 10), (b"si2", b"2" * 10)]:
+            secrets = ( self.write_enabler(b"we1"),
+                        self.renew_secret(b"we1"),
+                        self.cancel_secret(b"we1") )
+            answer = rstaraw(si, secrets,
+                             {0: ([], [(0,data)], None),
+                              1: ([], [(0,data)], None)},
+                             [])
+            self.failUnlessEqual(answer, (True, {}))
+        results = ss.remote_slot_readv_many([(b"si2", [1], [(0,2)]),
+                                             (b"si3", [], [(0,2)]),
+                                             (b"si1", [], [(0,1), (9,5)])])
+        self.failUnlessEqual(results, [{1: [b"22"]},
+                                       {},
+                                       {0: [b"1", b"1"], 1: [b"1", b"1"]}])
+        self.failUnlessEqual(ss.remote_slot_readv_many([]), [])
+        self.failUnlessEqual(ss.get_latencies()["readv-many"]["samplesize"], 2)
+
     def test_container_size(self):
         ss = self.create("test_container_size")
         self.allocate(ss, b"si1", b"we1", next(self._lease_secret),
@@ -2933,12 +3071,17 @@ class Stats(unittest.TestCase):
         basedir = os.path.join("storage", "Server", name)
         return basedir
 
-    def create(self, name):
+    def create(self, name, get_current_time=time.time):
         workdir = self.workdir(name)
-        ss = StorageServer(workdir, b"\x00" * 20)
+        ss = StorageServer(workdir, b"\x00" * 20,
+                           get_current_time=get_current_time)
         ss.setServiceParent(self.sparent)
         return ss
 
+    def assertClose(self, actual, expected, output):
+        # the percentiles come from histogram buckets about 4% wide
+        self.failUnless(abs(actual - expected) <= 0.025 * expected, output)
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2955,47 +3098,47 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.assertClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.assertClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.assertClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.assertClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.assertClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.assertClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.assertClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
         self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
+        self.assertClose(output["renew"]["01_0_percentile"],  10, output)
+        self.assertClose(output["renew"]["10_0_percentile"], 100, output)
+        self.assertClose(output["renew"]["50_0_percentile"], 500, output)
+        self.assertClose(output["renew"]["90_0_percentile"], 900, output)
+        self.assertClose(output["renew"]["95_0_percentile"], 950, output)
+        self.assertClose(output["renew"]["99_0_percentile"], 990, output)
+        self.assertClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
         self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.assertClose(output["write"]["10_0_percentile"],  2, output)
+        self.assertClose(output["write"]["50_0_percentile"], 10, output)
+        self.assertClose(output["write"]["90_0_percentile"], 18, output)
+        self.assertClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.assertClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.assertClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.assertClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -3005,6 +3148,32 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+    def test_latency_window(self):
+        """
+        ``get_latencies`` only covers the last few minutes, while
+        ``get_histograms`` covers everything.
+        """
+        clock = Clock()
+        ss = self.create("test_latency_window", get_current_time=clock.seconds)
+        for i in range(10):
+            ss.add_latency("read", 10.0)
+        clock.advance(3600)
+        for i in range(10):
+            ss.add_latency("read", 1.0)
+
+        output = ss.get_latencies()
+        self.failUnlessEqual(output["read"]["samplesize"], 10)
+        self.failUnlessEqual(output["read"]["mean"], 1.0)
+        self.failUnlessEqual(output["read"]["50_0_percentile"], 1.0)
+
+        histograms = ss.get_histograms()
+        self.failUnlessEqual(list(histograms.keys()),
+                             ["storage_server.latencies.read"])
+        self.failUnlessEqual(histograms["storage_server.latencies.read"].count, 20)
+
+        clock.advance(3600)
+        self.failIf("read" in ss.get_latencies())
+
 
 class ShareFileTests(unittest.TestCase):
     """Tests for allmydata.storage.immutable.ShareFile."""
@@ -3039,3 +3208,2219 @@ class ShareFileTests(unittest.TestCase):
         sf = self.get_sharefile()
         with self.assertRaises(IndexError):
             sf.cancel_lease(b"garbage")
+
+
+def prefetch_prefix(crawler, storage_index):
+    """
+    Have ``crawler`` list the prefixdir of ``storage_index`` in a worker
+    thread, as it does ahead of time.
+
+    :return Deferred: Fires once the listing is ready.
+    """
+    i = crawler.prefixes.index(bytes_to_native_str(si_b2a(storage_index))[:2])
+    listed = defer.Deferred()
+    prefetched = crawler._prefetched
+    def _prefetched(buckets, i):
+        prefetched(buckets, i)
+        listed.callback(None)
+    crawler._prefetched = _prefetched
+    crawler.prefetch_prefixes = 1
+    crawler.prefetch(i)
+    crawler.prefetch_prefixes = 0
+    return listed
+
+
+class StorageServerMixin(object):
+    """
+    Create storage servers which run until the end of the test, each in its
+    own directory below ``storage/<basedir>``.
+
+    :ivar str basedir: Where below ``storage/`` the servers go.
+    :ivar dict server_kwargs: The ``StorageServer`` arguments every server
+        gets, unless ``create`` is given others.
+    """
+
+    basedir = None
+    server_kwargs = {}
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self.addCleanup(self.sparent.stopService)
+        return super(StorageServerMixin, self).setUp()
+
+    def workdir(self, name):
+        return os.path.join("storage", self.basedir, name)
+
+    def make_server(self, name, **kwargs):
+        for (k, v) in self.server_kwargs.items():
+            kwargs.setdefault(k, v)
+        return StorageServer(self.workdir(name), b"\x00" * 20, **kwargs)
+
+    def create(self, name, **kwargs):
+        ss = self.make_server(name, **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+
+class ShareCatalogTests(StorageServerMixin, unittest.TestCase):
+    """Tests for the storage server's optional share catalog."""
+
+    basedir = "ShareCatalog"
+    server_kwargs = {"share_catalog": True}
+
+    def setUp(self):
+        self._lease_secret = itertools.count()
+        return super(ShareCatalogTests, self).setUp()
+
+    def crawl(self, ss):
+        """Run a complete catalog crawler cycle synchronously."""
+        c = ss.catalog_crawler
+        c.cpu_slice = 500
+        c.start_current_prefix(time.time())
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        renew_secret = hashutil.my_renewal_secret_hash(b"%d" % next(self._lease_secret))
+        cancel_secret = hashutil.my_cancel_secret_hash(b"%d" % next(self._lease_secret))
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums, 10,
+            FakeCanary())
+        for i, wb in writers.items():
+            wb.remote_write(0, b"%10d" % i)
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, test_and_write_vectors):
+        secrets = (hashutil.tagged_hash(b"we_blah", b"we1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, [])
+
+    def catalog_shares(self, ss, storage_index):
+        si_b32 = bytes_to_native_str(si_b2a(storage_index))
+        return [(shnum, sharetype)
+                for (shnum, sharetype, size)
+                in ss._share_catalog.get_shares(si_b32)]
+
+    @defer.inlineCallbacks
+    def test_disabled(self):
+        """
+        Without ``share_catalog`` no catalog is kept, and any catalog left
+        over from an earlier run is deleted.
+        """
+        ss = self.create("test_disabled")
+        catalogfile = os.path.join(ss.storedir, "share_catalog.sqlite")
+        self.assertTrue(os.path.exists(catalogfile))
+        yield ss.disownServiceParent()
+        ss = self.create("test_disabled", share_catalog=False)
+        self.assertIs(ss._share_catalog, None)
+        self.assertFalse(os.path.exists(catalogfile))
+
+    def test_immutable_close_and_abort(self):
+        """
+        Closed immutable shares are added to the catalog, aborted ones are
+        not.
+        """
+        ss = self.create("test_immutable_close_and_abort")
+        self.write_immutable(ss, b"si1", [0, 3])
+        self.assertEqual(self.catalog_shares(ss, b"si1"),
+                         [(0, "immutable"), (3, "immutable")])
+        already, writers = ss.remote_allocate_buckets(
+            b"si2", b"r" * 32, b"c" * 32, [0], 10, FakeCanary())
+        writers[0].remote_abort()
+        self.assertEqual(self.catalog_shares(ss, b"si2"), [])
+
+    def test_mutable_create_and_delete(self):
+        """
+        Mutable shares are added to the catalog when created and removed when
+        truncated to zero length.
+        """
+        ss = self.create("test_mutable_create_and_delete")
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"x" * 10)], None),
+                                        1: ([], [(0, b"y" * 10)], None)})
+        self.assertEqual(self.catalog_shares(ss, b"si1"),
+                         [(0, "mutable"), (1, "mutable")])
+        self.write_mutable(ss, b"si1", {0: ([], [], 0)})
+        self.assertEqual(self.catalog_shares(ss, b"si1"), [(1, "mutable")])
+
+    def test_lookups_use_complete_catalog(self):
+        """
+        Once the catalog is complete, lookups are answered without listing
+        bucket directories.
+        """
+        ss = self.create("test_lookups_use_complete_catalog")
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_mutable(ss, b"si2", {2: ([], [(0, b"z" * 10)], None)})
+        self.assertFalse(ss._share_catalog.is_complete())
+        self.crawl(ss)
+        self.assertTrue(ss._share_catalog.is_complete())
+
+        def listdir(path):
+            raise AssertionError("listed %r" % (path,))
+        self.patch(os, "listdir", listdir)
+        self.assertEqual(set(ss.remote_get_buckets(b"si1").keys()), {0, 1})
+        self.assertEqual(ss.remote_get_buckets(b"missing"), {})
+        self.assertEqual(ss.remote_slot_readv(b"si2", [], [(0, 3)]),
+                         {2: [b"zzz"]})
+        self.assertEqual(ss.remote_slot_readv(b"missing", [], [(0, 3)]), {})
+
+    @defer.inlineCallbacks
+    def test_crawler_rebuilds(self):
+        """
+        Shares written while the catalog was disabled are found by the
+        crawler, and buckets which have disappeared are forgotten.
+        """
+        ss = self.create("test_crawler_rebuilds", share_catalog=False)
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_mutable(ss, b"si2", {4: ([], [(0, b"z" * 10)], None)})
+        yield ss.disownServiceParent()
+        ss = self.create("test_crawler_rebuilds")
+        self.assertEqual(self.catalog_shares(ss, b"si1"), [])
+        ss._share_catalog.add_share(
+            bytes_to_native_str(si_b2a(b"gone")), 0, "immutable", 100)
+        self.crawl(ss)
+        self.assertEqual(self.catalog_shares(ss, b"si1"),
+                         [(0, "immutable"), (1, "immutable")])
+        self.assertEqual(self.catalog_shares(ss, b"si2"), [(4, "mutable")])
+        self.assertEqual(self.catalog_shares(ss, b"gone"), [])
+        self.assertEqual(ss.catalog_crawler.get_state()["catalog-shares"], 3)
+        self.assertEqual(ss.get_stats()["storage_server.share_catalog.complete"], 1)
+
+    @defer.inlineCallbacks
+    def test_prefetched_listing(self):
+        """
+        A bucket uploaded after its prefixdir was listed ahead of time is not
+        forgotten by the crawler.
+        """
+        ss = self.create("test_prefetched_listing")
+        yield prefetch_prefix(ss.catalog_crawler, b"si1")
+        self.write_immutable(ss, b"si1", [0])
+        self.crawl(ss)
+        self.assertTrue(ss._share_catalog.is_complete())
+        self.assertEqual(self.catalog_shares(ss, b"si1"), [(0, "immutable")])
+        self.assertEqual(set(ss.remote_get_buckets(b"si1")), {0})
+
+    @defer.inlineCallbacks
+    def test_clean_shutdown(self):
+        """
+        A complete catalog which was closed cleanly is trusted when it is
+        reopened.
+        """
+        ss = self.create("test_clean_shutdown")
+        self.crawl(ss)
+        yield ss.disownServiceParent()
+        ss = self.create("test_clean_shutdown")
+        self.assertTrue(ss._share_catalog.is_complete())
+
+    def test_unclean_shutdown(self):
+        """
+        A complete catalog which was not closed cleanly is not trusted when it
+        is reopened.
+        """
+        ss = self.create("test_unclean_shutdown")
+        self.crawl(ss)
+        self.assertTrue(ss._share_catalog.is_complete())
+        # Opening it again without stopping the first server looks like a
+        # crash.
+        ss2 = StorageServer(self.workdir("test_unclean_shutdown"), b"\x00" * 20,
+                            share_catalog=True)
+        self.assertFalse(ss2._share_catalog.is_complete())
+
+
+class LeaseDBTests(StorageServerMixin, unittest.TestCase):
+    """Tests for the storage server's optional lease database."""
+
+    basedir = "LeaseDB"
+    server_kwargs = {"lease_db": True}
+
+    def migrate(self, ss):
+        """Run a complete migration crawler cycle synchronously."""
+        c = ss.lease_migrator
+        c.cpu_slice = 500
+        c.start_current_prefix(time.time())
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, 10, FakeCanary())
+        for i, wb in writers.items():
+            wb.remote_write(0, b"%10d" % i)
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, test_and_write_vectors):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, [])
+
+    def db_leases(self, ss, storage_index):
+        si_b32 = bytes_to_native_str(si_b2a(storage_index))
+        shares = ss._lease_db.get_prefix_shares(si_b32[:2]).get(si_b32, {})
+        return dict((shnum, (sharetype, len(leases)))
+                    for (shnum, (sharetype, size, used_space, leases))
+                    in shares.items())
+
+    def test_disabled(self):
+        """
+        Without ``lease_db`` no database is kept, and any database left over
+        from an earlier run is deleted.
+        """
+        ss = self.create("test_disabled")
+        dbfile = os.path.join(ss.storedir, "leasedb.sqlite")
+        self.assertTrue(os.path.exists(dbfile))
+        ss2 = StorageServer(self.workdir("test_disabled"), b"\x00" * 20)
+        self.assertIs(ss2._lease_db, None)
+        self.assertFalse(os.path.exists(dbfile))
+
+    def test_write_through(self):
+        """
+        Leases added, renewed and cancelled through the storage server are
+        recorded in the database, as are shares being deleted.
+        """
+        ss = self.create("test_write_through")
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_mutable(ss, b"si2", {0: ([], [(0, b"x" * 10)], None)})
+        self.assertEqual(self.db_leases(ss, b"si1"),
+                         {0: ("immutable", 1), 1: ("immutable", 1)})
+        self.assertEqual(self.db_leases(ss, b"si2"), {0: ("mutable", 1)})
+
+        ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32)
+        ss.remote_add_lease(b"si2", b"R" * 32, b"C" * 32)
+        self.assertEqual(self.db_leases(ss, b"si1"),
+                         {0: ("immutable", 2), 1: ("immutable", 2)})
+        self.assertEqual(self.db_leases(ss, b"si2"), {0: ("mutable", 2)})
+
+        # renewal moves the expiration time forward
+        [sf] = [sf for sf in ss._iter_share_files(b"si2")]
+        [old, new] = sorted(lease.get_expiration_time()
+                            for lease in sf.get_leases())
+        self.patch(ss, "_get_current_time",
+                   lambda: old - DEFAULT_RENEWAL_TIME + 1000)
+        ss.remote_renew_lease(b"si2", b"r" * 32)
+        si_b32 = bytes_to_native_str(si_b2a(b"si2"))
+        [leases] = [
+            leases for (sharetype, size, used_space, leases)
+            in ss._lease_db.get_prefix_shares(si_b32[:2])[si_b32].values()]
+        self.assertEqual(sorted(t for (owner, t) in leases)[-1], old + 1000)
+
+        # cancelling the last lease deletes the share
+        for sf in ss._iter_share_files(b"si1"):
+            sf.cancel_lease(b"c" * 32)
+        self.assertEqual(self.db_leases(ss, b"si1"),
+                         {0: ("immutable", 1), 1: ("immutable", 1)})
+        for sf in ss._iter_share_files(b"si1"):
+            sf.cancel_lease(b"C" * 32)
+        self.assertEqual(self.db_leases(ss, b"si1"), {})
+
+        self.write_mutable(ss, b"si2", {0: ([], [], 0)})
+        self.assertEqual(self.db_leases(ss, b"si2"), {})
+        self.assertEqual(ss._lease_db.count_leases(), 0)
+
+    @defer.inlineCallbacks
+    def test_migration(self):
+        """
+        Leases on shares written while the database was disabled are copied
+        into it by the migration crawler, which then goes away for good.
+        """
+        ss = self.create("test_migration", lease_db=False)
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_mutable(ss, b"si2", {3: ([], [(0, b"x" * 10)], None)})
+        ss.remote_add_lease(b"si2", b"R" * 32, b"C" * 32)
+        yield ss.disownServiceParent()
+
+        ss = self.create("test_migration")
+        self.assertFalse(ss._lease_db.is_migrated())
+        self.assertEqual(self.db_leases(ss, b"si1"), {})
+        ss._lease_db.set_share(bytes_to_native_str(si_b2a(b"gone")), 0,
+                               "immutable", 100, 100, [(1, 0)])
+        self.migrate(ss)
+        self.assertTrue(ss._lease_db.is_migrated())
+        self.assertEqual(self.db_leases(ss, b"si1"),
+                         {0: ("immutable", 1), 1: ("immutable", 1)})
+        self.assertEqual(self.db_leases(ss, b"si2"), {3: ("mutable", 2)})
+        self.assertEqual(self.db_leases(ss, b"gone"), {})
+        self.assertEqual(ss.lease_migrator.get_state()["migrated-shares"], 3)
+        self.assertIs(ss.lease_migrator.parent, None)
+        self.assertEqual(ss.get_stats()["storage_server.lease_db.migrated"], 1)
+        yield ss.disownServiceParent()
+
+        ss = self.create("test_migration")
+        self.assertTrue(ss._lease_db.is_migrated())
+        self.assertFalse(hasattr(ss, "lease_migrator"))
+
+    @defer.inlineCallbacks
+    def test_prefetched_listing(self):
+        """
+        The leases of a bucket uploaded after its prefixdir was listed ahead
+        of time are kept by the migration crawler.
+        """
+        ss = self.create("test_prefetched_listing")
+        # crawl by hand instead
+        ss.lease_migrator.timer.cancel()
+        ss.lease_migrator.timer = None
+        yield prefetch_prefix(ss.lease_migrator, b"si1")
+        self.write_immutable(ss, b"si1", [0])
+        self.migrate(ss)
+        self.assertTrue(ss._lease_db.is_migrated())
+        self.assertEqual(self.db_leases(ss, b"si1"), {0: ("immutable", 1)})
+
+    def test_interrupted_migration(self):
+        """
+        A migration cycle which was started by an earlier process does not
+        mark the database migrated.
+        """
+        ss = self.create("test_interrupted_migration")
+        self.write_immutable(ss, b"si1", [0])
+        c = ss.lease_migrator
+        c._cycle_started_here = False
+        c.state["current-cycle"] = 0
+        c.cpu_slice = 500
+        c.start_current_prefix(time.time())
+        self.assertFalse(ss._lease_db.is_migrated())
+        c.start_current_prefix(time.time())
+        self.assertTrue(ss._lease_db.is_migrated())
+
+
+class CountingBloomFilterTests(unittest.TestCase):
+    """Tests for allmydata.storage.bloom.CountingBloomFilter."""
+
+    def test_add_remove(self):
+        f = CountingBloomFilter(100)
+        self.assertNotIn(b"a", f)
+        f.add(b"a")
+        f.add(b"b")
+        self.assertIn(b"a", f)
+        self.assertIn(b"b", f)
+        f.remove(b"a")
+        self.assertNotIn(b"a", f)
+        self.assertIn(b"b", f)
+
+    def test_duplicates(self):
+        """An item added twice stays present until removed twice."""
+        f = CountingBloomFilter(100)
+        f.add(b"a")
+        f.add(b"a")
+        f.remove(b"a")
+        self.assertIn(b"a", f)
+        f.remove(b"a")
+        self.assertNotIn(b"a", f)
+
+    def test_saturation(self):
+        """Saturated counters are never decremented."""
+        f = CountingBloomFilter(100)
+        for i in range(CountingBloomFilter.MAX_COUNT + 10):
+            f.add(b"a")
+        for i in range(CountingBloomFilter.MAX_COUNT + 10):
+            f.remove(b"a")
+        self.assertIn(b"a", f)
+
+    def test_false_positive_rate(self):
+        """The filter is sized to give roughly the requested rate."""
+        f = CountingBloomFilter(1000, 0.01)
+        for i in range(1000):
+            f.add(b"in-%d" % i)
+        for i in range(1000):
+            self.assertIn(b"in-%d" % i, f)
+        false_positives = sum(1 for i in range(10000) if b"out-%d" % i in f)
+        self.assertLess(false_positives, 300)
+
+
+class StorageIndexFilterTests(StorageServerMixin, unittest.TestCase):
+    """Tests for the storage server's optional storage index filter."""
+
+    basedir = "StorageIndexFilter"
+    server_kwargs = {"bloom_filter_capacity": 1000}
+
+    def setUp(self):
+        self._lease_secret = itertools.count()
+        return super(StorageIndexFilterTests, self).setUp()
+
+    def create(self, name):
+        # not started: the tests write shares before the filter is built
+        return self.make_server(name)
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        renew_secret = hashutil.my_renewal_secret_hash(b"%d" % next(self._lease_secret))
+        cancel_secret = hashutil.my_cancel_secret_hash(b"%d" % next(self._lease_secret))
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, renew_secret, cancel_secret, sharenums, 10,
+            FakeCanary())
+        for i, wb in writers.items():
+            wb.remote_write(0, b"%10d" % i)
+            wb.remote_close()
+
+    def write_mutable(self, ss, storage_index, test_and_write_vectors):
+        secrets = (hashutil.tagged_hash(b"we_blah", b"we1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, [])
+
+    def forbid_listdir(self):
+        def listdir(path):
+            raise AssertionError("listed %r" % (path,))
+        self.patch(os, "listdir", listdir)
+
+    @defer.inlineCallbacks
+    def test_misses_skip_disk(self):
+        """
+        Once the filter has been built, lookups for storage indexes the server
+        does not hold do not touch the disk, and existing shares are found.
+        """
+        ss = self.create("test_misses_skip_disk")
+        self.write_immutable(ss, b"si1", [0])
+        ss.setServiceParent(self.sparent)
+        yield ss._si_filter.when_ready()
+        self.assertEqual(set(ss.remote_get_buckets(b"si1").keys()), {0})
+        self.forbid_listdir()
+        self.assertEqual(ss.remote_get_buckets(b"missing"), {})
+        self.assertEqual(ss.remote_slot_readv(b"missing", [], [(0, 3)]), {})
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.bloom_filter.ready"], 1)
+        self.assertEqual(stats["storage_server.bloom_filter.lookups"], 3)
+        self.assertEqual(stats["storage_server.bloom_filter.negatives"], 2)
+        self.assertEqual(stats["storage_server.bloom_filter.false_positives"], 0)
+
+    @defer.inlineCallbacks
+    def test_added_and_removed(self):
+        """
+        Buckets created after the filter was built are found, and buckets
+        whose last share is deleted are dropped from the filter.
+        """
+        ss = self.create("test_added_and_removed")
+        ss.setServiceParent(self.sparent)
+        yield ss._si_filter.when_ready()
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_mutable(ss, b"si2", {0: ([], [(0, b"x" * 10)], None),
+                                        1: ([], [(0, b"y" * 10)], None)})
+        self.write_mutable(ss, b"si2", {1: ([], [(0, b"z" * 10)], None)})
+        self.assertEqual(set(ss.remote_get_buckets(b"si1").keys()), {0, 1})
+        self.assertEqual(set(ss.remote_slot_readv(b"si2", [], [(0, 1)])), {0, 1})
+
+        self.write_mutable(ss, b"si2", {0: ([], [], 0)})
+        self.assertEqual(set(ss.remote_slot_readv(b"si2", [], [(0, 1)])), {1})
+        self.write_mutable(ss, b"si2", {1: ([], [], 0)})
+        negatives = ss.get_stats()["storage_server.bloom_filter.negatives"]
+        self.forbid_listdir()
+        self.assertEqual(ss.remote_slot_readv(b"si2", [], [(0, 1)]), {})
+        self.assertEqual(ss.get_stats()["storage_server.bloom_filter.negatives"],
+                         negatives + 1)
+
+    def test_not_ready(self):
+        """
+        Until the filter has been built every lookup goes to the disk.
+        """
+        ss = self.create("test_not_ready")
+        self.write_immutable(ss, b"si1", [0])
+        self.assertEqual(set(ss.remote_get_buckets(b"si1").keys()), {0})
+        self.assertEqual(ss.remote_get_buckets(b"missing"), {})
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.bloom_filter.ready"], 0)
+        self.assertEqual(stats["storage_server.bloom_filter.lookups"], 0)
+
+    @defer.inlineCallbacks
+    def test_stopped_while_building(self):
+        """
+        Stopping the server while the filter is being built abandons the scan
+        and waits for its thread to finish.
+        """
+        scanning = threading.Event()
+        release = threading.Event()
+        stopped = []
+        def scan_buckets(sharedir, stop=None):
+            scanning.set()
+            release.wait()
+            stopped.append(stop())
+            return []
+        self.patch(bloom, "scan_buckets", scan_buckets)
+        ss = self.create("test_stopped_while_building")
+        ss.setServiceParent(self.sparent)
+        yield threads.deferToThread(scanning.wait)
+        d = ss.disownServiceParent()
+        self.assertNoResult(d)
+        release.set()
+        yield d
+        self.assertEqual(stopped, [True])
+        self.assertFalse(ss._si_filter.is_ready())
+
+
+class FileDescriptorCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.fdcache.FileDescriptorCache."""
+
+    def setUp(self):
+        self.basedir = self.mktemp()
+        os.mkdir(self.basedir)
+        self.cache = FileDescriptorCache(2)
+        self.addCleanup(self.cache.close_all)
+
+    def make_file(self, name, data):
+        filename = os.path.join(self.basedir, name)
+        with open(filename, "wb") as f:
+            f.write(data)
+        return filename
+
+    def test_pread(self):
+        fn = self.make_file("a", b"0123456789")
+        self.assertEqual(self.cache.pread(fn, 3, 2), b"234")
+        self.assertEqual(self.cache.pread(fn, 10, 8), b"89")
+        self.assertEqual(self.cache.pread(fn, 3, 20), b"")
+        self.assertEqual(self.cache.get_stats(),
+                         {"open": 1, "hits": 2, "misses": 1, "evictions": 0})
+
+    def test_file_view(self):
+        fn = self.make_file("a", b"0123456789")
+        with self.cache.open_file(fn) as f:
+            f.seek(4)
+            self.assertEqual(f.read(2), b"45")
+            self.assertEqual(f.tell(), 6)
+            self.assertEqual(f.read(2), b"67")
+            self.assertEqual(os.fstat(f.fileno()).st_size, 10)
+        # closing the view leaves the descriptor open
+        self.assertEqual(self.cache.get_stats()["open"], 1)
+        self.assertRaises(EnvironmentError, self.cache.open_file,
+                          os.path.join(self.basedir, "missing"))
+
+    def test_writes_are_visible(self):
+        fn = self.make_file("a", b"0123456789")
+        self.assertEqual(self.cache.pread(fn, 2, 0), b"01")
+        with open(fn, "rb+") as f:
+            f.write(b"ab")
+        self.assertEqual(self.cache.pread(fn, 2, 0), b"ab")
+
+    def test_lru(self):
+        fns = [self.make_file(name, name.encode("ascii"))
+               for name in ("a", "b", "c")]
+        self.cache.pread(fns[0], 1, 0)
+        self.cache.pread(fns[1], 1, 0)
+        self.cache.pread(fns[0], 1, 0)
+        self.cache.pread(fns[2], 1, 0) # evicts b, the least recently used
+        self.assertEqual(self.cache.get_stats(),
+                         {"open": 2, "hits": 1, "misses": 3, "evictions": 1})
+        self.cache.pread(fns[0], 1, 0)
+        self.assertEqual(self.cache.get_stats()["hits"], 2)
+
+    def test_invalidate(self):
+        fn = self.make_file("a", b"old")
+        self.assertEqual(self.cache.pread(fn, 3, 0), b"old")
+        self.cache.invalidate(fn)
+        self.cache.invalidate(fn)
+        os.unlink(fn)
+        self.make_file("a", b"new")
+        self.assertEqual(self.cache.pread(fn, 3, 0), b"new")
+        self.assertEqual(self.cache.get_stats()["misses"], 2)
+
+    def test_dropped_while_in_use(self):
+        """
+        A descriptor dropped from the cache while it is being read from stays
+        open until the reader is done with it.
+        """
+        fn = self.make_file("a", b"0123456789")
+        with self.cache.open_file(fn) as f:
+            fd = f.fileno()
+            self.cache.invalidate(fn)
+            self.assertEqual(self.cache.get_stats()["open"], 0)
+            self.assertEqual(f.read(3), b"012")
+        self.assertRaises(OSError, os.fstat, fd)
+
+
+class ServerFileDescriptorCacheTests(StorageServerMixin, unittest.TestCase):
+    """Tests for the storage server's use of a FileDescriptorCache."""
+
+    basedir = "ServerFileDescriptorCache"
+    server_kwargs = {"fd_cache_size": 10}
+
+    def setUp(self):
+        self._lease_secret = itertools.count()
+        return super(ServerFileDescriptorCacheTests, self).setUp()
+
+    def write_mutable(self, ss, storage_index, test_and_write_vectors):
+        secrets = (hashutil.tagged_hash(b"we_blah", b"we1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, [])
+
+    def test_immutable_reads(self):
+        ss = self.create("test_immutable_reads")
+        renew_secret = hashutil.my_renewal_secret_hash(b"%d" % next(self._lease_secret))
+        cancel_secret = hashutil.my_cancel_secret_hash(b"%d" % next(self._lease_secret))
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", renew_secret, cancel_secret, {0}, 10, FakeCanary())
+        writers[0].remote_write(0, b"0123456789")
+        writers[0].remote_close()
+
+        reader = ss.remote_get_buckets(b"si1")[0]
+        self.assertEqual(reader.remote_read(2, 3), b"234")
+        self.assertEqual(reader.remote_read(8, 10), b"89")
+        self.assertEqual(ss.remote_get_buckets(b"si1")[0].remote_read(0, 1),
+                         b"0")
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.fd_cache.open"], 1)
+        self.assertEqual(stats["storage_server.fd_cache.misses"], 1)
+
+    def test_mutable_rewrites(self):
+        ss = self.create("test_mutable_rewrites")
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"old data")], None)})
+        self.assertEqual(ss.remote_slot_readv(b"si1", [0], [(0, 3)]),
+                         {0: [b"old"]})
+        # writes, including ones which grow the container, are visible
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"new"),
+                                                 (5000, b"end")], None)})
+        self.assertEqual(ss.remote_slot_readv(b"si1", [0], [(0, 3), (5000, 3)]),
+                         {0: [b"new", b"end"]})
+        # a deleted and re-created share is not read through a stale
+        # descriptor
+        self.write_mutable(ss, b"si1", {0: ([], [], 0)})
+        self.assertEqual(ss.remote_slot_readv(b"si1", [0], [(0, 3)]), {})
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"recreated")], None)})
+        self.assertEqual(ss.remote_slot_readv(b"si1", [0], [(0, 9)]),
+                         {0: [b"recreated"]})
+
+    def test_share_removed(self):
+        """
+        Shares deleted behind the cache's back are forgotten by
+        ``share_removed``.
+        """
+        ss = self.create("test_share_removed")
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"old data")], None)})
+        self.assertEqual(ss.remote_slot_readv(b"si1", [0], [(0, 3)]),
+                         {0: [b"old"]})
+        si_b32 = si_b2a(b"si1").decode("ascii")
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir(b"si1"), "0"))
+        ss.share_removed(si_b32, 0)
+        self.assertEqual(ss.get_stats()["storage_server.fd_cache.open"], 0)
+
+    def test_stop(self):
+        ss = self.create("test_stop")
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"data")], None)})
+        ss.remote_slot_readv(b"si1", [0], [(0, 3)])
+        d = ss.disownServiceParent()
+        d.addCallback(lambda ign: self.assertEqual(
+            ss.get_stats()["storage_server.fd_cache.open"], 0))
+        return d
+
+
+class IOExecutorTests(unittest.TestCase):
+    """Tests for allmydata.storage.executor.IOExecutor."""
+
+    def setUp(self):
+        self.waits = []
+        self.executor = IOExecutor("test", 2, record_wait=self.waits.append)
+        self.executor.startService()
+        self.addCleanup(self.executor.stopService)
+
+    @defer.inlineCallbacks
+    def test_run(self):
+        main_thread = threading.current_thread()
+        in_thread = yield self.executor.run(
+            lambda: threading.current_thread() is not main_thread)
+        self.assertTrue(in_thread)
+        self.assertEqual(len(self.waits), 1)
+        self.assertEqual(self.executor.get_stats(),
+                         {"threads": 2, "queued": 0, "running": 0,
+                          "serialized_keys": 0})
+        d = self.executor.run(lambda: 1 // 0)
+        yield self.assertFailure(d, ZeroDivisionError)
+
+    @defer.inlineCallbacks
+    def test_serialized(self):
+        """
+        Operations with the same key run in order, one at a time, while
+        operations with other keys run alongside them.
+        """
+        started = []
+        gate = threading.Event()
+        def _slow():
+            started.append("a1")
+            gate.wait(10)
+        d_a1 = self.executor.run_serially("a", _slow)
+        d_a2 = self.executor.run_serially("a", started.append, "a2")
+        yield self.executor.run_serially("b", lambda: None)
+        self.assertNotIn("a2", started)
+        self.assertEqual(self.executor.get_stats()["serialized_keys"], 1)
+        gate.set()
+        yield d_a1
+        yield d_a2
+        self.assertEqual(started, ["a1", "a2"])
+        self.assertEqual(self.executor.get_stats()["serialized_keys"], 0)
+
+    @defer.inlineCallbacks
+    def test_restart(self):
+        yield self.executor.stopService()
+        self.executor.startService()
+        self.assertEqual((yield self.executor.run(lambda: 3)), 3)
+
+
+class ThreadedServerTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server which does its disk I/O in threads."""
+
+    basedir = "ThreadedServer"
+    server_kwargs = {"io_threads": 2, "fd_cache_size": 10}
+
+    @defer.inlineCallbacks
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0, 1}, 10, FakeCanary())
+        d = writers[0].remote_write(0, b"01234")
+        # the writes to one share happen in order
+        writers[0].remote_write(5, b"56789")
+        yield writers[0].remote_close()
+        self.assertTrue(d.called)
+        yield writers[1].remote_abort()
+
+        buckets = yield ss.remote_get_buckets(b"si1")
+        self.assertEqual(set(buckets.keys()), {0})
+        self.assertEqual((yield buckets[0].remote_read(3, 4)), b"3456")
+        results = yield ss.remote_get_buckets_many([b"si1", b"si2"])
+        self.assertEqual(list(results.keys()), [b"si1"])
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.io.threads"], 2)
+        self.assertEqual(stats["storage_server.io.queued"], 0)
+        self.assertIn("storage_server.latencies.io-wait.mean", stats)
+
+    @defer.inlineCallbacks
+    def test_close_fails(self):
+        """
+        A share which cannot be moved into place in an I/O thread gives back
+        its space, and what was uploaded is thrown away.
+        """
+        ss = self.create("test_close_fails")
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"0123456789")
+        def _fail(src, dst):
+            raise OSError(errno.EIO, "disk on fire")
+        self.patch(fileutil, "rename", _fail)
+        with self.assertRaises(OSError):
+            yield writers[0].remote_close()
+        self.assertEqual(ss.allocated_size(), 0)
+        self.assertEqual(ss._bucket_writers, {})
+        self.assertFalse(os.path.exists(writers[0].incominghome))
+
+    @defer.inlineCallbacks
+    def test_mutable_ordering(self):
+        """
+        Test-and-set operations on one slot, and reads of it, happen in the
+        order they were requested even though they run in threads.
+        """
+        ss = self.create("test_mutable_ordering")
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        staraw = ss.remote_slot_testv_and_readv_and_writev
+        d1 = staraw(b"si1", secrets,
+                    {0: ([(0, 2, b"eq", b"")], [(0, b"v1")], None)}, [])
+        d2 = staraw(b"si1", secrets,
+                    {0: ([(0, 2, b"eq", b"v1")], [(0, b"v2")], None)},
+                    [(0, 2)])
+        d3 = ss.remote_slot_readv(b"si1", [], [(0, 2)])
+        d4 = ss.remote_slot_readv_many([(b"si1", [0], [(0, 1)]),
+                                        (b"si2", [], [(0, 1)])])
+        self.assertEqual((yield d1), (True, {}))
+        self.assertEqual((yield d2), (True, {0: [b"v1"]}))
+        self.assertEqual((yield d3), {0: [b"v2"]})
+        self.assertEqual((yield d4), [{0: [b"v"]}, {}])
+
+        # a failed test vector writes nothing
+        result = yield staraw(b"si1", secrets,
+                              {0: ([(0, 2, b"eq", b"v1")], [(0, b"v3")], None)},
+                              [(0, 2)])
+        self.assertEqual(result, (False, {0: [b"v2"]}))
+        yield staraw(b"si1", secrets, {0: ([], [], 0)}, [])
+        self.assertEqual((yield ss.remote_slot_readv(b"si1", [], [(0, 2)])), {})
+
+    @defer.inlineCallbacks
+    def test_share_catalog(self):
+        """
+        Lookups answered by the share catalog work from the I/O threads.
+        """
+        ss = self.create("test_share_catalog", share_catalog=True)
+        ss._share_catalog.mark_complete()
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"0123456789")
+        yield writers[0].remote_close()
+        buckets = yield ss.remote_get_buckets(b"si1")
+        self.assertEqual(set(buckets.keys()), {0})
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        yield ss.remote_slot_testv_and_readv_and_writev(
+            b"si2", secrets, {0: ([], [(0, b"v1")], None)}, [])
+        self.assertEqual((yield ss.remote_slot_readv(b"si2", [], [(0, 2)])),
+                         {0: [b"v1"]})
+
+
+class GroupCommitterTests(unittest.TestCase):
+    """Tests for allmydata.storage.commit.GroupCommitter."""
+
+    def setUp(self):
+        self.synced = []
+        self.patch(commit, "fsync_path", self.synced.append)
+        self.clock = Clock()
+        self.batches = []
+        self.committer = GroupCommitter(
+            0.5, clock=self.clock,
+            record_commit=lambda size, latency: self.batches.append(size))
+
+    def test_batched(self):
+        """
+        Paths synced within one interval are committed together, once each,
+        and nobody is acknowledged before the commit.
+        """
+        d1 = self.committer.sync(["b", "a"])
+        self.clock.advance(0.2)
+        d2 = self.committer.sync(["a", "c"])
+        self.assertNoResult(d1)
+        self.assertNoResult(d2)
+        self.assertEqual(self.committer.get_stats()["waiting"], 2)
+        self.clock.advance(0.3)
+        self.successResultOf(d1)
+        self.successResultOf(d2)
+        self.assertEqual(self.synced, ["a", "b", "c"])
+
+        d3 = self.committer.sync(["d"])
+        self.assertNoResult(d3)
+        self.clock.advance(0.5)
+        self.successResultOf(d3)
+        self.assertEqual(self.batches, [3, 1])
+        self.assertEqual(self.committer.get_stats(),
+                         {"commits": 2, "synced": 4, "max_batch_size": 3,
+                          "waiting": 0, "mean_batch_size": 2})
+
+    def test_failure(self):
+        """
+        Everybody in a batch is told if it could not be committed.
+        """
+        def _fail(path):
+            raise EnvironmentError("disk on fire")
+        self.patch(commit, "fsync_path", _fail)
+        d1 = self.committer.sync(["a"])
+        d2 = self.committer.sync(["b"])
+        self.clock.advance(0.5)
+        self.failureResultOf(d1, EnvironmentError)
+        self.failureResultOf(d2, EnvironmentError)
+        self.assertEqual(self.committer.get_stats()["commits"], 0)
+
+    def test_stop(self):
+        """
+        Stopping commits whatever is waiting straight away.
+        """
+        self.committer.startService()
+        d = self.committer.sync(["a"])
+        self.committer.stopService()
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_fsync_path(self):
+        basedir = self.mktemp()
+        fileutil.make_dirs(basedir)
+        fn = os.path.join(basedir, "share")
+        fileutil.write(fn, b"data")
+        fsync_path(fn)
+        fsync_path(basedir)
+        # something else removed it: nothing to sync
+        fsync_path(os.path.join(basedir, "gone"))
+
+
+class DurableServerTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server with durable writes."""
+
+    basedir = "DurableServer"
+    server_kwargs = {"commit_interval": 0}
+
+    def setUp(self):
+        self.synced = []
+        self.patch(commit, "fsync_path", self.synced.append)
+        return super(DurableServerTests, self).setUp()
+
+    @defer.inlineCallbacks
+    def _test_immutable(self, ss):
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"0123456789")
+        self.assertEqual(self.synced, [])
+        d = writers[0].remote_close()
+        self.assertNoResult(d)
+        yield d
+        sharefile = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"), "0")
+        self.assertEqual(self.synced, [os.path.dirname(os.path.dirname(sharefile)),
+                                       os.path.dirname(sharefile),
+                                       sharefile])
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.group_commit.commits"], 1)
+        self.assertEqual(stats["storage_server.group_commit.max_batch_size"], 3)
+        self.assertEqual(ss.get_latencies()["commit"]["samplesize"], 1)
+
+    def test_immutable(self):
+        return self._test_immutable(self.create("test_immutable"))
+
+    def test_immutable_threaded(self):
+        return self._test_immutable(self.create("test_immutable_threaded",
+                                                io_threads=2))
+
+    @defer.inlineCallbacks
+    def _test_mutable(self, ss):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        staraw = ss.remote_slot_testv_and_readv_and_writev
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"))
+        sharefile = os.path.join(bucketdir, "0")
+
+        d = staraw(b"si1", secrets, {0: ([], [(0, b"v1")], None)}, [])
+        self.assertNoResult(d)
+        self.assertEqual((yield d), (True, {}))
+        self.assertEqual(sorted(self.synced),
+                         sorted([os.path.dirname(bucketdir), bucketdir,
+                                 sharefile]))
+
+        # rewriting a share only needs the share synced
+        del self.synced[:]
+        result = yield staraw(b"si1", secrets,
+                              {0: ([], [(0, b"v2")], None)}, [(0, 2)])
+        self.assertEqual(result, (True, {0: [b"v1"]}))
+        self.assertEqual(self.synced, [sharefile])
+
+        # a failed test vector has nothing to sync
+        del self.synced[:]
+        result = yield staraw(b"si1", secrets,
+                              {0: ([(0, 2, b"eq", b"v1")], [(0, b"v3")], None)},
+                              [])
+        self.assertEqual(result, (False, {0: []}))
+        self.assertEqual(self.synced, [])
+
+    def test_mutable(self):
+        return self._test_mutable(self.create("test_mutable"))
+
+    def test_mutable_threaded(self):
+        return self._test_mutable(self.create("test_mutable_threaded",
+                                              io_threads=2))
+
+
+class DiskStatsCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.diskstats.DiskStatsCache."""
+
+    def setUp(self):
+        self.calls = 0
+        self.avail = 1000
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            self.calls += 1
+            if self.avail is None:
+                raise AttributeError()
+            return {'total': 2000, 'free_for_root': self.avail,
+                    'free_for_nonroot': self.avail, 'used': 2000 - self.avail,
+                    'avail': self.avail - reserved_space}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+        self.clock = Clock()
+        self.cache = DiskStatsCache("dir", 100, 10, clock=self.clock)
+
+    def test_ttl(self):
+        self.assertEqual(self.cache.get()['avail'], 900)
+        self.avail = 500
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get()['avail'], 900)
+        self.assertEqual(self.calls, 1)
+        self.clock.advance(1)
+        self.assertEqual(self.cache.get()['avail'], 400)
+        self.assertEqual(self.calls, 2)
+
+    def test_background_refresh(self):
+        """
+        While running, the statistics are refreshed before they expire.
+        """
+        self.cache.startService()
+        self.addCleanup(self.cache.stopService)
+        self.cache.get()
+        self.avail = 500
+        self.clock.advance(5)
+        self.assertEqual(self.calls, 2)
+        self.clock.advance(5)
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(self.cache.get()['avail'], 400)
+        self.assertEqual(self.calls, 3)
+
+    def test_consume(self):
+        self.cache.get()
+        self.cache.consume(300)
+        stats = self.cache.get()
+        self.assertEqual((stats['avail'], stats['free_for_root'], stats['used']),
+                         (600, 700, 1300))
+        self.cache.consume(1000)
+        self.assertEqual(self.cache.get()['avail'], 0)
+
+    def test_error(self):
+        """
+        Failures are remembered like answers.
+        """
+        self.avail = None
+        self.assertRaises(AttributeError, self.cache.get)
+        self.assertRaises(AttributeError, self.cache.get)
+        self.assertEqual(self.calls, 1)
+        self.cache.consume(100)
+
+
+class PackStoreTests(unittest.TestCase):
+    """Tests for allmydata.storage.pack.PackStore."""
+
+    def create(self, name, segment_size=1000):
+        basedir = os.path.join("storage", "PackStore", name)
+        self.sharedir = os.path.join(basedir, "shares")
+        return PackStore(os.path.join(basedir, "packs"), self.sharedir,
+                         segment_size=segment_size)
+
+    def sharefile(self, si_b32, shnum):
+        return os.path.join(self.sharedir, si_b32[:2], si_b32, "%d" % shnum)
+
+    def test_put_read(self):
+        pack = self.create("test_put_read")
+        a = self.sharefile("aaaa", 0)
+        b = self.sharefile("aabb", 3)
+        pack.put(a, b"a" * 100)
+        pack.put(b, b"0123456789")
+        self.assertTrue(pack.has_share(a))
+        self.assertFalse(pack.has_share(self.sharefile("aaaa", 1)))
+        self.assertEqual(pack.get(a), b"a" * 100)
+        self.assertEqual(pack.read(b, 3, 4), b"3456")
+        # reads are truncated at the end of the share
+        self.assertEqual(pack.read(b, 8, 10), b"89")
+        self.assertEqual(pack.read(b, 20, 10), b"")
+        self.assertEqual(pack.get_size(b), 10)
+        self.assertEqual(pack.list_shares("aaaa"), [0])
+        self.assertEqual(pack.list_buckets(), ["aaaa", "aabb"])
+        self.assertEqual(pack.list_buckets("ab"), [])
+        self.assertRaises(EnvironmentError, pack.get,
+                          self.sharefile("zzzz", 0))
+
+    def test_segments(self):
+        """
+        A new segment is started when the current one is full, and the index
+        survives a restart.
+        """
+        pack = self.create("test_segments", segment_size=250)
+        for i in range(5):
+            pack.put(self.sharefile("aaaa", i), b"%100d" % i)
+        self.assertEqual(pack.get_stats()["segments"], 3)
+        pack.stopService()
+        pack = self.create("test_segments", segment_size=250)
+        for i in range(5):
+            self.assertEqual(pack.get(self.sharefile("aaaa", i)),
+                             b"%100d" % i)
+
+    def test_recover(self):
+        """
+        Bytes appended after the last index update are cut off.
+        """
+        pack = self.create("test_recover")
+        pack.put(self.sharefile("aaaa", 0), b"x" * 10)
+        segment = os.path.join(pack.packdir, "segment-00000001")
+        with open(segment, "ab") as f:
+            f.write(b"garbage")
+        pack = self.create("test_recover")
+        self.assertEqual(os.stat(segment).st_size, 10)
+        pack.put(self.sharefile("aaaa", 1), b"y" * 10)
+        self.assertEqual(pack.get(self.sharefile("aaaa", 1)), b"y" * 10)
+
+    def test_replace(self):
+        """
+        A share rewritten at the same size is changed in place; at another
+        size it is appended and the old copy is dead.
+        """
+        pack = self.create("test_replace")
+        a = self.sharefile("aaaa", 0)
+        pack.put(a, b"x" * 10)
+        pack.put(a, b"y" * 10)
+        self.assertEqual(pack.get(a), b"y" * 10)
+        self.assertEqual(pack.get_stats()["dead_bytes"], 0)
+        pack.put(a, b"z" * 20)
+        self.assertEqual(pack.get(a), b"z" * 20)
+        stats = pack.get_stats()
+        self.assertEqual((stats["live_bytes"], stats["dead_bytes"]), (20, 10))
+
+    def test_compact(self):
+        """
+        Segments which are mostly dead are compacted, and the shares in them
+        stay readable.
+        """
+        pack = self.create("test_compact", segment_size=300)
+        for i in range(6):
+            pack.put(self.sharefile("aaaa", i), b"%100d" % i)
+        # segment 1 holds shares 0-2, segment 2 holds 3-5
+        pack.remove(self.sharefile("aaaa", 0))
+        pack.remove(self.sharefile("aaaa", 1))
+        pack.remove(self.sharefile("aaaa", 3))
+        self.assertRaises(EnvironmentError, pack.remove,
+                          self.sharefile("aaaa", 3))
+        self.assertEqual(pack.compact(), 300)
+        self.assertFalse(os.path.exists(
+            os.path.join(pack.packdir, "segment-00000001")))
+        self.assertEqual(pack.list_shares("aaaa"), [2, 4, 5])
+        for i in (2, 4, 5):
+            self.assertEqual(pack.get(self.sharefile("aaaa", i)),
+                             b"%100d" % i)
+        stats = pack.get_stats()
+        self.assertEqual((stats["live_bytes"], stats["dead_bytes"]),
+                         (300, 100))
+        self.assertEqual((stats["compactions"], stats["reclaimed_bytes"]),
+                         (1, 300))
+        # nothing more is worth compacting
+        self.assertEqual(pack.compact(), 0)
+
+    def test_compaction_service(self):
+        clock = Clock()
+        basedir = os.path.join("storage", "PackStore", "test_compaction_service")
+        self.sharedir = os.path.join(basedir, "shares")
+        pack = PackStore(os.path.join(basedir, "packs"), self.sharedir,
+                         compaction_interval=100, clock=clock)
+        pack.put(self.sharefile("aaaa", 0), b"x" * 10)
+        pack.remove(self.sharefile("aaaa", 0))
+        pack.startService()
+        self.addCleanup(pack.stopService)
+        clock.advance(100)
+        self.assertEqual(pack.get_stats()["segments"], 0)
+
+
+class PackedServerTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server which packs small shares."""
+
+    basedir = "PackedServer"
+    server_kwargs = {"pack_max_share_size": 100}
+
+    def write_immutable(self, ss, storage_index, sharenums, size=10):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, size,
+            FakeCanary())
+        for i, wb in writers.items():
+            wb.remote_write(0, (b"%d" % i) * size)
+            wb.remote_close()
+        return writers
+
+    def test_small_shares_packed(self):
+        ss = self.create("test_small_shares_packed")
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_immutable(ss, b"si2", [0], size=1000)
+        # only the big share has a bucket directory
+        self.assertFalse(os.path.exists(
+            os.path.join(ss.sharedir, storage_index_to_dir(b"si1"))))
+        self.assertTrue(os.path.exists(
+            os.path.join(ss.sharedir, storage_index_to_dir(b"si2"), "0")))
+        self.assertEqual(ss.pack.count_shares(), 2)
+        self.assertTrue(ss.have_shares())
+
+        buckets = ss.remote_get_buckets(b"si1")
+        self.assertEqual(set(buckets.keys()), {0, 1})
+        self.assertEqual(buckets[1].remote_read(0, 20), b"1" * 10)
+        self.assertEqual(ss.remote_get_buckets(b"si2")[0].remote_read(0, 3),
+                         b"000")
+        results = ss.remote_get_buckets_many([b"si1", b"si3"])
+        self.assertEqual(list(results.keys()), [b"si1"])
+
+        # allocating again finds the packed shares
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0, 1, 2}, 10, FakeCanary())
+        self.assertEqual(already, {0, 1})
+        self.assertEqual(set(writers.keys()), {2})
+        writers[2].remote_abort()
+        self.assertEqual(ss.get_stats()["storage_server.pack.shares"], 2)
+
+    def test_leases(self):
+        ss = self.create("test_leases")
+        self.write_immutable(ss, b"si1", [0])
+        ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32)
+        self.assertEqual(len(list(ss.get_leases(b"si1"))), 2)
+        ss.remote_renew_lease(b"si1", b"R" * 32)
+        [sf] = list(ss._iter_share_files(b"si1"))
+        self.assertIsInstance(sf, PackedShareFile)
+        self.assertEqual(sf.read_share_data(0, 10), b"0" * 10)
+        sf.cancel_lease(b"c" * 32)
+        self.assertEqual(len(list(ss.get_leases(b"si1"))), 1)
+        sf.cancel_lease(b"C" * 32)
+        self.assertEqual(ss.remote_get_buckets(b"si1"), {})
+        self.assertEqual(ss.pack.get_stats()["shares"], 0)
+
+    def test_readable_when_disabled(self):
+        """
+        Shares packed by an earlier run can still be read once packing is
+        turned off.
+        """
+        ss = self.create("test_readable_when_disabled")
+        self.write_immutable(ss, b"si1", [0])
+        ss.disownServiceParent()
+        ss = self.create("test_readable_when_disabled",
+                         pack_max_share_size=None)
+        self.assertEqual(ss.remote_get_buckets(b"si1")[0].remote_read(0, 3),
+                         b"000")
+        self.write_immutable(ss, b"si2", [0])
+        self.assertTrue(os.path.exists(
+            os.path.join(ss.sharedir, storage_index_to_dir(b"si2"), "0")))
+
+    def test_crawlers(self):
+        """
+        The share catalog, lease database and storage index filter all know
+        about packed shares.
+        """
+        ss = self.create("test_crawlers", share_catalog=True, lease_db=True,
+                         bloom_filter_capacity=1000)
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_immutable(ss, b"si2", [0], size=1000)
+        si1 = bytes_to_native_str(si_b2a(b"si1"))
+        self.assertEqual([shnum for (shnum, _, _)
+                          in ss._share_catalog.get_shares(si1)], [0, 1])
+
+        for c in (ss.catalog_crawler, ss.lease_migrator):
+            c.cpu_slice = 500
+            c.start_current_prefix(time.time())
+        self.assertTrue(ss._share_catalog.is_complete())
+        self.assertEqual(ss._share_catalog.count_shares(), 3)
+        self.assertEqual(ss._lease_db.count_shares(), 3)
+        self.assertEqual(set(ss.remote_get_buckets(b"si1").keys()), {0, 1})
+
+        d = ss._si_filter.rebuild()
+        def _rebuilt(ign):
+            self.assertTrue(ss._si_filter.might_contain(si_b2a(b"si1")))
+            self.assertTrue(ss._si_filter.might_contain(si_b2a(b"si2")))
+        d.addCallback(_rebuilt)
+        return d
+
+    def test_expiry(self):
+        """
+        The lease checker expires packed shares, and compaction then gets
+        their space back.
+        """
+        ss = self.create("test_expiry", expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 1000)
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_immutable(ss, b"si2", [0], size=1000)
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        self.assertEqual(ss.remote_get_buckets(b"si1"), {})
+        self.assertEqual(ss.remote_get_buckets(b"si2"), {})
+        rec = lc.get_state()["history"][0]["space-recovered"]
+        self.assertEqual(rec["actual-shares"], 3)
+        self.assertEqual(rec["actual-buckets"], 2)
+        self.assertEqual(ss.pack.get_stats()["live_bytes"], 0)
+        self.assertTrue(ss.pack.compact() > 0)
+        self.assertEqual(ss.pack.get_stats()["segments"], 0)
+
+    def test_expiry_queue(self):
+        """
+        Packed shares are expired from the lease database too.
+        """
+        ss = self.create("test_expiry_queue", lease_db=True,
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 1000)
+        self.write_immutable(ss, b"si1", [0, 1])
+        ss._lease_db.mark_migrated()
+        self.assertEqual(ss.lease_expiry_queue.expire_due_shares(time.time()),
+                         2)
+        self.assertEqual(ss.remote_get_buckets(b"si1"), {})
+        self.assertEqual(ss._lease_db.count_shares(), 0)
+        rec = ss.lease_checker.state["recovered-between-cycles"]
+        self.assertEqual(rec["actual-shares"], 2)
+        self.assertEqual(rec["actual-buckets"], 1)
+
+    @defer.inlineCallbacks
+    def test_threaded(self):
+        ss = self.create("test_threaded", io_threads=2, fd_cache_size=10)
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"0123456789")
+        yield writers[0].remote_close()
+        buckets = yield ss.remote_get_buckets(b"si1")
+        self.assertEqual((yield buckets[0].remote_read(3, 4)), b"3456")
+
+    @defer.inlineCallbacks
+    def test_durable(self):
+        """
+        With durable writes, a packed share's segment file is synced before
+        its upload is acknowledged.
+        """
+        synced = []
+        self.patch(commit, "fsync_path", synced.append)
+        ss = self.create("test_durable", commit_interval=0)
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"0123456789")
+        yield writers[0].remote_close()
+        self.assertEqual(synced, [os.path.join(ss.pack.packdir,
+                                               "segment-00000001")])
+
+
+class MultiDirServerTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server with more than one share directory."""
+
+    basedir = "MultiDirServer"
+
+    def make_server(self, name, **kwargs):
+        basedir = self.workdir(name)
+        kwargs.setdefault("share_dirs", [os.path.join(basedir, "disk1"),
+                                         os.path.join(basedir, "disk2")])
+        return super(MultiDirServerTests, self).make_server(name, **kwargs)
+
+    def allocate(self, ss, storage_index, sharenums, size=10):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, size,
+            FakeCanary())
+        return writers
+
+    def write_immutable(self, ss, storage_index, sharenums, size=10):
+        writers = self.allocate(ss, storage_index, sharenums, size)
+        for i, wb in writers.items():
+            wb.remote_write(0, (b"%d" % i) * size)
+            wb.remote_close()
+        return writers
+
+    def write_mutable(self, ss, storage_index, test_and_write_vectors):
+        secrets = (hashutil.tagged_hash(b"we_blah", b"we1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        return ss.remote_slot_testv_and_readv_and_writev(
+            storage_index, secrets, test_and_write_vectors, [])
+
+    def bucket_sharedir(self, ss, storage_index):
+        [sharedir] = [d for d in ss.sharedirs
+                      if os.path.isdir(os.path.join(
+                          d, storage_index_to_dir(storage_index)))]
+        return sharedir
+
+    def test_placement(self):
+        """
+        New buckets go to the share directory with the fewest uploads in
+        progress, and all of a bucket's shares go in the same one.
+        """
+        ss = self.create("test_placement")
+        self.assertEqual(len(ss.sharedirs), 3)
+        w1 = self.allocate(ss, b"si1", {0, 1})
+        w2 = self.allocate(ss, b"si2", {0})
+        w3 = self.allocate(ss, b"si3", {0})
+        dirs = [self.bucket_sharedir(ss, si) for si in (b"si1", b"si2",
+                                                         b"si3")]
+        self.assertEqual(sorted(dirs), sorted(ss.sharedirs))
+        stats = ss.get_stats()
+        i = ss.sharedirs.index(dirs[0])
+        self.assertEqual(stats["storage_server.share_dirs.%d.writers" % i], 2)
+        self.assertEqual(stats["storage_server.share_dirs.%d.allocated" % i],
+                         20)
+        for writers in (w1, w2, w3):
+            for i, wb in writers.items():
+                wb.remote_write(0, (b"%d" % i) * 10)
+                wb.remote_close()
+        self.assertEqual([v for (k, v) in ss.get_stats().items()
+                          if k.endswith(".writers")], [0, 0, 0])
+
+        # more shares for a bucket join the others
+        self.write_immutable(ss, b"si2", {1, 2})
+        self.assertEqual(self.bucket_sharedir(ss, b"si2"), dirs[1])
+        buckets = ss.remote_get_buckets(b"si2")
+        self.assertEqual(set(buckets), {0, 1, 2})
+        self.assertEqual(buckets[2].remote_read(0, 10), b"2" * 10)
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0, 1, 2}, 10, FakeCanary())
+        self.assertEqual(already, {0, 1})
+        writers[2].remote_abort()
+        self.assertEqual(len(list(ss.get_leases(b"si3"))), 1)
+
+    def test_same_disk(self):
+        """
+        Share directories on the same filesystem are only counted once in
+        the available space.
+        """
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            return {'free_for_nonroot': 1000, 'avail': 1000 - reserved_space,
+                    'total': 2000, 'used': 1000, 'free_for_root': 1000}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+        ss = self.create("test_same_disk", reserved_space=100)
+        self.assertEqual(ss.get_available_space(), 900)
+        self.assertEqual(ss.get_disk_stats()["total"], 2000)
+        version = ss.remote_get_version()[
+            b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.assertEqual(version[b"maximum-immutable-share-size"], 900)
+
+    def test_restart(self):
+        """
+        Shares in every share directory are found after a restart, and
+        partial uploads in each of them are cleaned up.
+        """
+        ss = self.create("test_restart")
+        self.write_immutable(ss, b"si1", {0})
+        self.write_immutable(ss, b"si2", {0})
+        self.allocate(ss, b"si3", {0})
+        self.allocate(ss, b"si4", {0})
+        ss.disownServiceParent()
+        ss = self.create("test_restart")
+        self.assertTrue(ss.have_shares())
+        for incomingdir in ss.incomingdirs:
+            self.assertEqual(os.listdir(incomingdir), [])
+        self.assertEqual(ss.remote_get_buckets(b"si1")[0].remote_read(0, 10),
+                         b"0" * 10)
+        self.assertEqual(set(ss.remote_get_buckets(b"si2")), {0})
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        self.allocate(ss, b"si0", {0})
+        self.write_mutable(ss, b"si1", {0: ([], [(0, b"data")], None)})
+        sharedir = self.bucket_sharedir(ss, b"si1")
+        self.assertNotEqual(sharedir, ss.sharedir)
+        # later writes find the share where it is
+        self.allocate(ss, b"si2", {0})
+        self.write_mutable(ss, b"si1", {1: ([], [(0, b"more")], None)})
+        self.assertEqual(self.bucket_sharedir(ss, b"si1"), sharedir)
+        self.assertEqual(ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+                         {0: [b"data"], 1: [b"more"]})
+
+    def test_crawlers(self):
+        """
+        The crawlers, share catalog and storage index filter see the shares
+        in every share directory.
+        """
+        ss = self.create("test_crawlers", share_catalog=True, lease_db=True,
+                         bloom_filter_capacity=1000)
+        writers = [self.allocate(ss, si, {0, 1})
+                   for si in (b"si1", b"si2", b"si3")]
+        for w in writers:
+            for i, wb in w.items():
+                wb.remote_write(0, b"x" * 10)
+                wb.remote_close()
+        for c in (ss.catalog_crawler, ss.lease_migrator, ss.bucket_counter):
+            c.cpu_slice = 500
+            c.start_current_prefix(time.time())
+        self.assertTrue(ss._share_catalog.is_complete())
+        self.assertEqual(ss._share_catalog.count_shares(), 6)
+        self.assertEqual(ss._lease_db.count_shares(), 6)
+        self.assertEqual(
+            ss.bucket_counter.get_state()["last-complete-bucket-count"], 3)
+        for si in (b"si1", b"si2", b"si3"):
+            self.assertEqual(set(ss.remote_get_buckets(si)), {0, 1})
+
+        d = ss._si_filter.rebuild()
+        def _rebuilt(ign):
+            for si in (b"si1", b"si2", b"si3"):
+                self.assertTrue(ss._si_filter.might_contain(si_b2a(si)))
+        d.addCallback(_rebuilt)
+        return d
+
+    def test_expiry(self):
+        ss = self.create("test_expiry", lease_db=True,
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 1000)
+        writers = [self.allocate(ss, si, {0})
+                   for si in (b"si1", b"si2", b"si3")]
+        for w in writers:
+            w[0].remote_write(0, b"x" * 10)
+            w[0].remote_close()
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        rec = lc.get_state()["history"][0]["space-recovered"]
+        self.assertEqual(rec["actual-shares"], 3)
+        self.assertEqual(rec["actual-buckets"], 3)
+        for si in (b"si1", b"si2", b"si3"):
+            self.assertEqual(ss.remote_get_buckets(si), {})
+
+        # and from the lease database
+        self.write_immutable(ss, b"si4", {0})
+        self.allocate(ss, b"si5", {0})
+        self.write_immutable(ss, b"si6", {0})
+        ss._lease_db.mark_migrated()
+        self.assertEqual(ss.lease_expiry_queue.expire_due_shares(time.time()),
+                         2)
+        self.assertEqual(ss.remote_get_buckets(b"si4"), {})
+        self.assertEqual(ss.remote_get_buckets(b"si6"), {})
+
+
+class ReadTrackerTests(unittest.TestCase):
+    """Tests for allmydata.storage.tiering.ReadTracker."""
+
+    def test_lru(self):
+        t = ReadTracker(capacity=2)
+        t.record_read("a", False)
+        t.record_read("b", False)
+        t.record_read("a", True)
+        t.record_read("c", False)
+        # b was the least recently read
+        self.assertEqual([t.get_reads(si) for si in "abc"], [2, 0, 1])
+        self.assertEqual(t.get_stats(), {"hot_reads": 1, "cold_reads": 3,
+                                         "tracked": 2, "hit_ratio": 0.25})
+
+    def test_decay(self):
+        t = ReadTracker()
+        for i in range(5):
+            t.record_read("a", False)
+        t.record_read("b", False)
+        t.decay()
+        self.assertEqual((t.get_reads("a"), t.get_reads("b")), (2, 0))
+        self.assertEqual(len(t), 1)
+
+
+class TieredServerTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server with a hot share directory."""
+
+    basedir = "TieredServer"
+
+    def make_server(self, name, **kwargs):
+        kwargs.setdefault("hot_dir", os.path.join(self.workdir(name), "hot"))
+        return super(TieredServerTests, self).make_server(name, **kwargs)
+
+    def create(self, name, **kwargs):
+        ss = super(TieredServerTests, self).create(name, **kwargs)
+        ss.tier_migrator.cpu_slice = 500
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums, size=10):
+        already, writers = ss.remote_allocate_buckets(
+            storage_index, b"r" * 32, b"c" * 32, sharenums, size,
+            FakeCanary())
+        for i, wb in writers.items():
+            wb.remote_write(0, (b"%d" % i) * size)
+            wb.remote_close()
+        return writers
+
+    def is_hot(self, ss, storage_index):
+        return os.path.isdir(os.path.join(
+            ss.hotdir, storage_index_to_dir(storage_index)))
+
+    def read(self, ss, storage_index, times=1):
+        for i in range(times):
+            buckets = ss.remote_get_buckets(storage_index)
+        return buckets
+
+    def test_promote_and_demote(self):
+        ss = self.create("test_promote_and_demote")
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_immutable(ss, b"si2", [0])
+        self.assertFalse(ss.remote_allocate_buckets(
+            b"si3", b"r" * 32, b"c" * 32, [0], 10, FakeCanary())[1][0]
+                         .finalhome.startswith(ss.hotdir))
+        buckets = self.read(ss, b"si1", 3)
+        self.read(ss, b"si2", 2)
+
+        m = ss.tier_migrator
+        m.start_current_prefix(time.time())
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        self.assertFalse(self.is_hot(ss, b"si2"))
+        self.assertEqual(m.state["promoted-buckets"], 1)
+        self.assertEqual(m.hot_bytes, 2 * os.path.getsize(ss.find_share(
+            b"si1", 0)))
+        # a reader made before the move finds the share where it went
+        self.assertEqual(buckets[1].remote_read(0, 10), b"1" * 10)
+        buckets = self.read(ss, b"si1")
+        self.assertEqual(buckets[0].remote_read(0, 10), b"0" * 10)
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.tiering.hot_reads"], 1)
+        self.assertEqual(stats["storage_server.tiering.cold_reads"], 5)
+        self.assertEqual(stats["storage_server.tiering.promoted"], 1)
+
+        # the counts are halved after each cycle: 3 reads became 1, one more
+        # made 2, which becomes 1, then 0
+        for i in range(2):
+            m.start_current_prefix(time.time())
+            self.assertTrue(self.is_hot(ss, b"si1"))
+        m.start_current_prefix(time.time())
+        self.assertFalse(self.is_hot(ss, b"si1"))
+        self.assertEqual(m.state["demoted-buckets"], 1)
+        self.assertEqual(set(ss.remote_get_buckets(b"si1")), {0, 1})
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        secrets = (hashutil.tagged_hash(b"we_blah", b"we1"),
+                   hashutil.tagged_hash(b"renew_blah", b"1"),
+                   hashutil.tagged_hash(b"cancel_blah", b"1"))
+        ss.remote_slot_testv_and_readv_and_writev(
+            b"si1", secrets, {0: ([], [(0, b"data")], None)}, [])
+        for i in range(3):
+            ss.remote_slot_readv(b"si1", [], [(0, 4)])
+        ss.tier_migrator.start_current_prefix(time.time())
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        # writes go to the share where it is now
+        ss.remote_slot_testv_and_readv_and_writev(
+            b"si1", secrets, {0: ([], [(0, b"DATA")], None)}, [])
+        self.assertEqual(ss.remote_slot_readv(b"si1", [], [(0, 4)]),
+                         {0: [b"DATA"]})
+        self.assertEqual(len(os.listdir(ss.hotdir)), 2) # incoming/, prefix
+
+    def test_limits(self):
+        """
+        Buckets being uploaded to are not moved, and nor are any which would
+        not fit in the hot tier.
+        """
+        ss = self.create("test_limits", hot_dir_max_size=25)
+        self.write_immutable(ss, b"si1", [0, 1])
+        self.write_immutable(ss, b"si2", [0])
+        already, writers = ss.remote_allocate_buckets(
+            b"si2", b"r" * 32, b"c" * 32, [1], 10, FakeCanary())
+        self.read(ss, b"si1", 3)
+        self.read(ss, b"si2", 3)
+        ss.tier_migrator.start_current_prefix(time.time())
+        self.assertFalse(self.is_hot(ss, b"si1"))
+        self.assertFalse(self.is_hot(ss, b"si2"))
+
+        writers[1].remote_write(0, b"1" * 10)
+        writers[1].remote_close()
+        ss.tier_migrator.max_size = None
+        self.read(ss, b"si1", 3)
+        self.read(ss, b"si2", 3)
+        ss.tier_migrator.start_current_prefix(time.time())
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        self.assertTrue(self.is_hot(ss, b"si2"))
+
+        # over the limit, buckets not read often enough are moved out
+        ss.tier_migrator.max_size = 1
+        self.read(ss, b"si1", 4)
+        ss.tier_migrator.start_current_prefix(time.time())
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        self.assertFalse(self.is_hot(ss, b"si2"))
+
+    def test_copy(self):
+        """
+        Buckets are copied between filesystems, and left in the capacity
+        tier if a copy was interrupted.
+        """
+        ss = self.create("test_copy", fd_cache_size=10)
+        m = ss.tier_migrator
+        m._same_filesystem = lambda a, b: False
+        self.write_immutable(ss, b"si1", [0, 1])
+        buckets = self.read(ss, b"si1", 3)
+        self.assertEqual(buckets[0].remote_read(0, 10), b"0" * 10)
+        m.start_current_prefix(time.time())
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        self.assertEqual(m.state["migrated-bytes"], m.hot_bytes)
+        self.assertEqual(ss.remote_get_buckets(b"si1")[1].remote_read(0, 10),
+                         b"1" * 10)
+        self.assertEqual(os.listdir(os.path.join(ss.hotdir, "incoming",
+                                                 "migrating")), [])
+
+        colddir = os.path.join(ss.sharedir, storage_index_to_dir(b"si1"))
+        shutil.copytree(os.path.join(ss.hotdir, storage_index_to_dir(b"si1")),
+                        colddir)
+        m.start_current_prefix(time.time())
+        self.assertFalse(self.is_hot(ss, b"si1"))
+        self.assertEqual(sorted(os.listdir(colddir)), ["0", "1"])
+        self.assertEqual(set(ss.remote_get_buckets(b"si1")), {0, 1})
+
+    @defer.inlineCallbacks
+    def test_copy_threaded(self):
+        """
+        With I/O threads, buckets are copied between filesystems in them,
+        and a bucket given a lease while it was copied is left where it was.
+        """
+        ss = self.create("test_copy_threaded", io_threads=2)
+        m = ss.tier_migrator
+        m._same_filesystem = lambda a, b: False
+        copied = []
+        copy_bucket = m._copy_bucket
+        def _copy_bucket(bucketdir, tmpdir):
+            copied.append(threading.current_thread())
+            result = copy_bucket(bucketdir, tmpdir)
+            if bucketdir.endswith(si2_b32):
+                threads.blockingCallFromThread(
+                    reactor, ss.remote_add_lease, b"si2", b"R" * 32,
+                    b"C" * 32)
+            return result
+        m._copy_bucket = _copy_bucket
+        for si in [b"si1", b"si2"]:
+            already, writers = ss.remote_allocate_buckets(
+                si, b"r" * 32, b"c" * 32, {0, 1}, 10, FakeCanary())
+            for i, wb in writers.items():
+                yield wb.remote_write(0, (b"%d" % i) * 10)
+                yield wb.remote_close()
+            for i in range(3):
+                yield ss.remote_get_buckets(si)
+        si1_b32 = bytes_to_native_str(si_b2a(b"si1"))
+        si2_b32 = bytes_to_native_str(si_b2a(b"si2"))
+
+        m.start_current_prefix(time.time())
+        self.assertFalse(self.is_hot(ss, b"si1"))
+        moves = list(m._moving.values())
+        self.assertEqual(sorted(m._moving), sorted([si1_b32, si2_b32]))
+        # a bucket being moved is left alone by the next cycle
+        m.start_current_prefix(time.time())
+        self.assertEqual(len(m._moving), 2)
+        yield defer.DeferredList(moves)
+        self.assertEqual(len(copied), 2)
+        self.assertNotIn(threading.current_thread(), copied)
+        self.assertEqual(m._moving, {})
+        self.assertTrue(self.is_hot(ss, b"si1"))
+        self.assertFalse(self.is_hot(ss, b"si2"))
+        self.assertEqual(m.state["promoted-buckets"], 1)
+        self.assertEqual(m.state["migrated-bytes"], 2 * os.path.getsize(
+            ss.find_share(b"si1", 0)))
+        self.assertEqual(len(list(ss.get_leases(b"si2"))), 2)
+        self.assertEqual(os.listdir(os.path.join(ss.hotdir, "incoming",
+                                                 "migrating")), [])
+        buckets = yield ss.remote_get_buckets(b"si1")
+        self.assertEqual((yield buckets[1].remote_read(0, 10)), b"1" * 10)
+
+    def test_migrator_rate_limit(self):
+        ss = self.make_server("test_migrator_rate_limit",
+                              crawler_max_bytes_per_second=10000,
+                              hot_dir_max_bytes_per_second=1000)
+        self.assertEqual(ss.tier_migrator.max_bytes_per_second, 1000)
+        self.assertEqual(ss.lease_checker.max_bytes_per_second, 10000)
+
+
+class BlockCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.blockcache.BlockCache."""
+
+    def test_get_put(self):
+        c = BlockCache(1600)
+        self.assertIs(c.get(b"si1", 0, 0, 10), None)
+        c.put(b"si1", 0, 0, 10, b"0123456789")
+        self.assertEqual(c.get(b"si1", 0, 0, 10), b"0123456789")
+        self.assertIs(c.get(b"si1", 0, 0, 5), None)
+        self.assertIs(c.get(b"si1", 1, 0, 10), None)
+        # too big to cache
+        c.put(b"si1", 0, 10, 101, b"x" * 101)
+        self.assertIs(c.get(b"si1", 0, 10, 101), None)
+        self.assertEqual(c.get_stats(), {"entries": 1, "bytes": 10,
+                                         "hits": 1, "misses": 4,
+                                         "evictions": 0})
+
+    def test_eviction(self):
+        c = BlockCache(160)
+        for i in range(16):
+            c.put(b"si1", 0, i * 10, 10, b"%d" % (i % 10) * 10)
+        c.get(b"si1", 0, 0, 10)
+        c.put(b"si1", 1, 0, 10, b"x" * 10)
+        # the least recently used read was dropped
+        self.assertIs(c.get(b"si1", 0, 10, 10), None)
+        self.assertEqual(c.get(b"si1", 0, 0, 10), b"0" * 10)
+        stats = c.get_stats()
+        self.assertEqual((stats["entries"], stats["bytes"],
+                          stats["evictions"]), (16, 160, 1))
+
+    def test_invalidate(self):
+        c = BlockCache(1600)
+        c.put(b"si1", 0, 0, 10, b"0" * 10)
+        c.put(b"si1", 0, 10, 10, b"1" * 10)
+        c.put(b"si1", 1, 0, 10, b"2" * 10)
+        c.invalidate(b"si1", 0)
+        c.invalidate(b"si2", 0)
+        self.assertIs(c.get(b"si1", 0, 0, 10), None)
+        self.assertIs(c.get(b"si1", 0, 10, 10), None)
+        self.assertEqual(c.get(b"si1", 1, 0, 10), b"2" * 10)
+        self.assertEqual(c.get_stats()["bytes"], 10)
+
+
+class ServerBlockCacheTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server with a block cache."""
+
+    basedir = "ServerBlockCache"
+    server_kwargs = {"block_cache_size": 10000}
+
+    @defer.inlineCallbacks
+    def _test_cached_reads(self, ss):
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 100, FakeCanary())
+        yield writers[0].remote_write(0, b"a" * 100)
+        yield writers[0].remote_close()
+        for i in range(3):
+            buckets = yield ss.remote_get_buckets(b"si1")
+            self.assertEqual((yield buckets[0].remote_read(0, 10)), b"a" * 10)
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.block_cache.misses"], 1)
+        self.assertEqual(stats["storage_server.block_cache.hits"], 2)
+        self.assertEqual(stats["storage_server.block_cache.bytes"], 10)
+
+        ss.share_removed(bytes_to_native_str(si_b2a(b"si1")), 0)
+        self.assertEqual(ss.get_stats()["storage_server.block_cache.bytes"],
+                         0)
+
+    def test_cached_reads(self):
+        return self._test_cached_reads(self.create("test_cached_reads"))
+
+    def test_cached_reads_threaded(self):
+        return self._test_cached_reads(
+            self.create("test_cached_reads_threaded", io_threads=2))
+
+    def test_expired(self):
+        """
+        A share deleted by the lease checker is not read from the cache.
+        """
+        ss = self.create("test_expired", expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 1000)
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 100, FakeCanary())
+        writers[0].remote_write(0, b"a" * 100)
+        writers[0].remote_close()
+        [reader] = ss.remote_get_buckets(b"si1").values()
+        reader.remote_read(0, 10)
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.start_current_prefix(time.time())
+        self.assertEqual(ss.remote_get_buckets(b"si1"), {})
+        self.assertEqual(ss.get_stats()["storage_server.block_cache.entries"],
+                         0)
+        self.assertRaises(EnvironmentError, reader.remote_read, 0, 10)
+
+
+class MutableHeaderCacheTests(unittest.TestCase):
+    """Tests for allmydata.storage.headercache.MutableHeaderCache."""
+
+    def setUp(self):
+        self.data = b"0123456789" * 10
+        self.reads = []
+
+    def read(self, readv):
+        def _read():
+            self.reads.append(readv)
+            return [self.data[offset:offset+length]
+                    for (offset, length) in readv]
+        return _read
+
+    def readv(self, c, readv, shnum=0):
+        return c.readv(b"si1", shnum, readv, self.read(readv))
+
+    def test_prefix(self):
+        c = MutableHeaderCache(1600)
+        self.assertEqual(self.readv(c, [(0, 20)]), [self.data[:20]])
+        # anything within the first 20 bytes is answered from memory
+        self.assertEqual(self.readv(c, [(0, 5), (10, 10)]),
+                         [self.data[:5], self.data[10:20]])
+        self.assertEqual(len(self.reads), 1)
+        self.assertEqual(self.readv(c, [(10, 20)]), [self.data[10:30]])
+        self.assertEqual(self.readv(c, [(0, 5)], shnum=1), [self.data[:5]])
+        self.assertEqual(len(self.reads), 3)
+        self.assertEqual(c.get_stats(), {"entries": 2, "bytes": 25,
+                                         "hits": 1, "misses": 3,
+                                         "evictions": 0, "invalidations": 0})
+
+    def test_whole_share(self):
+        """
+        A read from offset 0 which comes back short holds all of the share,
+        so reads beyond its end are answered too.
+        """
+        c = MutableHeaderCache(1600)
+        self.readv(c, [(0, 200)])
+        self.assertEqual(self.readv(c, [(90, 20), (150, 10)]),
+                         [self.data[90:], b""])
+        self.assertEqual(len(self.reads), 1)
+
+    def test_limits(self):
+        c = MutableHeaderCache(320)
+        # no more than 20 bytes are kept of any share
+        self.readv(c, [(0, 200)])
+        self.assertEqual(self.readv(c, [(0, 20)]), [self.data[:20]])
+        self.readv(c, [(0, 30)])
+        self.assertEqual(len(self.reads), 2)
+        for shnum in range(1, 17):
+            self.readv(c, [(0, 20)], shnum=shnum)
+        stats = c.get_stats()
+        self.assertEqual((stats["entries"], stats["bytes"],
+                          stats["evictions"]), (16, 320, 1))
+        # the least recently read share was dropped
+        self.readv(c, [(0, 10)], shnum=1)
+        self.assertEqual(len(self.reads), 18)
+        self.readv(c, [(0, 10)], shnum=0)
+        self.assertEqual(len(self.reads), 19)
+
+    def test_invalidate(self):
+        c = MutableHeaderCache(1600)
+        self.readv(c, [(0, 20)])
+        c.invalidate(b"si1", 0)
+        c.invalidate(b"si1", 1)
+        self.data = b"x" * 100
+        self.assertEqual(self.readv(c, [(0, 20)]), [b"x" * 20])
+        self.assertEqual(c.get_stats()["invalidations"], 1)
+
+    def test_invalidated_while_reading(self):
+        """
+        A read which was under way when its share was written to is not
+        remembered, since it may have read the old data.
+        """
+        c = MutableHeaderCache(1600)
+        def _read():
+            c.invalidate(b"si1", 0)
+            return [b"old"]
+        self.assertEqual(c.readv(b"si1", 0, [(0, 3)], _read), [b"old"])
+        self.assertEqual(c.get_stats()["entries"], 0)
+        self.readv(c, [(0, 3)])
+        self.assertEqual(c.get_stats()["entries"], 1)
+
+
+class ServerMutableHeaderCacheTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server with a mutable header cache."""
+
+    basedir = "ServerMutableHeaderCache"
+    server_kwargs = {"mutable_header_cache_size": 10000}
+
+    @defer.inlineCallbacks
+    def _test_cached_reads(self, ss):
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        staraw = ss.remote_slot_testv_and_readv_and_writev
+        yield staraw(b"si1", secrets, {0: ([], [(0, b"v1" * 10)], None),
+                                       1: ([], [(0, b"v1" * 10)], None)}, [])
+        for i in range(3):
+            result = yield ss.remote_slot_readv(b"si1", [], [(0, 4)])
+            self.assertEqual(result, {0: [b"v1v1"], 1: [b"v1v1"]})
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.mutable_header_cache.misses"],
+                         2)
+        self.assertEqual(stats["storage_server.mutable_header_cache.hits"], 4)
+
+        # a write is seen by the next read
+        yield staraw(b"si1", secrets, {0: ([], [(0, b"v2")], None)}, [])
+        result = yield ss.remote_slot_readv(b"si1", [0], [(0, 4)])
+        self.assertEqual(result, {0: [b"v2v1"]})
+        stats = ss.get_stats()
+        self.assertEqual(
+            stats["storage_server.mutable_header_cache.invalidations"], 1)
+
+        # and so is a deletion
+        yield staraw(b"si1", secrets, {1: ([], [], 0)}, [])
+        result = yield ss.remote_slot_readv(b"si1", [], [(0, 4)])
+        self.assertEqual(result, {0: [b"v2v1"]})
+        self.assertEqual(
+            ss.get_stats()["storage_server.mutable_header_cache.entries"], 1)
+
+    def test_cached_reads(self):
+        return self._test_cached_reads(self.create("test_cached_reads"))
+
+    def test_cached_reads_threaded(self):
+        return self._test_cached_reads(
+            self.create("test_cached_reads_threaded", io_threads=2))
+
+
+class SequentialReadAheadTests(unittest.TestCase):
+    """Tests for allmydata.storage.readahead.SequentialReadAhead."""
+
+    def setUp(self):
+        self.data = b"".join(b"%02d" % i for i in range(100))
+        self.reads = []
+        self.stats = ReadAheadStats()
+        self.ra = SequentialReadAhead(self.read, 4, stats=self.stats)
+
+    def read(self, offset, length):
+        self.reads.append((offset, length))
+        return self.data[offset:offset+length]
+
+    def check_read(self, offset, length):
+        self.assertEqual(self.ra.read(offset, length, lambda data: data),
+                         self.data[offset:offset+length])
+
+    def test_sequential(self):
+        self.check_read(0, 10)
+        self.check_read(10, 10)
+        self.assertEqual(self.reads, [(0, 10), (10, 50)])
+        for offset in range(20, 60, 10):
+            self.check_read(offset, 10)
+        self.assertEqual(len(self.reads), 2)
+        self.check_read(60, 10)
+        self.assertEqual(self.reads[-1], (60, 50))
+        stats = self.stats.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (4, 3))
+        self.assertEqual((stats["prefetches"], stats["prefetched_bytes"],
+                          stats["wasted_bytes"]), (2, 80, 40))
+
+    def test_random(self):
+        """
+        Reads which do not follow each other are not read ahead of, and
+        throw away what was.
+        """
+        self.check_read(100, 10)
+        self.check_read(0, 10)
+        self.check_read(50, 10)
+        self.check_read(60, 10)
+        self.check_read(20, 10)
+        self.check_read(70, 10)
+        self.assertEqual(self.reads, [(100, 10), (0, 10), (50, 10), (60, 50),
+                                      (20, 10), (70, 10)])
+        self.assertEqual(self.stats.get_stats()["wasted_bytes"], 40)
+
+    def test_skipped(self):
+        """
+        Reads answered from elsewhere (the block cache) still count as
+        sequential, and use up what was read ahead.
+        """
+        self.ra.skipped(0, 10)
+        self.check_read(10, 10)
+        self.ra.skipped(20, 10)
+        self.check_read(30, 10)
+        self.assertEqual(self.reads, [(10, 50)])
+        self.assertEqual(self.stats.get_stats()["wasted_bytes"], 20)
+
+
+class ServerReadAheadTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server which reads ahead."""
+
+    basedir = "ServerReadAhead"
+    server_kwargs = {"read_ahead_blocks": 4}
+
+    @defer.inlineCallbacks
+    def _test_streaming(self, ss, misses):
+        data = b"".join(b"%02d" % i for i in range(50))
+        already, writers = ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 100, FakeCanary())
+        yield writers[0].remote_write(0, data)
+        yield writers[0].remote_close()
+        buckets = yield ss.remote_get_buckets(b"si1")
+        for offset in range(0, 100, 10):
+            self.assertEqual((yield buckets[0].remote_read(offset, 10)),
+                             data[offset:offset+10])
+        stats = ss.get_stats()
+        self.assertEqual(stats["storage_server.read_ahead.misses"], misses)
+        self.assertEqual(stats["storage_server.read_ahead.hits"], 10 - misses)
+
+    def test_streaming(self):
+        return self._test_streaming(self.create("test_streaming"), 3)
+
+    def test_streaming_threaded(self):
+        """
+        With I/O threads the next blocks are read while the client reads
+        the ones before, so only the first two reads wait for the disk.
+        """
+        return self._test_streaming(
+            self.create("test_streaming_threaded", io_threads=2), 2)
+
+
+class FairSchedulerTests(unittest.TestCase):
+    """Tests for allmydata.storage.scheduler.FairScheduler."""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = FairScheduler(1, get_time=self.clock.seconds)
+        self.started = []
+        # the first operation holds the only slot until this fires
+        self.blocker = defer.Deferred()
+        self.scheduler.submit("blocker", PRIORITY_READ, lambda: self.blocker)
+
+    def submit(self, client, priority, name):
+        def _start():
+            self.started.append(name)
+            return name
+        return self.scheduler.submit(client, priority, _start)
+
+    def test_fair(self):
+        """
+        A client with many operations queued does not hold up one which
+        asks for something later.
+        """
+        for i in range(4):
+            self.submit("busy", PRIORITY_READ, "busy%d" % i)
+        d = self.submit("quiet", PRIORITY_READ, "quiet")
+        self.assertNoResult(d)
+        self.assertEqual(self.scheduler.waiting(), 5)
+        self.blocker.callback(None)
+        self.assertEqual(self.successResultOf(d), "quiet")
+        self.assertEqual(self.started,
+                         ["busy0", "quiet", "busy1", "busy2", "busy3"])
+        self.assertEqual(self.scheduler.waiting(), 0)
+
+    def test_priority(self):
+        """
+        Reads overtake the lease renewals queued before them.
+        """
+        for i in range(3):
+            self.submit("c", PRIORITY_LEASE, "lease%d" % i)
+        self.submit("c", PRIORITY_WRITE, "write")
+        self.submit("c", PRIORITY_READ, "read")
+        self.blocker.callback(None)
+        self.assertEqual(self.started,
+                         ["read", "write", "lease0", "lease1", "lease2"])
+
+    def test_failure(self):
+        d = self.scheduler.submit("c", PRIORITY_READ,
+                                  lambda: 1 // 0)
+        self.submit("c", PRIORITY_READ, "after")
+        self.blocker.callback(None)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(self.started, ["after"])
+
+    def test_stats(self):
+        slow = defer.Deferred()
+        self.clock.advance(2)
+        self.scheduler.submit("c", PRIORITY_READ, lambda: slow)
+        self.submit("c", PRIORITY_READ, "fast")
+        self.assertEqual(self.scheduler.get_client_stats()["c"]["queued"], 2)
+        self.clock.advance(3)
+        self.blocker.callback(None)
+        self.clock.advance(5)
+        slow.callback(None)
+        self.assertEqual(self.scheduler.get_client_stats()["c"],
+                         {"queued": 0, "running": 0, "operations": 2,
+                          "service_time": 5.0, "wait_time": 11.0})
+        self.assertEqual(self.scheduler.get_stats(),
+                         {"slots": 1, "queued": 0, "running": 0,
+                          "clients": 2})
+
+
+class ServerFairQueuingTests(StorageServerMixin, unittest.TestCase):
+    """Tests for a storage server which queues requests fairly."""
+
+    basedir = "ServerFairQueuing"
+    server_kwargs = {"io_threads": 1, "fair_queuing": True}
+
+    @defer.inlineCallbacks
+    def test_operations(self):
+        ss = self.create("test_operations")
+        already, writers = yield ss.remote_allocate_buckets(
+            b"si1", b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+        yield writers[0].remote_write(0, b"a" * 10)
+        yield writers[0].remote_close()
+        buckets = yield ss.remote_get_buckets(b"si1")
+        self.assertEqual((yield buckets[0].remote_read(0, 10)), b"a" * 10)
+        yield ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32)
+        yield ss.remote_renew_lease(b"si1", b"R" * 32)
+        yield self.assertFailure(ss.remote_renew_lease(b"si2", b"R" * 32),
+                                 IndexError)
+        secrets = (b"w" * 32, b"r" * 32, b"c" * 32)
+        result = yield ss.remote_slot_testv_and_readv_and_writev(
+            b"si3", secrets, {0: ([], [(0, b"data")], None)}, [])
+        self.assertEqual(result, (True, {}))
+        result = yield ss.remote_slot_readv_many([(b"si3", [], [(0, 4)])])
+        self.assertEqual(result, [{0: [b"data"]}])
+        stats = ss.get_stats()
+        # calls not made through foolscap are counted as from nobody known
+        self.assertEqual(
+            stats["storage_server.scheduler.client.unknown.operations"], 9)
+        self.assertEqual(stats["storage_server.scheduler.queued"], 0)
+
+    @defer.inlineCallbacks
+    def test_foolscap_client(self):
+        """
+        Requests which arrive over a Foolscap connection handled by a
+        ``ClientBroker`` are counted as from the tubid at its other end,
+        including those made to the buckets they hand out.
+        """
+        ss = self.create("test_foolscap_client")
+        server_tub = Tub()
+        server_tub.brokerClass = ClientBroker
+        server_tub.setServiceParent(self.sparent)
+        listenOnUnused(server_tub)
+        furl = server_tub.registerReference(ss)
+        client_tub = Tub()
+        client_tub.setServiceParent(self.sparent)
+        rref = yield client_tub.getReference(furl)
+        already, writers = yield rref.callRemote(
+            "allocate_buckets", b"si1", b"r" * 32, b"c" * 32, {0}, 10,
+            Referenceable())
+        yield writers[0].callRemote("write", 0, b"a" * 10)
+        yield writers[0].callRemote("close")
+        buckets = yield rref.callRemote("get_buckets", b"si1")
+        self.assertEqual((yield buckets[0].callRemote("read", 0, 10)),
+                         b"a" * 10)
+        yield rref.callRemote("add_lease", b"si1", b"R" * 32, b"C" * 32)
+        stats = ss.scheduler.get_client_stats()
+        self.assertEqual(list(stats), [client_tub.getTubID()])
+        self.assertEqual(stats[client_tub.getTubID()]["operations"], 5)
+
+    def test_for_client_without_scheduler(self):
+        """
+        A server which does not queue requests fairly needs no per-client
+        view of itself.
+        """
+        ss = self.create("test_for_client_without_scheduler",
+                         fair_queuing=False)
+        self.assertIs(ss.for_client(b"a" * 32), ss)
+
+    def test_crawlers_yield(self):
+        """
+        The crawlers give way while requests are waiting.
+        """
+        ss = self.create("test_crawlers_yield")
+        crawler = ss.bucket_counter
+        self.assertFalse(crawler.should_yield(time.time()))
+        blocker = defer.Deferred()
+        ss.scheduler.submit(None, PRIORITY_READ, lambda: blocker)
+        d = ss.remote_add_lease(b"si1", b"R" * 32, b"C" * 32)
+        self.assertTrue(crawler.should_yield(time.time()))
+        blocker.callback(None)
+        self.successResultOf(d)
+        self.assertFalse(crawler.should_yield(time.time()))
@@ -57,18 +57,24 @@ from twisted.internet.defer import (
     Deferred,
     inlineCallbacks,
 )
+from twisted.internet.task import (
+    Clock,
+)
 from twisted.python.filepath import (
     FilePath,
 )
 
 from foolscap.api import (
     Tub,
+    RemoteException,
+    flushEventualQueue,
 )
 from foolscap.ipb import (
     IConnectionHintHandler,
 )
 
-from .no_network import LocalWrapper
+from .no_network import LocalWrapper, wrap_storage_server
+from .common_util import FakeCanary
 from .common import (
     EMPTY_CLIENT_CONFIG,
     SyncTestCase,
@@ -91,9 +97,11 @@ from allmydata.util import base32, yamlutil
 from allmydata.storage_client import (
     IFoolscapStorageServer,
     NativeStorageServer,
+    ServerSpeed,
     StorageFarmBroker,
     _FoolscapStorage,
     _NullStorage,
+    _StorageServer,
 )
 from ..storage.server import (
     StorageServer,
@@ -442,6 +450,222 @@ class FoolscapStorageServers(unittest.TestCase):
         )
 
 
+class BatchedGetBuckets(unittest.TestCase):
+    """
+    Tests for the batching of ``get_buckets`` calls by ``_StorageServer``.
+    """
+    def setUp(self):
+        self.server = StorageServer(self.mktemp(), b"x" * 20)
+        for si in (b"a" * 16, b"b" * 16):
+            _, writers = self.server.remote_allocate_buckets(
+                si, b"r" * 32, b"c" * 32, {0}, 10, FakeCanary())
+            writers[0].remote_write(0, b"x" * 10)
+            writers[0].remote_close()
+
+    @inlineCallbacks
+    def test_batched(self):
+        """
+        ``get_buckets`` calls made while the maximum number of lookups are
+        outstanding on a server which supports ``get_buckets_many`` are sent
+        together in a single message.
+        """
+        rref = wrap_storage_server(self.server)
+        storage_server = _StorageServer(lambda: rref)
+        self.assertEqual(storage_server.MAX_LOOKUPS_IN_FLIGHT, 2)
+        # the first two are sent right away
+        d_a = storage_server.get_buckets(b"a" * 16)
+        d_c = storage_server.get_buckets(b"c" * 16)
+        # these wait for one of them to finish
+        d_b = storage_server.get_buckets(b"b" * 16)
+        d_c_again = storage_server.get_buckets(b"c" * 16)
+        d_d = storage_server.get_buckets(b"d" * 16)
+        self.assertEqual(set((yield d_a).keys()), {0})
+        self.assertEqual((yield d_c), {})
+        self.assertEqual(set((yield d_b).keys()), {0})
+        self.assertEqual((yield d_c_again), {})
+        self.assertEqual((yield d_d), {})
+        self.assertEqual(rref.counter_by_methname,
+                         {"get_buckets": 2, "get_buckets_many": 1})
+
+    @inlineCallbacks
+    def test_batch_failure(self):
+        """
+        If a batched ``get_buckets_many`` fails, its lookups are retried one
+        at a time, and only the ones which fail again errback.
+        """
+        def get_buckets_many(storage_indexes):
+            raise ValueError("get_buckets_many failed")
+        self.server.remote_get_buckets_many = get_buckets_many
+        get_buckets = self.server.remote_get_buckets
+        def _get_buckets(storage_index):
+            if storage_index == b"d" * 16:
+                raise ValueError("get_buckets failed")
+            return get_buckets(storage_index)
+        self.server.remote_get_buckets = _get_buckets
+        rref = wrap_storage_server(self.server)
+        storage_server = _StorageServer(lambda: rref)
+        d_a = storage_server.get_buckets(b"a" * 16)
+        d_c = storage_server.get_buckets(b"c" * 16)
+        # these are batched, and the batch fails
+        d_b = storage_server.get_buckets(b"b" * 16)
+        d_c_again = storage_server.get_buckets(b"c" * 16)
+        d_d = storage_server.get_buckets(b"d" * 16)
+        self.assertEqual(set((yield d_a).keys()), {0})
+        self.assertEqual((yield d_c), {})
+        self.assertEqual(set((yield d_b).keys()), {0})
+        self.assertEqual((yield d_c_again), {})
+        yield self.assertFailure(d_d, RemoteException)
+        self.assertEqual(rref.counter_by_methname,
+                         {"get_buckets": 5, "get_buckets_many": 1})
+
+    @inlineCallbacks
+    def test_hung_lookups(self):
+        """
+        Lookups which have not been answered after ``BATCH_TIMEOUT`` seconds
+        no longer hold back the ones requested after them.
+        """
+        rref = wrap_storage_server(self.server)
+        clock = Clock()
+        storage_server = _StorageServer(lambda: rref, clock=clock)
+        rref.hung_until = Deferred()
+        d_a = storage_server.get_buckets(b"a" * 16)
+        d_b = storage_server.get_buckets(b"b" * 16)
+        d_c = storage_server.get_buckets(b"c" * 16)
+        yield flushEventualQueue()
+        hung_until, rref.hung_until = rref.hung_until, None
+        self.assertEqual(list(storage_server._pending_lookups), [b"c" * 16])
+        clock.advance(storage_server.BATCH_TIMEOUT)
+        self.assertEqual(storage_server._pending_lookups, {})
+        self.assertEqual((yield d_c), {})
+        # the hung lookups still get their answers
+        hung_until.callback(None)
+        self.assertEqual(set((yield d_a).keys()), {0})
+        self.assertEqual(set((yield d_b).keys()), {0})
+        self.assertEqual(storage_server._lookups_in_flight, 0)
+
+    @inlineCallbacks
+    def test_unbatched(self):
+        """
+        Servers without ``get_buckets_many`` get one ``get_buckets`` message
+        per lookup, and ``get_buckets_many`` is emulated.
+        """
+        rref = wrap_storage_server(self.server)
+        v1 = rref.version[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        del v1[b"get-buckets-many"]
+        storage_server = _StorageServer(lambda: rref)
+        buckets = yield storage_server.get_buckets(b"a" * 16)
+        self.assertEqual(set(buckets.keys()), {0})
+        results = yield storage_server.get_buckets_many(
+            [b"a" * 16, b"b" * 16, b"c" * 16])
+        self.assertEqual(set(results.keys()), {b"a" * 16, b"b" * 16})
+        self.assertEqual(rref.counter_by_methname, {"get_buckets": 4})
+
+
+class BatchedSlotReadv(unittest.TestCase):
+    """
+    Tests for the batching of ``slot_readv`` calls by ``_StorageServer``.
+    """
+    def setUp(self):
+        self.server = StorageServer(self.mktemp(), b"x" * 20)
+        for (si, data) in [(b"a" * 16, b"aaaa"), (b"b" * 16, b"bbbb")]:
+            self.server.remote_slot_testv_and_readv_and_writev(
+                si, (b"w" * 32, b"r" * 32, b"c" * 32),
+                {0: ([], [(0, data)], None)}, [])
+
+    @inlineCallbacks
+    def test_batched(self):
+        """
+        ``slot_readv`` calls made while the maximum number of reads are
+        outstanding on a server which supports ``slot_readv_many`` are sent
+        together in a single message.
+        """
+        rref = wrap_storage_server(self.server)
+        storage_server = _StorageServer(lambda: rref)
+        # the first two are sent right away
+        d_a = storage_server.slot_readv(b"a" * 16, [], [(0, 4)])
+        d_c = storage_server.slot_readv(b"c" * 16, [], [(0, 4)])
+        # these wait for one of them to finish
+        d_b = storage_server.slot_readv(b"b" * 16, [0], [(1, 2)])
+        d_a_again = storage_server.slot_readv(b"a" * 16, [1], [(0, 4)])
+        self.assertEqual((yield d_a), {0: [b"aaaa"]})
+        self.assertEqual((yield d_c), {})
+        self.assertEqual((yield d_b), {0: [b"bb"]})
+        self.assertEqual((yield d_a_again), {})
+        self.assertEqual(rref.counter_by_methname,
+                         {"slot_readv": 2, "slot_readv_many": 1})
+
+    @inlineCallbacks
+    def test_batch_failure(self):
+        """
+        If a batched ``slot_readv_many`` fails, its reads are retried one at a
+        time, and only the ones which fail again errback.
+        """
+        def slot_readv_many(reads):
+            raise ValueError("slot_readv_many failed")
+        self.server.remote_slot_readv_many = slot_readv_many
+        slot_readv = self.server.remote_slot_readv
+        def _slot_readv(storage_index, shares, readv):
+            if storage_index == b"d" * 16:
+                raise ValueError("slot_readv failed")
+            return slot_readv(storage_index, shares, readv)
+        self.server.remote_slot_readv = _slot_readv
+        rref = wrap_storage_server(self.server)
+        storage_server = _StorageServer(lambda: rref)
+        d_a = storage_server.slot_readv(b"a" * 16, [], [(0, 4)])
+        d_c = storage_server.slot_readv(b"c" * 16, [], [(0, 4)])
+        # these are batched, and the batch fails
+        d_b = storage_server.slot_readv(b"b" * 16, [0], [(1, 2)])
+        d_d = storage_server.slot_readv(b"d" * 16, [], [(0, 4)])
+        self.assertEqual((yield d_a), {0: [b"aaaa"]})
+        self.assertEqual((yield d_c), {})
+        self.assertEqual((yield d_b), {0: [b"bb"]})
+        yield self.assertFailure(d_d, RemoteException)
+        self.assertEqual(rref.counter_by_methname,
+                         {"slot_readv": 4, "slot_readv_many": 1})
+
+    @inlineCallbacks
+    def test_hung_reads(self):
+        """
+        Reads which have not been answered after ``BATCH_TIMEOUT`` seconds no
+        longer hold back the ones requested after them.
+        """
+        rref = wrap_storage_server(self.server)
+        clock = Clock()
+        storage_server = _StorageServer(lambda: rref, clock=clock)
+        rref.hung_until = Deferred()
+        d_a = storage_server.slot_readv(b"a" * 16, [], [(0, 4)])
+        d_b = storage_server.slot_readv(b"b" * 16, [], [(0, 4)])
+        d_c = storage_server.slot_readv(b"c" * 16, [], [(0, 4)])
+        yield flushEventualQueue()
+        hung_until, rref.hung_until = rref.hung_until, None
+        self.assertEqual(len(storage_server._pending_reads), 1)
+        clock.advance(storage_server.BATCH_TIMEOUT)
+        self.assertEqual(storage_server._pending_reads, [])
+        self.assertEqual((yield d_c), {})
+        # the hung reads still get their answers
+        hung_until.callback(None)
+        self.assertEqual((yield d_a), {0: [b"aaaa"]})
+        self.assertEqual((yield d_b), {0: [b"bbbb"]})
+        self.assertEqual(storage_server._reads_in_flight, 0)
+
+    @inlineCallbacks
+    def test_unbatched(self):
+        """
+        Servers without ``slot_readv_many`` get one ``slot_readv`` message per
+        read, and ``slot_readv_many`` is emulated.
+        """
+        rref = wrap_storage_server(self.server)
+        v1 = rref.version[b"http://allmydata.org/tahoe/protocols/storage/v1"]
+        del v1[b"slot-readv-many"]
+        storage_server = _StorageServer(lambda: rref)
+        datavs = yield storage_server.slot_readv(b"a" * 16, [], [(0, 4)])
+        self.assertEqual(datavs, {0: [b"aaaa"]})
+        results = yield storage_server.slot_readv_many(
+            [(b"b" * 16, [], [(0, 1)]), (b"c" * 16, [], [(0, 1)])])
+        self.assertEqual(results, [{0: [b"b"]}, {}])
+        self.assertEqual(rref.counter_by_methname, {"slot_readv": 3})
+
+
 class StoragePluginWebPresence(AsyncTestCase):
     """
     Tests for the web resources ``IFoolscapStorageServer`` plugins may expose.
@@ -588,6 +812,59 @@ class SpyHandler(object):
         return (SpyEndpoint(self._connects.append), hint)
 
 
+class ServerSpeedTests(unittest.TestCase):
+    """
+    Tests for ``ServerSpeed``.
+    """
+
+    def test_unknown(self):
+        """
+        Before anything is measured, nothing is expected.
+        """
+        speed = ServerSpeed()
+        self.assertEqual(speed.expected_time(100, 0), None)
+
+    def test_round_trip(self):
+        """
+        Small responses measure the round-trip time, which is a moving
+        average of them.
+        """
+        speed = ServerSpeed()
+        speed.add_round_trip(1.0, 0)
+        self.assertEqual(speed.expected_time(100, 0), 1.0)
+        speed.add_response(100, 3.0, 0)
+        self.assertEqual(speed.round_trip_time, 1.5)
+        self.assertEqual(speed.throughput, None)
+        # with no throughput measured, big reads are expected to take a
+        # round trip too
+        self.assertEqual(speed.expected_time(100000, 0), 1.5)
+
+    def test_throughput(self):
+        """
+        Big responses measure the throughput, which decides how long big
+        reads are expected to take.
+        """
+        speed = ServerSpeed()
+        speed.add_round_trip(0.5, 0)
+        speed.add_response(10000, 1.0, 0)
+        speed.add_response(10000, 0.5, 0)
+        self.assertEqual(speed.throughput, 12500)
+        self.assertEqual(speed.expected_time(25000, 0), 2.0)
+        self.assertEqual(speed.expected_time(100, 0), 0.5)
+
+    def test_stale(self):
+        """
+        Nothing is expected of a server which has not been measured for a
+        while.
+        """
+        speed = ServerSpeed()
+        speed.add_round_trip(1.0, 100)
+        self.assertEqual(speed.expected_time(100, 100 + ServerSpeed.MAX_AGE),
+                         1.0)
+        self.assertEqual(
+            speed.expected_time(100, 101 + ServerSpeed.MAX_AGE), None)
+
+
 class TestStorageFarmBroker(unittest.TestCase):
 
     def test_static_servers(self):
@@ -658,6 +935,24 @@ storage:
         self.assertEqual(s.get_permutation_seed(),
                          hashlib.sha256(server_id).digest())
 
+    def test_server_speed(self):
+        """
+        ``StorageFarmBroker.get_server_speed`` returns the same ``ServerSpeed``
+        for a server every time, and a different one for each server.
+        """
+        broker = make_broker()
+        ann = {
+            "anonymous-storage-FURL": SOME_FURL,
+        }
+        broker.set_static_servers({u"v0-server-a": {"ann": ann},
+                                   u"v0-server-b": {"ann": ann}})
+        a = broker.servers[b"v0-server-a"]
+        b = broker.servers[b"v0-server-b"]
+        speed = broker.get_server_speed(a)
+        self.assertIsInstance(speed, ServerSpeed)
+        self.assertIdentical(broker.get_server_speed(a), speed)
+        self.assertNotIdentical(broker.get_server_speed(b), speed)
+
     @inlineCallbacks
     def test_threshold_reached(self):
         """
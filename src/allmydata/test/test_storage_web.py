@@ -31,7 +31,7 @@ from allmydata.util import fileutil, hashutil, base32, pollmixin
 from allmydata.storage.common import storage_index_to_dir, \
      UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
 from allmydata.storage.server import StorageServer
-from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.crawler import BucketCountingCrawler, TimeSliceExceeded
 from allmydata.storage.expirer import LeaseCheckingCrawler
 from allmydata.web.storage import (
     StorageStatus,
@@ -193,6 +193,27 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check2)
         return d
 
+    def test_bucket_counter_resume(self):
+        basedir = "storage/BucketCounter/bucket_counter_resume"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        bc = ss.bucket_counter
+        bc.cpu_slice = -1.0 # yield after the first prefix
+        bc.checkpoint_interval = 0
+        self.failUnlessRaises(TimeSliceExceeded,
+                              bc.start_current_prefix, time.time())
+        bc.checkpoint()
+
+        # a restarted node picks up from the journal, with the same counts
+        bc2 = BucketCountingCrawler(ss, bc.statefile)
+        self.failUnlessEqual(bc2.last_complete_prefix_index, 0)
+        self.failUnlessEqual(bc2.state["bucket-counts"], {0: {bc.prefixes[0]: 0}})
+        bc2.cpu_slice = 500
+        bc2.start_current_prefix(time.time())
+        self.failUnlessEqual(bc2.state["last-complete-bucket-count"], 0)
+        self.failUnlessEqual(len(bc2.state["bucket-counts"][0]),
+                             len(bc2.prefixes))
+
     def test_bucket_counter_eta(self):
         basedir = "storage/BucketCounter/bucket_counter_eta"
         fileutil.make_dirs(basedir)
@@ -635,6 +656,203 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_age_lease_db(self):
+        basedir = "storage/LeaseCrawler/expire_age_lease_db"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           lease_db=True)
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        migrator = ss.lease_migrator
+        migrator.cpu_slice = 500
+        migrator.start_current_prefix(time.time())
+        self.failUnless(ss._lease_db.is_migrated())
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+
+        # expire the only lease on two of the shares, and record that in the
+        # lease database (backdate_lease goes behind its back)
+        now = time.time()
+        sf0 = _get_sharefile(immutable_si_0)
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        ss._lease_db.record_share(sf0)
+        sf2 = _get_sharefile(mutable_si_2)
+        self.backdate_lease(sf2, self.renew_secrets[3], now - 1000)
+        ss._lease_db.record_share(sf2)
+        size = os.stat(sf0.home).st_size + os.stat(sf2.home).st_size
+
+        # only the shares with expired leases are opened
+        opened = []
+        def process_share(sharefilename):
+            opened.append(sharefilename)
+            return LeaseCheckingCrawler.process_share(lc, sharefilename)
+        lc.process_share = process_share
+        lc.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(opened), sorted([sf0.home, sf2.home]))
+
+        self.failUnlessEqual(count_shares(immutable_si_0), 0)
+        self.failUnlessEqual(count_shares(immutable_si_1), 1)
+        self.failUnlessEqual(count_shares(mutable_si_2), 0)
+        self.failUnlessEqual(count_shares(mutable_si_3), 1)
+        self.failUnlessEqual(ss._lease_db.count_shares(), 2)
+
+        last = lc.get_state()["history"][0]
+        self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+        rec = last["space-recovered"]
+        self.failUnlessEqual(rec["examined-buckets"], 4)
+        self.failUnlessEqual(rec["examined-shares"], 4)
+        self.failUnlessEqual(rec["actual-buckets"], 2)
+        self.failUnlessEqual(rec["configured-buckets"], 2)
+        self.failUnlessEqual(rec["original-buckets"], 2)
+        self.failUnlessEqual(rec["actual-shares"], 2)
+        self.failUnlessEqual(rec["actual-sharebytes"], size)
+        self.failUnlessEqual(rec["actual-shares-mutable"], 1)
+        self.failUnlessEqual(rec["actual-shares-immutable"], 1)
+
+    def test_resume_from_journal(self):
+        basedir = "storage/LeaseCrawler/resume_from_journal"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        lc = ss.lease_checker
+        lc.cpu_slice = 500
+        lc.checkpoint_interval = 0
+        self.make_shares(ss)
+
+        # the node dies after the first two buckets, before it can save
+        # its state
+        class Killed(Exception):
+            pass
+        examined = []
+        def process_bucket(cycle, prefix, prefixdir, storage_index_b32):
+            if len(examined) == 2:
+                raise Killed()
+            examined.append(storage_index_b32)
+            LeaseCheckingCrawler.process_bucket(lc, cycle, prefix, prefixdir,
+                                                storage_index_b32)
+        lc.process_bucket = process_bucket
+        self.failUnlessRaises(Killed, lc.start_current_prefix, time.time())
+
+        lc2 = LeaseCheckingCrawler(ss, lc.statefile, lc.historyfile,
+                                   False, "age", None, None,
+                                   ("mutable", "immutable"))
+        so_far = lc2.state["cycle-to-date"]
+        self.failUnlessEqual(so_far["space-recovered"]["examined-buckets"], 2)
+        self.failUnlessEqual(so_far["lease-age-histogram"],
+                             {(0, 24*60*60): 3})
+        self.failUnlessEqual(so_far["leases-per-share-histogram"],
+                             {1: 1, 2: 1})
+        self.failUnlessEqual(lc2.state["last-complete-bucket"], examined[-1])
+
+        resumed = []
+        def process_bucket2(cycle, prefix, prefixdir, storage_index_b32):
+            resumed.append(storage_index_b32)
+            LeaseCheckingCrawler.process_bucket(lc2, cycle, prefix, prefixdir,
+                                                storage_index_b32)
+        lc2.process_bucket = process_bucket2
+        lc2.cpu_slice = 500
+        lc2.start_current_prefix(time.time())
+        self.failUnlessEqual(len(resumed), 2)
+        self.failIf(set(examined) & set(resumed))
+
+        last = lc2.get_state()["history"][0]
+        self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+        self.failUnlessEqual(last["space-recovered"]["examined-buckets"], 4)
+        self.failUnlessEqual(last["space-recovered"]["examined-shares"], 4)
+
+    def test_expiry_queue(self):
+        basedir = "storage/LeaseCrawler/expiry_queue"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           lease_db=True)
+        lc = ss.lease_checker
+        lc.slow_start = 100000 # don't start crawling
+        queue = ss.lease_expiry_queue
+        queue.slow_start = 0
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        migrator = ss.lease_migrator
+        migrator.cpu_slice = 500
+        migrator.start_current_prefix(time.time())
+
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def count_leases(si):
+            return len(list(list(ss._iter_share_files(si))[0].get_leases()))
+
+        now = time.time()
+        sf0 = list(ss._iter_share_files(immutable_si_0))[0]
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        ss._lease_db.record_share(sf0)
+        sf3 = list(ss._iter_share_files(mutable_si_3))[0]
+        self.backdate_lease(sf3, self.renew_secrets[4], now - 1000)
+        ss._lease_db.record_share(sf3)
+        # the lease database thinks this one has expired, but the share file
+        # knows better
+        sf1 = list(ss._iter_share_files(immutable_si_1))[0]
+        [lease] = [l for l in sf1.get_leases()
+                   if l.renew_secret == self.renew_secrets[1]]
+        ss._lease_db.set_share(base32.b2a(immutable_si_1).decode("ascii"), 0,
+                               "immutable", 100, 100,
+                               [(lease.owner_num, now - 1000)])
+        size = os.stat(sf0.home).st_size
+
+        ss.setServiceParent(self.s)
+        d = fireEventually()
+        def _wait():
+            return count_shares(immutable_si_0) == 0
+        d.addCallback(lambda ign: self.poll(_wait))
+        def _check(ignored):
+            self.failUnlessEqual(count_shares(immutable_si_1), 1)
+            self.failUnlessEqual(count_leases(immutable_si_1), 2)
+            self.failUnlessEqual(count_shares(mutable_si_2), 1)
+            self.failUnlessEqual(count_shares(mutable_si_3), 1)
+            self.failUnlessEqual(count_leases(mutable_si_3), 1)
+            self.failUnlessEqual(ss._lease_db.count_shares(), 3)
+            self.failUnlessEqual(ss._lease_db.count_leases(), 4)
+            self.failUnlessEqual(queue.expire_due_shares(time.time()), 0)
+
+            # the remaining leases were all granted just now, so the next one
+            # is due in 2000 seconds
+            self.failUnless(abs(queue.next_wake_time - (now + 2000)) < 60,
+                            queue.next_wake_time - now)
+            # a lease which is due sooner wakes the queue up earlier
+            ss._lease_db.set_share(base32.b2a(b"\xff" * 16).decode("ascii"),
+                                   0, "immutable", 100, 100,
+                                   [(1, now - 30*24*60*60)])
+            self.failUnless(queue.next_wake_time < now + 10)
+
+            # the crawler wasn't running, so the space recovered counts
+            # towards its next cycle
+            rec = lc.get_state()["recovered-between-cycles"]
+            self.failUnlessEqual(rec["actual-shares"], 1)
+            self.failUnlessEqual(rec["actual-shares-immutable"], 1)
+            self.failUnlessEqual(rec["actual-sharebytes"], size)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            lc.started_cycle(0)
+            rec = lc.state["cycle-to-date"]["space-recovered"]
+            self.failUnlessEqual(rec["actual-shares"], 1)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            self.failIfIn("recovered-between-cycles", lc.state)
+        d.addCallback(_check)
+        d.addCallback(lambda ign: renderDeferred(StorageStatus(ss)))
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn(b"Expiration Enabled: expired leases will be "
+                              b"removed as soon as they expire", s)
+        d.addCallback(_check_html)
+        return d
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -1190,6 +1408,41 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin):
         d.addCallback(_check_json)
         return d
 
+    def test_status_tiering(self):
+        basedir = "storage/WebStatus/status_tiering"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20,
+                           hot_dir=os.path.join(basedir, "hot"),
+                           hot_dir_max_size=2**20)
+        ss.setServiceParent(self.s)
+        html = renderSynchronously(StorageStatus(ss))
+        s = remove_tags(html)
+        self.failUnlessIn(b"Reads served from the hot tier: no reads yet", s)
+        for i in range(3):
+            ss.tier_migrator.tracker.record_read(u"aaaa", i == 0)
+        html = renderSynchronously(StorageStatus(ss))
+        s = remove_tags(html)
+        self.failUnlessIn(b"of 1.05 MB", s)
+        self.failUnlessIn(b"Reads served from the hot tier: 33.3% (1 hot, 2 cold)",
+                          s)
+        self.failUnlessIn(b"Buckets moved: 0 promoted, 0 demoted", s)
+        d = renderJSON(StorageStatus(ss))
+        def _check_json(raw):
+            data = json.loads(raw)
+            self.failUnlessEqual(
+                data["stats"]["storage_server.tiering.cold_reads"], 2)
+            self.failUnlessIn("tier-migrator", data)
+        d.addCallback(_check_json)
+        return d
+
+    def test_status_no_tiering(self):
+        basedir = "storage/WebStatus/status_no_tiering"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, b"\x00" * 20)
+        ss.setServiceParent(self.s)
+        html = renderSynchronously(StorageStatus(ss))
+        self.failIfIn(b"Share Tiers", html)
+
 
     def test_status_no_disk_stats(self):
         def call_get_disk_stats(whichdir, reserved_space=0):
@@ -172,6 +172,8 @@ def build_one_ds():
     e.finished(20, now+1)
     e = ds.add_block_request(serverB, 1, 120, 30, now+1) # left unfinished
 
+    ds.add_share_selection(0, serverA, 1, 0.25, 0, now)
+
     # make sure that add_read_event() can come first too
     ds1 = DownloadStatus(storage_index, 1234)
     e = ds1.add_read_event(0, 120, now)
@@ -261,6 +263,7 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.tier_migrator = None
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
     def on_status_changed(self, cb):
@@ -1019,6 +1022,7 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(lambda res: self.GET("/status/down-%d" % dl_num))
         def _check_dl(res):
             self.failUnlessIn(b"File Download Status", res)
+            self.failUnlessIn(b"Share Selection:", res)
         d.addCallback(_check_dl)
         d.addCallback(lambda res: self.GET("/status/down-%d/event_json" % dl_num))
         def _check_dl_json(res):
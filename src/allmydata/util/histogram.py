@@ -0,0 +1,175 @@
+"""
+Constant-memory histograms of latencies (or any other positive numbers).
+
+Ported to Python 3.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import math, time
+from collections import deque
+
+
+class Histogram(object):
+    """
+    I count values in log-linear buckets, in the style of an HDR histogram:
+    every power of two from ``MIN_VALUE`` up to ``MIN_VALUE * 2**OCTAVES`` is
+    split into ``SUBBUCKETS`` buckets, so a percentile is never off by more
+    than half a bucket (about 2%) however many values I have seen. Smaller
+    values share one bucket below ``MIN_VALUE``, and larger ones share one
+    above the top.
+
+    For seconds, the defaults cover a microsecond to about 12 days.
+    """
+
+    MIN_VALUE = 2.0 ** -20
+    OCTAVES = 40
+    SUBBUCKETS = 16
+
+    def __init__(self):
+        self._counts = {} # bucket index -> count, only for non-empty buckets
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def upper_bound(cls, index):
+        """
+        :return: The largest value counted in bucket ``index``. Bucket -1
+            holds everything below ``MIN_VALUE``.
+        """
+        if index >= cls.OCTAVES * cls.SUBBUCKETS:
+            return float("inf")
+        return cls.MIN_VALUE * 2.0 ** ((index + 1) / cls.SUBBUCKETS)
+
+    @classmethod
+    def bucket_for(cls, value):
+        if value < cls.MIN_VALUE:
+            return -1
+        last = cls.OCTAVES * cls.SUBBUCKETS
+        if value > cls.upper_bound(last - 1):
+            return last
+        index = int(math.log(value / cls.MIN_VALUE, 2) * cls.SUBBUCKETS)
+        # correct for rounding, so that a value on a boundary is counted in
+        # the lower bucket, as "le" bounds require
+        while value > cls.upper_bound(index):
+            index += 1
+        while index > -1 and value <= cls.upper_bound(index - 1):
+            index -= 1
+        return index
+
+    def add(self, value):
+        index = self.bucket_for(value)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add everything ``other`` has counted to me.
+        """
+        for index, n in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + n
+        self.count += other.count
+        self.sum += other.sum
+        for v in (other.min, other.max):
+            if v is not None:
+                if self.min is None or v < self.min:
+                    self.min = v
+                if self.max is None or v > self.max:
+                    self.max = v
+
+    def percentile(self, fraction):
+        """
+        :return: Approximately the value which a fraction ``fraction`` of
+            the values are below, or None if I am empty. This is the value
+            ``sorted(values)[int(fraction * count)]`` would give, to within
+            the width of its bucket.
+        """
+        if not self.count:
+            return None
+        rank = min(int(fraction * self.count), self.count - 1)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen > rank:
+                break
+        if index == -1:
+            lower = 0.0
+        else:
+            lower = self.upper_bound(index - 1)
+        upper = self.upper_bound(index)
+        if math.isinf(upper):
+            return self.max
+        return max(self.min, min(self.max, (lower + upper) / 2))
+
+    def cumulative_counts(self):
+        """
+        :return: A list of ``(upper_bound, count)`` pairs giving the number
+            of values at or below each power of two from ``MIN_VALUE`` up,
+            ending with infinity and the total count. The bounds are the
+            same whatever I have counted, as exported histograms need.
+        """
+        result = []
+        indices = sorted(self._counts)
+        seen = 0
+        i = 0
+        for octave in range(self.OCTAVES + 1):
+            last_index = octave * self.SUBBUCKETS - 1
+            while i < len(indices) and indices[i] <= last_index:
+                seen += self._counts[indices[i]]
+                i += 1
+            result.append((self.upper_bound(last_index), seen))
+        result.append((float("inf"), self.count))
+        return result
+
+
+class WindowedHistogram(object):
+    """
+    I keep two views of the same values: a ``Histogram`` of everything
+    since I was created, and one of only the last ``window`` seconds. The
+    window moves in ``slices`` steps, each with a histogram of its own, so my
+    memory use does not grow with the number of values.
+    """
+
+    def __init__(self, window=300, slices=10, clock=time.time):
+        self.total = Histogram()
+        self._slice_length = window / slices
+        self._num_slices = slices
+        self._clock = clock
+        self._slices = deque() # (slice number, Histogram), oldest first
+
+    def _current_slice(self):
+        number = int(self._clock() // self._slice_length)
+        while self._slices and self._slices[0][0] <= number - self._num_slices:
+            self._slices.popleft()
+        return number
+
+    def add(self, value):
+        number = self._current_slice()
+        if not self._slices or self._slices[-1][0] != number:
+            self._slices.append((number, Histogram()))
+        self._slices[-1][1].add(value)
+        self.total.add(value)
+
+    def recent(self):
+        """
+        :return Histogram: The values added in the last ``window`` seconds.
+        """
+        self._current_slice()
+        h = Histogram()
+        for (_, s) in self._slices:
+            h.merge(s)
+        return h
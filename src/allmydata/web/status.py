@@ -428,6 +428,8 @@ class _EventJson(Resource, object):
         # so they get converted to strings. Stupid javascript.
         data["serverids"] = server_shortnames
         data["bounds"] = {"min": ds.first_timestamp, "max": ds.last_timestamp}
+        data["segment_cache"] = {"hits": ds.segment_cache_hits,
+                                 "misses": ds.segment_cache_misses}
         return json.dumps(data, indent=1) + "\n"
 
 
@@ -619,6 +621,30 @@ class DownloadStatusElement(Element):
         evtag(tags.h2("Segment Events:"), segtag)
         evtag(tags.br(clear="all"))
 
+        # "Share Selection" table.
+        seltag = tags.table(align="left",class_="status-download-events")
+
+        seltag(tags.tr(
+            tags.th("segnum"),
+            tags.th("serverid"),
+            tags.th("shnum"),
+            tags.th("chosen"),
+            tags.th("expected"),
+            tags.th("rank")))
+
+        for sel in self._download_status.share_selections:
+            server = sel["server"]
+            seltag(tags.tr(style="background: %s" % _color(server))(
+                tags.td("seg%d" % sel["segment_number"]),
+                tags.td(server.get_name()),
+                tags.td(str(sel["shnum"])),
+                tags.td(srt(sel["time"])),
+                tags.td(abbreviate_time(sel["expected_time"])),
+                tags.td(str(sel["rank"]))))
+
+        evtag(tags.h2("Share Selection:"), seltag)
+        evtag(tags.br(clear="all"))
+
         # "Requests" table.
         reqtab = tags.table(align="left",class_="status-download-events")
 
@@ -693,6 +719,16 @@ class DownloadStatusElement(Element):
     def status(self, req, tag):
         return tag(self._download_status.get_status())
 
+    @renderer
+    def segment_cache(self, req, tag):
+        ds = self._download_status
+        hit_rate = ds.get_segment_cache_hit_rate()
+        if hit_rate is None:
+            return tag("not used")
+        return tag("%d hits, %d misses (%.1f%%)"
+                   % (ds.segment_cache_hits, ds.segment_cache_misses,
+                      100.0 * hit_rate))
+
     @renderer
     def servers_used(self, req, tag):
         servers_used = self.download_results().servers_used
@@ -1568,12 +1604,22 @@ class Statistics(MultiFormatResource):
             return re.sub(
                 u"_(\d\d)_(\d)_percentile",
                 u'{quantile="0.\g<1>\g<2>"}',
-                name.replace(u".", u"_")
+                name.replace(u".", u"_").replace(u"-", u"_")
             )
 
         def mangle_value(val):
             return str(val) if val is not None else u"NaN"
 
+        def mangle_bound(bound):
+            return repr(bound) if bound != float("inf") else u"+Inf"
+
+        for (k, h) in sorted(self._provider.get_histograms().items()):
+            name = u"tahoe_histograms_%s" % (mangle_name(k),)
+            ret.append(u"# TYPE %s histogram" % (name,))
+            for (bound, count) in h.cumulative_counts():
+                ret.append(u'%s_bucket{le="%s"} %d' % (name, mangle_bound(bound), count))
+            ret.append(u"%s_count %d" % (name, h.count))
+            ret.append(u"%s_sum %s" % (name, mangle_value(h.sum)))
         for (k, v) in sorted(stats['counters'].items()):
             ret.append(u"tahoe_counters_%s %s" % (mangle_name(k), mangle_value(v)))
         for (k, v) in sorted(stats['stats'].items()):
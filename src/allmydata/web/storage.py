@@ -161,6 +161,28 @@ class StorageStatusElement(Element):
             return ["Next crawl in %s" % abbreviate_time(soon),
                     cycletime_s]
 
+    @renderer
+    def tiering(self, req, tag):
+        migrator = self._storage.tier_migrator
+        if migrator is None:
+            return ""
+        stats = migrator.get_stats()
+        hit_ratio = stats.get("hit_ratio")
+        tag.fillSlots(
+            hot_dir=migrator.hotdir,
+            hot_bytes=self.render_abbrev_space(stats.get("hot_bytes")),
+            max_size=(self.render_abbrev_space(migrator.max_size)
+                      if migrator.max_size is not None else "no limit"),
+            hit_ratio=("%.1f%%" % (100 * hit_ratio)
+                       if hit_ratio is not None else "no reads yet"),
+            hot_reads=str(stats["hot_reads"]),
+            cold_reads=str(stats["cold_reads"]),
+            promoted=str(stats["promoted"]),
+            demoted=str(stats["demoted"]),
+            progress=self.format_crawler_progress(migrator.get_progress()),
+        )
+        return tag
+
     @renderer
     def storage_running(self, req, tag):
         if self._storage:
@@ -171,6 +193,9 @@ class StorageStatusElement(Element):
     def lease_expiration_enabled(self, req, tag):
         lc = self._storage.lease_checker
         if lc.expiration_enabled:
+            if self._storage.lease_expiry_queue is not None:
+                return tag("Enabled: expired leases will be removed "
+                           "as soon as they expire")
             return tag("Enabled: expired leases will be removed")
         else:
             return tag("Disabled: scan-only mode, no leases will be removed")
@@ -328,4 +353,6 @@ class StorageStatus(MultiFormatResource):
              "lease-checker": self._storage.lease_checker.get_state(),
              "lease-checker-progress": self._storage.lease_checker.get_progress(),
              }
+        if self._storage.tier_migrator is not None:
+            d["tier-migrator"] = self._storage.tier_migrator.get_state()
         return json.dumps(d, indent=1) + "\n"